@@ -1,7 +1,12 @@
 def print_message(message):
-    print("Message on topic {} received with payload {}".format(message.topic, message.payload))
+    print("Message on topic {} received with payload {}".format(message.topic, message.document))
 
 def get_actions():
-    actions = {}
-    actions["print_message"] = print_message
-    return actions
+    """Return all the available actions, the built-in ones and the ones provided by the installed plugins
+
+    All the plugins are imported, the loader imports only the actions referenced by pihome.ini instead
+    (see common.plugins)
+    """
+    from ..common import plugins
+    registry = plugins.get_registry()
+    return {name: registry.action(name) for name in registry.names(plugins.ACTIONS)}
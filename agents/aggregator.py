@@ -0,0 +1,180 @@
+import math
+import time
+from array import array
+from ..common.logger import logger
+from ..sensors.sensor import Sample
+
+
+class RingBuffer(object):
+    """A fixed size buffer of floats keeping the statistics of its content up to date
+
+    The values are stored in a preallocated array of doubles, once the buffer is full every new value
+    overwrites the oldest one. Count, sum and sum of squares are updated incrementally on every push and
+    eviction (the sums are computed on the values shifted by the first one of the window to preserve the
+    precision of the variance), minimum and maximum are updated incrementally as well and recomputed
+    from the buffer only when the evicted value was one of the two.
+
+    Attributes:
+        _values (array): the storage of the values
+        _start (int): the index of the oldest value
+        _count (int): the number of values stored
+        _shift (float): the value subtracted from every value before summing it
+        _sum (float): the sum of the shifted values
+        _sum_squares (float): the sum of the squares of the shifted values
+        _min (float): the minimum value stored
+        _max (float): the maximum value stored
+        _last (float): the last value pushed
+    """
+    __slots__ = ("_values", "_start", "_count", "_shift", "_sum", "_sum_squares", "_min", "_max", "_last")
+
+    def __init__(self, capacity):
+        """Initialize an empty RingBuffer
+
+        Args:
+            capacity (int): the maximum number of values stored
+        """
+        if capacity < 1:
+            raise ValueError("The capacity of a RingBuffer must be at least 1")
+        self._values = array("d", bytes(8 * capacity))
+        self.clear()
+
+    def __len__(self):
+        return self._count
+
+    def clear(self):
+        """Remove all the values"""
+        self._start = 0
+        self._count = 0
+        self._shift = 0.0
+        self._sum = 0.0
+        self._sum_squares = 0.0
+        self._min = None
+        self._max = None
+        self._last = None
+
+    def push(self, value):
+        """Add a value evicting the oldest one if the buffer is full
+
+        Args:
+            value (float): the value to add
+        """
+        capacity = len(self._values)
+        if self._count == 0:
+            self._shift = value
+        if self._count == capacity:
+            evicted = self._values[self._start]
+            self._values[self._start] = value
+            self._start = (self._start + 1) % capacity
+            self._sum -= evicted - self._shift
+            self._sum_squares -= (evicted - self._shift) ** 2
+        else:
+            self._values[(self._start + self._count) % capacity] = value
+            self._count += 1
+            evicted = None
+        self._sum += value - self._shift
+        self._sum_squares += (value - self._shift) ** 2
+        self._last = value
+        if evicted is not None and (evicted == self._min or evicted == self._max):
+            self._min = min(self._values)
+            self._max = max(self._values)
+        else:
+            if self._min is None or value < self._min:
+                self._min = value
+            if self._max is None or value > self._max:
+                self._max = value
+
+    def stats(self):
+        """Return the statistics of the values stored
+
+        Returns:
+            {str: float}. A dictionary with the keys count, min, max, mean, stddev (population standard
+            deviation) and last, None if the buffer is empty
+        """
+        if not self._count:
+            return None
+        mean = self._sum / self._count
+        variance = max(0.0, self._sum_squares / self._count - mean * mean)
+        return {"count": self._count,
+                "min": self._min,
+                "max": self._max,
+                "mean": self._shift + mean,
+                "stddev": math.sqrt(variance),
+                "last": self._last}
+
+
+class SampleAggregator(object):
+    """An aggregation stage turning the samples collected within a time window into a sample per label
+
+    The samples are accumulated, per label, in a RingBuffer; at the end of every (tumbling) window a sample
+    is emitted for every label seen during the window: its data is the mean of the values collected and its
+    stats the min, max, stddev, last value and number of values of the window.
+    The memory used does not depend on how long the process runs: every label has a buffer of a fixed
+    capacity and, if more values than the capacity are collected within a window, only the most recent are
+    aggregated.
+
+    Attributes:
+        _window (float): the length, in seconds, of a window
+        _capacity (int): the capacity of the buffer of every label
+        _buffers ({str: RingBuffer}): the buffers indexed by label
+        _units ({str: str}): the unit of measure of every label
+        _window_end (float): the time at which the current window ends
+        _clock (callable): the function returning the current time in seconds
+    """
+
+    def __init__(self, window=60, capacity=120, clock=time.monotonic):
+        """Initialize the SampleAggregator
+
+        Args:
+            window (float): the length, in seconds, of a window
+            capacity (int): the maximum number of values aggregated per label within a window
+            clock (callable): the function returning the current time in seconds
+        """
+        self._window = window
+        self._capacity = capacity
+        self._buffers = {}
+        self._units = {}
+        self._clock = clock
+        self._window_end = clock() + window
+
+    def add(self, samples):
+        """Accumulate samples in the current window
+
+        Args:
+            samples ([Sample]): the samples collected
+        """
+        for sample in samples:
+            buffer = self._buffers.get(sample.label)
+            if buffer is None:
+                buffer = RingBuffer(self._capacity)
+                self._buffers[sample.label] = buffer
+            buffer.push(sample.data)
+            self._units[sample.label] = sample.unit
+
+    def flush(self, force=False):
+        """Emit the aggregated samples if the current window is over
+
+        Args:
+            force (bool): if True the samples are emitted even if the window is not over yet
+
+        Returns:
+            [Sample]. A sample for every label seen within the window (an empty list if the window is
+            not over yet), with the mean as data and the rest of the statistics in stats
+        """
+        now = self._clock()
+        if not force and now < self._window_end:
+            return []
+        # tumbling windows: the next one starts where this ended, unless more than a window was skipped
+        self._window_end += self._window
+        if self._window_end <= now:
+            self._window_end = now + self._window
+        samples = []
+        for label, buffer in self._buffers.items():
+            stats = buffer.stats()
+            if stats is None:
+                continue
+            mean = round(stats.pop("mean"), 3)
+            stats["stddev"] = round(stats["stddev"], 3)
+            samples.append(Sample(label, mean, self._units[label], stats))
+            buffer.clear()
+        logger.debug("Aggregated %d labels", len(samples))
+        return samples
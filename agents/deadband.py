@@ -0,0 +1,131 @@
+import time
+from array import array
+from ..common.logger import logger
+
+
+class DeadbandFilter(object):
+    """A report-by-exception stage for samples
+
+    A sample is let through only if its value differs from the last value published for the same label
+    by more than the deadband of the label (an absolute amount, a percentage of the last value or both),
+    or if the last value of the label was published more than heartbeat seconds ago. The samples whose
+    label has no deadband are always let through.
+    The state is kept in a compact table: every label has a slot in a set of arrays of doubles, so that
+    checking a sample costs a dictionary lookup and a few array accesses.
+
+    Attributes:
+        _slots ({str: int}): the slot of every label within the arrays
+        _absolute (array): the absolute deadband of every slot (0 if not set)
+        _percent (array): the percent deadband of every slot (0 if not set)
+        _last_value (array): the last value published for every slot
+        _last_time (array): the time the last value was published for every slot (-inf if never)
+        _heartbeat (float): the amount of time, in seconds, after which a sample is published anyway
+        _clock (callable): the function returning the current time in seconds
+        _published (int): the number of samples let through
+        _suppressed (int): the number of samples filtered out
+    """
+
+    def __init__(self, deadbands, heartbeat=900, clock=time.monotonic):
+        """Initialize the DeadbandFilter
+
+        Args:
+            deadbands ({str: (float, float)}): a dictionary where the key is a label and the value a tuple
+                                               (absolute, percent); a value is published if it changes by more
+                                               than either of the two (a 0 disables that criterion)
+            heartbeat (float): the amount of time, in seconds, after which a sample is published even if
+                               its value did not change
+            clock (callable): the function returning the current time in seconds
+        """
+        self._slots = {}
+        self._absolute = array("d")
+        self._percent = array("d")
+        self._last_value = array("d")
+        self._last_time = array("d")
+        for label, (absolute, percent) in deadbands.items():
+            self._slots[label] = len(self._slots)
+            self._absolute.append(absolute)
+            self._percent.append(percent)
+            self._last_value.append(0.0)
+            self._last_time.append(float("-inf"))
+        self._heartbeat = heartbeat
+        self._clock = clock
+        self._published = 0
+        self._suppressed = 0
+
+    def _must_publish(self, slot, value, now):
+        """Check if a value must be published
+
+        Args:
+            slot (int): the slot of the label of the value
+            value (float): the value sampled
+            now (float): the current time
+
+        Returns:
+            bool. True if the value must be published
+        """
+        if now - self._last_time[slot] >= self._heartbeat:
+            return True
+        change = abs(value - self._last_value[slot])
+        if self._absolute[slot] and change > self._absolute[slot]:
+            return True
+        if self._percent[slot] and change > abs(self._last_value[slot]) * self._percent[slot] / 100.0:
+            return True
+        return False
+
+    def filter(self, samples):
+        """Return the samples that must be published
+
+        Args:
+            samples ([Sample]): the samples collected
+
+        Returns:
+            [Sample]. The samples to publish
+        """
+        now = self._clock()
+        published = []
+        for sample in samples:
+            slot = self._slots.get(sample.label)
+            if slot is None:
+                published.append(sample)
+                continue
+            if self._must_publish(slot, sample.data, now):
+                self._last_value[slot] = sample.data
+                self._last_time[slot] = now
+                published.append(sample)
+            else:
+                self._suppressed += 1
+        self._published += len(published)
+        logger.debug("Deadband: %d of %d samples to publish", len(published), len(samples))
+        return published
+
+    def stats(self):
+        """Return the number of samples let through and filtered out
+
+        Returns:
+            {str: int}. A dictionary with the keys published and suppressed
+        """
+        return {"published": self._published, "suppressed": self._suppressed}
+
+
+def parse_deadbands(deadbands):
+    """Parse a deadbands definition
+
+    Args:
+        deadbands (str): a comma separated list of label:deadband where deadband is either an absolute
+                         amount (0.2) or a percentage (1%); a label can appear twice to set both
+
+    Returns:
+        {str: (float, float)}. A dictionary where the key is a label and the value a tuple (absolute, percent)
+    """
+    parsed = {}
+    for definition in deadbands.split(","):
+        if not definition.strip():
+            continue
+        label, amount = definition.strip().split(":")
+        absolute, percent = parsed.get(label, (0.0, 0.0))
+        if amount.endswith("%"):
+            percent = float(amount[:-1])
+        else:
+            absolute = float(amount)
+        parsed[label] = (absolute, percent)
+    return parsed
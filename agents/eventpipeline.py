@@ -0,0 +1,206 @@
+import collections
+import threading
+import time
+from ..common import metrics
+from ..common.histogram import Histogram
+from ..common.logger import logger
+
+
+class EventSource(object):
+    """A GPIO input raising an event (a PIR, a door contact, a button, ...)
+
+    Attributes:
+        channel (int): the GPIO channel of the input
+        event (str): the name of the event, it is the subtopic on which the event is published
+        edge (str): the edge raising the event, one of "rising", "falling" and "both"
+        pull (str): the pull resistor of the input, one of "up", "down" and "off"
+        bouncetime (int): the bouncetime, in milliseconds, of the event detection; if None the default one of
+                          the SensorsManager is used
+        window (float): the amount of time, in seconds, an event throttles the following edges; if None the
+                        default one of the EventPipeline is used
+    """
+    EDGES = ("rising", "falling", "both")
+    PULLS = ("up", "down", "off")
+    __slots__ = ("channel", "event", "edge", "pull", "bouncetime", "window")
+
+    def __init__(self, channel, event, edge="rising", pull="down", bouncetime=None, window=None):
+        """Initialize an EventSource
+
+        Raises:
+            ValueError: if the edge or the pull are not supported
+        """
+        if edge not in self.EDGES:
+            raise ValueError("Unsupported edge {}".format(edge))
+        if pull not in self.PULLS:
+            raise ValueError("Unsupported pull {}".format(pull))
+        self.channel = channel
+        self.event = event
+        self.edge = edge
+        self.pull = pull
+        self.bouncetime = bouncetime
+        self.window = window
+
+    def _key(self):
+        return self.channel, self.event, self.edge, self.pull, self.bouncetime, self.window
+
+    def __eq__(self, other):
+        return isinstance(other, EventSource) and self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        return "EventSource({!r}, {!r}, edge={!r}, pull={!r}, bouncetime={!r}, window={!r})".format(*self._key())
+
+
+class EventPipeline(object):
+    """The handoff between the GPIO callbacks and the publication of the events
+
+    The GPIO callback thread must never wait: push only appends the channel and the monotonic time of the edge
+    to a bounded deque (an atomic operation, no lock is taken) and wakes up the publisher thread. A single
+    pipeline serves all the GPIO channels, push being the callback of every event detection: the publisher
+    drains the deque, looks up the source of each edge in a table indexed by channel and throttles the bursts
+    (leading edge): an edge arriving within the window of its source from the last edge published on the same
+    channel is counted but not published. The first edge of a burst is published right away, stamped with the
+    time it actually happened, so the throttling doesn't delay it. When the deque is full the oldest edges are
+    discarded (and counted).
+
+    Attributes:
+        _publish (callable): the function publishing an event, it receives the EventSource and the unix time of
+                             the edge
+        _sources ({int: EventSource}): the sources of the events indexed by channel, the edges of the channels
+                                       missing from it are ignored
+        _window (float): the amount of time, in seconds, an event throttles the following edges of its channel
+                         when its source doesn't define a window
+        _edges (collections.deque): the bounded queue of the (channel, monotonic time) of the edges to handle
+        _wakeup (threading.Event): the event waking up the publisher thread
+        _stopping (threading.Event): the event set to terminate the publisher thread
+        _thread (threading.Thread): the publisher thread, None if not started
+        _last_published ({int: float}): the monotonic time of the last edge published indexed by channel
+        _counters ({str: int}): the edges received, published, throttled and dropped
+        _counters_lock (threading.Lock): the lock protecting _counters, updated by the publisher thread and, for
+                                         the edges dropped, by the GPIO callback thread
+        _latency (Histogram): the time from the edges to the end of their publication
+        _metrics ({str: object}): the same counters and latency in the metrics of the process
+    """
+
+    def __init__(self, publish, sources=None, window=0.0, queue_size=1000):
+        """Initialize the EventPipeline
+
+        Args:
+            publish (callable): the function publishing an event, it receives the EventSource and the unix time
+                                of the edge; it is called on the publisher thread
+            sources ({int: EventSource}, optional): the sources of the events indexed by channel
+            window (float, optional): the amount of time, in seconds, an event throttles the following edges of
+                                      its channel when its source doesn't define a window, 0 publishes every edge
+            queue_size (int, optional): the maximum number of edges waiting to be handled
+        """
+        self._publish = publish
+        self._sources = dict(sources or {})
+        self._window = window
+        self._edges = collections.deque(maxlen=queue_size)
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._last_published = {}
+        self._counters = {"edges": 0, "published": 0, "throttled": 0, "dropped": 0}
+        self._counters_lock = threading.Lock()
+        self._latency = Histogram()
+        registry = metrics.get_registry()
+        self._metrics = {
+            "throttled": registry.counter("gpio_edges_throttled_total", "GPIO edges throttled by a recent event"),
+            "dropped": registry.counter("gpio_edges_dropped_total", "GPIO edges dropped, queue full"),
+            "latency": registry.histogram("event_publish_seconds",
+                                          "Time from the GPIO edge to the publication of the event"),
+        }
+
+    def set_sources(self, sources):
+        """Replace the sources of the events, the edges already queued are handled with the new ones
+
+        Args:
+            sources ({int: EventSource}): the sources of the events indexed by channel
+        """
+        # the table is replaced as a whole since the publisher thread reads it
+        self._sources = dict(sources)
+
+    def push(self, channel):
+        """Queue an edge, the method is meant to be the GPIO callback and it never blocks
+
+        Args:
+            channel (int): the channel of the edge
+        """
+        timestamp = time.monotonic()
+        if len(self._edges) == self._edges.maxlen:
+            # the lock is taken only when the queue overflows
+            with self._counters_lock:
+                self._counters["dropped"] += 1
+            self._metrics["dropped"].inc()
+        self._edges.append((channel, timestamp))
+        self._wakeup.set()
+
+    def _handle(self, channel, timestamp):
+        """Publish an edge, unless it is throttled by the last one published on its channel"""
+        source = self._sources.get(channel)
+        if source is None:
+            # the channel was removed while its edge was queued
+            return
+        window = source.window if source.window is not None else self._window
+        last = self._last_published.get(channel)
+        throttled = last is not None and timestamp - last < window
+        with self._counters_lock:
+            self._counters["edges"] += 1
+            if throttled:
+                self._counters["throttled"] += 1
+        if throttled:
+            self._metrics["throttled"].inc()
+            return
+        self._last_published[channel] = timestamp
+        try:
+            self._publish(source, time.time() - (time.monotonic() - timestamp))
+        except Exception as error:
+            logger.exception("Publication of the event of GPIO #%d failed: %s", channel, error)
+            return
+        latency = time.monotonic() - timestamp
+        with self._counters_lock:
+            self._counters["published"] += 1
+        self._latency.observe(latency)
+        self._metrics["latency"].observe(latency)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            while self._edges:
+                self._handle(*self._edges.popleft())
+            if self._stopping.is_set():
+                return
+
+    def start(self):
+        """Start the publisher thread, if not started yet"""
+        if self._thread is None:
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="event-publisher", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the publisher thread, the edges already queued are handled before it terminates"""
+        if self._thread is not None:
+            self._stopping.set()
+            self._wakeup.set()
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        """Return the counters and the latency of the pipeline
+
+        Returns:
+            {str: object}. A dictionary with the keys: edges, published, throttled, dropped, pending (the edges
+            waiting to be handled) and latency (a snapshot of the edge to publication latency histogram, see
+            Histogram.snapshot, with the p50 and p95 estimates)
+        """
+        with self._counters_lock:
+            stats = dict(self._counters, pending=len(self._edges))
+        stats["latency"] = self._latency.snapshot()
+        stats["latency"]["p50"] = self._latency.quantile(0.5)
+        stats["latency"]["p95"] = self._latency.quantile(0.95)
+        return stats
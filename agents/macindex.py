@@ -0,0 +1,136 @@
+import json
+import os
+from ..common.logger import logger
+
+
+class MacIdentityIndex(object):
+    """An index mapping the hardware address of the known devices to their owners and current IPs
+
+    The index identifies a person through the MAC address of their device instead of its IP (that changes
+    whenever the device gets a new DHCP lease) and keeps track of the IP each known device was last seen
+    with. The bindings are updated incrementally with the outcome of every subnet discovery and saved on
+    file only when they change, this way after a restart the index is immediately warm.
+
+    Attributes:
+        _persons_by_mac ({str: str}): a dictionary where the key is a MAC address and the value the name of
+                                      the owner of the device
+        _bindings ({str: str}): a dictionary where the key is a known MAC address and the value the last
+                                IP the device was seen with
+        _index_file (str): the path of the file holding the bindings, if None they are not persisted
+    """
+
+    def __init__(self, persons, index_file=None):
+        """Initialize the MacIdentityIndex
+
+        Args:
+            persons ([(str, str)]): an array of tuples (name, mac_address) containing the name
+                                    of the person and its smartphone's MAC address
+            index_file (str, optional): the path of the file holding the bindings across restarts
+        """
+        self._persons_by_mac = {mac.lower(): name for name, mac in persons}
+        self._bindings = {}
+        self._index_file = index_file
+        self._load()
+
+    def _load(self):
+        """Load the bindings saved by a previous run
+
+        Only the bindings of the currently known MAC addresses are kept.
+        """
+        if not self._index_file or not os.path.exists(self._index_file):
+            return
+        try:
+            with open(self._index_file, "r") as index_file:
+                bindings = json.load(index_file)
+            self._bindings = {mac: ip_addr for mac, ip_addr in bindings.items() if mac in self._persons_by_mac}
+            logger.info("Loaded %d MAC to IP bindings from %s", len(self._bindings), self._index_file)
+        except (OSError, ValueError) as e:
+            logger.error("Unable to load the MAC index %s: %s", self._index_file, e)
+
+    def _save(self):
+        """Save the bindings on file
+
+        The file is replaced atomically so that a crash while saving never leaves a corrupted index
+        """
+        if not self._index_file:
+            return
+        try:
+            directory = os.path.dirname(self._index_file)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            temp_file = self._index_file + ".tmp"
+            with open(temp_file, "w") as index_file:
+                json.dump(self._bindings, index_file)
+            os.replace(temp_file, self._index_file)
+        except OSError as e:
+            logger.error("Unable to save the MAC index %s: %s", self._index_file, e)
+
+    def set_persons(self, persons):
+        """Replace the known devices
+
+        The bindings of the devices still known are kept, the others are dropped.
+
+        Args:
+            persons ([(str, str)]): an array of tuples (name, mac_address) containing the name
+                                    of the person and its smartphone's MAC address
+        """
+        self._persons_by_mac = {mac.lower(): name for name, mac in persons}
+        self._bindings = {mac: ip_addr for mac, ip_addr in self._bindings.items() if mac in self._persons_by_mac}
+
+    def person_of(self, mac):
+        """Return the owner of a device
+
+        Args:
+            mac (str): the MAC address of the device
+
+        Returns:
+            str. The name of the owner or None if the device is unknown
+        """
+        return self._persons_by_mac.get(mac.lower())
+
+    def macs(self):
+        """Return the MAC addresses of the known devices
+
+        Returns:
+            set. The MAC addresses of the known devices
+        """
+        return set(self._persons_by_mac)
+
+    def bindings(self):
+        """Return the IPs the known devices were last seen with
+
+        Returns:
+            {str: str}. A dictionary where the key is an IP address and the value the MAC address of the
+            known device bound to it
+        """
+        return {ip_addr: mac for mac, ip_addr in self._bindings.items()}
+
+    def update(self, discovered):
+        """Update the bindings with the outcome of a discovery
+
+        Only the bindings that changed are touched: a known device seen with a new IP gets the new binding
+        and a known device whose IP has been taken by another device loses its binding.
+
+        Args:
+            discovered ({str: str}): a dictionary where the key is the MAC address of a device detected on
+                                     the network and the value its IP
+
+        Returns:
+            int. The number of bindings changed
+        """
+        changes = 0
+        owners = {ip_addr: mac.lower() for mac, ip_addr in discovered.items()}
+        for mac, ip_addr in list(self._bindings.items()):
+            if owners.get(ip_addr, mac) != mac:
+                logger.info("IP %s of %s now belongs to another device", ip_addr, self._persons_by_mac[mac])
+                del self._bindings[mac]
+                changes += 1
+        for mac, ip_addr in discovered.items():
+            mac = mac.lower()
+            if mac in self._persons_by_mac and self._bindings.get(mac) != ip_addr:
+                logger.info("Device of %s bound to %s", self._persons_by_mac[mac], ip_addr)
+                self._bindings[mac] = ip_addr
+                changes += 1
+        if changes:
+            self._save()
+        return changes
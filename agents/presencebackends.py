@@ -0,0 +1,333 @@
+import os
+import socket
+import struct
+from abc import ABCMeta, abstractmethod
+from libnmap.process import NmapProcess
+from libnmap.parser import NmapParser, NmapParserException
+from ..common.logger import logger
+
+# the rtnetlink messages and attributes used to dump the kernel neighbour table (see linux/neighbour.h)
+_RTM_NEWNEIGH, _RTM_GETNEIGH = 28, 30
+_NLMSG_ERROR, _NLMSG_DONE = 2, 3
+_NLM_F_REQUEST, _NLM_F_DUMP = 0x01, 0x300
+_NDA_DST, _NDA_LLADDR = 1, 2
+_NLMSG_HEADER = struct.Struct("=LHHLL")
+_NDMSG = struct.Struct("=BxxxiHBB")
+_RTATTR = struct.Struct("=HH")
+_NUD_STATES = {0x01: "INCOMPLETE", 0x02: "REACHABLE", 0x04: "STALE", 0x08: "DELAY", 0x10: "PROBE",
+               0x20: "FAILED", 0x40: "NOARP", 0x80: "PERMANENT"}
+_NETLINK_BUFFER_SIZE = 65536
+_NEIGHBOUR_TIMEOUT = 5
+# the NUD states of the entries confirmed by the kernel: any other state (STALE, DELAY, PROBE, FAILED,
+# INCOMPLETE) means the host has not been heard from recently and it has to be probed
+_CONFIRMED_STATES = frozenset(("REACHABLE", "PERMANENT", "NOARP"))
+
+
+def is_ip_online(ip_addr):
+    """A function that checks if a certain IP is currently connected to the network
+
+    The function leverege the NMAP service to verify if the IP received in input is currently
+    connected to the network. The nmac scan process is not always super accurate and multiple
+    invocation of the function might be necessary to have accurate results (NMAP infact might
+    not detect something that is actually conected at its first attempt)
+
+    Args:
+        ip_addr (str): the IP address to look-up
+
+    Returns:
+        bool. It returns True if the IP is detected on the network and False if not or if an
+        error occurred
+    """
+    nmap_process = NmapProcess(ip_addr, "-sn")
+    scan_result = nmap_process.run()
+    if scan_result != 0: #scan failed
+        logger.error("nmap scan failed: %s", nmap_process.stderr)
+
+    try:
+        report = NmapParser.parse(nmap_process.stdout)
+        host = report.hosts[0]
+        if host.status == "up":
+            return True
+    except NmapParserException as e:
+        logger.error("Exception raised while parsing scan: %s", e.msg)
+
+    return False
+
+
+def get_online_ips(ip_addrs):
+    """A function that checks which IPs of a list are currently connected to the network
+
+    Unlike is_ip_online the function probes all the IPs received in input with a single NMAP scan
+    and parses the resulting report once, this way checking N addresses costs one process spawn
+    instead of N.
+
+    Args:
+        ip_addrs ([str]): the IP addresses to look-up
+
+    Returns:
+        set. The subset of the IP addresses received in input detected on the network (an empty set
+        if an error occurred)
+    """
+    ip_addrs = list(ip_addrs)
+    if not ip_addrs:
+        return set()
+    nmap_process = NmapProcess(ip_addrs, "-sn")
+    scan_result = nmap_process.run()
+    if scan_result != 0: #scan failed
+        logger.error("nmap scan failed: %s", nmap_process.stderr)
+
+    online_ips = set()
+    try:
+        report = NmapParser.parse(nmap_process.stdout)
+        online_ips = {host.address for host in report.hosts if host.status == "up"}
+    except NmapParserException as e:
+        logger.error("Exception raised while parsing scan: %s", e.msg)
+
+    return online_ips
+
+
+def discover_hosts(subnet):
+    """A function that discovers the hosts connected to a subnet
+
+    The function performs a NMAP ping sweep of the whole subnet; note that NMAP reports the hardware
+    address of the hosts only when it runs with root privileges on the same network segment.
+
+    Args:
+        subnet (str): the subnet to sweep (something like "192.168.1.0/24")
+
+    Returns:
+        {str: str}. A dictionary where the key is the (lowercase) hardware address of an host detected on
+        the network and the value is its IP address (an empty dictionary if an error occurred)
+    """
+    nmap_process = NmapProcess(subnet, "-sn")
+    scan_result = nmap_process.run()
+    if scan_result != 0: #scan failed
+        logger.error("nmap scan failed: %s", nmap_process.stderr)
+
+    hosts = {}
+    try:
+        report = NmapParser.parse(nmap_process.stdout)
+        hosts = {host.mac.lower(): host.address for host in report.hosts if host.status == "up" and host.mac}
+    except NmapParserException as e:
+        logger.error("Exception raised while parsing scan: %s", e.msg)
+
+    return hosts
+
+
+def parse_neighbour_messages(data, table):
+    """Parse the rtnetlink messages answering a dump of the neighbour table
+
+    Every RTM_NEWNEIGH message carries an IPv4 entry: an ndmsg header with the NUD state, followed by the
+    NDA_DST (the IP address) and NDA_LLADDR (the hardware address, missing while unresolved) attributes.
+
+    Args:
+        data (bytes): the messages received from the socket
+        table ({str: (str, str)}): the table the entries are added to, in the format of read_neighbour_table
+
+    Returns:
+        bool. True if the messages include the one closing the dump, False if more messages are due
+
+    Raises:
+        OSError: if the kernel answered with an error
+    """
+    position = 0
+    while position + _NLMSG_HEADER.size <= len(data):
+        length, message_type, _, _, _ = _NLMSG_HEADER.unpack_from(data, position)
+        if length < _NLMSG_HEADER.size:
+            break
+        body = position + _NLMSG_HEADER.size
+        if message_type == _NLMSG_DONE:
+            return True
+        if message_type == _NLMSG_ERROR:
+            error = struct.unpack_from("=i", data, body)[0]
+            if error:
+                raise OSError(-error, os.strerror(-error))
+        elif message_type == _RTM_NEWNEIGH:
+            family, _, state, _, _ = _NDMSG.unpack_from(data, body)
+            ip_addr = mac = None
+            attribute = body + _NDMSG.size
+            while attribute + _RTATTR.size <= position + length:
+                attribute_length, attribute_type = _RTATTR.unpack_from(data, attribute)
+                if attribute_length < _RTATTR.size:
+                    break
+                value = data[attribute + _RTATTR.size:attribute + attribute_length]
+                if attribute_type == _NDA_DST and family == socket.AF_INET:
+                    ip_addr = socket.inet_ntoa(value)
+                elif attribute_type == _NDA_LLADDR:
+                    mac = ":".join("{:02x}".format(byte) for byte in value) or None
+                attribute += (attribute_length + 3) & ~3
+            if ip_addr is not None:
+                table[ip_addr] = (mac, _NUD_STATES.get(state, "NONE"))
+        position += (length + 3) & ~3
+    return False
+
+
+def read_neighbour_table():
+    """Read the kernel neighbour table with the NUD state of its entries
+
+    The IPv4 entries are dumped through an rtnetlink socket: unlike /proc/net/arp the messages carry the NUD
+    state, which tells the entries confirmed recently from the STALE ones, and no process is spawned.
+
+    Returns:
+        {str: (str, str)}. A dictionary where the key is an IP address and the value the (lowercase) hardware
+        address, None if not resolved, and the NUD state of its entry (an empty dictionary if the table could
+        not be read, this way every IP is handed to the fallback backend)
+    """
+    try:
+        with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE) as sock:
+            sock.settimeout(_NEIGHBOUR_TIMEOUT)
+            sock.bind((0, 0))
+            request = _NDMSG.pack(socket.AF_INET, 0, 0, 0, 0)
+            sock.send(_NLMSG_HEADER.pack(_NLMSG_HEADER.size + len(request), _RTM_GETNEIGH,
+                                         _NLM_F_REQUEST | _NLM_F_DUMP, 1, 0) + request)
+            table = {}
+            while not parse_neighbour_messages(sock.recv(_NETLINK_BUFFER_SIZE), table):
+                pass
+            return table
+    except (OSError, AttributeError, struct.error) as e:
+        # AttributeError: AF_NETLINK is available on Linux only
+        logger.error("Unable to read the neighbour table: %s", e)
+        return {}
+
+
+def confirmed_entries(table):
+    """Return the entries of a neighbour table confirmed by the kernel
+
+    Args:
+        table ({str: (str, str)}): the neighbour table, as returned by read_neighbour_table
+
+    Returns:
+        {str: str}. A dictionary where the key is an IP address and the value its hardware address
+    """
+    return {ip_addr: mac for ip_addr, (mac, state) in table.items() if mac and state in _CONFIRMED_STATES}
+
+
+class PresenceBackend(metaclass=ABCMeta):
+    """Base presence backend class
+
+    A presence backend is the strategy used by NetworkPresenceDetector to check if an IP is connected to
+    the network. Any backend must inherit from this class and implement the abstract methods get_online_ips
+    and discover
+    """
+
+    @abstractmethod
+    def get_online_ips(self, ip_addrs):
+        """Check which IPs of a list are currently connected to the network
+
+        Args:
+            ip_addrs ([str]): the IP addresses to look-up
+
+        Returns:
+            set. The subset of the IP addresses received in input detected on the network
+        """
+        pass
+
+    def is_ip_online(self, ip_addr):
+        """Check if a certain IP is currently connected to the network
+
+        Args:
+            ip_addr (str): the IP address to look-up
+
+        Returns:
+            bool. True if the IP is detected on the network, False otherwise
+        """
+        return ip_addr in self.get_online_ips([ip_addr])
+
+    def get_online_macs(self, bindings):
+        """Check which devices are still connected to the network with a known IP
+
+        Args:
+            bindings ({str: str}): a dictionary where the key is an IP address and the value the hardware
+                                   address of the device last seen with that IP
+
+        Returns:
+            set. The hardware addresses of the devices detected on the network
+        """
+        return {bindings[ip_addr] for ip_addr in self.get_online_ips(list(bindings))}
+
+    @abstractmethod
+    def discover(self, subnet):
+        """Discover the devices connected to a subnet
+
+        Args:
+            subnet (str): the subnet to sweep (something like "192.168.1.0/24")
+
+        Returns:
+            {str: str}. A dictionary where the key is the hardware address of a device and the value its IP,
+            empty if the backend can't tell the hardware address of the devices
+        """
+        pass
+
+
+class NmapBackend(PresenceBackend):
+    """A backend actively probing the IPs with a NMAP ping scan"""
+
+    def get_online_ips(self, ip_addrs):
+        return get_online_ips(ip_addrs)
+
+    def discover(self, subnet):
+        return discover_hosts(subnet)
+
+    def is_ip_online(self, ip_addr):
+        return is_ip_online(ip_addr)
+
+
+class ArpTableBackend(PresenceBackend):
+    """A backend reading the kernel neighbour table
+
+    The backend looks the IPs up in the kernel neighbour table, which costs a single rtnetlink dump and no
+    probe; only the entries the kernel has confirmed recently (the REACHABLE ones, plus the static
+    ones) count as online. The IPs missing from the table or whose entry is STALE, still being resolved or
+    failed are handed to a fallback backend, typically one actively probing the network: the kernel keeps
+    STALE entries around for long after a device left, so their mere presence proves nothing.
+
+    Attributes:
+        _read_table (callable): the function returning the neighbour table, see read_neighbour_table
+        _fallback (PresenceBackend): the backend used for the IPs not confirmed by the table, if None
+                                     such IPs are considered offline
+    """
+
+    def __init__(self, fallback=None, read_table=read_neighbour_table):
+        """Initialize the ArpTableBackend
+
+        Args:
+            fallback (PresenceBackend, optional): the backend used for the IPs not confirmed by the table
+            read_table (callable, optional): the function returning the neighbour table, replaced by the tests
+                                             and the benchmarks with a fixture
+        """
+        self._fallback = fallback
+        self._read_table = read_table
+
+    def get_online_ips(self, ip_addrs):
+        table = confirmed_entries(self._read_table())
+        online_ips = {ip_addr for ip_addr in ip_addrs if ip_addr in table}
+        missing_ips = [ip_addr for ip_addr in ip_addrs if ip_addr not in online_ips]
+        if missing_ips and self._fallback is not None:
+            logger.debug("%d IPs not confirmed by the neighbour table, probing them", len(missing_ips))
+            online_ips |= self._fallback.get_online_ips(missing_ips)
+        return online_ips
+
+    def get_online_macs(self, bindings):
+        # unlike an active probe the table tells which device owns an IP, this way an IP reassigned
+        # to another device is not mistaken for the known one, as long as the kernel has confirmed the entry
+        confirmed = confirmed_entries(self._read_table())
+        online_macs = set()
+        missing = {}
+        for ip_addr, mac in bindings.items():
+            if ip_addr in confirmed:
+                if confirmed[ip_addr] == mac:
+                    online_macs.add(mac)
+            else:
+                # a STALE entry may still name the device that left, only a probe can tell
+                missing[ip_addr] = mac
+        if missing and self._fallback is not None:
+            online_macs |= self._fallback.get_online_macs(missing)
+        return online_macs
+
+    def discover(self, subnet):
+        # the sweep of the fallback backend refreshes the neighbour table as well, the entries it didn't
+        # confirm are left out: a STALE entry would report a departed device present again at every sweep
+        hosts = self._fallback.discover(subnet) if self._fallback is not None else {}
+        confirmed = confirmed_entries(self._read_table())
+        hosts.update({mac: ip_addr for ip_addr, mac in confirmed.items()})
+        return hosts
@@ -1,48 +1,17 @@
-import json
-from libnmap.process import NmapProcess
-from libnmap.parser import NmapParser, NmapParserException
+import time
+from .presencebackends import NmapBackend
+from ..common import metrics
 from ..common.stoppableprocess import StoppableLoopProcess
 from ..common.logger import logger
 
 
-def is_ip_online(ip_addr):
-    """A function that checks if a certain IP is currently connected to the network
-
-    The function leverege the NMAP service to verify if the IP received in input is currently
-    connected to the network. The nmac scan process is not always super accurate and multiple
-    invocation of the function might be necessary to have accurate results (NMAP infact might
-    not detect something that is actually conected at its first attempt)
-
-    Args:
-        ip_addr (str): the IP address to look-up
-
-    Returns:
-        bool. It returns True if the IP is detected on the network and False if not or if an
-        error occurred
-    """
-    nmap_process = NmapProcess(ip_addr, "-sn")
-    scan_result = nmap_process.run()
-    if scan_result != 0: #scan failed
-        logger.error("nmap scan failed: %s", nmap_process.stderr)
-
-    try:
-        report = NmapParser.parse(nmap_process.stdout)
-        host = report.hosts[0]
-        if host.status == "up":
-            return True
-    except NmapParserException as e:
-        logger.error("Exception raised while parsing scan: %s", e.msg)
-
-    return False
-
-
 class NetworkPresenceDetector(StoppableLoopProcess):
     """This class is a process that tries to detect if a list of known persons is currently connected to the network
     and publishes its findings on a Broker
 
-    The class, which is a subclass of multiprocessing.Process, uses the tool NMAP to detect if the IP of a device
-    of a known person is connected to the local network and publishes its finding (person present or absent) on a
-    Broker
+    The class, which is a subclass of multiprocessing.Process, uses a presence backend (by default the tool NMAP)
+    to detect if the IP of a device of a known person is connected to the local network and publishes its finding
+    (person present or absent) on a Broker
 
     Attributes:
         _persons_list ([(str, str)]): an array of tuples (name, ip_address) containing the name
@@ -56,15 +25,32 @@ class NetworkPresenceDetector(StoppableLoopProcess):
                                or only in case of status change
         _sampling_interval (int): the number expressing how often (in seconds) the process must perform
                                   a presence detection for all the known persons
+        _batch_scan (bool): a boolean that states if all the known IPs must be probed with a single scan
+                            per attempt instead of one scan per person and attempt
+        _backend (PresenceBackend): the backend used to check if an IP is connected to the network
+        _identity_index (MacIdentityIndex): the index used to identify the persons through the MAC address
+                                            of their device, if None the persons are identified by IP
+        _subnet (str): the subnet swept to discover the devices when the persons are identified by MAC
+        _addresses ({str: str}): a dictionary where the key is the name of a person and the value the address
+                                 (IP or MAC) of its device
+        _scheduler (AdaptiveScheduler): the scheduler deciding when each person must be probed, if None all
+                                        the persons are checked at every loop with up to _max_detection_attempts
+        _config_watcher (ConfigWatcher): the watcher checked periodically to apply the changes of the
+                                         configuration, if None the configuration is never reloaded
+        _metrics_exporter (MetricsExporter): the exporter publishing the metrics of the process periodically,
+                                             if None the metrics are not exported by this agent
 
     """
 
-    def __init__(self, persons, mqtt_client, max_detection_attempts=7, notify_always=True, detection_frequency=10):
+    def __init__(self, persons, mqtt_client, max_detection_attempts=7, notify_always=True, detection_frequency=10,
+                 batch_scan=False, backend=None, identity_index=None, subnet=None, scheduler=None,
+                 config_watcher=None, metrics_exporter=None):
         """Initialize the network presence detector class
 
         Args:
             persons ([(str, str)]): an array of tuples (name, ip_address) containing the name
-                                    of the person and it smartphone's ip address
+                                    of the person and it smartphone's ip address (or its MAC address
+                                    when an identity_index is provided)
             mqtt_client (MQTTClient): the broker client to use to puplish the outcome of the presence detection
             max_detection_attempts (int): the maximum number of attempts to detect a certein ip before
                                           considering it absent
@@ -72,12 +58,42 @@ class NetworkPresenceDetector(StoppableLoopProcess):
                                   or only in case of status change
             detection_frequency (int): the number expressing how often (in minutes) the process must perform
                                        a presence detection for all the known persons
+            batch_scan (bool): a boolean that states if all the known IPs must be probed with a single scan
+                               per attempt instead of one scan per person and attempt
+            backend (PresenceBackend, optional): the backend used to check if an IP is connected to the network,
+                                                 if None the NMAP backend is used
+            identity_index (MacIdentityIndex, optional): the index used to identify the persons through the
+                                                         MAC address of their device
+            subnet (str, optional): the subnet swept to discover the devices, mandatory with an identity_index
+            scheduler (AdaptiveScheduler, optional): the scheduler deciding when each person must be probed, when
+                                                     provided the loop runs every scheduler.min_interval seconds
+                                                     and detection_frequency is ignored
+            config_watcher (ConfigWatcher, optional): the watcher to check periodically, its listeners are
+                                                      called within the detection loop
+            metrics_exporter (MetricsExporter, optional): the exporter to run within the detection loop
         """
         self._persons_list = persons
         self._persons_status = {person[0]: False for person in persons}
         self._max_detection_attempts = max_detection_attempts
         self._notify_always = notify_always
         self._mqtt_client = mqtt_client
+        self._batch_scan = batch_scan
+        self._backend = backend if backend is not None else NmapBackend()
+        self._identity_index = identity_index
+        self._subnet = subnet
+        self._addresses = dict(persons)
+        self._scheduler = scheduler
+        self._config_watcher = config_watcher
+        self._metrics_exporter = metrics_exporter
+        registry = metrics.get_registry()
+        self._cycle_metric = registry.histogram("presence_cycle_seconds", "Duration of the detection cycles",
+                                                buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+        self._changes_metric = registry.counter("presence_status_changes_total", "Changes of presence status")
+        registry.gauge("presence_persons_present", "Known persons currently present").set_function(
+            lambda: sum(self._persons_status.values()))
+        if scheduler is not None:
+            super(NetworkPresenceDetector, self).__init__(scheduler.min_interval)
+            return
         # since the loop interval of StoppableLoopProcess is expressed in seconds and the detection_frequency
         # is in minutes I have to muliply by 60
         super(NetworkPresenceDetector, self).__init__(detection_frequency*60)
@@ -97,7 +113,7 @@ class NetworkPresenceDetector(StoppableLoopProcess):
         else:
             status = "absent"
         payload = {"name": name, "status": status}
-        self._mqtt_client.publish("presence", json.dumps(payload))
+        self._mqtt_client.publish("presence", payload)
 
     def _update_presence_status(self, name, is_present):
         """Update the status of a person within the internal register
@@ -109,6 +125,7 @@ class NetworkPresenceDetector(StoppableLoopProcess):
         status_changed = is_present != self._persons_status[name]
         if status_changed:
             logger.info("%s's status changed", name)
+            self._changes_metric.inc()
         self._persons_status[name] = is_present
         if self._notify_always or status_changed:
             self._notify_status(name, is_present)
@@ -127,7 +144,7 @@ class NetworkPresenceDetector(StoppableLoopProcess):
         while attempts < self._max_detection_attempts:
             attempts += 1
             logger.debug("Detection attempt #%d ongoing...", attempts)
-            if is_ip_online(ip_addr):
+            if self._backend.is_ip_online(ip_addr):
                 presence_detected = True
                 break
             self._wait(3)
@@ -139,6 +156,130 @@ class NetworkPresenceDetector(StoppableLoopProcess):
 
         self._update_presence_status(person_name, presence_detected)
 
+    def _detect_persons_presence(self):
+        """Check which of the known persons are currently connected to the local network
+
+        All the IPs still undetected are probed together with a single scan per attempt, at every attempt
+        only the hosts that were not detected yet are scanned again.
+        """
+        logger.info("Batched detection of %d persons started", len(self._persons_list))
+        pending = {}
+        for name, ip_addr in self._persons_list:
+            pending.setdefault(ip_addr, []).append(name)
+
+        present = set()
+        attempts = 0
+        while pending and attempts < self._max_detection_attempts:
+            attempts += 1
+            logger.debug("Detection attempt #%d ongoing for %d hosts...", attempts, len(pending))
+            for ip_addr in self._backend.get_online_ips(list(pending)):
+                present.update(pending.pop(ip_addr, []))
+            if pending:
+                self._wait(3)
+
+        for name, _ in self._persons_list:
+            is_present = name in present
+            logger.info("%s %s", name, "present" if is_present else "absent")
+            self._update_presence_status(name, is_present)
+
+    def _probe_by_mac(self, names):
+        """Check, with a single attempt, which persons are connected to the local network using their MAC
+
+        The IPs the devices of the persons were last seen with are checked first with a single probe; only if
+        some device is not found that way the whole subnet is swept, once, and the MAC index is updated with
+        the bindings discovered. Resolving N persons therefore costs at most a probe and a sweep.
+
+        Args:
+            names ([str]): the names of the persons to look for
+
+        Returns:
+            set. The names of the persons detected
+        """
+        index = self._identity_index
+        macs = {self._addresses[name].lower(): name for name in names}
+        bindings = {ip_addr: mac for ip_addr, mac in index.bindings().items() if mac in macs}
+        present_macs = self._backend.get_online_macs(bindings) if bindings else set()
+        if set(macs) - present_macs:
+            logger.debug("Sweeping subnet %s", self._subnet)
+            discovered = self._backend.discover(self._subnet)
+            index.update(discovered)
+            present_macs |= set(macs) & set(discovered)
+        return {macs[mac] for mac in present_macs if mac in macs}
+
+    def _probe(self, names):
+        """Check, with a single attempt, which persons are connected to the local network
+
+        Args:
+            names ([str]): the names of the persons to look for
+
+        Returns:
+            set. The names of the persons detected
+        """
+        if self._identity_index is not None:
+            return self._probe_by_mac(names)
+        online_ips = self._backend.get_online_ips(list({self._addresses[name] for name in names}))
+        return {name for name in names if self._addresses[name] in online_ips}
+
+    def _detect_persons_presence_by_mac(self):
+        """Check which of the known persons are currently connected to the local network using their MAC"""
+        logger.info("MAC based detection of %d persons started", len(self._persons_list))
+        present = self._probe_by_mac([name for name, _ in self._persons_list])
+        for name, _ in self._persons_list:
+            is_present = name in present
+            logger.info("%s %s", name, "present" if is_present else "absent")
+            self._update_presence_status(name, is_present)
+
+    def _detect_scheduled_presence(self):
+        """Probe the persons whose detection is due according to the scheduler
+
+        The due persons are probed together with a single attempt, the scheduler decides (applying its
+        hysteresis) the status to report and when each person must be probed again.
+        """
+        names = self._scheduler.pop_due()
+        if not names:
+            return
+        logger.info("Scheduled detection of %s", ", ".join(names))
+        present = self._probe(names)
+        for name in names:
+            if self._scheduler.record(name, name in present):
+                logger.info("%s %s", name, "present" if self._scheduler.is_present(name) else "absent")
+            self._update_presence_status(name, self._scheduler.is_present(name))
+
+    def update_persons(self, persons):
+        """Replace the list of known persons while the process is running
+
+        The status of the persons already known is kept, the new ones start as absent (and, with the adaptive
+        scheduling, are probed right away). The method must be called within the detection loop (for example
+        by a listener of the config watcher).
+
+        Args:
+            persons ([(str, str)]): the new array of tuples (name, address), the address is an IP or, when
+                                    the persons are identified by MAC, a MAC address
+        """
+        names = {person[0] for person in persons}
+        for name in set(self._persons_status) - names:
+            del self._persons_status[name]
+            if self._scheduler is not None:
+                self._scheduler.remove(name)
+        for name in names - set(self._persons_status):
+            self._persons_status[name] = False
+            if self._scheduler is not None:
+                self._scheduler.add(name)
+        if self._identity_index is not None:
+            self._identity_index.set_persons(persons)
+        self._persons_list = persons
+        self._addresses = dict(persons)
+        logger.info("Known persons: %s", ", ".join(sorted(names)))
+
+    def stats(self):
+        """Return the probe statistics of every person
+
+        Returns:
+            {str: {str: float}}. The statistics indexed by name (see AdaptiveScheduler.stats), an empty
+            dictionary if the adaptive scheduling is not enabled
+        """
+        return self._scheduler.stats() if self._scheduler is not None else {}
+
     def _setup(self):
         """Preparing the process to start
 
@@ -146,17 +287,46 @@ class NetworkPresenceDetector(StoppableLoopProcess):
         """
         # starts the MQTT client
         self._mqtt_client.start()
+        self._schedule("loop", self._loop_interval, self._loop)
+        if self._config_watcher is not None:
+            self._schedule("config reload", self._config_watcher.interval, self._config_watcher.check,
+                           delay=self._config_watcher.interval)
+        if self._metrics_exporter is not None:
+            self._metrics_exporter.start_server()
+            self._schedule("metrics export", self._metrics_exporter.interval, self._metrics_exporter.publish,
+                           delay=self._metrics_exporter.interval)
 
     def _teardown(self):
         """Prepares the process for termination
 
         The method closes the connection with the broker
         """
+        for name, stats in self.stats().items():
+            logger.info("%s: %d probes (%.1f per hour), %d transitions", name, stats["probes"],
+                        stats["probes_per_hour"], stats["transitions"])
+        if self._metrics_exporter is not None:
+            self._metrics_exporter.stop_server()
+            self._metrics_exporter.publish()
         #disconnect from the mqtt broker
         self._mqtt_client.stop()
 
 
-    def _loop(self):
-        """Check if any known person is currently connected to the network"""
+    def _detect(self):
+        """Run a detection cycle with the strategy configured"""
+        if self._scheduler is not None:
+            self._detect_scheduled_presence()
+            return
+        if self._identity_index is not None:
+            self._detect_persons_presence_by_mac()
+            return
+        if self._batch_scan:
+            self._detect_persons_presence()
+            return
         for name, ip_addr in self._persons_list:
             self._detect_person_presence(name, ip_addr)
+
+    def _loop(self):
+        """Check if any known person is currently connected to the network"""
+        started = time.monotonic()
+        self._detect()
+        self._cycle_metric.observe(time.monotonic() - started)
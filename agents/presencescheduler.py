@@ -0,0 +1,216 @@
+import heapq
+import time
+
+
+class PersonTracker(object):
+    """The detection state of a person
+
+    Attributes:
+        name (str): the name of the person
+        is_present (bool): the status currently reported for the person
+        misses (int): the number of consecutive probes that did not detect a person reported as present
+        missing_since (float): the time of the first of the consecutive missed detections, None if the last
+                               probe detected the person
+        interval (float): the current amount of time, in seconds, between two probes
+        next_due (float): the time at which the person must be probed again
+        probes (int): the number of probes spent on the person
+        detections (int): the number of probes that detected the person
+        transitions (int): the number of status changes reported
+    """
+    __slots__ = ("name", "is_present", "misses", "missing_since", "interval", "next_due", "probes", "detections", "transitions")
+
+    def __init__(self, name, interval, next_due):
+        self.name = name
+        self.is_present = False
+        self.misses = 0
+        self.missing_since = None
+        self.interval = interval
+        self.next_due = next_due
+        self.probes = 0
+        self.detections = 0
+        self.transitions = 0
+
+
+class AdaptiveScheduler(object):
+    """A scheduler deciding when each person must be probed
+
+    The scheduler keeps a state machine per person and a priority queue of the next probe times:
+        - a person whose status is stable is probed less and less often (the interval is multiplied by
+          the backoff factor up to max_interval, or absent_max_interval for absent persons so that
+          arrivals are still detected quickly)
+        - a status change brings the interval back to min_interval whereas after a missed detection only
+          the next probe is anticipated to min_interval
+        - a present person is reported absent only after misses_before_absent consecutive missed
+          detections spanning at least absent_after seconds (hysteresis) whereas a single detection is
+          enough to report an arrival
+
+    Every probe is a single detection attempt: the retries happen in the following probes.
+
+    Attributes:
+        _trackers ({str: PersonTracker}): the state of every person indexed by name
+        _queue ([(float, str)]): the priority queue of (next_due, name)
+        _min_interval (float): the interval, in seconds, used around transitions
+        _max_interval (float): the maximum interval, in seconds, for persons stably present
+        _absent_max_interval (float): the maximum interval, in seconds, for persons stably absent
+        _misses_before_absent (int): the number of consecutive missed detections before reporting an absence
+        _absent_after (float): the minimum number of seconds of missed detections before reporting an absence
+        _backoff (float): the factor applied to the interval after every probe confirming the status
+        _clock (callable): the function returning the current time in seconds
+        _started_at (float): the time at which the scheduler was created
+    """
+
+    def __init__(self, names, min_interval=30, max_interval=600, absent_max_interval=120, misses_before_absent=5,
+                 absent_after=300, backoff=2.0, clock=time.monotonic):
+        """Initialize the AdaptiveScheduler
+
+        All the persons start as absent and due immediately.
+
+        Args:
+            names ([str]): the names of the persons to schedule
+            min_interval (float): the interval, in seconds, used around transitions
+            max_interval (float): the maximum interval, in seconds, for persons stably present
+            absent_max_interval (float): the maximum interval, in seconds, for persons stably absent
+            misses_before_absent (int): the number of consecutive missed detections before reporting an absence
+            absent_after (float): the minimum number of seconds of missed detections before reporting an absence
+            backoff (float): the factor applied to the interval after every probe confirming the status
+            clock (callable): the function returning the current time in seconds
+        """
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._absent_max_interval = absent_max_interval
+        self._misses_before_absent = max(1, misses_before_absent)
+        self._absent_after = absent_after
+        self._backoff = backoff
+        self._clock = clock
+        self._started_at = clock()
+        self._trackers = {}
+        self._queue = []
+        for name in names:
+            self.add(name)
+
+    @property
+    def min_interval(self):
+        return self._min_interval
+
+    def add(self, name):
+        """Start scheduling a person, the person is due immediately
+
+        Args:
+            name (str): the name of the person
+        """
+        if name in self._trackers:
+            return
+        now = self._clock()
+        self._trackers[name] = PersonTracker(name, self._min_interval, now)
+        heapq.heappush(self._queue, (now, name))
+
+    def remove(self, name):
+        """Stop scheduling a person
+
+        Args:
+            name (str): the name of the person
+        """
+        # the stale entries left in the queue are skipped by pop_due
+        self._trackers.pop(name, None)
+
+    def is_present(self, name):
+        """Return the status currently reported for a person
+
+        Args:
+            name (str): the name of the person
+
+        Returns:
+            bool. True if the person is reported as present, False otherwise
+        """
+        return self._trackers[name].is_present
+
+    def next_due(self):
+        """Return the time at which the next probe is due
+
+        Returns:
+            float. The time of the next probe or None if no person is scheduled
+        """
+        while self._queue:
+            due, name = self._queue[0]
+            tracker = self._trackers.get(name)
+            if tracker is not None and tracker.next_due == due:
+                return due
+            heapq.heappop(self._queue)
+        return None
+
+    def pop_due(self):
+        """Return the persons whose probe is due
+
+        Returns:
+            [str]. The names of the persons to probe now
+        """
+        now = self._clock()
+        names = []
+        while self._queue and self._queue[0][0] <= now:
+            due, name = heapq.heappop(self._queue)
+            tracker = self._trackers.get(name)
+            # skip the entries of removed persons and the ones superseded by a reschedule
+            if tracker is not None and tracker.next_due == due:
+                names.append(name)
+        return names
+
+    def record(self, name, detected):
+        """Record the outcome of a probe and reschedule the person
+
+        Args:
+            name (str): the name of the person probed
+            detected (bool): True if the probe detected the person
+
+        Returns:
+            bool. True if the status reported for the person changed
+        """
+        tracker = self._trackers[name]
+        tracker.probes += 1
+        now = self._clock()
+        changed = False
+        if detected:
+            tracker.detections += 1
+            tracker.misses = 0
+            tracker.missing_since = None
+            if tracker.is_present:
+                tracker.interval = min(tracker.interval * self._backoff, self._max_interval)
+            else:
+                changed = True
+        elif tracker.is_present:
+            tracker.misses += 1
+            if tracker.missing_since is None:
+                tracker.missing_since = now
+            # a phone asleep misses several probes in a row, only a long enough silence is a departure: the
+            # time is counted from the first miss since the last detection may be max_interval old
+            changed = (tracker.misses >= self._misses_before_absent and
+                       now - tracker.missing_since >= self._absent_after)
+        else:
+            tracker.interval = min(tracker.interval * self._backoff, self._absent_max_interval)
+
+        if changed:
+            tracker.is_present = not tracker.is_present
+            tracker.transitions += 1
+            tracker.misses = 0
+            tracker.missing_since = None
+            tracker.interval = self._min_interval
+        # a person that might be leaving is checked again soon, without losing the interval reached so far
+        # since a single missed detection is usually just a sleeping device
+        delay = self._min_interval if tracker.misses else tracker.interval
+        tracker.next_due = now + delay
+        heapq.heappush(self._queue, (tracker.next_due, name))
+        return changed
+
+    def stats(self):
+        """Return the probe statistics of every person
+
+        Returns:
+            {str: {str: float}}. A dictionary indexed by name with the keys: probes, detections, transitions,
+            interval (the current one, in seconds) and probes_per_hour
+        """
+        hours = max(self._clock() - self._started_at, 1.0) / 3600.0
+        return {name: {"probes": tracker.probes,
+                       "detections": tracker.detections,
+                       "transitions": tracker.transitions,
+                       "interval": tracker.interval,
+                       "probes_per_hour": tracker.probes / hours}
+                for name, tracker in self._trackers.items()}
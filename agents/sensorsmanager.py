@@ -1,7 +1,12 @@
 import multiprocessing
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from ..common.histogram import Histogram
 from ..common.logger import logger
-from ..common.gpiomanager import GPIO
+from ..common import gpiomanager, metrics
 from ..common.stoppableprocess import StoppableLoopProcess
+from .eventpipeline import EventPipeline, EventSource
 
 
 class SensorsManager(StoppableLoopProcess):
@@ -15,16 +20,43 @@ class SensorsManager(StoppableLoopProcess):
 
     Attributes:
         _sensors ([Sensor]): the array of sensors to use
-        _events ({int: str}): the dictionary of event to listen for
+        _events ({int: EventSource}): the sources of the events to listen for indexed by GPIO channel
         _mqtt_client (MQTTClient): the mqtt client to use to puplish the sampled data and notify events
-        _sampling_interval (int): the amount of time (in seconds) between each sampling
+        _sampling_interval (int): the amount of time (in seconds) between each sampling of the sensors without
+                                  a sampling_interval of their own
         _lock (multiprocessing.Lock): a lock use to prevent process termination while publishing data
         _stop_sampling (threading.Event): event to detect when the process should be interrupted; as long
                                           as the internal flag is set to False the process keeps running
+        _publish_mode (str): how the samples are published: "per_label" publishes every sample on its own topic,
+                             "batch" publishes a single document per sampling cycle on _batch_topic and "both"
+                             does both
+        _batch_topic (str): the subtopic on which the batch documents are published
+        _sequence_number (int): the sequence number of the last batch document published
+        _executor (ThreadPoolExecutor): the pool of threads reading the sensors concurrently
+        _pending_reads (set): the sensors whose reading missed its deadline and is still running
+        _read_stats ({str: {str: object}}): the reading statistics indexed by sensor name, each one with
+                                            a "latency" Histogram and the "failures" and "timeouts" counters
+        _stats_lock (threading.Lock): the lock protecting _pending_reads and _read_stats
+        _deadband (DeadbandFilter): the report-by-exception stage the samples go through before being published,
+                                    if None every sample is published
+        _aggregator (SampleAggregator): the stage aggregating the samples over a time window before publishing
+                                        them, if None every sample is published as soon as it is collected
+        _history (HistoryStore): the store where every sample collected is saved, if None the samples are not saved
+        _config_watcher (ConfigWatcher): the watcher checked periodically to apply the changes of the
+                                         configuration, if None the configuration is never reloaded
+        _metrics_exporter (MetricsExporter): the exporter publishing the metrics of the process periodically,
+                                             if None the metrics are not exported by this agent
+        _metrics (MetricsRegistry): the registry the agent reports into
+        _event_pipeline (EventPipeline): the handoff between the GPIO callbacks and the publication of the events
+        _event_bouncetime (int): the bouncetime, in milliseconds, of the GPIO event detections
 
     """
+    PUBLISH_MODES = ("per_label", "batch", "both")
 
-    def __init__(self, sensors, events, mqtt_client, sampling_interval=60):
+    def __init__(self, sensors, events, mqtt_client, sampling_interval=60, publish_mode="per_label",
+                 batch_topic="samples", deadband=None, aggregator=None,
+                 history=None, config_watcher=None, metrics_exporter=None, event_window=10.0,
+                 event_bouncetime=200, event_queue_size=1000):
         """Initialize the SensorsManager class
 
         Init the SensorManager class with a list of sensors, a list of event to listen to,
@@ -32,59 +64,371 @@ class SensorsManager(StoppableLoopProcess):
 
         Args:
             sensors ([Sensor]): the array of sensors to use
-            events ({int: str}): the dictionary of event to listen for
+            events ({int: EventSource}): the sources of the events to listen for indexed by GPIO channel, an
+                                         event name in place of a source listens for the rising edges with
+                                         the default settings
             mqtt_client (MQTTClient): the mqtt client to use to puplish the sampled data and notify events
-            sampling_interval (int): the amount of time (in seconds) between each sampling,
-                                     the default value is 60 seconds
+            sampling_interval (int): the amount of time (in seconds) between each sampling of the sensors without
+                                     a sampling_interval of their own, the default value is 60 seconds
+            publish_mode (str): how the samples are published, one of "per_label" (the default), "batch" and "both"
+            batch_topic (str): the subtopic on which the batch documents are published
+            deadband (DeadbandFilter, optional): the report-by-exception stage the samples go through before
+                                                 being published
+            aggregator (SampleAggregator, optional): the stage aggregating the samples before publishing them
+            history (HistoryStore, optional): the store where every sample collected is saved
+            config_watcher (ConfigWatcher, optional): the watcher to check periodically, its listeners are
+                                                      called within the sampling loop
+            metrics_exporter (MetricsExporter, optional): the exporter to run within the sampling loop
+            event_window (float, optional): the amount of time, in seconds, an event throttles the following edges
+                                            of its GPIO channel
+            event_bouncetime (int, optional): the bouncetime, in milliseconds, of the GPIO event detections
+            event_queue_size (int, optional): the maximum number of edges waiting to be published
         """
+        if publish_mode not in self.PUBLISH_MODES:
+            raise ValueError("Unsupported publish mode {}".format(publish_mode))
         self._sensors = sensors
-        self._events = events
+        self._sampling_interval = sampling_interval
+        self._events = self._event_sources(events)
         self._mqtt_client = mqtt_client
+        self._publish_mode = publish_mode
+        self._batch_topic = batch_topic
+        self._sequence_number = 0
+        self._deadband = deadband
+        self._aggregator = aggregator
+        self._history = history
+        self._config_watcher = config_watcher
+        self._metrics_exporter = metrics_exporter
+        self._metrics = metrics.get_registry()
+        self._published_metric = self._metrics.counter("samples_published_total", "Samples published")
+        self._cycle_metric = self._metrics.histogram("sampling_cycle_seconds",
+                                                     "Time from the start of a sampling cycle to its publication")
+        self._event_pipeline = EventPipeline(self._publish_event, self._events, event_window, event_queue_size)
+        self._event_bouncetime = event_bouncetime
+        self._executor = None
+        self._pending_reads = set()
+        self._read_stats = {sensor.name: {"latency": Histogram(), "failures": 0, "timeouts": 0} for sensor in sensors}
+        self._stats_lock = threading.Lock()
         self._lock = multiprocessing.Lock()
         super(SensorsManager, self).__init__(sampling_interval)
 
+    def _build_batch(self, samples):
+        """Build the document holding all the samples of a sampling cycle
+
+        The document is a dictionary in the format:
+        {"seq": int, "ts": float, "samples": [[label, data, unit], ...]}
+        where seq is a sequence number incremented at every document (to let consumers detect gaps),
+        ts is the unix time of the sampling cycle and every sample is a [str, float, str] array; encoded as json
+        it would be for example:
+        {"seq":7,"ts":1500000000.0,"samples":[["temperature",22.5,"C"],["pressure",1013.2,"mbar"]]}
+        Aggregated samples carry their statistics as a fourth element: [label, data, unit, {stats}]
+
+        Args:
+            samples ([Sample]): the samples collected in the sampling cycle
+
+        Returns:
+            {str: object}. The document, encoded by the MQTTClient with the codec of the batch topic
+        """
+        self._sequence_number += 1
+        return {"seq": self._sequence_number,
+                "ts": round(time.time(), 3),
+                "samples": [[sample.label, sample.data, sample.unit] if sample.stats is None else
+                            [sample.label, sample.data, sample.unit, sample.stats] for sample in samples]}
+
     def _post_samples(self, samples):
         """Publish samples on the mqtt broker
 
-        The method publishes a list of sample objects received in input. The topic on which a sample is published
-        is the concatenation of the base_topic of the broker and the 'label' attribute of the sample whereas the
-        payload is a json string in the format {"data": float, "unit": str}, for example the payload of a temperature
-        sample would be: {"data": 22.5, "unit": "C"}
+        The method publishes a list of sample objects received in input. In "per_label" mode the topic on which
+        a sample is published is the concatenation of the base_topic of the broker and the 'label' attribute of
+        the sample whereas the payload is a document in the format {"data": float, "unit": str}, for example
+        the payload of a temperature sample would be: {"data": 22.5, "unit": "C"}; the statistics of aggregated
+        samples are added to the payload: {"data": 22.5, "unit": "C", "min": 22.1, "max": 22.8, ...}.
+        The documents are encoded by the MQTTClient with the codec of their topic (json by default).
+        In "batch" mode all the samples are published as a single document (see _build_batch) on the batch topic,
+        in "both" mode the two are combined.
 
         Args:
-            samples ([{str: float}]): an array of samples, each sample is a dictionary that must have at
-                                      least a key "type" (will be used to generate the topic)
+            samples ([Sample]): an array of samples
         """
         logger.info("Publishing samples")
         if self._lock.acquire(block=True, timeout=5):
-            for sample in samples:
-                payload = "{{\"data\": {data}, \"unit\": \"{unit}\"}}".format(data=sample.data, unit=sample.unit)
-                self._mqtt_client.publish(sample.label, payload)
+            if self._publish_mode != "per_label" and samples:
+                self._mqtt_client.publish(self._batch_topic, self._build_batch(samples))
+            if self._publish_mode != "batch":
+                for sample in samples:
+                    document = {"data": sample.data, "unit": sample.unit}
+                    if sample.stats is not None:
+                        document.update(sample.stats)
+                    self._mqtt_client.publish(sample.label, document)
             self._lock.release()
+            self._published_metric.inc(len(samples))
 
-    def _post_event(self, channel):
-        """Notify events on the mqtt broker
+    @staticmethod
+    def _event_sources(events):
+        """Return the sources of the events, building the default one for the channels mapped to an event name"""
+        return {channel: source if isinstance(source, EventSource) else EventSource(channel, source)
+                for channel, source in events.items()}
+
+    def _publish_event(self, source, timestamp):
+        """Notify an event on the mqtt broker
+
+        The method is called by the publisher thread of the event pipeline, never by the GPIO callback thread.
+        The payload is a document in the format {"ts": float} where ts is the unix time of the edge
 
         Args:
-            channel (int): the number of the gpio port rising the event
+            source (EventSource): the source of the event
+            timestamp (float): the unix time of the edge
         """
-        # to avoid the disconnection of the client let's acquire the lock,
-        # in this case the timeout is 20 seconds because if the lock is acquired
-        # by the sampling method it could take a while since some sensors may require
-        # time to acquire the data
         logger.info("Publishing event")
-        if self._lock.acquire(block=True, timeout=20):
-            self._mqtt_client.publish_event(self._events[channel])
-            self._lock.release()
+        self._mqtt_client.publish_event(source.event, {"ts": round(timestamp, 3)})
+
+    def _read_sensor(self, sensor):
+        """Read a sensor recording the latency of the reading
+
+        Args:
+            sensor (Sensor): the sensor to read
+
+        Returns:
+            [Sample]. The samples collected by the sensor
+        """
+        started = time.monotonic()
+        try:
+            return sensor.sample()
+        finally:
+            latency = time.monotonic() - started
+            with self._stats_lock:
+                # the sensor may have been removed while it was read
+                stats = self._read_stats.get(sensor.name)
+                if stats is not None:
+                    stats["latency"].observe(latency)
+            self._metrics.histogram("sensor_read_seconds", "Duration of the sensor readings",
+                                    sensor=sensor.name).observe(latency)
+
+    def _record_failure(self, sensor, timeout=False):
+        """Record a failed reading
+
+        Args:
+            sensor (Sensor): the sensor whose reading failed
+            timeout (bool): True if the reading failed because it missed its deadline
+        """
+        with self._stats_lock:
+            stats = self._read_stats.get(sensor.name)
+            if stats is None:
+                return
+            stats["failures"] += 1
+            if timeout:
+                stats["timeouts"] += 1
+        self._metrics.counter("sensor_read_failures_total", "Sensor readings failed", sensor=sensor.name).inc()
+        if timeout:
+            self._metrics.counter("sensor_read_timeouts_total", "Sensor readings that missed their deadline",
+                                  sensor=sensor.name).inc()
+
+    def _on_late_read_done(self, sensor):
+        """Return the callback invoked when a reading that missed its deadline finally completes"""
+        def callback(future):
+            with self._stats_lock:
+                self._pending_reads.discard(sensor)
+        return callback
+
+    def _collect_samples(self, sensors):
+        """Read sensors concurrently
+
+        Every sensor is read on its own thread and has read_timeout seconds to complete; a sensor missing
+        its deadline is recorded as failed and its samples are dropped without delaying the others. A sensor
+        still busy with a reading that missed the deadline of a previous cycle is skipped.
+
+        Args:
+            sensors ([Sensor]): the sensors to read
+
+        Returns:
+            [Sample]. The samples collected, in the order of the sensors
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=max(1, len(self._sensors)),
+                                                thread_name_prefix="sensor-read")
+        reads = []
+        for sensor in sensors:
+            with self._stats_lock:
+                busy = sensor in self._pending_reads
+            if busy:
+                logger.error("%s: previous reading still ongoing, sensor skipped", sensor.name)
+                self._record_failure(sensor, timeout=True)
+                continue
+            reads.append((sensor, self._executor.submit(self._read_sensor, sensor),
+                          time.monotonic() + sensor.read_timeout))
+
+        samples = []
+        for sensor, future, deadline in reads:
+            try:
+                sensor_samples = future.result(timeout=max(0, deadline - time.monotonic()))
+            except TimeoutError:
+                logger.error("%s: reading missed its %.1f seconds deadline", sensor.name, sensor.read_timeout)
+                self._record_failure(sensor, timeout=True)
+                with self._stats_lock:
+                    self._pending_reads.add(sensor)
+                future.add_done_callback(self._on_late_read_done(sensor))
+                continue
+            except Exception as error:
+                logger.exception("%s: reading failed: %s", sensor.name, error)
+                self._record_failure(sensor)
+                continue
+            if not sensor_samples:
+                self._record_failure(sensor)
+            samples.extend(sensor_samples)
+        return samples
 
-    def _sample(self):
+    def read_stats(self):
+        """Return the reading statistics of every sensor
+
+        Returns:
+            {str: {str: object}}. A dictionary indexed by sensor name with the keys: failures, timeouts,
+            latency (a snapshot of the latency histogram, see Histogram.snapshot, with the p50 and p95 estimates)
+            and sensor (the statistics specific to the sensor, see Sensor.stats)
+        """
+        stats = {}
+        with self._stats_lock:
+            for name, sensor_stats in self._read_stats.items():
+                latency = sensor_stats["latency"].snapshot()
+                latency["p50"] = sensor_stats["latency"].quantile(0.5)
+                latency["p95"] = sensor_stats["latency"].quantile(0.95)
+                stats[name] = {"failures": sensor_stats["failures"], "timeouts": sensor_stats["timeouts"],
+                               "latency": latency}
+        for sensor in self._sensors:
+            if sensor.name in stats:
+                stats[sensor.name]["sensor"] = sensor.stats()
+        return stats
+
+    def _sample(self, sensors=None):
         """Use the sensors to sample data and publish it on the MQTT broker
 
-        The method collect data from all its sensor and then publish it all on the MQTT broker
+        The method collect data from the sensors received in input (all its sensors by default) and then
+        publish it all on the MQTT broker; with an aggregator the samples are accumulated and only the
+        aggregates are published, once the aggregation window is over
+
+        Args:
+            sensors ([Sensor], optional): the sensors to read, if None all the sensors are read
         """
         logger.info("Collecting samples from sensors.")
-        samples = [sample for sublist in [sensor.sample() for sensor in self._sensors] for sample in sublist]
+        started = time.monotonic()
+        samples = self._collect_samples(self._sensors if sensors is None else sensors)
+        if self._history is not None:
+            self._history.append_samples(samples)
+        if self._aggregator is not None:
+            self._aggregator.add(samples)
+            samples = self._aggregator.flush()
+            if not samples:
+                return
+        if self._deadband is not None:
+            samples = self._deadband.filter(samples)
         self._post_samples(samples)
+        self._cycle_metric.observe(time.monotonic() - started)
+
+    def _schedule_sampling(self, schedules=None):
+        """Schedule the sampling of the sensors
+
+        The sensors are grouped by sampling interval, each group is sampled (and published) by a task of its own
+
+        Args:
+            schedules ({str: (float, float)}, optional): the interval and the next due time of the sampling tasks
+                                                         previously scheduled, indexed by name: the tasks with
+                                                         the same name and interval keep their due time
+        """
+        schedules = schedules or {}
+        now = time.monotonic()
+        groups = {}
+        for sensor in self._sensors:
+            interval = sensor.sampling_interval or self._sampling_interval
+            groups.setdefault(interval, []).append(sensor)
+        for interval, sensors in sorted(groups.items()):
+            name = "sample " + ",".join(sensor.name for sensor in sensors)
+            previous_interval, next_due = schedules.get(name, (None, now))
+            delay = max(0, next_due - now) if previous_interval == interval else 0
+            self._schedule(name, interval, lambda sensors=sensors: self._sample(sensors), delay=delay)
+            logger.info("Sampling %s every %s seconds", ", ".join(sensor.name for sensor in sensors), interval)
+
+    def update_sensors(self, sensors, sampling_interval=None):
+        """Replace the sensors while the process is running
+
+        The sampling tasks are rescheduled: a group of sensors whose name and interval didn't change keeps its
+        schedule, the others are sampled right away. The GPIO events and the broker connection are not touched.
+        The method must be called within the sampling loop (for example by a listener of the config watcher).
+
+        Args:
+            sensors ([Sensor]): the new sensors, the ones not changed should be the instances currently in use
+            sampling_interval (float, optional): the new default sampling interval, if None it doesn't change
+        """
+        if sampling_interval is not None:
+            self._sampling_interval = sampling_interval
+        names = {sensor.name for sensor in sensors}
+        with self._stats_lock:
+            # the statistics of the sensors removed go with them, the ones of the sensors kept are preserved
+            removed = [name for name in self._read_stats if name not in names]
+            for name in removed:
+                del self._read_stats[name]
+            for sensor in sensors:
+                self._read_stats.setdefault(sensor.name, {"latency": Histogram(), "failures": 0, "timeouts": 0})
+        for name in removed:
+            for metric in ("sensor_read_seconds", "sensor_read_failures_total", "sensor_read_timeouts_total"):
+                self._metrics.unregister(metric, sensor=name)
+        if self._executor is not None and len(sensors) > len(self._sensors):
+            # the pool is sized on the number of sensors, a new one is created at the next sampling
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        self._sensors = sensors
+        schedules = {}
+        for task in [task for task in self._tasks if task.name.startswith("sample ")]:
+            self._unschedule(task.name)
+            schedules[task.name] = (task.interval, task.next_due)
+        self._schedule_sampling(schedules)
+
+    def update_events(self, events):
+        """Replace the events to listen for while the process is running
+
+        Only the GPIO channels added, removed or whose source changed are registered or unregistered, the
+        detection of the others keeps running. The method must be called within the sampling loop.
+
+        Args:
+            events ({int: EventSource}): the new sources of the events indexed by GPIO channel
+        """
+        events = self._event_sources(events)
+        changed = {channel for channel, source in self._events.items() if events.get(channel) != source}
+        for event_channel in changed:
+            gpiomanager.GPIO.remove_event_detect(event_channel)
+            logger.info("Stopped listening for events on GPIO #%d", event_channel)
+        added = {channel for channel in events if channel not in self._events or channel in changed}
+        self._events = events
+        self._event_pipeline.set_sources(events)
+        for event_channel in sorted(added):
+            self._listen_for_events(event_channel)
+
+    def update_publishing(self, publish_mode, batch_topic):
+        """Change how the samples are published while the process is running
+
+        Args:
+            publish_mode (str): how the samples are published, one of "per_label", "batch" and "both"
+            batch_topic (str): the subtopic on which the batch documents are published
+        """
+        if publish_mode not in self.PUBLISH_MODES:
+            raise ValueError("Unsupported publish mode {}".format(publish_mode))
+        self._publish_mode = publish_mode
+        self._batch_topic = batch_topic
+
+    def _listen_for_events(self, event_channel):
+        """Start the detection of the events on a GPIO channel, according to its source"""
+        GPIO = gpiomanager.GPIO
+        source = self._events[event_channel]
+        pull = {"up": GPIO.PUD_UP, "down": GPIO.PUD_DOWN, "off": GPIO.PUD_OFF}[source.pull]
+        edge = {"rising": GPIO.RISING, "falling": GPIO.FALLING, "both": GPIO.BOTH}[source.edge]
+        bouncetime = source.bouncetime if source.bouncetime is not None else self._event_bouncetime
+        GPIO.setup(event_channel, GPIO.IN, pull_up_down=pull)
+        self._event_pipeline.start()
+        # all the channels share the same callback, it only queues the edge: the source of the event is looked
+        # up by the pipeline and the bursts longer than the bouncetime are throttled there
+        if bouncetime > 0:
+            GPIO.add_event_detect(event_channel, edge, callback=self._event_pipeline.push, bouncetime=bouncetime)
+        else:
+            # RPi.GPIO refuses a bouncetime of 0
+            GPIO.add_event_detect(event_channel, edge, callback=self._event_pipeline.push)
+        logger.info("Listening for %s events on GPIO #%d", source.event, event_channel)
 
     def _setup(self):
         """ Setting up the process for execution
@@ -95,11 +439,18 @@ class SensorsManager(StoppableLoopProcess):
         self._mqtt_client.start()
         # registering the events to detect
         for event_channel in self._events.keys():
-            GPIO.setup(event_channel, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
-            # we start listening for events on the event_chnnel port, a bouncetime of 10000 means that
-            # after an event is detected a minimum of 10 seconds has to pass before another event could be detected
-            GPIO.add_event_detect(event_channel, GPIO.RISING, callback=self._post_event, bouncetime=10000)
-            logger.info("Listening for events on GPIO #%d", event_channel)
+            self._listen_for_events(event_channel)
+        self._schedule_sampling()
+        if self._history is not None:
+            # downsampling and retention run between the samplings, the first one right away
+            self._schedule("history maintenance", self._history.maintenance_interval, self._history.maintain)
+        if self._config_watcher is not None:
+            self._schedule("config reload", self._config_watcher.interval, self._config_watcher.check,
+                           delay=self._config_watcher.interval)
+        if self._metrics_exporter is not None:
+            self._metrics_exporter.start_server()
+            self._schedule("metrics export", self._metrics_exporter.interval, self._metrics_exporter.publish,
+                           delay=self._metrics_exporter.interval)
         logger.info("Sampling started")
 
     def _teardown(self):
@@ -109,13 +460,31 @@ class SensorsManager(StoppableLoopProcess):
         """
         logger.info("Sampling stopped")
         # perform clean-up befor exiting
+        if self._metrics_exporter is not None:
+            self._metrics_exporter.stop_server()
+            self._metrics_exporter.publish()
         if self._lock.acquire(block=True, timeout=10):
             #unregistering the events' detection
             for event_channel in self._events.keys():
-                GPIO.remove_event_detect(event_channel)
+                gpiomanager.GPIO.remove_event_detect(event_channel)
                 logger.info("Stopped listening for events on GPIO #%d", event_channel)
+            # the edges already queued are published before disconnecting
+            self._event_pipeline.stop()
             #disconnect from the mqtt broker
             self._mqtt_client.stop()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        if self._history is not None:
+            self._history.close()
+        for name, stats in self.read_stats().items():
+            logger.info("%s: %d readings, %d failures (%d timeouts), p95 latency %s s", name,
+                        stats["latency"]["count"], stats["failures"], stats["timeouts"], stats["latency"]["p95"])
+            if stats["sensor"]:
+                logger.info("%s: %s", name, stats["sensor"])
+        if self._events:
+            stats = self._event_pipeline.stats()
+            logger.info("Events: %d edges, %d published, %d throttled, %d dropped, p95 latency %s s", stats["edges"],
+                        stats["published"], stats["throttled"], stats["dropped"], stats["latency"]["p95"])
 
     def _loop(self):
         """ Collects data from sensors and publishes them on the broker"""
@@ -0,0 +1,121 @@
+"""Benchmark of the DHT retry strategies
+
+Reads a simulated DHT22 every 5 seconds for an hour, on a virtual clock, with a fake MyPyDHT driver failing
+with a given probability (and returning a corrupted value now and then), and compares the fixed budget of
+10 attempts with the retry budget of DHTSensor (capped by read_timeout, probing a sensor not answering); a
+failure rate of 100% is a disconnected sensor. For each strategy it reports the attempts (bus accesses),
+the time spent reading, the readings missing the 20 seconds deadline, the failed readings and the corrupted
+values published.
+Run it from the directory containing the package with:
+
+    python -m PiHome.benchmarks.dht_retry
+"""
+import enum
+import logging
+import random
+import sys
+import types
+from ..common.logger import logger
+
+# every attempt keeps the data line busy for about 5 ms, a failed one waits for the driver timeout
+_SUCCESS_LATENCY = 0.005
+_FAILURE_LATENCY = 0.1
+_RETRY_DELAY = 2.0
+_READ_TIMEOUT = 20.0
+
+
+class _VirtualClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class _DHTException(Exception):
+
+    def __init__(self, message):
+        super(_DHTException, self).__init__(message)
+        self.message = message
+
+
+def _fake_driver(clock, failure_rate, corruption_rate, rng):
+    """Build a fake MyPyDHT module whose sensor_read fails with the given probability"""
+    driver = types.ModuleType("MyPyDHT")
+    driver.Sensor = enum.Enum("Sensor", "DHT11 DHT22")
+    driver.DHTException = _DHTException
+    driver.attempts = 0
+
+    def sensor_read(model, pin, reading_attempts=1, use_cache=False):
+        for attempt in range(reading_attempts):
+            if attempt:
+                clock.sleep(_RETRY_DELAY)
+            driver.attempts += 1
+            if rng.random() < failure_rate:
+                clock.sleep(_FAILURE_LATENCY)
+                continue
+            clock.sleep(_SUCCESS_LATENCY)
+            temperature = 21.0 + rng.gauss(0, 0.1)
+            if rng.random() < corruption_rate:
+                temperature += 30.0
+            return 45.0 + rng.gauss(0, 0.5), temperature
+        raise _DHTException("DHT sensor not responding")
+
+    driver.sensor_read = sensor_read
+    return driver
+
+
+def _run(strategy, failure_rate, corruption_rate, duration=3600, interval=5):
+    """Read the simulated sensor for duration seconds and return the statistics of the strategy"""
+    clock = _VirtualClock()
+    driver = _fake_driver(clock, failure_rate, corruption_rate, random.Random(7))
+    sys.modules["MyPyDHT"] = driver
+    from ..sensors import dhtsensor
+    dhtsensor.MyPyDHT = driver
+    sensor = dhtsensor.DHTSensor(["temperature", "humidity"], "AM2302", 17, clock=clock, sleep=clock.sleep)
+    results = {"busy": 0.0, "missed": 0, "failed": 0, "corrupted": 0}
+    next_reading = 0.0
+    while next_reading < duration:
+        clock.now = max(clock.now, next_reading)
+        started = clock.now
+        if strategy == "fixed":
+            try:
+                _, temperature = driver.sensor_read(None, 17, reading_attempts=10)
+                samples = [temperature]
+            except _DHTException:
+                samples = []
+        else:
+            samples = [sample.data for sample in sensor.sample() if sample.label == "temperature"]
+        elapsed = clock.now - started
+        results["busy"] += elapsed
+        if elapsed > _READ_TIMEOUT:
+            results["missed"] += 1
+        if not samples:
+            results["failed"] += 1
+        elif samples[0] > 40:
+            results["corrupted"] += 1
+        next_reading += interval
+    results["attempts"] = driver.attempts
+    return results
+
+
+def run():
+    """Run the benchmark and print the results"""
+    logger.setLevel(logging.CRITICAL)
+    print("720 readings (every 5 seconds for an hour), 1% corrupted values")
+    print("{:<8} {:<9} {:>9} {:>9} {:>7} {:>7} {:>10}".format("failure", "strategy", "attempts", "busy (s)",
+                                                              "missed", "failed", "corrupted"))
+    for failure_rate in (0.1, 0.5, 0.8, 1.0):
+        for strategy in ("fixed", "budget"):
+            results = _run(strategy, failure_rate, 0.01)
+            print("{:<8} {:<9} {:>9} {:>9.1f} {:>7} {:>7} {:>10}".format(
+                "{:.0%}".format(failure_rate), strategy, results["attempts"], results["busy"], results["missed"],
+                results["failed"], results["corrupted"]))
+
+
+if __name__ == "__main__":
+    run()
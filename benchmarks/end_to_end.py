@@ -0,0 +1,161 @@
+"""End to end benchmarks on the simulation backend
+
+Runs the real agents, MQTT client and presence backends on top of the simulation backend (fake GPIO, sensor
+drivers and nmap plus an in-process broker), so it needs neither a Raspberry Pi nor a network and can run in CI
+on plain Linux. It measures:
+    - the publish throughput: sampling cycles of a DHT and a BMP sensor published per second, in every
+      publish mode, till the broker has received all the messages
+    - the event latency: from the GPIO edge to the broker and from the broker to the EventManager action
+    - the presence cycle: the time a NetworkPresenceDetector detection cycle takes with one scan per person
+      and with the batched scans (the 3 seconds pauses between the attempts are scaled down by 100)
+Run it from the directory containing the package with:
+
+    python -m PiHome.benchmarks.end_to_end [cycles] [events] [persons]
+"""
+import logging
+import sys
+import threading
+import time
+from .. import simulation
+from ..common.logger import logger
+
+_PAUSE_SCALE = 0.01
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else float("nan")
+
+
+def _client(broker):
+    from ..common.mqttclient import MQTTClient
+    return MQTTClient(broker.host, broker.port, None, "home")
+
+
+def _sensors():
+    from ..sensors.bmpsensor import BMPSensor
+    from ..sensors.dhtsensor import DHTSensor
+    return [DHTSensor(["temperature", "humidity"], "DHT22", 17, cache_ttl=0), BMPSensor(["pressure", "temperature"])]
+
+
+def publish_throughput(broker, cycles):
+    """Publish sampling cycles in every publish mode
+
+    Returns:
+        {str: (float, float)}. The cycles and the messages per second indexed by publish mode
+    """
+    from ..agents.sensorsmanager import SensorsManager
+    results = {}
+    for publish_mode, messages_per_cycle in (("per_label", 4), ("batch", 1), ("both", 5)):
+        broker.clear()
+        sensors_manager = SensorsManager(_sensors(), {}, _client(broker), publish_mode=publish_mode)
+        sensors_manager._mqtt_client.start()
+        started = time.perf_counter()
+        for _ in range(cycles):
+            sensors_manager._sample()
+        if not broker.wait_for(cycles * messages_per_cycle, timeout=60):
+            logger.error("Only %d messages of %d received", len(broker.messages), cycles * messages_per_cycle)
+        elapsed = time.perf_counter() - started
+        sensors_manager._mqtt_client.stop()
+        results[publish_mode] = (cycles / elapsed, len(broker.messages) / elapsed)
+    return results
+
+
+def event_latency(broker, gpio, events):
+    """Raise GPIO edges one at a time and time their way to the EventManager action
+
+    Returns:
+        ([float], [float]). The edge to broker and the broker to action latencies, in seconds
+    """
+    from ..agents.sensorsmanager import SensorsManager
+    from ..eventmanager import EventManager
+    received = []
+    delivered = threading.Event()
+
+    def motion(message):
+        received.append(time.perf_counter())
+        delivered.set()
+
+    broker.clear()
+    event_manager = EventManager(_client(broker), [("motion", "motion", motion)])
+    event_manager.start_listening()
+    # the edges are raised one at a time, none of them must be throttled
+    sensors_manager = SensorsManager([], {26: "motion"}, _client(broker), event_window=0)
+    sensors_manager._mqtt_client.start()
+    sensors_manager._listen_for_events(26)
+    # let the subscription of the EventManager reach the broker
+    time.sleep(0.2)
+    to_broker = []
+    to_action = []
+    for _ in range(events):
+        delivered.clear()
+        gpio.fire(26)
+        if not delivered.wait(timeout=5):
+            logger.error("Event lost")
+            continue
+        edge = gpio.edges[-1][1]
+        published = broker.messages[-1][0]
+        to_broker.append(published - edge)
+        to_action.append(received[-1] - published)
+    gpio.remove_event_detect(26)
+    sensors_manager._event_pipeline.stop()
+    sensors_manager._mqtt_client.stop()
+    event_manager.stop_listening()
+    return to_broker, to_action
+
+
+def presence_cycle(broker, network, persons):
+    """Time a detection cycle of all the persons, half of them at home
+
+    Returns:
+        {str: (float, int)}. The duration of the cycle, in seconds, and the scans performed indexed by mode
+    """
+    from ..agents.presencedetector import NetworkPresenceDetector
+    known = [("person{}".format(index), "192.168.1.{}".format(10 + index)) for index in range(persons)]
+    for index, (_, ip_addr) in enumerate(known):
+        if index % 2 == 0:
+            # phones sleep, they don't answer every probe
+            network.connect(ip_addr, answer_probability=0.7)
+    results = {}
+    for mode, batch_scan in (("per person", False), ("batch", True)):
+        detector = NetworkPresenceDetector(known, _client(broker), batch_scan=batch_scan)
+        detector._wait = lambda seconds: time.sleep(seconds * _PAUSE_SCALE)
+        detector._mqtt_client.start()
+        scans = network.scans
+        started = time.perf_counter()
+        detector._loop()
+        results[mode] = (time.perf_counter() - started, network.scans - scans)
+        detector._mqtt_client.stop()
+    return results
+
+
+def run(cycles=500, events=200, persons=10):
+    """Run the benchmarks and print the results"""
+    logger.setLevel(logging.WARNING)
+    sim = simulation.install(gpio=simulation.FakeGPIO(honor_bouncetime=False),
+                             network=simulation.FakeNetwork(spawn_latency=0.02, probe_latency=0.002, seed=42))
+    broker = simulation.SimulatedBroker()
+    broker.start()
+    try:
+        print("publish throughput ({} cycles of a DHT and a BMP)".format(cycles))
+        for publish_mode, (cycles_rate, messages_rate) in publish_throughput(broker, cycles).items():
+            print("  {:<10} {:>9.0f} cycles/s {:>9.0f} messages/s".format(publish_mode, cycles_rate, messages_rate))
+
+        to_broker, to_action = event_latency(broker, sim.gpio, events)
+        print("event latency ({} edges)".format(len(to_broker)))
+        for name, latencies in (("edge to broker", to_broker), ("broker to action", to_action),
+                                ("edge to action", [a + b for a, b in zip(to_broker, to_action)])):
+            print("  {:<17} p50 {:>6.2f} ms  p95 {:>6.2f} ms  max {:>6.2f} ms".format(
+                name, _percentile(latencies, 0.5) * 1000, _percentile(latencies, 0.95) * 1000,
+                max(latencies) * 1000))
+
+        print("presence cycle ({} persons, half of them at home)".format(persons))
+        for mode, (duration, scans) in presence_cycle(broker, sim.network, persons).items():
+            print("  {:<10} {:>7.2f} s {:>5} scans".format(mode, duration, scans))
+    finally:
+        broker.stop()
+        simulation.uninstall()
+
+
+if __name__ == "__main__":
+    run(*[int(arg) for arg in sys.argv[1:4]])
@@ -0,0 +1,117 @@
+"""Benchmark of the GPIO event sources at scale
+
+Validates the event dispatch of SensorsManager with many GPIO event sources on the simulation backend:
+    - the dispatch cost per edge of the channel table of EventPipeline (a dictionary) for a growing number of
+      sources, compared with a linear scan of the sources
+    - a run with dozens of simulated pins (PIRs on rising edges, door contacts on falling edges) raising
+      Poisson distributed edges at a high rate, with and without throttling: the edges raised, the events
+      received by the broker, the edges throttled and dropped and the edge to publication latency
+Run it from the directory containing the package with:
+
+    python -m PiHome.benchmarks.event_sources [pins] [edges per second per pin] [seconds]
+"""
+import logging
+import random
+import sys
+import time
+from .. import simulation
+from ..agents.eventpipeline import EventPipeline, EventSource
+from ..common.logger import logger
+
+_FIRST_PIN = 100
+
+
+def _sources(pins):
+    """Build the sources: one in every four is a door contact (pull up, falling edge), the others are PIRs"""
+    sources = {}
+    for index in range(pins):
+        channel = _FIRST_PIN + index
+        if index % 4 == 0:
+            sources[channel] = EventSource(channel, "door{}".format(index), edge="falling", pull="up")
+        else:
+            sources[channel] = EventSource(channel, "motion{}".format(index))
+    return sources
+
+
+def dispatch_cost(pins, edges=50000):
+    """Time the lookup and throttling of edges spread over the channels
+
+    Returns:
+        (float, float). The nanoseconds per edge with the channel table and with a linear scan of the sources
+    """
+    sources = _sources(pins)
+    channels = [random.choice(list(sources)) for _ in range(edges)]
+    pipeline = EventPipeline(lambda source, timestamp: None, sources, window=0.5)
+    now = time.monotonic()
+    started = time.perf_counter()
+    for channel in channels:
+        pipeline._handle(channel, now)
+    table = (time.perf_counter() - started) / edges * 1e9
+    source_list = list(sources.values())
+    started = time.perf_counter()
+    for channel in channels:
+        for source in source_list:
+            if source.channel == channel:
+                break
+    scan = (time.perf_counter() - started) / edges * 1e9
+    return table, scan
+
+
+def simulated_run(gpio, broker, pins, rate, duration, window):
+    """Raise edges on all the pins for a while
+
+    Returns:
+        {str: object}. The edges raised and the events received by the broker plus the statistics of the
+        pipeline (see EventPipeline.stats)
+    """
+    from ..agents.sensorsmanager import SensorsManager
+    from ..common.mqttclient import MQTTClient
+    sources = _sources(pins)
+    sensors_manager = SensorsManager([], sources, MQTTClient(broker.host, broker.port, None, "home"),
+                                     event_window=window, event_bouncetime=0, event_queue_size=10000)
+    sensors_manager._mqtt_client.start()
+    for channel in sources:
+        sensors_manager._listen_for_events(channel)
+    broker.clear()
+    edges = len(gpio.edges)
+    for index, source in enumerate(sources.values()):
+        gpio.start_edges(source.channel, rate, seed=index, level=gpio.LOW if source.edge == "falling" else gpio.HIGH)
+    time.sleep(duration)
+    gpio.stop_edges()
+    raised = len(gpio.edges) - edges
+    for channel in sources:
+        gpio.remove_event_detect(channel)
+    sensors_manager._event_pipeline.stop()
+    stats = sensors_manager._event_pipeline.stats()
+    broker.wait_for(stats["published"], timeout=30)
+    sensors_manager._mqtt_client.stop()
+    return dict(stats, raised=raised, received=len(broker.messages))
+
+
+def run(pins=64, rate=100, duration=3):
+    """Run the benchmark and print the results"""
+    logger.setLevel(logging.WARNING)
+    print("dispatch cost per edge")
+    for sources in (8, 64, 512, 4096):
+        table, scan = dispatch_cost(sources)
+        print("  {:>5} sources  table {:>7.0f} ns  linear scan {:>9.0f} ns".format(sources, table, scan))
+
+    sim = simulation.install(gpio=simulation.FakeGPIO(honor_bouncetime=False))
+    broker = simulation.SimulatedBroker()
+    broker.start()
+    try:
+        print("{} pins, {} edges/s per pin for {} s".format(pins, rate, duration))
+        for window in (0, 0.05):
+            stats = simulated_run(sim.gpio, broker, pins, rate, duration, window)
+            latency = stats["latency"]
+            print("  window {:>4} s  raised {:>6}  received {:>6}  throttled {:>6}  dropped {:>4}  latency "
+                  "p50 {:>6.2f} ms  p95 {:>6.2f} ms  max {:>7.2f} ms".format(
+                      window, stats["raised"], stats["received"], stats["throttled"], stats["dropped"],
+                      (latency["p50"] or 0) * 1000, (latency["p95"] or 0) * 1000, (latency["max"] or 0) * 1000))
+    finally:
+        broker.stop()
+        simulation.uninstall()
+
+
+if __name__ == "__main__":
+    run(*[float(arg) if index else int(arg) for index, arg in enumerate(sys.argv[1:4])])
@@ -0,0 +1,74 @@
+"""Benchmark of the history store
+
+Appends a million points (a label sampled every 5 seconds for about two months) to a HistoryStore in a
+temporary directory, runs the maintenance to fill the rollups and then times some range scans: the raw
+points of an hour and of a day, a day at 5 minutes resolution and the whole history at one hour resolution
+(answered from the rollups).
+Run it from the directory containing the package with:
+
+    python -m PiHome.benchmarks.history_store
+"""
+import logging
+import os
+import shutil
+import tempfile
+import time
+from ..common.historystore import HistoryStore
+from ..common.logger import logger
+
+_POINTS = 1000000
+_INTERVAL = 5.0
+_START = 1500000000.0
+
+
+def _size_on_disk(path):
+    """Return the bytes actually allocated by the files of a directory tree"""
+    total = 0
+    for directory, _, files in os.walk(path):
+        for name in files:
+            total += os.stat(os.path.join(directory, name)).st_blocks * 512
+    return total
+
+
+def _timed(function, *args, **kwargs):
+    started = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - started, result
+
+
+def run():
+    """Run the benchmark and print the results"""
+    logger.setLevel(logging.WARNING)
+    path = tempfile.mkdtemp(prefix="history")
+    now = [_START]
+    end = _START + _POINTS * _INTERVAL
+    # the retention keeps all the raw points, the scans compare raw and rollup reads of the same data
+    store = HistoryStore(path, retention=end - _START + 86400 * 2, clock=lambda: now[0])
+    try:
+        started = time.perf_counter()
+        for index in range(_POINTS):
+            store.append("temperature", _START + index * _INTERVAL, 20.0 + (index % 1000) / 100.0)
+        elapsed = time.perf_counter() - started
+        print("append {} points: {:.2f} s ({:,.0f} points/s)".format(_POINTS, elapsed, _POINTS / elapsed))
+        print("size on disk: {:.1f} MB".format(_size_on_disk(path) / 1e6))
+
+        now[0] = end
+        elapsed, result = _timed(store.maintain)
+        print("maintenance (downsampling): {:.2f} s, {} rollup rows".format(elapsed, result["downsampled"]))
+
+        middle = _START + _POINTS * _INTERVAL / 2
+        scans = [("raw, 1 hour", dict(start=middle, end=middle + 3600)),
+                 ("raw, 1 day", dict(start=middle, end=middle + 86400)),
+                 ("1 day at 300 s, mean", dict(start=middle, end=middle + 86400, resolution=300)),
+                 ("all at 3600 s, max", dict(start=_START, end=end, resolution=3600, aggregate="max")),
+                 ("all at 60 s, mean (raw)", dict(start=_START, end=end, resolution=60))]
+        for name, query in scans:
+            elapsed, result = _timed(store.query, "temperature", **query)
+            print("{:<26} {:>8} rows {:>9.1f} ms".format(name, len(result), elapsed * 1000))
+    finally:
+        store.close()
+        shutil.rmtree(path)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,108 @@
+"""Benchmark of the logging overhead per published message
+
+Publishes a burst of messages through MQTTClient, on the in-process broker of the simulation backend, with
+the logging of PiHomeLogger configured in turn:
+    - disabled: the logger level is WARNING, the per message lines are not even built
+    - synchronous: a StreamHandler formats and writes every record on the publishing thread
+    - asynchronous: the records are queued and written by the listener thread (see common.logpipeline)
+    - asynchronous + rate limit: as above, each logging call is also limited to 20 records per second
+The records are written to os.devnull so that the terminal speed doesn't matter. For every configuration it
+reports the time spent on the publishing thread per message, the overhead compared with the disabled logging
+and the time the listener took to write the records left in the queue.
+Run it from the directory containing the package with:
+
+    python -m PiHome.benchmarks.logging_overhead [messages]
+"""
+import logging
+import os
+import sys
+import time
+from .. import simulation
+from ..common import logpipeline
+from ..common.logger import logger
+
+
+def _publish(broker, messages):
+    """Publish a burst of messages
+
+    Returns:
+        float. The seconds spent on the publishing thread per message
+    """
+    from ..common.mqttclient import MQTTClient
+    client = MQTTClient(broker.host, broker.port, None, "home")
+    client.start()
+    payload = '{"data": 22.5, "unit": "C"}'
+    started = time.perf_counter()
+    for _ in range(messages):
+        client.publish("temperature", payload)
+    elapsed = time.perf_counter() - started
+    broker.wait_for(messages, timeout=60)
+    client.stop()
+    return elapsed / messages
+
+
+def measure(broker, messages, level, asynchronous, rate):
+    """Publish a burst of messages with a logging configuration
+
+    Returns:
+        (float, float). The seconds spent on the publishing thread per message and the seconds the listener
+        took, after the burst, to write the records left
+    """
+    handlers, filters, previous_level = list(logger.handlers), list(logger.filters), logger.level
+    for handler in handlers:
+        logger.removeHandler(handler)
+    for log_filter in filters:
+        logger.removeFilter(log_filter)
+    stream = open(os.devnull, "w")
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    if rate:
+        logger.addFilter(logpipeline.RateLimitFilter(rate))
+    async_logging = logpipeline.AsyncLogging(logger, queue_size=messages * 2) if asynchronous else None
+    broker.clear()
+    try:
+        per_message = _publish(broker, messages)
+        started = time.perf_counter()
+        if async_logging is not None:
+            async_logging.stop()
+        drain = time.perf_counter() - started
+    finally:
+        for current in list(logger.handlers):
+            logger.removeHandler(current)
+        for log_filter in list(logger.filters):
+            logger.removeFilter(log_filter)
+        for previous in handlers:
+            logger.addHandler(previous)
+        for log_filter in filters:
+            logger.addFilter(log_filter)
+        logger.setLevel(previous_level)
+        stream.close()
+    return per_message, drain
+
+
+def run(messages=5000):
+    """Run the benchmark and print the results"""
+    simulation.install()
+    broker = simulation.SimulatedBroker()
+    broker.start()
+    try:
+        results = []
+        for name, level, asynchronous, rate in (("disabled", logging.WARNING, False, 0),
+                                                ("synchronous", logging.DEBUG, False, 0),
+                                                ("asynchronous", logging.DEBUG, True, 0),
+                                                ("asynchronous + rate limit", logging.DEBUG, True, 20)):
+            results.append((name,) + measure(broker, messages, level, asynchronous, rate))
+        baseline = results[0][1]
+        print("logging overhead per published message ({} messages)".format(messages))
+        for name, per_message, drain in results:
+            print("  {:<26} {:>7.1f} us/message  overhead {:>6.1f} us  queue drained in {:>6.1f} ms".format(
+                name, per_message * 1e6, (per_message - baseline) * 1e6, drain * 1000))
+    finally:
+        broker.stop()
+        simulation.uninstall()
+
+
+if __name__ == "__main__":
+    run(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,49 @@
+"""Micro-benchmark of the overhead of the metrics
+
+Times the operations performed by the instrumented code (incrementing a counter, observing a latency, running
+a scheduled task) with the metrics disabled and enabled, against the same code without any metric.
+Run it from the directory containing the package with:
+
+    python -m PiHome.benchmarks.metrics_overhead [iterations]
+"""
+import sys
+import timeit
+from ..common import metrics
+from ..common.stoppableprocess import ScheduledTask
+
+
+def measure(registry, iterations):
+    """Time the metric operations on a registry
+
+    Returns:
+        {str: float}. The nanoseconds per operation indexed by operation
+    """
+    counter = registry.counter("benchmark_total", "Benchmark counter")
+    histogram = registry.histogram("benchmark_seconds", "Benchmark histogram")
+    previous = metrics._registry
+    metrics._registry = registry
+    try:
+        task = ScheduledTask("benchmark", lambda: None, 1.0, 0.0, agent="benchmark")
+    finally:
+        metrics._registry = previous
+    results = {}
+    for name, statement in (("counter.inc", lambda: counter.inc()),
+                            ("histogram.observe", lambda: histogram.observe(0.042)),
+                            ("task run", lambda: (task.record_start(task.next_due), task.execute()))):
+        results[name] = min(timeit.repeat(statement, number=iterations, repeat=3)) / iterations * 1e9
+    return results
+
+
+def run(iterations=200000):
+    """Run the benchmark and print the results"""
+    baseline = min(timeit.repeat(lambda: None, number=iterations, repeat=3)) / iterations * 1e9
+    print("empty call {:>8.0f} ns".format(baseline))
+    disabled = measure(metrics.NullRegistry(), iterations)
+    enabled = measure(metrics.MetricsRegistry(), iterations)
+    print("{:<18} {:>10} {:>10}".format("operation", "disabled", "enabled"))
+    for name in disabled:
+        print("{:<18} {:>7.0f} ns {:>7.0f} ns".format(name, disabled[name], enabled[name]))
+
+
+if __name__ == "__main__":
+    run(*[int(arg) for arg in sys.argv[1:2]])
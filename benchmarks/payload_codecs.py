@@ -0,0 +1,87 @@
+"""Benchmark of the payload codecs
+
+For the documents published by the agents (a sample, an aggregated sample, a batch document, an event and a
+presence status) it reports, for every codec, the size of the payload and the encode and decode throughput.
+It then runs a day of one minute sampling cycles of three sensors in the per_label and batch publish modes
+and reports the bytes on the wire (the MQTT packets of QoS 2 included) with every codec.
+The documents not supported by the struct codec (events and presence) are marked with a dash.
+Run it from the directory containing the package with:
+
+    python -m PiHome.benchmarks.payload_codecs [iterations]
+"""
+import logging
+import sys
+import timeit
+from ..agents.sensorsmanager import SensorsManager
+from ..common import payloads
+from ..common.logger import logger
+from .sample_publishing import FakeSensor, RecordingMQTTClient
+
+_LABELS = [("temperature", "C"), ("humidity", "%"), ("pressure", "mbar")]
+_STATS = {"count": 10, "min": 22.1, "max": 22.8, "stddev": 0.213, "last": 22.6}
+_DOCUMENTS = [
+    ("sample", "home/temperature", {"data": 22.51, "unit": "C"}),
+    ("aggregated sample", "home/temperature", dict({"data": 22.43, "unit": "C"}, **_STATS)),
+    ("batch", "home/samples", {"seq": 1042, "ts": 1500000000.123,
+                               "samples": [["temperature", 22.51, "C"], ["humidity", 48.3, "%"],
+                                           ["pressure", 1013.25, "mbar"]]}),
+    ("event", "home/motion", {"ts": 1500000000.123}),
+    ("presence", "home/presence", {"name": "Stefano", "status": "present"}),
+]
+
+
+def _codecs():
+    return [payloads.get_codec(name, _LABELS) for name in ("json", "struct", "cbor")]
+
+
+def measure(codec, topic, document, iterations):
+    """Time the encoding and the decoding of a document
+
+    Returns:
+        (int, float, float). The size of the payload in bytes and the encodings and decodings per second,
+        None if the codec doesn't support the document
+    """
+    try:
+        payload = codec.encode(topic, document)
+    except ValueError:
+        return None
+    encoded = payload.encode() if isinstance(payload, str) else payload
+    encode = min(timeit.repeat(lambda: codec.encode(topic, document), number=iterations, repeat=3))
+    decode = min(timeit.repeat(lambda: codec.decode(topic, encoded), number=iterations, repeat=3))
+    return len(encoded), iterations / encode, iterations / decode
+
+
+def daily_traffic(codec, publish_mode, cycles=24 * 60):
+    """Return the bytes on the wire of a day of sampling cycles published with a codec"""
+    sensors = [FakeSensor([("temperature", 22.51, "C"), ("humidity", 48.3, "%")]),
+               FakeSensor([("pressure", 1013.25, "mbar")])]
+    client = RecordingMQTTClient(codecs=payloads.CodecTable(default=codec))
+    manager = SensorsManager(sensors, {}, client, publish_mode=publish_mode)
+    for _ in range(cycles):
+        manager._sample()
+    return client.bytes
+
+
+def run(iterations=20000):
+    """Run the benchmark and print the results"""
+    logger.setLevel(logging.WARNING)
+    codecs = _codecs()
+    print("{:<18} {:<7} {:>6} {:>14} {:>14}".format("document", "codec", "bytes", "encodings/s", "decodings/s"))
+    for name, topic, document in _DOCUMENTS:
+        for codec in codecs:
+            result = measure(codec, topic, document, iterations)
+            if result is None:
+                print("{:<18} {:<7} {:>6} {:>14} {:>14}".format(name, codec.name, "-", "-", "-"))
+                continue
+            size, encodings, decodings = result
+            print("{:<18} {:<7} {:>6} {:>14,.0f} {:>14,.0f}".format(name, codec.name, size, encodings, decodings))
+    print()
+    print("a day of one minute cycles of 3 samples, bytes on the wire (QoS 2)")
+    print("{:<10} {}".format("mode", "".join("{:>10}".format(codec.name) for codec in codecs)))
+    for publish_mode in ("per_label", "batch"):
+        print("{:<10} {}".format(publish_mode, "".join("{:>10}".format(daily_traffic(codec, publish_mode))
+                                                       for codec in codecs)))
+
+
+if __name__ == "__main__":
+    run(*[int(arg) for arg in sys.argv[1:2]])
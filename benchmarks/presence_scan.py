@@ -0,0 +1,138 @@
+"""Benchmark of a NetworkPresenceDetector detection cycle
+
+Compares the per-person detection path with the batched one using a fake nmap stand-in that runs on
+a virtual clock: every spawned process costs a fixed startup time plus a per-host probe time and
+present devices answer a probe only with a certain probability (like sleeping phones do).
+Run it from the directory containing the package with:
+
+    python -m PiHome.benchmarks.presence_scan [persons_count]
+"""
+import logging
+import random
+import sys
+from ..agents import presencebackends
+from ..agents.presencedetector import NetworkPresenceDetector
+
+_NMAP_REPORT = """<?xml version="1.0"?>
+<nmaprun scanner="nmap" args="nmap -sn" start="0" version="7.80" xmloutputversion="1.04">
+{hosts}
+<runstats><finished time="0" elapsed="0"/><hosts up="{up}" down="{down}" total="{total}"/></runstats>
+</nmaprun>"""
+
+_NMAP_HOST = """<host><status state="{state}" reason="arp-response"/><address addr="{ip}" addrtype="ipv4"/></host>"""
+
+
+class VirtualClock(object):
+    """A clock advanced by the fake nmap processes and by the detector waits"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.spawns = 0
+
+    def wait(self, time_interval):
+        self.now += time_interval
+
+
+class FakeNetwork(object):
+    """The devices of the fake network
+
+    Attributes:
+        clock (VirtualClock): the clock to advance
+        present ({str: float}): the IPs of the devices connected to the network mapped to the probability
+                                that they answer to a probe
+        spawn_cost (float): the time, in seconds, spent starting a nmap process
+        probe_cost (float): the time, in seconds, spent probing each host
+    """
+
+    def __init__(self, clock, present, spawn_cost=1.0, probe_cost=0.25, seed=42):
+        self.clock = clock
+        self.present = present
+        self.spawn_cost = spawn_cost
+        self.probe_cost = probe_cost
+        self.random = random.Random(seed)
+
+    def process_class(self):
+        """Return a class implementing the subset of libnmap.process.NmapProcess used by the detector"""
+        network = self
+
+        class FakeNmapProcess(object):
+
+            def __init__(self, targets, options):
+                self.targets = [targets] if isinstance(targets, str) else list(targets)
+                self.stdout = ""
+                self.stderr = ""
+
+            def run(self):
+                network.clock.spawns += 1
+                network.clock.now += network.spawn_cost + network.probe_cost * len(self.targets)
+                hosts = []
+                for ip_addr in self.targets:
+                    answers = network.random.random() < network.present.get(ip_addr, 0.0)
+                    hosts.append(_NMAP_HOST.format(state="up" if answers else "down", ip=ip_addr))
+                up = sum(1 for host in hosts if 'state="up"' in host)
+                self.stdout = _NMAP_REPORT.format(hosts="\n".join(hosts), up=up, down=len(hosts) - up,
+                                                  total=len(hosts))
+                return 0
+
+        return FakeNmapProcess
+
+
+class _NullMQTTClient(object):
+
+    def publish(self, topic, payload):
+        pass
+
+
+def _neighbour_table(ip_addrs, present):
+    """Build a neighbour table fixture
+
+    Every IP received in input has an entry, like the devices that have been home at least once: the present
+    ones are REACHABLE, the departed ones are STALE (the kernel doesn't garbage collect them)
+    """
+    return {ip_addr: ("02:00:00:00:00:{:02x}".format(index), "REACHABLE" if ip_addr in present else "STALE")
+            for index, ip_addr in enumerate(ip_addrs)}
+
+
+def _run_cycle(persons, network, batch_scan, backend=None):
+    """Run a detection cycle and return the (virtual) time spent and the processes spawned"""
+    network.clock.now = 0.0
+    network.clock.spawns = 0
+    detector = NetworkPresenceDetector(persons, _NullMQTTClient(), batch_scan=batch_scan, backend=backend)
+    detector._wait = network.clock.wait
+    detector._loop()
+    return network.clock.now, network.clock.spawns
+
+
+def _run_scenario(persons, present):
+    """Run a detection cycle with every strategy and print the results"""
+    clock = VirtualClock()
+    network = FakeNetwork(clock, present)
+    presencebackends.NmapProcess = network.process_class()
+    # the devices at home are confirmed by the neighbour table, the stale entries of the absent ones must be probed
+    table = _neighbour_table([ip_addr for _, ip_addr in persons], present)
+    arp_backend = presencebackends.ArpTableBackend(fallback=presencebackends.NmapBackend(), read_table=lambda: table)
+
+    print("persons: {}, present: {}".format(len(persons), len(present)))
+    for label, batch_scan, backend in (("per-person", False, None), ("batched", True, None),
+                                       ("batched+arp", True, arp_backend)):
+        cycle_time, spawns = _run_cycle(persons, network, batch_scan, backend)
+        print("  {:<11} cycle time: {:7.1f} s   nmap processes: {:4d}".format(label, cycle_time, spawns))
+
+
+def run(persons_count=8):
+    """Run the benchmark and print the results
+
+    Two scenarios are measured: half of the persons at home and everybody at home; the devices at
+    home answer to 60% of the nmap probes
+
+    Args:
+        persons_count (int): the number of known persons
+    """
+    logging.getLogger("PiHomeLogger").setLevel(logging.WARNING)
+    persons = [("person{}".format(index), "192.168.1.{}".format(100 + index)) for index in range(persons_count)]
+    _run_scenario(persons, {ip_addr: 0.6 for index, (_, ip_addr) in enumerate(persons) if index % 2 == 0})
+    _run_scenario(persons, {ip_addr: 0.6 for _, ip_addr in persons})
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 8)
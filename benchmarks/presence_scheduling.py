@@ -0,0 +1,137 @@
+"""Benchmark of the presence detection scheduling
+
+Simulates a day of a household on a virtual clock and compares the fixed schedule (everybody checked
+every 10 minutes with up to 7 attempts) with the adaptive scheduler, reporting the probes spent per hour,
+the delay in detecting arrivals and departures and the number of false absences reported.
+Run it from the directory containing the package with:
+
+    python -m PiHome.benchmarks.presence_scheduling [persons_count]
+"""
+import logging
+import random
+import sys
+from ..agents.presencebackends import PresenceBackend
+from ..agents.presencedetector import NetworkPresenceDetector
+from ..agents.presencescheduler import AdaptiveScheduler
+
+_HOUR = 3600.0
+_DAY = 24 * _HOUR
+
+
+class VirtualClock(object):
+    """A clock advanced by the simulated scans and by the detector waits"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def wait(self, time_interval):
+        self.now += time_interval
+
+
+class SimulatedHousehold(PresenceBackend):
+    """A presence backend simulating the devices of a household
+
+    Every person leaves home in the morning and comes back in the evening; while at home its phone
+    answers only to a fraction of the probes.
+
+    Attributes:
+        clock (VirtualClock): the clock to advance
+        away ({str: (float, float)}): the time each IP leaves and comes back home
+        answer_rate (float): the probability that a device at home answers to a probe
+        probes (int): the number of hosts probed so far
+    """
+
+    def __init__(self, clock, away, answer_rate=0.6, seed=7):
+        self.clock = clock
+        self.away = away
+        self.answer_rate = answer_rate
+        self.probes = 0
+        self._random = random.Random(seed)
+
+    def is_home(self, ip_addr, at_time):
+        leaves, comes_back = self.away[ip_addr]
+        return not leaves <= at_time % _DAY < comes_back
+
+    def get_online_ips(self, ip_addrs):
+        ip_addrs = list(ip_addrs)
+        self.probes += len(ip_addrs)
+        self.clock.now += 1.0 + 0.25 * len(ip_addrs)
+        return {ip_addr for ip_addr in ip_addrs
+                if self.is_home(ip_addr, self.clock.now) and self._random.random() < self.answer_rate}
+
+    def discover(self, subnet):
+        return {}
+
+
+class _RecordingMQTTClient(object):
+
+    def __init__(self):
+        self.reports = []
+
+    def publish(self, topic, payload):
+        self.reports.append(payload)
+
+
+def _simulate(persons, adaptive):
+    """Run a simulated day and return the probes per hour, the mean detection delays and the false absences"""
+    clock = VirtualClock()
+    away = {ip_addr: (8 * _HOUR + index * 1800, 17 * _HOUR + index * 2500)
+            for index, (_, ip_addr) in enumerate(persons)}
+    household = SimulatedHousehold(clock, away)
+    scheduler = None
+    # the fixed schedule checks everybody every 10 minutes
+    tick = 600
+    if adaptive:
+        scheduler = AdaptiveScheduler([name for name, _ in persons], clock=clock)
+        tick = scheduler.min_interval
+    detector = NetworkPresenceDetector(persons, _RecordingMQTTClient(), backend=household, scheduler=scheduler)
+    detector._wait = clock.wait
+
+    reported = {name: False for name, _ in persons}
+    arrival_delays, departure_delays = [], []
+    false_absences = 0
+    arrived = set()
+    addresses = dict(persons)
+    while clock.now < _DAY:
+        detector._loop()
+        for name, ip_addr in persons:
+            is_home = household.is_home(ip_addr, clock.now)
+            status = detector._persons_status[name]
+            if status != reported[name]:
+                reported[name] = status
+                leaves, comes_back = away[addresses[name]]
+                if status != is_home:
+                    false_absences += 1
+                elif status and clock.now >= comes_back and name not in arrived:
+                    arrived.add(name)
+                    arrival_delays.append(clock.now - comes_back)
+                elif not status:
+                    departure_delays.append(clock.now - leaves)
+        clock.wait(tick)
+
+    mean = lambda values: sum(values) / len(values) if values else float("nan")
+    return household.probes / 24.0, mean(arrival_delays), mean(departure_delays), false_absences
+
+
+def run(persons_count=4):
+    """Run the benchmark and print the results
+
+    Args:
+        persons_count (int): the number of persons in the household
+    """
+    logging.getLogger("PiHomeLogger").setLevel(logging.WARNING)
+    persons = [("person{}".format(index), "192.168.1.{}".format(100 + index)) for index in range(persons_count)]
+    print("persons: {}, simulated time: 24 h".format(persons_count))
+    print("{:<9} {:>12} {:>16} {:>18} {:>15}".format("schedule", "probes/hour", "arrival delay s",
+                                                       "departure delay s", "false absences"))
+    for label, adaptive in (("fixed", False), ("adaptive", True)):
+        probes, arrival, departure, false_absences = _simulate(persons, adaptive)
+        print("{:<9} {:>12.1f} {:>16.0f} {:>18.0f} {:>15d}".format(label, probes, arrival, departure,
+                                                                   false_absences))
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 4)
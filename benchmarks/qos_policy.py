@@ -0,0 +1,103 @@
+"""Benchmark of the QoS policy and of the deduplication of the QoS 1 copies
+
+Publishes a burst of samples and events through MQTTClient, on the in-process broker of the simulation backend
+duplicating a fraction of the QoS 1 deliveries (as if their acknowledgement had been lost), to an EventManager
+counting the messages its action gets, the copies are discarded by the queue of the action. The policies compared
+are:
+    - QoS 2: every message is sent with QoS 2, as before the QoS policy
+    - per topic: samples with QoS 0 and events with QoS 1 and a sequence number, the copies are discarded
+    - per topic, no dedup: as above but the receiver doesn't discard the copies
+For every policy it reports the time to publish the burst till its last acknowledgement, the acknowledgement
+latency of every topic class, the events the action got and the copies discarded.
+Run it from the directory containing the package with:
+
+    python -m PiHome.benchmarks.qos_policy [samples] [events] [redelivery rate]
+"""
+import logging
+import sys
+import time
+from .. import simulation
+from ..common.delivery import QoSPolicy
+from ..common.logger import logger
+
+
+def _wait(condition, timeout=30):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def measure(broker, policy, dedup_size, samples, events):
+    """Publish a burst of samples and events with a QoS policy
+
+    Args:
+        dedup_size (int): the number of messages the action remembers to discard the copies, 0 disables it
+
+    Returns:
+        (float, {str: object}, int). The seconds till the last acknowledgement, the delivery statistics of the
+        publisher (see MQTTClient.delivery_stats) and the events received by the action
+    """
+    from ..common.actiondispatcher import ActionDispatcher
+    from ..common.mqttclient import MQTTClient
+    from ..eventmanager import EventManager
+    received = {"events": 0}
+
+    def count_events(message):
+        received["events"] += 1
+
+    publisher = MQTTClient(broker.host, broker.port, None, "home", qos_policy=policy)
+    receiver = MQTTClient(broker.host, broker.port, None, "home")
+    event_manager = EventManager(receiver, [("motion", "count_events", count_events)],
+                                 ActionDispatcher(dedup_size=dedup_size))
+    duplicates = lambda: event_manager.stats()["count_events"]["duplicates"]
+    event_manager.start_listening()
+    publisher.start()
+    _wait(lambda: publisher._online.is_set() and receiver._online.is_set())
+    time.sleep(0.2)
+    broker.clear()
+    started = time.perf_counter()
+    for index in range(max(samples, events)):
+        if index < samples:
+            publisher.publish("temperature", {"data": 22.5, "unit": "C"})
+        if index < events:
+            publisher.publish_event("motion", {"ts": round(time.time(), 3)})
+    _wait(lambda: all(stats["in_flight"] == 0 for stats in publisher._deliveries.stats().values()) and
+          sum(stats["acknowledged"] for stats in publisher._deliveries.stats().values()) >= samples + events)
+    elapsed = time.perf_counter() - started
+    _wait(lambda: received["events"] + duplicates() >= events, timeout=5)
+    time.sleep(0.2)
+    stats = publisher.delivery_stats()
+    stats["duplicates"] = duplicates()
+    event_manager.stop_listening()
+    publisher.stop()
+    return elapsed, stats, received["events"]
+
+
+def run(samples=2000, events=500, redelivery_rate=0.1):
+    """Run the benchmark and print the results"""
+    logger.setLevel(logging.WARNING)
+    simulation.install()
+    broker = simulation.SimulatedBroker(redelivery_rate=redelivery_rate, seed=42)
+    broker.start()
+    try:
+        print("{} samples and {} events, {:.0%} of the QoS 1 deliveries duplicated".format(samples, events,
+                                                                                           redelivery_rate))
+        for name, policy, dedup_size in (
+                ("QoS 2", QoSPolicy(), 1024),
+                ("per topic", QoSPolicy(messages_qos=0, events_qos=1, sequence_numbers=True), 1024),
+                ("per topic, no dedup", QoSPolicy(messages_qos=0, events_qos=1, sequence_numbers=True), 0)):
+            elapsed, stats, received = measure(broker, policy, dedup_size, samples, events)
+            print("{:<20} burst acknowledged in {:>7.1f} ms, events received {:>5}, copies discarded {:>4}".format(
+                name, elapsed * 1000, received, stats["duplicates"]))
+            for topic_class, class_stats in sorted(stats["classes"].items()):
+                latency = class_stats["latency"]
+                print("  {:<10} acknowledged {:>5}  latency p50 {:>6.2f} ms  p95 {:>6.2f} ms  max {:>6.2f} ms".format(
+                    topic_class, class_stats["acknowledged"], latency["p50"] * 1000, latency["p95"] * 1000,
+                    latency["max"] * 1000))
+    finally:
+        broker.stop()
+        simulation.uninstall()
+
+
+if __name__ == "__main__":
+    run(*[float(arg) if index == 2 else int(arg) for index, arg in enumerate(sys.argv[1:4])])
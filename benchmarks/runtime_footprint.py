@@ -0,0 +1,151 @@
+"""Benchmark of the footprint of the process per agent layout versus the single process runtime
+
+Starts the three agents (a SensorsManager with a fake sensor, a NetworkPresenceDetector with a fake backend and an
+EventManager) either as they are started today, two processes plus the EventManager in the main process, each
+one with its own MQTT client, or within an AgentRuntime sharing a single client. Every layout runs in a fresh
+interpreter and reports the startup time (from the launch of the interpreter till all the agents are connected),
+the broker connections opened and the memory used by all its processes: the sum of their RSS and of their PSS
+(which splits the pages shared by the forked processes among them, so it is the fair measure of the first layout).
+A broker must be listening, by default on localhost:1883. Run it from the directory containing the package with:
+
+    python -m PiHome.benchmarks.runtime_footprint [host] [port]
+"""
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from ..common.logger import logger
+
+
+def _broker_connections(port):
+    """Return the number of established TCP connections towards the broker port"""
+    connections = 0
+    for table in ("/proc/net/tcp", "/proc/net/tcp6"):
+        try:
+            with open(table) as tcp_table:
+                next(tcp_table)
+                for line in tcp_table:
+                    fields = line.split()
+                    # the remote address is in the form ADDRESS:PORT (hexadecimal), 01 is ESTABLISHED
+                    if int(fields[2].rsplit(":", 1)[1], 16) == port and fields[3] == "01":
+                        connections += 1
+        except FileNotFoundError:
+            pass
+    return connections
+
+
+def _memory(pids):
+    """Return the sum of the RSS and of the PSS, in kB, of the processes"""
+    rss = pss = 0
+    for pid in pids:
+        with open("/proc/{}/smaps_rollup".format(pid)) as rollup:
+            for line in rollup:
+                if line.startswith("Rss:"):
+                    rss += int(line.split()[1])
+                elif line.startswith("Pss:"):
+                    pss += int(line.split()[1])
+    return rss, pss
+
+
+def _build_agents(client_factory):
+    """Build the three agents, client_factory is called to get the client of each one"""
+    from ..agents.presencebackends import PresenceBackend
+    from ..agents.presencedetector import NetworkPresenceDetector
+    from ..agents.sensorsmanager import SensorsManager
+    from ..eventmanager import EventManager
+    from .sample_publishing import FakeSensor
+
+    class EveryoneHome(PresenceBackend):
+        def get_online_ips(self, ips):
+            return set(ips)
+
+        def discover(self, subnet):
+            return {}
+
+    sensors_manager = SensorsManager([FakeSensor([("temperature", 22.5, "C")])], {}, client_factory(), 60)
+    presence_detector = NetworkPresenceDetector([("alice", "192.168.1.10")], client_factory(), batch_scan=True,
+                                                backend=EveryoneHome())
+    event_manager = EventManager(client_factory(), [("motion", "ignore", lambda message: None)])
+    return sensors_manager, presence_detector, event_manager
+
+
+def _wait_connections(port, expected, baseline, timeout=30):
+    """Wait for the connections opened towards the broker to reach the expected number, return their number
+
+    Args:
+        port (int): the port of the broker
+        expected (int): the number of connections to wait for
+        baseline (int): the number of connections open before starting the agents
+        timeout (float): the maximum amount of time, in seconds, to wait
+    """
+    deadline = time.monotonic() + timeout
+    while _broker_connections(port) - baseline < expected and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return _broker_connections(port) - baseline
+
+
+def _run_layout(layout, host, port, launched):
+    """Start the agents with a layout, print the measures as json and stop them"""
+    from ..common.mqttclient import MQTTClient
+    baseline = _broker_connections(port)
+    if layout == "processes":
+        sensors_manager, presence_detector, event_manager = _build_agents(lambda: MQTTClient(host, port, None, "home"))
+        sensors_manager.start()
+        presence_detector.start()
+        event_manager.start_listening()
+        connections = _wait_connections(port, 3, baseline)
+        startup = time.time() - launched
+        time.sleep(1)
+        pids = [os.getpid()] + [child.pid for child in multiprocessing.active_children()]
+        rss, pss = _memory(pids)
+        print("RESULT", json.dumps({"startup": startup, "connections": connections, "processes": len(pids),
+                          "rss": rss, "pss": pss}), flush=True)
+        event_manager.stop_listening()
+        for agent in (sensors_manager, presence_detector):
+            os.kill(agent.pid, signal.SIGTERM)
+            agent.join()
+    else:
+        from ..runtime import AgentRuntime
+        client = MQTTClient(host, port, None, "home")
+        sensors_manager, presence_detector, event_manager = _build_agents(lambda: client)
+        runtime = AgentRuntime(client, [sensors_manager, presence_detector], [event_manager])
+
+        def measure():
+            connections = _wait_connections(port, 1, baseline)
+            startup = time.time() - launched
+            time.sleep(1)
+            rss, pss = _memory([os.getpid()])
+            print("RESULT", json.dumps({"startup": startup, "connections": connections, "processes": 1,
+                              "rss": rss, "pss": pss}), flush=True)
+            runtime.stop()
+
+        threading.Thread(target=measure, daemon=True).start()
+        runtime.run()
+
+
+def run(host="localhost", port=1883):
+    """Run the benchmark and print the results"""
+    print("{:<10} {:>11} {:>12} {:>10} {:>10} {:>10}".format("layout", "startup (s)", "connections",
+                                                              "processes", "RSS (MB)", "PSS (MB)"))
+    for layout in ("processes", "runtime"):
+        launched = time.time()
+        output = subprocess.run([sys.executable, "-m", __package__ + ".runtime_footprint", "--layout", layout, host, str(port), str(launched)],
+                                stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+        # the agents log on the standard output as well
+        result = json.loads([line for line in output.splitlines() if line.startswith("RESULT ")][-1][7:])
+        print("{:<10} {:>11.2f} {:>12} {:>10} {:>10.1f} {:>10.1f}".format(
+            layout, result["startup"], result["connections"], result["processes"], result["rss"] / 1024,
+            result["pss"] / 1024))
+
+
+if __name__ == "__main__":
+    logger.setLevel(logging.WARNING)
+    if len(sys.argv) > 1 and sys.argv[1] == "--layout":
+        _run_layout(sys.argv[2], sys.argv[3], int(sys.argv[4]), float(sys.argv[5]))
+    else:
+        run(*(sys.argv[1:2] + [int(port) for port in sys.argv[2:3]]))
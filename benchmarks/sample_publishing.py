@@ -0,0 +1,103 @@
+"""Benchmark of the broker traffic generated by a sampling cycle
+
+Runs a sampling cycle of SensorsManager in every publish mode with a recording MQTT client and reports,
+per cycle, the messages published, the MQTT packets exchanged with the broker (a QoS 2 publish costs the
+PUBLISH, PUBREC, PUBREL and PUBCOMP packets) and the bytes on the wire.
+It then simulates a day of one minute cycles of slowly drifting readings and compares the traffic with and
+without the deadband stage.
+Run it from the directory containing the package with:
+
+    python -m PiHome.benchmarks.sample_publishing
+"""
+import logging
+import math
+import random
+from ..agents.deadband import DeadbandFilter
+from ..agents.sensorsmanager import SensorsManager
+from ..common.payloads import CodecTable
+from ..sensors.sensor import Sensor, Sample
+
+# the packets exchanged to deliver a message for each QoS level
+_PACKETS_PER_QOS = {0: 1, 1: 2, 2: 4}
+_ACK_SIZE = 4
+
+
+def _publish_packet_size(topic, payload, qos):
+    """Return the size, in bytes, of a PUBLISH packet"""
+    payload_length = len(payload.encode() if isinstance(payload, str) else payload)
+    remaining_length = 2 + len(topic.encode()) + (2 if qos else 0) + payload_length
+    length_bytes = 1
+    while remaining_length >= 128 ** length_bytes:
+        length_bytes += 1
+    return 1 + length_bytes + remaining_length
+
+
+class RecordingMQTTClient(object):
+    """A stand-in for MQTTClient counting the traffic each publish would generate"""
+
+    def __init__(self, base_topic="home", qos=2, codecs=None):
+        self.base_topic = base_topic
+        self.qos = qos
+        self.codecs = codecs if codecs is not None else CodecTable()
+        self.messages = 0
+        self.packets = 0
+        self.bytes = 0
+
+    def publish(self, topic, payload):
+        complete_topic = "{}/{}".format(self.base_topic, topic)
+        if not isinstance(payload, (str, bytes)):
+            payload = self.codecs.encode(complete_topic, payload)
+        self.messages += 1
+        self.packets += _PACKETS_PER_QOS[self.qos]
+        self.bytes += _publish_packet_size(complete_topic, payload, self.qos)
+        self.bytes += _ACK_SIZE * (_PACKETS_PER_QOS[self.qos] - 1)
+
+
+class FakeSensor(Sensor):
+
+    def __init__(self, samples):
+        self._samples = samples
+
+    def _fetch_data(self, samples):
+        samples.extend(Sample(label, data, unit) for label, data, unit in self._samples)
+
+
+def run():
+    """Run the benchmark and print the results"""
+    logging.getLogger("PiHomeLogger").setLevel(logging.WARNING)
+    sensors = [FakeSensor([("temperature", 22.51, "C"), ("humidity", 48.3, "%")]),
+               FakeSensor([("pressure", 1013.25, "mbar")])]
+    print("samples per cycle: 3")
+    print("{:<10} {:>9} {:>8} {:>6}".format("mode", "messages", "packets", "bytes"))
+    for publish_mode in SensorsManager.PUBLISH_MODES:
+        client = RecordingMQTTClient()
+        manager = SensorsManager(sensors, {}, client, publish_mode=publish_mode)
+        manager._sample()
+        print("{:<10} {:>9} {:>8} {:>6}".format(publish_mode, client.messages, client.packets, client.bytes))
+
+    cycles = 24 * 60
+    print()
+    print("{} cycles of drifting readings, 15 minutes heartbeat".format(cycles))
+    print("{:<10} {:>9} {:>8} {:>8}".format("deadband", "messages", "packets", "bytes"))
+    deadbands = {"temperature": (0.2, 0), "humidity": (0, 1.0), "pressure": (0.5, 0)}
+    for deadband in (None, deadbands):
+        clock = [0.0]
+        rng = random.Random(42)
+        sensor = FakeSensor([])
+        client = RecordingMQTTClient()
+        manager = SensorsManager([sensor], {}, client,
+                                 deadband=DeadbandFilter(deadband, 900, clock=lambda: clock[0]) if deadband else None)
+        for cycle in range(cycles):
+            clock[0] = cycle * 60.0
+            hour = cycle / 60.0
+            sensor._samples = [
+                ("temperature", round(21 + 3 * math.sin(hour / 24 * 2 * math.pi) + rng.gauss(0, 0.05), 1), "C"),
+                ("humidity", round(50 + 5 * math.cos(hour / 24 * 2 * math.pi) + rng.gauss(0, 0.2), 1), "%"),
+                ("pressure", round(1013 + rng.gauss(0, 0.2), 2), "mbar")]
+            manager._sample()
+        print("{:<10} {:>9} {:>8} {:>8}".format("on" if deadband else "off",
+                                                client.messages, client.packets, client.bytes))
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,87 @@
+"""Report of the startup time of every agent
+
+Builds each agent through the loader in a fresh interpreter started with -X importtime and reports the total
+time spent importing modules, the time spent building the agent (imports included) and the modules with the
+highest import time of their own. The agents whose hardware or third party modules are missing on this machine
+are reported as unavailable. Run it from the directory containing the package with:
+
+    python -m PiHome.benchmarks.startup_time [number of top imports]
+"""
+import subprocess
+import sys
+
+_AGENTS = ("sensors_manager", "presence_detector", "event_manager", "runtime")
+
+_BUILD = """
+import time
+started = time.perf_counter()
+try:
+    from {package} import loader
+    agent = loader.get_{agent}()
+except ImportError as error:
+    print("UNAVAILABLE", error.name, flush=True)
+else:
+    print("BUILD", time.perf_counter() - started, flush=True)
+"""
+
+
+def _imported_modules(script):
+    """Run a script in a fresh interpreter with -X importtime
+
+    Returns:
+        (str, {str: int}). The standard output of the script and the import time of their own, in
+        microseconds, of the imported modules indexed by name
+    """
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-c", script], stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, universal_newlines=True)
+    modules = {}
+    for line in completed.stderr.splitlines():
+        if line.startswith("import time:") and "self [us]" not in line:
+            self_time, _, name = line[len("import time:"):].split("|")
+            modules[name.strip()] = int(self_time)
+    return completed.stdout, modules
+
+
+def measure(agent):
+    """Build an agent in a fresh interpreter
+
+    The modules imported by the bare interpreter (site and its dependencies) are not taken into account.
+
+    Args:
+        agent (str): the name of the agent, as in the loader.get_<name> functions
+
+    Returns:
+        dict. The keys are "unavailable" (why the agent could not be built, None if it was), "build" (the seconds
+        taken to build the agent), "imports" (the total import time in seconds) and "modules" (the
+        (self time in microseconds, module name) of the imported modules)
+    """
+    _, baseline = _imported_modules("pass")
+    package = __package__.rsplit(".", 1)[0]
+    output, modules = _imported_modules(_BUILD.format(package=package, agent=agent))
+    modules = [(self_time, name) for name, self_time in modules.items() if name not in baseline]
+    result = {"unavailable": "unknown error", "build": None, "imports": sum(module[0] for module in modules) / 1e6,
+              "modules": modules}
+    for line in output.splitlines():
+        if line.startswith("BUILD "):
+            result["build"] = float(line.split()[1])
+            result["unavailable"] = None
+        elif line.startswith("UNAVAILABLE "):
+            result["unavailable"] = "missing " + line.split(None, 1)[1]
+    return result
+
+
+def run(top=5):
+    """Run the report and print the results"""
+    for agent in _AGENTS:
+        result = measure(agent)
+        if result["unavailable"] is not None:
+            print("{:<18} unavailable ({})".format(agent, result["unavailable"]))
+            continue
+        print("{:<18} build {:>7.1f} ms   imports {:>7.1f} ms   modules {:>4}".format(
+            agent, result["build"] * 1000, result["imports"] * 1000, len(result["modules"])))
+        for self_time, name in sorted(result["modules"], reverse=True)[:top]:
+            print("{:<18}   {:>7.1f} ms  {}".format("", self_time / 1000, name))
+
+
+if __name__ == "__main__":
+    run(*[int(top) for top in sys.argv[1:2]])
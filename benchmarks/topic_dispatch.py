@@ -0,0 +1,78 @@
+"""Micro-benchmark of the MQTT topic dispatch
+
+Compares the segment level TopicTrie used by MQTTClient.on_messagge against the previous
+dispatch strategy (a linear scan of a dictionary of compiled regexes).
+Run it from the directory containing the package with:
+
+    python -m PiHome.benchmarks.topic_dispatch [filters_count]
+"""
+import re
+import sys
+import timeit
+from ..common.topictrie import TopicTrie
+
+
+def _topic_to_regex(topic):
+    """The topic to regex conversion previously used by MQTTClient"""
+    regex_topic = topic.replace('/', '\\/').replace('#', '(.*)').replace('+', '(.*)')
+    return re.compile(regex_topic)
+
+
+def _build_filters(count):
+    """Build a realistic set of subscription filters for a gateway node
+
+    Args:
+        count (int): the number of filters to build
+
+    Returns:
+        [str]. The list of topic filters
+    """
+    filters = []
+    for index in range(count):
+        room = "room{}".format(index % 25)
+        kind = index % 4
+        if kind == 0:
+            filters.append("home/{}/sensor{}/temperature".format(room, index))
+        elif kind == 1:
+            filters.append("home/{}/sensor{}/+".format(room, index))
+        elif kind == 2:
+            filters.append("home/{}/device{}/#".format(room, index))
+        else:
+            filters.append("home/{}/+/event{}".format(room, index))
+    return filters
+
+
+def run(filters_count=500, lookups=20000):
+    """Run the benchmark and print the results
+
+    Args:
+        filters_count (int): the number of registered filters
+        lookups (int): the number of topics dispatched per measurement
+    """
+    filters = _build_filters(filters_count)
+    topics = ["home/room{}/sensor{}/temperature".format(index % 25, index) for index in range(lookups)]
+
+    regexes = {_topic_to_regex(topic_filter): topic_filter for topic_filter in filters}
+    trie = TopicTrie()
+    for topic_filter in filters:
+        trie.add(topic_filter, topic_filter)
+
+    def regex_scan():
+        for topic in topics:
+            for regex in regexes:
+                regex.match(topic)
+
+    def trie_lookup():
+        for topic in topics:
+            trie.match(topic)
+
+    regex_time = min(timeit.repeat(regex_scan, number=1, repeat=3))
+    trie_time = min(timeit.repeat(trie_lookup, number=1, repeat=3))
+    print("filters registered: {}, topics dispatched: {}".format(filters_count, lookups))
+    print("regex scan:  {:8.2f} us/message".format(regex_time / lookups * 1e6))
+    print("topic trie:  {:8.2f} us/message".format(trie_time / lookups * 1e6))
+    print("speed-up:    {:8.1f}x".format(regex_time / trie_time))
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
@@ -0,0 +1,427 @@
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from . import metrics
+from .delivery import Deduplicator
+from .logger import logger
+
+
+class DispatchedMessage(object):
+    """A snapshot of a received MQTT message
+
+    The paho message object is bound to the network loop thread and it cannot be pickled, therefore
+    the dispatcher hands to the actions a lightweight copy exposing the same attributes used by them.
+    Besides the raw payload the actions get the document it encodes, decoded by the worker with the codec of
+    the topic (see ActionQueue), so they don't depend on how the publisher encoded it.
+
+    Attributes:
+        topic (str): the topic on which the message was received
+        payload (bytes): the payload of the message
+        qos (int): the quality of service level of the message
+        retain (bool): True if the message was a retained one
+        received_at (float): the monotonic time at which the message was received
+        document (object): the payload decoded with the codec of the topic, None for an empty payload; when
+                           the payload cannot be decoded (or there are no codecs) it is the payload itself
+    """
+    __slots__ = ("topic", "payload", "qos", "retain", "received_at", "document")
+
+    def __init__(self, topic, payload, qos=0, retain=False, received_at=None, document=None):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.received_at = time.monotonic() if received_at is None else received_at
+        self.document = document
+
+    @classmethod
+    def from_message(cls, message):
+        """Build a DispatchedMessage out of a paho message
+
+        Args:
+            message (paho.mqtt.client.MQTTMessage): the received message
+
+        Returns:
+            DispatchedMessage
+        """
+        return cls(message.topic, message.payload, getattr(message, "qos", 0), getattr(message, "retain", False))
+
+    def __getstate__(self):
+        return (self.topic, self.payload, self.qos, self.retain, self.received_at, self.document)
+
+    def __setstate__(self, state):
+        self.topic, self.payload, self.qos, self.retain, self.received_at, self.document = state
+
+
+class ActionPolicy(object):
+    """The execution policy of an action
+
+    Attributes:
+        executor (str): "thread" to run the action in a pool of threads, "process" to run it in a pool of processes
+        workers (int): the number of workers serving the action
+        queue_size (int): the maximum number of messages waiting to be processed by the action
+        overflow_policy (str): what to do when the queue is full, "drop_oldest" discards the oldest queued message
+                               whereas "drop_newest" discards the message just received
+    """
+    EXECUTORS = ("thread", "process")
+    OVERFLOW_POLICIES = ("drop_oldest", "drop_newest")
+
+    def __init__(self, executor="thread", workers=1, queue_size=100, overflow_policy="drop_oldest"):
+        """Initialize an ActionPolicy
+
+        Raises:
+            ValueError: if any of the parameters has an unsupported value
+        """
+        if executor not in self.EXECUTORS:
+            raise ValueError("Unsupported executor {}".format(executor))
+        if overflow_policy not in self.OVERFLOW_POLICIES:
+            raise ValueError("Unsupported overflow policy {}".format(overflow_policy))
+        if workers < 1 or queue_size < 1:
+            raise ValueError("workers and queue_size must be positive")
+        self.executor = executor
+        self.workers = workers
+        self.queue_size = queue_size
+        self.overflow_policy = overflow_policy
+
+
+class ActionQueue(object):
+    """A bounded queue of messages served by a pool of workers running an action
+
+    An instance of this class is callable and it is meant to be registered as callback of the MQTTClient:
+    calling it never blocks, the message is enqueued (or dropped according to the overflow policy) and
+    one of the worker threads will run the action. When the executor is "process" the worker threads
+    forward the execution to a pool of processes. The worker threads decode the payloads before running the
+    action, this way the decoding costs neither the network loop nor the processes of the pool. Once decoded
+    the copies of the messages received with QoS 1 already (see Deduplicator) are discarded.
+
+    Attributes:
+        name (str): the name of the action
+        _action (callable): the action to run for every message
+        _policy (ActionPolicy): the execution policy of the action
+        _codecs (CodecTable): the codecs decoding the payloads, if None the document of the messages is their
+                              payload
+        _queue (queue.Queue): the bounded queue of pending messages
+        _workers ([threading.Thread]): the threads consuming the queue
+        _executor (ProcessPoolExecutor): the pool of processes used when the executor is "process"
+        _deduplicator (Deduplicator): the messages received with QoS 1 already, if None no copy is discarded
+        _dedup_lock (threading.Lock): the lock serializing the access of the workers to the deduplicator
+        _abandoned (threading.Event): set when stop gave up waiting for the workers, they terminate as soon as
+                                      their action returns
+        _stats_lock (threading.Lock): the lock protecting the counters
+        _counters ({str: float}): the counters of the action (see stats)
+        _metrics ({str: object}): the metrics of the action (messages received, dropped, processed, failed and
+                                  duplicated, latency) labelled with its name
+    """
+    _STOP = object()
+
+    def __init__(self, name, action, policy, codecs=None, deduplicator=None):
+        """Initialize an ActionQueue
+
+        Args:
+            name (str): the name of the action
+            action (callable): the action to run for every message, it receives a DispatchedMessage
+            policy (ActionPolicy): the execution policy of the action
+            codecs (CodecTable, optional): the codecs decoding the payloads of the messages
+            deduplicator (Deduplicator, optional): the LRU discarding the copies of the messages received with
+                                                   QoS 1, they are recognised by the sequence number (seq) of
+                                                   their document
+        """
+        self.name = name
+        self._action = action
+        self._policy = policy
+        self._codecs = codecs
+        self._queue = queue.Queue(maxsize=policy.queue_size)
+        self._workers = []
+        self._executor = None
+        self._deduplicator = deduplicator
+        self._dedup_lock = threading.Lock()
+        self._abandoned = threading.Event()
+        self._stats_lock = threading.Lock()
+        self._counters = {"received": 0, "dropped": 0, "processed": 0, "failed": 0, "duplicates": 0,
+                          "max_depth": 0,
+                          "latency_total": 0.0, "latency_max": 0.0, "wait_total": 0.0, "wait_max": 0.0}
+        registry = metrics.get_registry()
+        self._metrics = {
+            "received": registry.counter("action_messages_received_total", "Messages received", action=name),
+            "dropped": registry.counter("action_messages_dropped_total", "Messages dropped, queue full",
+                                        action=name),
+            "processed": registry.counter("action_messages_processed_total", "Messages processed", action=name),
+            "failed": registry.counter("action_messages_failed_total", "Messages the action failed on",
+                                       action=name),
+            "duplicates": registry.counter("action_messages_duplicate_total", "Copies of messages already "
+                                           "received, discarded", action=name),
+            "latency": registry.histogram("action_latency_seconds", "Time from the reception of a message to the "
+                                          "end of its action", action=name),
+        }
+
+    def __call__(self, message):
+        """Enqueue a message without ever blocking the caller
+
+        Args:
+            message (paho.mqtt.client.MQTTMessage): the message to process
+        """
+        if not isinstance(message, DispatchedMessage):
+            message = DispatchedMessage.from_message(message)
+        dropped = 0
+        while True:
+            try:
+                self._queue.put_nowait(message)
+                break
+            except queue.Full:
+                if self._policy.overflow_policy == "drop_newest":
+                    dropped += 1
+                    break
+                try:
+                    self._queue.get_nowait()
+                    dropped += 1
+                except queue.Empty:
+                    pass
+        with self._stats_lock:
+            self._counters["received"] += 1
+            self._counters["dropped"] += dropped
+            self._counters["max_depth"] = max(self._counters["max_depth"], self._queue.qsize())
+            total_dropped = self._counters["dropped"]
+        self._metrics["received"].inc()
+        if dropped:
+            self._metrics["dropped"].inc(dropped)
+        # during a burst logging every drop would slow down the network loop, one line every 1000 is enough
+        if dropped and total_dropped % 1000 == 1:
+            logger.warning("Action %s queue full, %d messages dropped so far", self.name, total_dropped)
+
+    def start(self):
+        """Start the workers serving the action"""
+        if self._workers:
+            return
+        self._abandoned.clear()
+        # the gauge reads this queue, it is registered while the queue is served only
+        metrics.get_registry().gauge("action_queue_depth", "Messages waiting for the action",
+                                     action=self.name).set_function(self._queue.qsize)
+        if self._policy.executor == "process":
+            self._executor = ProcessPoolExecutor(max_workers=self._policy.workers)
+        for index in range(self._policy.workers):
+            worker = threading.Thread(target=self._work, name="action-{}-{}".format(self.name, index), daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self, timeout=5):
+        """Stop the workers
+
+        The messages already queued are processed before the workers terminate. The stop never takes longer
+        than timeout: if the action is stuck with its queue full the workers are abandoned, they terminate
+        as soon as the action returns without processing the messages left in the queue.
+
+        Args:
+            timeout (int): the maximum amount of time, in seconds, to wait for the workers to terminate
+        """
+        deadline = time.monotonic() + timeout
+        for _ in self._workers:
+            try:
+                self._queue.put(self._STOP, timeout=max(deadline - time.monotonic(), 0))
+            except queue.Full:
+                self._abandoned.set()
+                break
+        for worker in self._workers:
+            worker.join(max(deadline - time.monotonic(), 0))
+        if self._abandoned.is_set() or any(worker.is_alive() for worker in self._workers):
+            logger.warning("Action %s did not stop within %s seconds, its workers are abandoned", self.name,
+                           timeout)
+            self._abandoned.set()
+        self._workers = []
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        metrics.get_registry().unregister("action_queue_depth", action=self.name)
+
+    def _decode(self, message):
+        """Decode the payload of a message into its document"""
+        if self._codecs is None:
+            message.document = message.payload
+            return
+        try:
+            message.document = self._codecs.decode(message.topic, message.payload)
+        except ValueError as error:
+            # other clients may publish on the topics of the actions, their payloads are handed over as they are
+            message.document = message.payload
+            logger.debug("Payload on topic %s not decoded: %s", message.topic, error)
+
+    def _is_duplicate(self, message):
+        """Check whether a decoded message is a copy of one already received
+
+        Only the messages received with QoS 1 can be copies, they are identified by their topic and the sequence
+        number of their document: the messages whose document has no sequence number are never copies
+        """
+        if self._deduplicator is None or message.qos != 1:
+            return False
+        if not isinstance(message.document, dict) or message.document.get("seq") is None:
+            return False
+        with self._dedup_lock:
+            return self._deduplicator.is_duplicate(message.topic, message.document["seq"])
+
+    def _run_action(self, message):
+        """Run the action on the configured executor
+
+        Args:
+            message (DispatchedMessage): the message to process
+
+        Returns:
+            bool. False if the message was a copy of one already received and the action was not run
+        """
+        if message.document is None:
+            self._decode(message)
+        if self._is_duplicate(message):
+            logger.debug("Copy of a message already received on topic %s discarded", message.topic)
+            return False
+        if self._executor is not None:
+            self._executor.submit(self._action, message).result()
+        else:
+            self._action(message)
+        return True
+
+    def _work(self):
+        """The body of the worker threads"""
+        while True:
+            message = self._queue.get()
+            if message is self._STOP or self._abandoned.is_set():
+                return
+            started = time.monotonic()
+            outcome = "processed"
+            try:
+                if not self._run_action(message):
+                    outcome = "duplicates"
+            except Exception as error:
+                outcome = "failed"
+                logger.exception("Action %s failed on topic %s: %s", self.name, message.topic, error)
+            if outcome == "duplicates":
+                # the copies never reach the action, they don't count in its latency
+                with self._stats_lock:
+                    self._counters["duplicates"] += 1
+                self._metrics["duplicates"].inc()
+                continue
+            finished = time.monotonic()
+            wait = started - message.received_at
+            latency = finished - message.received_at
+            with self._stats_lock:
+                self._counters[outcome] += 1
+                self._counters["wait_total"] += wait
+                self._counters["wait_max"] = max(self._counters["wait_max"], wait)
+                self._counters["latency_total"] += latency
+                self._counters["latency_max"] = max(self._counters["latency_max"], latency)
+            self._metrics[outcome].inc()
+            self._metrics["latency"].observe(latency)
+
+    def stats(self):
+        """Return the counters of the action
+
+        Returns:
+            {str: float}. A dictionary with the keys: received, dropped, processed, failed, duplicates (the copies
+            of messages already received discarded), queue_depth, max_depth, wait_avg, wait_max, latency_avg and
+            latency_max (times are in seconds; wait is the time spent in the queue, latency the time between
+            reception and the end of the action)
+        """
+        with self._stats_lock:
+            counters = dict(self._counters)
+        completed = counters["processed"] + counters["failed"]
+        return {"received": counters["received"],
+                "dropped": counters["dropped"],
+                "processed": counters["processed"],
+                "failed": counters["failed"],
+                "duplicates": counters["duplicates"],
+                "queue_depth": self._queue.qsize(),
+                "max_depth": counters["max_depth"],
+                "wait_avg": counters["wait_total"] / completed if completed else 0.0,
+                "wait_max": counters["wait_max"],
+                "latency_avg": counters["latency_total"] / completed if completed else 0.0,
+                "latency_max": counters["latency_max"]}
+
+
+class ActionDispatcher(object):
+    """The dispatch stage between the MQTTClient and the actions
+
+    The dispatcher owns an ActionQueue for every action so that the actions never run on the network loop
+    thread of the MQTT client: a slow action only fills its own queue without delaying keepalives or the
+    delivery of other messages.
+
+    Attributes:
+        _policies ({str: ActionPolicy}): the execution policies indexed by action name
+        _default_policy (ActionPolicy): the policy used for the actions without a specific one
+        _queues ({str: ActionQueue}): the queues of the actions currently served
+        _dedup_size (int): the number of messages every queue remembers to discard the QoS 1 copies, 0 disables
+                           the deduplication
+        codecs (CodecTable): the codecs decoding the payloads of the messages, if None the actions get the
+                             payloads as they are
+    """
+
+    def __init__(self, policies=None, default_policy=None, codecs=None, dedup_size=0):
+        """Initialize the ActionDispatcher
+
+        Args:
+            policies ({str: ActionPolicy}, optional): the execution policies indexed by action name
+            default_policy (ActionPolicy, optional): the policy of the actions without a specific one
+            codecs (CodecTable, optional): the codecs decoding the payloads of the messages, usually the ones
+                                           of the MQTTClient the actions are registered on
+            dedup_size (int, optional): the number of messages every queue remembers to discard the copies of
+                                        the messages received with QoS 1, 0 disables the deduplication
+        """
+        self._policies = policies or {}
+        self._default_policy = default_policy or ActionPolicy()
+        self._queues = {}
+        self._dedup_size = dedup_size
+        self.codecs = codecs
+
+    def queue_for(self, name, action):
+        """Return the (started) queue serving an action
+
+        The queues and the policies are indexed by the configured name of the action, not by the name of its
+        function: two plugins may well both define a function called handle.
+
+        Args:
+            name (str): the name of the action
+            action (callable): the action
+
+        Returns:
+            ActionQueue. The callable to register on the MQTTClient in place of the action
+        """
+        action_queue = self._queues.get(name)
+        if action_queue is None:
+            # every action gets a copy of the messages of its topics, each queue discards its own copies
+            deduplicator = Deduplicator(self._dedup_size) if self._dedup_size > 0 else None
+            action_queue = ActionQueue(name, action, self._policies.get(name, self._default_policy), self.codecs,
+                                       deduplicator)
+            action_queue.start()
+            self._queues[name] = action_queue
+        return action_queue
+
+    def get(self, name):
+        """Return the queue serving an action, without creating it
+
+        Args:
+            name (str): the name of the action
+
+        Returns:
+            ActionQueue. The queue of the action, None if the action is not dispatched
+        """
+        return self._queues.get(name)
+
+    def remove(self, name):
+        """Stop and forget the queue of an action no longer dispatched
+
+        Args:
+            name (str): the name of the action
+        """
+        action_queue = self._queues.pop(name, None)
+        if action_queue is not None:
+            action_queue.stop()
+
+    def stop(self):
+        """Stop all the queues"""
+        for action_queue in self._queues.values():
+            action_queue.stop()
+        self._queues = {}
+
+    def stats(self):
+        """Return the counters of every action
+
+        Returns:
+            {str: {str: float}}. The counters (see ActionQueue.stats) indexed by action name
+        """
+        return {name: action_queue.stats() for name, action_queue in self._queues.items()}
@@ -1,5 +1,292 @@
-import configparser
+"""Access to the configuration of PiHome
+
+The configuration is read from pihome.ini and exposed, lazily, through two module attributes:
+    - settings: the configuration parsed into a typed, validated Settings object (see _SCHEMA)
+    - config: the raw configparser.ConfigParser, kept for the code reading strings directly
+Nothing is read at import time; the parsed Settings are cached next to the ini file (see load_cached) so
+the following runs skip the parsing as long as the file doesn't change.
+"""
 import os
+import pickle
+
+INI_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pihome.ini")
+# to increase whenever the schema or the cached objects change, it invalidates the caches of the previous runs
+_CACHE_VERSION = 11
+_REQUIRED = object()
+_BOOLEANS = {"1": True, "yes": True, "true": True, "on": True, "0": False, "no": False, "false": False, "off": False}
+
+
+def _boolean(value):
+    try:
+        return _BOOLEANS[value.lower()]
+    except KeyError:
+        raise ValueError("{} is not a boolean".format(value))
+
+
+def _list(value):
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+_ACTION_POLICY = {"executor": (str, "thread", ("thread", "process")),
+                  "workers": (int, 1),
+                  "queue_size": (int, 100),
+                  "overflow_policy": (str, "drop_oldest", ("drop_oldest", "drop_newest"))}
+
+# for every section the parameters with their (type, default[, allowed values]); the sections whose name ends with
+# ':*' match any section with that prefix. Sections missing from the file get the default values
+_SCHEMA = {
+    "gpio": {"mode": (str, "BCM", ("BCM", "BOARD", "PHY"))},
+    "sensors": {"sensors_list": (_list, []),
+                "event_generators": (_list, []),
+                "sampling_interval": (float, 60.0),
+                "publish_mode": (str, "per_label", ("per_label", "batch", "both")),
+                "batch_topic": (str, "samples"),
+                "event_window": (float, 10.0),
+                "event_bouncetime": (int, 200),
+                "event_queue_size": (int, 1000)},
+    "pir": {"gpio_pin": (int, _REQUIRED)},
+    # the parameters missing from an event:<name> section (but the pin) get the defaults of [sensors]
+    "event:*": {"gpio_pin": (int, _REQUIRED),
+                "event": (str, None),
+                "edge": (str, "rising", ("rising", "falling", "both")),
+                "pull": (str, "down", ("up", "down", "off")),
+                "bouncetime": (int, None),
+                "window": (float, None)},
+    "dht": {"model": (str, "DHT22"),
+            "active_sensors": (_list, ["temperature", "humidity"]),
+            "gpio_pin": (int, _REQUIRED),
+            "read_timeout": (float, None),
+            "sampling_interval": (float, None),
+            "max_attempts": (int, 10),
+            "retry_delay": (float, 2.0),
+            "cache_ttl": (float, 2.0),
+            "max_temperature_jump": (float, 5.0),
+            "max_humidity_jump": (float, 20.0)},
+    "bmp": {"active_sensors": (_list, ["pressure", "temperature"]),
+            "read_timeout": (float, None),
+            "sampling_interval": (float, None)},
+    "aggregation": {"window": (float, 0.0),
+                    "max_samples": (int, 120)},
+    "deadband": {"deadbands": (str, ""),
+                 "heartbeat": (float, 15.0)},
+    "runtime": {"agents": (_list, ["sensors_manager", "presence_detector", "event_manager"])},
+    "reload": {"interval": (float, 0.0)},
+    "metrics": {"enabled": (_boolean, False),
+                "interval": (float, 60.0),
+                "prometheus_port": (int, 0)},
+    "mqtt": {"host": (str, _REQUIRED),
+             "port": (int, 1883),
+             "user": (str, ""),
+             "password": (str, ""),
+             "base_topic": (str, ""),
+             "max_queued_messages": (int, 0),
+             "outbox": (_boolean, False),
+             "outbox_max_messages": (int, 10000),
+             "outbox_max_age": (int, 86400)},
+    "qos": {"topics": (_list, []),
+            "messages": (int, 2, (0, 1, 2)),
+            "events": (int, 2, (0, 1, 2)),
+            "sequence_numbers": (_boolean, False),
+            "dedup_size": (int, 0)},
+    "payloads": {"codecs": (_list, []),
+                 "default": (str, "json", ("json", "struct", "cbor")),
+                 "struct_labels": (_list, ["temperature:C", "humidity:%", "pressure:mbar"])},
+    "storage": {"data_dir": (str, "/var/lib/pihome")},
+    "history": {"enabled": (_boolean, False),
+                "partition_hours": (float, 24.0),
+                "segment_capacity": (int, 4096),
+                "retention_days": (float, 7.0),
+                "rollups": (_list, ["300:90", "3600:730"]),
+                "maintenance_interval": (float, 600.0)},
+    "network_presence_detector": {"identity": (str, "ip", ("ip", "mac")),
+                                  "known_ips": (_list, []),
+                                  "known_macs": (_list, []),
+                                  "subnet": (str, None),
+                                  "index_file": (str, "presence_index.json"),
+                                  "scheduling": (str, "fixed", ("fixed", "adaptive")),
+                                  "min_interval": (int, 30),
+                                  "max_interval": (int, 600),
+                                  "absent_max_interval": (int, 120),
+                                  "misses_before_absent": (int, 5),
+                                  "absent_after": (int, 300),
+                                  "batch_scan": (_boolean, False),
+                                  "backend": (str, "nmap", ("nmap", "arp"))},
+    "actions": dict(_ACTION_POLICY, topics_and_actions=(_list, [])),
+    # the parameters missing from an action:<name> section are None, they are taken from [actions]
+    "action:*": {key: (converter, None, *choices) for key, (converter, _, *choices) in _ACTION_POLICY.items()},
+}
+
+
+class Section(object):
+    """The typed parameters of a configuration section, exposed as attributes
+
+    Attributes:
+        _name (str): the name of the section
+    """
+
+    def __init__(self, name, values):
+        self._name = name
+        self.__dict__.update(values)
+
+    def __repr__(self):
+        return "Section({!r}, {!r})".format(self._name, self.values())
+
+    def get(self, key, default=None):
+        """Return a parameter of the section, default if the section doesn't have it"""
+        return self.__dict__.get(key, default) if not key.startswith("_") else default
+
+    def values(self):
+        """Return the parameters of the section as a dictionary"""
+        return {key: value for key, value in self.__dict__.items() if not key.startswith("_")}
+
+
+class Settings(object):
+    """The whole configuration, every section is an attribute (a Section)
+
+    Attributes:
+        _sections ({str: Section}): the sections indexed by name
+    """
+
+    def __init__(self, sections):
+        self._sections = sections
+
+    def __getattr__(self, name):
+        # the private attributes are never sections (pickle looks them up before _sections is set)
+        if name.startswith("_"):
+            raise AttributeError(name)
+        try:
+            return self._sections[name]
+        except KeyError:
+            raise AttributeError("No section [{}] in the configuration".format(name))
+
+    def __eq__(self, other):
+        return isinstance(other, Settings) and self.as_dict() == other.as_dict()
+
+    def has_section(self, name):
+        """Check if a section is defined (either in the file or by the schema)"""
+        return name in self._sections
+
+    def section(self, name):
+        """Return a section by name, None if it doesn't exist"""
+        return self._sections.get(name)
+
+    def sections(self):
+        """Return the names of all the sections"""
+        return list(self._sections)
+
+    def as_dict(self):
+        """Return the configuration as a dictionary of dictionaries"""
+        return {name: section.values() for name, section in self._sections.items()}
+
+
+def _section_schema(name):
+    schema = _SCHEMA.get(name)
+    if schema is None and ":" in name:
+        schema = _SCHEMA.get(name.split(":", 1)[0] + ":*")
+    return schema
+
+
+def parse_settings(path):
+    """Parse an ini file into a Settings object
+
+    Every parameter is converted to the type declared in the schema and checked against its allowed values;
+    the parameters missing from the file get their default value. The sections unknown to the schema are kept
+    with string values.
+
+    Args:
+        path (str): the path of the ini file
+
+    Returns:
+        Settings. The parsed configuration
+
+    Raises:
+        ValueError: if a parameter is unknown, has an invalid value or a required one is missing
+    """
+    import configparser
+    parser = configparser.ConfigParser()
+    if not parser.read(path):
+        raise ValueError("Configuration file {} not found".format(path))
+    sections = {}
+    for name in parser.sections():
+        schema = _section_schema(name)
+        if schema is None:
+            sections[name] = Section(name, dict(parser[name]))
+            continue
+        values = {}
+        for key, raw_value in parser[name].items():
+            if key not in schema:
+                raise ValueError("Unknown parameter {} in section [{}]".format(key, name))
+            converter, _, *choices = schema[key]
+            try:
+                value = converter(raw_value)
+            except ValueError as error:
+                raise ValueError("Invalid value for {} in section [{}]: {}".format(key, name, error))
+            if choices and value not in choices[0]:
+                raise ValueError("Invalid value {} for {} in section [{}], allowed values are: {}".format(
+                    value, key, name, ", ".join(str(choice) for choice in choices[0])))
+            values[key] = value
+        for key, (_, default, *_) in schema.items():
+            if key not in values:
+                if default is _REQUIRED:
+                    raise ValueError("Missing parameter {} in section [{}]".format(key, name))
+                values[key] = default
+        sections[name] = Section(name, values)
+    for name, schema in _SCHEMA.items():
+        if name not in sections and not name.endswith(":*"):
+            sections[name] = Section(name, {key: None if default is _REQUIRED else default
+                                            for key, (_, default, *_) in schema.items()})
+    return Settings(sections)
+
+
+def load_cached(path, parse):
+    """Return the result of parse(path) reusing, if the file didn't change, the one of a previous run
+
+    The result is pickled in <path>.cache along with the modification time and size of the file; if the cache
+    cannot be written (a read only installation for example) the file is simply parsed at every run.
+
+    Args:
+        path (str): the path of the file to parse
+        parse (callable): the function parsing the file, its result must be picklable
+
+    Returns:
+        object. The result of parse
+    """
+    stat = os.stat(path)
+    key = (_CACHE_VERSION, parse.__module__, parse.__name__, stat.st_mtime_ns, stat.st_size)
+    cache_path = path + ".cache"
+    try:
+        with open(cache_path, "rb") as cache_file:
+            cached_key, value = pickle.load(cache_file)
+        if cached_key == key:
+            return value
+    except Exception:
+        # missing, stale or corrupted cache: the file is parsed again
+        pass
+    value = parse(path)
+    try:
+        temporary_path = "{}.{}.tmp".format(cache_path, os.getpid())
+        with open(temporary_path, "wb") as cache_file:
+            pickle.dump((key, value), cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, cache_path)
+    except OSError:
+        pass
+    return value
+
+
+def _load_config():
+    import configparser
+    parser = configparser.ConfigParser()
+    parser.read(INI_PATH)
+    return parser
+
 
-config = configparser.ConfigParser()
-config.read(os.path.dirname(os.path.abspath(__file__)) + '/pihome.ini')
+def __getattr__(name):
+    # the configuration is read at the first access, then it is a regular module attribute
+    if name == "settings":
+        value = load_cached(INI_PATH, parse_settings)
+    elif name == "config":
+        value = _load_config()
+    else:
+        raise AttributeError("module {} has no attribute {}".format(__name__, name))
+    globals()[name] = value
+    return value
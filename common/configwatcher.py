@@ -0,0 +1,220 @@
+import os
+import threading
+from . import configmanager
+from .logger import logger
+
+
+def diff_settings(old, new):
+    """Compare two configurations
+
+    Args:
+        old (Settings): the previous configuration
+        new (Settings): the new configuration
+
+    Returns:
+        {str: set}. The parameters changed (added, removed or modified) indexed by section name, the sections
+        without changes are not included
+    """
+    old_sections = old.as_dict()
+    new_sections = new.as_dict()
+    changes = {}
+    for name in set(old_sections) | set(new_sections):
+        old_values = old_sections.get(name, {})
+        new_values = new_sections.get(name, {})
+        changed = {key for key in set(old_values) | set(new_values) if old_values.get(key) != new_values.get(key)}
+        if changed or (name in old_sections) != (name in new_sections):
+            changes[name] = changed
+    return changes
+
+
+class ConfigWatcher(object):
+    """Watches the configuration file and notifies its changes
+
+    The watcher polls the modification time and the size of the file; when they change the file is parsed
+    again, compared with the previous configuration (see diff_settings) and the listeners are called with
+    the new configuration and the changes, this way every agent can rebuild only the pieces affected.
+    An invalid file is reported and ignored: the previous configuration stays in use.
+    The check can be driven by the owner of the watcher (see check), for example as a task of a
+    StoppableLoopProcess so that the listeners run on the agent's own thread, or by the watcher's own
+    thread (see start). Several agents running in the same process share a watcher through its views (see
+    share): the file is checked and parsed once, every view notifies its own listeners on its owner's thread.
+
+    Attributes:
+        interval (float): the amount of time, in seconds, between two checks of the file
+        settings (Settings): the configuration currently in use
+        _path (str): the path of the configuration file
+        _parse (callable): the function parsing the file into a Settings object
+        _signature ((int, int)): the modification time and the size of the file when it was last parsed
+        _listeners ([callable]): the functions called, with the new Settings and the changes, at every change
+        _lock (threading.Lock): the lock serializing the checks
+        _stop (threading.Event): the event set to stop the watcher's thread
+        _thread (threading.Thread): the watcher's thread, None if not started
+    """
+
+    def __init__(self, interval=5, path=None, parse=None, settings=None):
+        """Initialize the ConfigWatcher
+
+        Args:
+            interval (float, optional): the amount of time, in seconds, between two checks of the file
+            path (str, optional): the path of the configuration file, by default pihome.ini
+            parse (callable, optional): the function parsing the file, by default configmanager.parse_settings
+            settings (Settings, optional): the configuration currently in use, by default configmanager.settings
+                                           when watching pihome.ini and the content of the file otherwise
+        """
+        self.interval = interval
+        self._path = path or configmanager.INI_PATH
+        self._parse = parse or configmanager.parse_settings
+        self._signature = self._file_signature()
+        if settings is None:
+            settings = configmanager.settings if self._path == configmanager.INI_PATH else self._parse(self._path)
+        self.settings = settings
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _file_signature(self):
+        try:
+            stat = os.stat(self._path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def add_listener(self, listener):
+        """Register a function to call whenever the configuration changes
+
+        Args:
+            listener (callable): the function, it receives the new Settings and the changes (see diff_settings)
+        """
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        """Unregister a function registered with add_listener
+
+        Args:
+            listener (callable): the function
+        """
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def share(self):
+        """Return a view of the watcher for an agent sharing it
+
+        Returns:
+            ConfigView. The view, see ConfigView
+        """
+        return ConfigView(self)
+
+    def check(self):
+        """Check the configuration file and, if it changed, notify the listeners
+
+        Returns:
+            {str: set}. The changes (see diff_settings), an empty dictionary if nothing changed
+        """
+        with self._lock:
+            signature = self._file_signature()
+            if signature is None or signature == self._signature:
+                return {}
+            self._signature = signature
+            try:
+                settings = self._parse(self._path)
+            except ValueError as error:
+                logger.error("Configuration not reloaded: %s", error)
+                return {}
+            changes = diff_settings(self.settings, settings)
+            if not changes:
+                return {}
+            logger.info("Configuration changed: %s", ", ".join(
+                "[{}] {}".format(name, ",".join(sorted(keys))) for name, keys in sorted(changes.items())))
+            self.settings = settings
+            if self._path == configmanager.INI_PATH:
+                configmanager.settings = settings
+            # the views started remove their listener from any thread
+            for listener in list(self._listeners):
+                try:
+                    listener(settings, changes)
+                except Exception as error:
+                    logger.exception("Reload of the configuration failed: %s", error)
+            return changes
+
+    def _watch(self):
+        while not self._stop.wait(self.interval):
+            self.check()
+
+    def start(self):
+        """Start checking the file on the watcher's own thread"""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._watch, name="config-watcher", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the watcher's thread"""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+
+class ConfigView(object):
+    """The view of a ConfigWatcher shared by several agents
+
+    A view has the interface of the watcher but it never reads the file: its check compares the configuration
+    last seen by the view with the one of the watcher and notifies the listeners of the view, this way an agent
+    checking its view from its own loop applies the changes on its own thread. The watcher must be driven by
+    its owner (see ConfigWatcher.start). A view started with start is checked, instead, right after every change
+    on the thread of the watcher.
+
+    Attributes:
+        interval (float): the amount of time, in seconds, between two checks of the view
+        settings (Settings): the configuration last notified to the listeners of the view
+        _watcher (ConfigWatcher): the watcher shared
+        _listeners ([callable]): the functions called, with the new Settings and the changes, at every change
+        _lock (threading.Lock): the lock serializing the checks
+    """
+
+    def __init__(self, watcher):
+        """Initialize the ConfigView
+
+        Args:
+            watcher (ConfigWatcher): the watcher shared
+        """
+        self.interval = watcher.interval
+        self.settings = watcher.settings
+        self._watcher = watcher
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def add_listener(self, listener):
+        """Register a function to call whenever the configuration changes, see ConfigWatcher.add_listener"""
+        self._listeners.append(listener)
+
+    def check(self):
+        """Notify the listeners of the view if the configuration of the watcher changed since the last check
+
+        Returns:
+            {str: set}. The changes (see diff_settings), an empty dictionary if nothing changed
+        """
+        with self._lock:
+            settings = self._watcher.settings
+            if settings is self.settings:
+                return {}
+            changes = diff_settings(self.settings, settings)
+            self.settings = settings
+            for listener in self._listeners:
+                try:
+                    listener(settings, changes)
+                except Exception as error:
+                    logger.exception("Reload of the configuration failed: %s", error)
+            return changes
+
+    def _on_change(self, settings, changes):
+        self.check()
+
+    def start(self):
+        """Check the view on the watcher's thread, right after every change"""
+        self._watcher.add_listener(self._on_change)
+
+    def stop(self):
+        """Stop checking the view on the watcher's thread"""
+        self._watcher.remove_listener(self._on_change)
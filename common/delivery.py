@@ -0,0 +1,264 @@
+"""The delivery guarantees of the messages exchanged through the MQTTClient
+
+    - QoSPolicy: the MQTT quality of service, and the topic class, of the messages published on every topic
+    - SequenceNumbers: the sequence numbers stamped on the documents published with QoS 1
+    - Deduplicator: the bounded LRU of the messages already received, used to discard the QoS 1 copies
+    - DeliveryTracker: the messages in flight and their acknowledgement latency per topic class
+"""
+import collections
+import threading
+import time
+from . import metrics
+from .histogram import Histogram
+from .topictrie import TopicTrie
+
+
+class QoSPolicy(object):
+    """The quality of service of the messages published on every topic
+
+    The rules map topic filters (subtopics of the base topic, with the MQTT wildcards) to a QoS, the first rule
+    matching a topic gives its QoS and its topic class (the filter of the rule). The topics not matched by any
+    rule are in the "events" class if published as events, in the "messages" class otherwise. The lookups are
+    cached per topic.
+
+    Attributes:
+        sequence_numbers (bool): if True the documents published with QoS 1 carry a sequence number
+        _trie (TopicTrie): the filters of the rules, every one mapped to its (position, filter, qos)
+        _messages_qos (int): the QoS of the messages not matched by any rule
+        _events_qos (int): the QoS of the events not matched by any rule
+        _cache ({(str, bool): (str, int)}): the class and QoS of the topics already looked up
+    """
+    MESSAGES = "messages"
+    EVENTS = "events"
+    _MAX_CACHED_TOPICS = 1024
+
+    def __init__(self, rules=(), messages_qos=2, events_qos=2, sequence_numbers=False, base_topic=""):
+        """Initialize the QoSPolicy
+
+        Args:
+            rules ([(str, int)], optional): the (topic filter, qos) rules, in order of precedence
+            messages_qos (int, optional): the QoS of the messages not matched by any rule
+            events_qos (int, optional): the QoS of the events not matched by any rule
+            sequence_numbers (bool, optional): if True the documents published with QoS 1 carry a sequence number
+            base_topic (str, optional): the base topic of the client, the filters are relative to it
+
+        Raises:
+            ValueError: if a filter is not a valid MQTT topic filter or a QoS is not 0, 1 or 2
+        """
+        self.sequence_numbers = sequence_numbers
+        self._trie = TopicTrie()
+        for index, (topic_filter, qos) in enumerate(rules):
+            if qos not in (0, 1, 2):
+                raise ValueError("Invalid QoS {} for topic {}".format(qos, topic_filter))
+            self._trie.add("{}/{}".format(base_topic, topic_filter) if base_topic else topic_filter,
+                           (index, topic_filter, qos))
+        if messages_qos not in (0, 1, 2) or events_qos not in (0, 1, 2):
+            raise ValueError("Invalid QoS")
+        self._messages_qos = messages_qos
+        self._events_qos = events_qos
+        self._cache = {}
+
+    def classify(self, topic, event=False):
+        """Return the topic class and the QoS of a topic
+
+        Args:
+            topic (str): the complete topic
+            event (bool, optional): True if the message is an event
+
+        Returns:
+            (str, int). The topic class and the QoS
+        """
+        key = (topic, event)
+        result = self._cache.get(key)
+        if result is None:
+            matches = self._trie.match(topic)
+            if matches:
+                result = min(matches)[1:]
+            else:
+                result = (self.EVENTS, self._events_qos) if event else (self.MESSAGES, self._messages_qos)
+            if len(self._cache) >= self._MAX_CACHED_TOPICS:
+                self._cache.clear()
+            self._cache[key] = result
+        return result
+
+
+class SequenceNumbers(object):
+    """The sequence numbers of the documents published on every topic
+
+    The numbers of every topic are consecutive, they start from the milliseconds of the time of the first
+    document (on 32 bits) so that they don't repeat the numbers of the previous run of the process.
+
+    Attributes:
+        _last ({str: int}): the last number given indexed by topic
+        _lock (threading.Lock): the lock protecting _last
+    """
+
+    def __init__(self):
+        self._last = {}
+        self._lock = threading.Lock()
+
+    def next(self, topic):
+        """Return the next sequence number of a topic
+
+        Args:
+            topic (str): the complete topic
+
+        Returns:
+            int. The sequence number, an unsigned 32 bits integer
+        """
+        with self._lock:
+            last = self._last.get(topic)
+            number = (last + 1 if last is not None else int(time.time() * 1000)) & 0xFFFFFFFF
+            self._last[topic] = number
+            return number
+
+
+class Deduplicator(object):
+    """The bounded LRU of the messages received, it recognises the copies of a message already received
+
+    A message is identified by its topic and the sequence number of its document, only the last size messages
+    are remembered. It is not thread safe: ActionQueue, which checks the messages once its workers have decoded
+    them, serializes the access of its workers with a lock.
+
+    Attributes:
+        duplicates (int): the number of copies recognised
+        _size (int): the maximum number of messages remembered
+        _seen (collections.OrderedDict): the messages remembered, the most recent last
+    """
+
+    def __init__(self, size=1024):
+        """Initialize the Deduplicator
+
+        Args:
+            size (int, optional): the maximum number of messages remembered
+        """
+        self.duplicates = 0
+        self._size = size
+        self._seen = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._seen)
+
+    def is_duplicate(self, topic, sequence_number):
+        """Check whether a message was already received, remembering it
+
+        Args:
+            topic (str): the topic of the message
+            sequence_number (int): the sequence number of the message
+
+        Returns:
+            bool. True if the message is a copy of one already received
+        """
+        key = (topic, sequence_number)
+        if key in self._seen:
+            self._seen.move_to_end(key)
+            self.duplicates += 1
+            return True
+        self._seen[key] = None
+        if len(self._seen) > self._size:
+            self._seen.popitem(last=False)
+        return False
+
+
+class DeliveryTracker(object):
+    """The messages in flight and their acknowledgement latency per topic class
+
+    A message is in flight from its handoff to paho till paho reports it delivered: for QoS 0 that is when it
+    is written on the socket, for QoS 1 at the PUBACK and for QoS 2 at the PUBCOMP of the broker. paho may
+    report a delivery before the publisher gets the message id back, such early acknowledgements are kept
+    till the message is recorded.
+
+    Attributes:
+        _pending ({int: (str, float)}): the topic class and the monotonic time of the handoff of the messages in
+                                        flight indexed by paho message id
+        _early ({int: float}): the monotonic time of the acknowledgements of the messages not recorded yet
+        _classes ({str: {str: object}}): the counters (in_flight, acknowledged) and the latency Histogram of every
+                                         topic class
+        _metrics ({str: (Gauge, Histogram)}): the in flight gauge and the latency histogram of every topic class
+        _lock (threading.Lock): the lock protecting the state of the tracker
+    """
+    _MAX_EARLY = 65535
+
+    def __init__(self):
+        self._pending = {}
+        self._early = {}
+        self._classes = {}
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _topic_class(self, topic_class):
+        counters = self._classes.get(topic_class)
+        if counters is None:
+            counters = self._classes[topic_class] = {"in_flight": 0, "acknowledged": 0, "latency": Histogram()}
+            registry = metrics.get_registry()
+            self._metrics[topic_class] = (
+                registry.gauge("mqtt_messages_in_flight", "Messages waiting for their acknowledgement",
+                               topic_class=topic_class),
+                registry.histogram("mqtt_ack_latency_seconds", "Time from the publication of a message to its "
+                                   "acknowledgement", topic_class=topic_class))
+        return counters
+
+    def sent(self, message_id, topic_class, started):
+        """Record a message handed to paho
+
+        Args:
+            message_id (int): the paho message id
+            topic_class (str): the topic class of the message
+            started (float): the monotonic time of the handoff
+        """
+        with self._lock:
+            counters = self._topic_class(topic_class)
+            acknowledged = self._early.pop(message_id, None)
+            if acknowledged is not None:
+                self._acknowledge(topic_class, counters, acknowledged - started, in_flight=False)
+                return
+            previous = self._pending.get(message_id)
+            if previous is not None:
+                # the message id was reused, the previous message is never going to be acknowledged
+                self._classes[previous[0]]["in_flight"] -= 1
+                self._metrics[previous[0]][0].dec()
+            self._pending[message_id] = (topic_class, started)
+            counters["in_flight"] += 1
+            self._metrics[topic_class][0].inc()
+
+    def acknowledged(self, message_id):
+        """Record the acknowledgement of a message
+
+        Args:
+            message_id (int): the paho message id
+        """
+        now = time.monotonic()
+        with self._lock:
+            pending = self._pending.pop(message_id, None)
+            if pending is None:
+                if len(self._early) >= self._MAX_EARLY:
+                    self._early.clear()
+                self._early[message_id] = now
+                return
+            self._acknowledge(pending[0], self._classes[pending[0]], now - pending[1], in_flight=True)
+
+    def _acknowledge(self, topic_class, counters, latency, in_flight):
+        if in_flight:
+            counters["in_flight"] -= 1
+            self._metrics[topic_class][0].dec()
+        counters["acknowledged"] += 1
+        counters["latency"].observe(latency)
+        self._metrics[topic_class][1].observe(latency)
+
+    def stats(self):
+        """Return the counters and the acknowledgement latency of every topic class
+
+        Returns:
+            {str: {str: object}}. The messages in_flight and acknowledged and the latency (a snapshot of the
+            latency histogram, see Histogram.snapshot, with the p50 and p95 estimates) indexed by topic class
+        """
+        with self._lock:
+            classes = {name: dict(counters) for name, counters in self._classes.items()}
+        stats = {}
+        for name, counters in classes.items():
+            latency = counters.pop("latency")
+            counters["latency"] = latency.snapshot()
+            counters["latency"]["p50"] = latency.quantile(0.5)
+            counters["latency"]["p95"] = latency.quantile(0.95)
+            stats[name] = counters
+        return stats
@@ -1,10 +1,24 @@
-import RPi.GPIO as GPIO
+"""Lazy access to RPi.GPIO
+
+RPi.GPIO is imported, and its numbering mode set according to the [gpio] section, only the first time
+gpiomanager.GPIO is accessed: the agents that don't use the GPIO don't pay for it (and can run on a machine
+without it).
+"""
 from . import configmanager
 
 
-if configmanager.config['gpio']['mode'] == "BCM":
-    #logger.info("GPIO mode: BCM")
-    GPIO.setmode(GPIO.BCM)
-else:
-    #logger.info("GPIO mode: BOARD")
-    GPIO.setmode(GPIO.BOARD)
+def _load_gpio():
+    import RPi.GPIO as GPIO
+    if configmanager.settings.gpio.mode == "BCM":
+        GPIO.setmode(GPIO.BCM)
+    else:
+        GPIO.setmode(GPIO.BOARD)
+    return GPIO
+
+
+def __getattr__(name):
+    if name != "GPIO":
+        raise AttributeError("module {} has no attribute {}".format(__name__, name))
+    GPIO = _load_gpio()
+    globals()["GPIO"] = GPIO
+    return GPIO
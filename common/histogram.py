@@ -0,0 +1,98 @@
+import bisect
+import threading
+
+# bucket upper bounds, in seconds, suited for sensor reads and broker round trips
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram(object):
+    """A thread safe histogram with fixed buckets
+
+    The histogram counts the observed values falling within each bucket (the last, implicit, bucket
+    collects the values greater than the last bound) and keeps their sum, minimum and maximum; its memory
+    footprint therefore does not depend on the number of values observed.
+
+    Attributes:
+        _bounds ((float)): the upper bound (inclusive) of every bucket, in increasing order
+        _counts ([int]): the number of values observed in every bucket (one more than the bounds)
+        _count (int): the number of values observed
+        _sum (float): the sum of the values observed
+        _min (float): the minimum value observed
+        _max (float): the maximum value observed
+        _lock (threading.Lock): the lock protecting the counters
+    """
+
+    def __init__(self, bounds=DEFAULT_LATENCY_BUCKETS):
+        """Initialize an empty Histogram
+
+        Args:
+            bounds ((float)): the upper bound (inclusive) of every bucket, in increasing order
+        """
+        self._bounds = tuple(bounds)
+        self._counts = [0] * (len(self._bounds) + 1)
+        self._count = 0
+        self._sum = 0.0
+        self._min = None
+        self._max = None
+        self._lock = threading.Lock()
+
+    @property
+    def bounds(self):
+        return self._bounds
+
+    def observe(self, value):
+        """Record a value
+
+        Args:
+            value (float): the value to record
+        """
+        index = bisect.bisect_left(self._bounds, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._count += 1
+            self._sum += value
+            if self._min is None or value < self._min:
+                self._min = value
+            if self._max is None or value > self._max:
+                self._max = value
+
+    def snapshot(self):
+        """Return the current state of the histogram
+
+        Returns:
+            {str: object}. A dictionary with the keys: count, sum, min, max, mean and buckets; buckets is
+            a list of (upper_bound, count) tuples where the upper bound of the last bucket is infinite
+        """
+        with self._lock:
+            counts = list(self._counts)
+            count, total, minimum, maximum = self._count, self._sum, self._min, self._max
+        return {"count": count,
+                "sum": total,
+                "min": minimum,
+                "max": maximum,
+                "mean": total / count if count else None,
+                "buckets": list(zip(self._bounds + (float("inf"),), counts))}
+
+    def quantile(self, fraction):
+        """Estimate a quantile of the values observed
+
+        The estimate is the upper bound of the bucket containing the quantile, capped to the maximum value
+
+        Args:
+            fraction (float): the quantile to estimate (0.5 for the median, 0.99 for the 99th percentile)
+
+        Returns:
+            float. The estimated quantile or None if no value has been observed
+        """
+        with self._lock:
+            counts = list(self._counts)
+            count, maximum = self._count, self._max
+        if not count:
+            return None
+        rank = fraction * count
+        cumulative = 0
+        for bound, bucket_count in zip(self._bounds + (float("inf"),), counts):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                return min(bound, maximum)
+        return maximum
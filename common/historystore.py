@@ -0,0 +1,470 @@
+import bisect
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from .logger import logger
+
+_MAGIC = b"PHTS"
+_VERSION = 1
+# magic, version, number of columns, capacity (rows), count (rows written)
+_HEADER = struct.Struct("<4sHHII")
+_COUNT_OFFSET = 12
+_SEGMENT_NAME = re.compile(r"^(\d+)-(\d+)\.seg$")
+
+# the columns of the segments of a rollup tier, a raw point (ts, value) is equivalent to (ts, 1, value, value, value, value)
+_ROLLUP_COLUMNS = ("ts", "count", "sum", "min", "max", "last")
+AGGREGATES = ("mean", "min", "max", "sum", "count", "last")
+
+
+class _Segment(object):
+    """A memory mapped, append-only file of float64 columns
+
+    The file starts with a fixed size header followed by the columns, each one preallocated for capacity
+    rows; the first column holds the timestamps, in non-decreasing order. The number of rows written is
+    updated in the header after every append, so a reader mapping the same file sees only complete rows.
+
+    Attributes:
+        path (str): the path of the file
+        partition (int): the start, in unix time, of the time partition the segment belongs to
+        capacity (int): the maximum number of rows of the segment
+        count (int): the number of rows written
+        _file (file): the file object
+        _mmap (mmap.mmap): the memory map of the file
+        _columns ([memoryview]): a float64 view of every column
+    """
+    __slots__ = ("path", "partition", "capacity", "count", "_file", "_mmap", "_columns")
+
+    def __init__(self, path, partition, columns=2, capacity=4096, writable=False):
+        """Open a segment, creating it if it doesn't exist and writable is True
+
+        Args:
+            path (str): the path of the file
+            partition (int): the start of the time partition the segment belongs to
+            columns (int): the number of columns (used only when creating the file)
+            capacity (int): the number of rows (used only when creating the file)
+            writable (bool): True to open the segment for appending
+        """
+        self.path = path
+        self.partition = partition
+        if writable and not os.path.exists(path):
+            with open(path, "wb") as new_file:
+                new_file.write(_HEADER.pack(_MAGIC, _VERSION, columns, capacity, 0))
+                # the file is sparse, the unwritten rows take no space on disk
+                new_file.truncate(_HEADER.size + columns * capacity * 8)
+        self._file = open(path, "r+b" if writable else "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        magic, version, columns, self.capacity, self.count = _HEADER.unpack_from(self._mmap)
+        if magic != _MAGIC or version != _VERSION:
+            self.close()
+            raise ValueError("{} is not a history segment".format(path))
+        view = memoryview(self._mmap)
+        size = self.capacity * 8
+        self._columns = [view[_HEADER.size + index * size:_HEADER.size + (index + 1) * size].cast("d")
+                         for index in range(columns)]
+        view.release()
+
+    @property
+    def full(self):
+        return self.count >= self.capacity
+
+    @property
+    def first_timestamp(self):
+        return self._columns[0][0] if self.count else None
+
+    @property
+    def last_timestamp(self):
+        return self._columns[0][self.count - 1] if self.count else None
+
+    def append(self, row):
+        """Append a row, the caller must check that the segment is not full
+
+        Args:
+            row ((float)): a value per column, the timestamp first
+        """
+        index = self.count
+        for column, value in zip(self._columns, row):
+            column[index] = value
+        self.count = index + 1
+        struct.pack_into("<I", self._mmap, _COUNT_OFFSET, self.count)
+
+    def read(self, start, end):
+        """Return the rows with a timestamp within [start, end)
+
+        Args:
+            start (float): the start of the time range (inclusive)
+            end (float): the end of the time range (exclusive)
+
+        Returns:
+            [[float]]. A list per column of the values of the rows in the range
+        """
+        timestamps = self._columns[0][:self.count]
+        first = bisect.bisect_left(timestamps, start)
+        last = bisect.bisect_left(timestamps, end, first)
+        return [column[first:last].tolist() for column in self._columns]
+
+    def close(self):
+        """Release the memory map and close the file"""
+        for column in getattr(self, "_columns", ()):
+            column.release()
+        self._columns = []
+        self._mmap.close()
+        self._file.close()
+
+
+class HistoryStore(object):
+    """An embedded time series store for the samples
+
+    Every label is stored in a set of tiers: the raw tier keeps the points (timestamp, value) as they are
+    appended while every rollup tier keeps, for buckets of a fixed resolution, the count, sum, minimum, maximum
+    and last value of the points of the bucket. Each tier of each label is a directory of time partitioned
+    segments (see _Segment) named <partition start>-<sequence number>.seg, a partition with more points than
+    the capacity of a segment continues in a new segment.
+    The maintenance (see maintain), meant to run periodically in background, fills the rollup tiers from the
+    previous tier (the raw one for the first) and deletes the partitions older than the retention of their tier.
+    The store is written by a single process but it can be queried by other processes at the same time.
+
+    Attributes:
+        _path (str): the directory holding the store
+        _partition (int): the length, in seconds, of a time partition
+        _capacity (int): the number of rows of a raw segment
+        _tiers ([(int, float)]): the (resolution, retention) of every tier, in seconds, the raw tier first with
+                                 resolution 0
+        _tails ({(int, str): _Segment}): the segment being appended to, indexed by (resolution, label)
+        _lock (threading.Lock): the lock serializing writers and maintenance
+        _clock (callable): the function returning the current unix time
+        maintenance_interval (float): the amount of time, in seconds, between two runs of the maintenance
+    """
+
+    def __init__(self, path, partition=86400, capacity=4096, retention=7 * 86400,
+                 rollups=((300, 90 * 86400), (3600, 730 * 86400)), maintenance_interval=600, clock=time.time):
+        """Initialize the HistoryStore
+
+        Args:
+            path (str): the directory holding the store, created if missing
+            partition (int): the length, in seconds, of a time partition
+            capacity (int): the number of points of a raw segment
+            retention (float): the amount of time, in seconds, the raw points are kept
+            rollups (((int, float))): the (resolution, retention) of every rollup tier, in seconds, by increasing
+                                      resolution; every resolution must be a multiple of the previous one
+            maintenance_interval (float): the amount of time, in seconds, between two runs of the maintenance
+            clock (callable): the function returning the current unix time
+        """
+        self._path = path
+        self._partition = int(partition)
+        self._capacity = capacity
+        self._tiers = [(0, retention)] + sorted((int(resolution), keep) for resolution, keep in rollups)
+        self._tails = {}
+        self._lock = threading.Lock()
+        self._clock = clock
+        self.maintenance_interval = maintenance_interval
+        os.makedirs(path, exist_ok=True)
+
+    def _directory(self, resolution, label):
+        return os.path.join(self._path, "raw" if resolution == 0 else "{}s".format(resolution), label)
+
+    def _segment_files(self, resolution, label):
+        """Return the segments of a tier of a label as (partition, sequence, path) tuples, oldest first"""
+        directory = self._directory(resolution, label)
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return []
+        files = []
+        for name in names:
+            match = _SEGMENT_NAME.match(name)
+            if match:
+                files.append((int(match.group(1)), int(match.group(2)), os.path.join(directory, name)))
+        return sorted(files)
+
+    def _tail(self, resolution, label, timestamp):
+        """Return the segment the rows of timestamp must be appended to, opening or creating it if needed"""
+        partition = int(timestamp // self._partition * self._partition)
+        tail = self._tails.get((resolution, label))
+        if tail is not None and tail.partition == partition and not tail.full:
+            return tail
+        if tail is not None:
+            tail.close()
+        sequence = 0
+        files = [entry for entry in self._segment_files(resolution, label) if entry[0] == partition]
+        if files:
+            sequence = files[-1][1]
+        columns, capacity = 2, self._capacity
+        if resolution:
+            columns, capacity = len(_ROLLUP_COLUMNS), max(1, math.ceil(self._partition / resolution))
+        directory = self._directory(resolution, label)
+        os.makedirs(directory, exist_ok=True)
+        tail = _Segment(os.path.join(directory, "{}-{}.seg".format(partition, sequence)), partition,
+                        columns, capacity, writable=True)
+        if tail.full:
+            tail.close()
+            tail = _Segment(os.path.join(directory, "{}-{}.seg".format(partition, sequence + 1)), partition,
+                            columns, capacity, writable=True)
+        self._tails[(resolution, label)] = tail
+        return tail
+
+    def _append(self, resolution, label, row):
+        tail = self._tail(resolution, label, row[0])
+        last_timestamp = tail.last_timestamp
+        if last_timestamp is not None and row[0] < last_timestamp:
+            # the segments must stay sorted, a clock going backwards must not break them
+            row = (last_timestamp,) + tuple(row[1:])
+        tail.append(row)
+
+    def append(self, label, timestamp, value):
+        """Store a point
+
+        Args:
+            label (str): the label of the point (something like "temperature")
+            timestamp (float): the unix time of the point
+            value (float): the value of the point
+        """
+        with self._lock:
+            self._append(0, label, (timestamp, value))
+
+    def append_samples(self, samples, timestamp=None):
+        """Store samples
+
+        Args:
+            samples ([Sample]): the samples to store
+            timestamp (float, optional): the unix time of the samples, now if None
+        """
+        timestamp = self._clock() if timestamp is None else timestamp
+        with self._lock:
+            for sample in samples:
+                self._append(0, sample.label, (timestamp, sample.data))
+
+    def labels(self):
+        """Return the labels stored
+
+        Returns:
+            [str]. The labels having at least a raw point
+        """
+        try:
+            return sorted(os.listdir(os.path.join(self._path, "raw")))
+        except FileNotFoundError:
+            return []
+
+    def _read(self, resolution, label, start, end):
+        """Read the rows of a tier within [start, end)
+
+        Returns:
+            [[float]]. A list per column of the values of the rows, the columns of the raw tier are (ts, value),
+            the ones of the rollup tiers are those of _ROLLUP_COLUMNS
+        """
+        columns = None
+        for partition, _, path in self._segment_files(resolution, label):
+            if partition >= end or partition + self._partition <= start:
+                continue
+            try:
+                segment = _Segment(path, partition)
+            except (FileNotFoundError, ValueError):
+                # deleted by the retention or still being created
+                continue
+            try:
+                rows = segment.read(start, end)
+            finally:
+                segment.close()
+            if columns is None:
+                columns = rows
+            else:
+                for column, values in zip(columns, rows):
+                    column.extend(values)
+        return columns or [[] for _ in range(2 if resolution == 0 else len(_ROLLUP_COLUMNS))]
+
+    def _oldest(self, resolution, label):
+        """Return the timestamp of the oldest row of a tier, None if the tier is empty"""
+        for partition, _, path in self._segment_files(resolution, label):
+            try:
+                segment = _Segment(path, partition)
+            except (FileNotFoundError, ValueError):
+                continue
+            try:
+                if segment.count:
+                    return segment.first_timestamp
+            finally:
+                segment.close()
+        return None
+
+    def _newest(self, resolution, label):
+        """Return the timestamp of the newest row of a tier, None if the tier is empty"""
+        for partition, _, path in reversed(self._segment_files(resolution, label)):
+            try:
+                segment = _Segment(path, partition)
+            except (FileNotFoundError, ValueError):
+                continue
+            try:
+                if segment.count:
+                    return segment.last_timestamp
+            finally:
+                segment.close()
+        return None
+
+    @staticmethod
+    def _as_rollup(columns):
+        """Return raw columns (ts, value) in the format of the rollup columns"""
+        timestamps, values = columns
+        return [timestamps, [1.0] * len(values), values, values, values, values]
+
+    @staticmethod
+    def _bucketize(rollup_columns, resolution):
+        """Merge rollup rows into buckets of a resolution
+
+        Returns:
+            [(float, float, float, float, float, float)]. A row (bucket start, count, sum, min, max, last)
+            per non empty bucket, oldest first
+        """
+        buckets = []
+        current = None
+        for timestamp, count, total, minimum, maximum, last in zip(*rollup_columns):
+            bucket = timestamp // resolution * resolution
+            if current is None or current[0] != bucket:
+                current = [bucket, count, total, minimum, maximum, last]
+                buckets.append(current)
+            else:
+                current[1] += count
+                current[2] += total
+                if minimum < current[3]:
+                    current[3] = minimum
+                if maximum > current[4]:
+                    current[4] = maximum
+                current[5] = last
+        return buckets
+
+    def query(self, label, start, end, resolution=None, aggregate="mean"):
+        """Return the history of a label within a time range
+
+        Without a resolution the raw points are returned as they are. With a resolution the points are grouped in
+        buckets of resolution seconds (aligned to the unix epoch) and every bucket is reduced with the aggregate;
+        the data is read from the coarsest tier whose resolution is not greater than the one requested and
+        whose data covers the range, so that a long range is answered from the rollups even after the raw points
+        have been deleted.
+
+        Args:
+            label (str): the label to query
+            start (float): the start of the time range, in unix time (inclusive)
+            end (float): the end of the time range, in unix time (exclusive)
+            resolution (float, optional): the length, in seconds, of the buckets
+            aggregate (str): how the points of a bucket are reduced, one of AGGREGATES
+
+        Returns:
+            [(float, float)]. The (timestamp, value) tuples, oldest first; with a resolution the timestamp is
+            the start of the bucket
+
+        Raises:
+            ValueError: if the aggregate is not supported
+        """
+        if aggregate not in AGGREGATES:
+            raise ValueError("Unsupported aggregate {}".format(aggregate))
+        if resolution is None:
+            return list(zip(*self._read(0, label, start, end)))
+
+        candidates = [tier for tier, _ in self._tiers if tier <= resolution]
+        chosen = None
+        for tier in reversed(candidates):
+            oldest = self._oldest(tier, label)
+            if oldest is not None and oldest <= start:
+                chosen = tier
+                break
+        if chosen is None:
+            # no tier covers the whole range, the one reaching further back is used
+            oldest_by_tier = [(self._oldest(tier, label), tier) for tier in candidates]
+            oldest_by_tier = [entry for entry in oldest_by_tier if entry[0] is not None]
+            if not oldest_by_tier:
+                return []
+            chosen = min(oldest_by_tier)[1]
+        columns = self._read(chosen, label, start, end)
+        if chosen == 0:
+            columns = self._as_rollup(columns)
+        result = []
+        for bucket, count, total, minimum, maximum, last in self._bucketize(columns, resolution):
+            if aggregate == "mean":
+                value = total / count
+            elif aggregate == "min":
+                value = minimum
+            elif aggregate == "max":
+                value = maximum
+            elif aggregate == "sum":
+                value = total
+            elif aggregate == "count":
+                value = count
+            else:
+                value = last
+            result.append((bucket, value))
+        return result
+
+    def _downsample(self, source, target, label, now):
+        """Fill a rollup tier with the complete buckets of the previous tier
+
+        Returns:
+            int. The number of rows appended to the rollup tier
+        """
+        newest = self._newest(target, label)
+        if newest is not None:
+            start = newest + target
+        else:
+            start = self._oldest(source, label)
+            if start is None:
+                return 0
+            start = start // target * target
+        # only the buckets that can't receive points anymore are rolled up
+        end = now // target * target
+        if start >= end:
+            return 0
+        columns = self._read(source, label, start, end)
+        if source == 0:
+            columns = self._as_rollup(columns)
+        buckets = self._bucketize(columns, target)
+        for row in buckets:
+            self._append(target, label, row)
+        return len(buckets)
+
+    def _expire(self, resolution, retention, label, now):
+        """Delete the partitions of a tier older than its retention
+
+        Returns:
+            int. The number of segments deleted
+        """
+        deleted = 0
+        for partition, _, path in self._segment_files(resolution, label):
+            if partition + self._partition > now - retention:
+                break
+            tail = self._tails.get((resolution, label))
+            if tail is not None and tail.path == path:
+                tail.close()
+                del self._tails[(resolution, label)]
+            os.remove(path)
+            deleted += 1
+        return deleted
+
+    def maintain(self):
+        """Downsample the new data into the rollup tiers and apply the retention of every tier
+
+        The method is meant to be called periodically; it holds the lock of the store (blocking the appends)
+        one label at a time.
+
+        Returns:
+            {str: int}. A dictionary with the keys: downsampled (the rows appended to the rollup tiers) and
+            expired (the segments deleted)
+        """
+        now = self._clock()
+        downsampled = expired = 0
+        for label in self.labels():
+            with self._lock:
+                for (source, _), (target, _) in zip(self._tiers, self._tiers[1:]):
+                    downsampled += self._downsample(source, target, label, now)
+                for resolution, retention in self._tiers:
+                    expired += self._expire(resolution, retention, label, now)
+        if downsampled or expired:
+            logger.info("History maintenance: %d rows downsampled, %d segments expired", downsampled, expired)
+        return {"downsampled": downsampled, "expired": expired}
+
+    def close(self):
+        """Close the segments being appended to"""
+        with self._lock:
+            for tail in self._tails.values():
+                tail.close()
+            self._tails = {}
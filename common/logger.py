@@ -1,10 +1,26 @@
 import os
 import logging
 import logging.config
-import yaml
+from .configmanager import load_cached
 
 
-with open(os.path.dirname(os.path.abspath(__file__)) + "/logging_conf.yml", "r") as config_file:
-    logging.config.dictConfig(yaml.load(config_file))
+def _parse_logging_conf(path):
+    import yaml
+    with open(path, "r") as config_file:
+        return yaml.safe_load(config_file)
+
+
+# the parsed configuration is cached like the ini one, yaml is imported only when the file changes
+_logging_conf = dict(load_cached(os.path.dirname(os.path.abspath(__file__)) + "/logging_conf.yml",
+                                 _parse_logging_conf))
+# the pipeline section is not part of the dictConfig schema, it configures common.logpipeline
+_pipeline = _logging_conf.pop("pipeline", None) or {}
+logging.config.dictConfig(_logging_conf)
 
 logger = logging.getLogger('PiHomeLogger')
+
+if _pipeline.get("asynchronous") or _pipeline.get("rate_limit") or _pipeline.get("sample_every", 1) > 1:
+    from . import logpipeline
+    logpipeline.install(logger, asynchronous=bool(_pipeline.get("asynchronous")),
+                        queue_size=_pipeline.get("queue_size", 10000), rate=_pipeline.get("rate_limit", 0),
+                        sample_every=_pipeline.get("sample_every", 1))
@@ -0,0 +1,190 @@
+"""The asynchronous, rate limited, logging pipeline
+
+Logging a record synchronously formats it and writes it on the thread calling the logger: the paho network
+loop, the GPIO callbacks and the action workers pay for the formatting and for the write to stdout at every
+message. The pipeline moves that work off the hot paths:
+    - RateLimitFilter drops, per call site, the records exceeding a rate (and keeps only one in every
+      sample_every records), the warnings and the errors always pass
+    - AsyncQueueHandler only hands the records to a bounded queue, it never formats them and never blocks
+    - a single listener thread (logging.handlers.QueueListener) formats and writes them with the handlers
+      of the configuration
+See install, used by common.logger according to the "pipeline" section of logging_conf.yml.
+"""
+import atexit
+import logging
+import logging.handlers
+import multiprocessing.util
+import queue
+import threading
+import time
+
+
+class RateLimitFilter(logging.Filter):
+    """Limits the records logged by every call site
+
+    A call site (a logging call in the code, identified by file and line) can log up to rate records per
+    second, with bursts of up to rate records; besides, with sample_every greater than 1 only one in every
+    sample_every records of a call site is considered. The records of level or above are never dropped.
+    The first record logged by a call site after some of its records were dropped reports how many.
+
+    Attributes:
+        _rate (float): the records per second allowed to every call site, 0 disables the limit
+        _sample_every (int): one in every sample_every records of every call site is considered
+        _level (int): the records of this level or above are never dropped
+        _sites ({(str, int): [float, float, int, int]}): the tokens available, the time of the last refill,
+                                                         the records seen and dropped indexed by call site
+        _lock (threading.Lock): the lock protecting _sites
+    """
+
+    def __init__(self, rate=0, sample_every=1, level=logging.WARNING):
+        """Initialize the RateLimitFilter
+
+        Args:
+            rate (float, optional): the records per second allowed to every call site, 0 disables the limit
+            sample_every (int, optional): one in every sample_every records of every call site is considered
+            level (int, optional): the records of this level or above are never dropped
+        """
+        super(RateLimitFilter, self).__init__()
+        self._rate = rate
+        self._sample_every = max(1, sample_every)
+        self._level = level
+        self._sites = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= self._level:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            site = self._sites.get(key)
+            if site is None:
+                site = self._sites[key] = [float(self._rate), now, 0, 0]
+            site[2] += 1
+            if site[2] % self._sample_every:
+                site[3] += 1
+                return False
+            if self._rate:
+                site[0] = min(float(self._rate), site[0] + (now - site[1]) * self._rate)
+                site[1] = now
+                if site[0] < 1:
+                    site[3] += 1
+                    return False
+                site[0] -= 1
+            dropped, site[3] = site[3], 0
+        if dropped:
+            # the message is rendered first: a record without arguments is not %-formatted by logging (it may
+            # contain a literal %), the arguments may be a mapping
+            record.args = (record.getMessage(), dropped)
+            record.msg = "%s [%d similar records dropped]"
+        return True
+
+
+class AsyncQueueHandler(logging.handlers.QueueHandler):
+    """Hands the records to a bounded queue without formatting them
+
+    Unlike QueueHandler the message is not formatted here but by the listener (the records never leave the
+    process, their arguments don't need to be pickled), only the exception information is turned into text
+    since the traceback keeps the frames alive. When the queue is full the record is dropped, the number of
+    records dropped is logged as soon as the queue has room again.
+
+    Attributes:
+        dropped (int): the number of records dropped since the last report
+    """
+
+    def __init__(self, record_queue):
+        super(AsyncQueueHandler, self).__init__(record_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            if self.dropped:
+                report = logging.LogRecord(record.name, logging.WARNING, __file__, 0,
+                                           "Logging queue full, %d records dropped", (self.dropped,), None)
+                self.queue.put_nowait(report)
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class AsyncLogging(object):
+    """The queue, handler and listener moving the handlers of a logger to a thread of their own
+
+    The listener thread does not survive a fork: the child process (every agent started as a process)
+    gets a new queue and a new listener, see _after_fork. A child process ends without running the atexit
+    functions, its listener is stopped (and the records left written) by a multiprocessing finalizer.
+
+    Attributes:
+        _logger (logging.Logger): the logger whose handlers are moved
+        _handlers ([logging.Handler]): the handlers run by the listener
+        _queue_size (int): the maximum number of records waiting for the listener
+        _handler (AsyncQueueHandler): the only handler left on the logger
+        _listener (logging.handlers.QueueListener): the thread running the handlers
+    """
+
+    def __init__(self, logger, queue_size=10000):
+        """Initialize the AsyncLogging, the handlers of the logger are moved right away
+
+        Args:
+            logger (logging.Logger): the logger whose handlers are moved
+            queue_size (int, optional): the maximum number of records waiting for the listener
+        """
+        self._logger = logger
+        self._handlers = list(logger.handlers)
+        self._queue_size = queue_size
+        self._handler = AsyncQueueHandler(queue.Queue(queue_size))
+        self._listener = None
+        for handler in self._handlers:
+            logger.removeHandler(handler)
+        logger.addHandler(self._handler)
+        self.start()
+
+    def start(self):
+        """Start the listener"""
+        if self._listener is None:
+            self._listener = logging.handlers.QueueListener(self._handler.queue, *self._handlers,
+                                                            respect_handler_level=True)
+            self._listener.start()
+
+    def stop(self):
+        """Stop the listener, the records already queued are written before it terminates"""
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+
+    def _after_fork(self):
+        # the listener thread and the state of the queue's locks are not inherited in a usable state
+        self._handler.queue = queue.Queue(self._queue_size)
+        self._listener = None
+        self.start()
+        multiprocessing.util.Finalize(self, self.stop, exitpriority=0)
+
+
+def install(logger, asynchronous=True, queue_size=10000, rate=0, sample_every=1):
+    """Set up the logging pipeline on a logger
+
+    Args:
+        logger (logging.Logger): the logger
+        asynchronous (bool, optional): if True the handlers of the logger are run by a listener thread
+        queue_size (int, optional): the maximum number of records waiting for the listener
+        rate (float, optional): the records per second allowed to every call site below WARNING, 0 means no limit
+        sample_every (int, optional): one in every sample_every records of every call site below WARNING is logged
+
+    Returns:
+        AsyncLogging. The asynchronous logging of the logger, None if not asynchronous
+    """
+    if rate or sample_every > 1:
+        logger.addFilter(RateLimitFilter(rate, sample_every))
+    if not asynchronous:
+        return None
+    async_logging = AsyncLogging(logger, queue_size)
+    atexit.register(async_logging.stop)
+    multiprocessing.util.register_after_fork(async_logging, AsyncLogging._after_fork)
+    return async_logging
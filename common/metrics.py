@@ -0,0 +1,460 @@
+"""The metrics of the agents and of the MQTT client
+
+The components report into the registry of their process (see get_registry) through three kinds of metrics:
+    - Counter: a value that only increases (readings failed, messages published, ...)
+    - Gauge: a value that goes up and down (queue depth, persons present, ...), it can be computed by a
+      function at collection time
+    - Histogram: the distribution of a value over fixed buckets (latencies), see common.histogram
+Every metric has a name and, optionally, labels: the metrics with the same name and different labels are the
+series of a family (for example sensor_read_seconds{sensor="dht"} and sensor_read_seconds{sensor="bmp"}).
+The metrics are disabled by default: till enable is called get_registry returns a registry handing out a
+single no-op metric, so the instrumented code pays a call to an empty method and nothing else. The components
+take their metrics when they are built, the metrics must therefore be enabled before building them.
+The MetricsExporter publishes the metrics periodically on the _metrics subtopic and, optionally, serves them
+in the Prometheus text format on localhost.
+"""
+import json
+import threading
+import time
+from .histogram import DEFAULT_LATENCY_BUCKETS, Histogram
+from .logger import logger
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+
+class Counter(object):
+    """A value that only increases
+
+    Attributes:
+        _value (float): the current value
+        _lock (threading.Lock): the lock protecting the value
+    """
+
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        """Increase the counter
+
+        Args:
+            amount (float, optional): the amount to add, it must not be negative
+        """
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self):
+        return self._value
+
+
+class Gauge(object):
+    """A value that goes up and down
+
+    Attributes:
+        _value (float): the current value
+        _function (callable): the function computing the value at collection time, if None _value is used
+        _lock (threading.Lock): the lock protecting the value
+    """
+
+    def __init__(self):
+        self._value = 0
+        self._function = None
+        self._lock = threading.Lock()
+
+    def set(self, value):
+        self._value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self._value -= amount
+
+    def set_function(self, function):
+        """Compute the value of the gauge, at collection time, with a function
+
+        Args:
+            function (callable): the function, it receives no arguments and returns the value
+        """
+        self._function = function
+
+    @property
+    def value(self):
+        if self._function is not None:
+            try:
+                return self._function()
+            except Exception as error:
+                logger.debug("Gauge function failed: %s", error)
+                return None
+        return self._value
+
+
+class _NullMetric(object):
+    """The metric handed out while the metrics are disabled, every method does nothing"""
+    __slots__ = ()
+    value = None
+
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def set_function(self, function):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+_NULL_METRIC = _NullMetric()
+
+
+class _Family(object):
+    """The metrics sharing a name
+
+    Attributes:
+        name (str): the name of the metrics
+        kind (str): COUNTER, GAUGE or HISTOGRAM
+        description (str): what the metrics measure
+        buckets ((float)): the bucket bounds of the histograms
+        series ({((str, str)): object}): the metrics indexed by their sorted (label, value) pairs
+    """
+    __slots__ = ("name", "kind", "description", "buckets", "series")
+
+    def __init__(self, name, kind, description, buckets):
+        self.name = name
+        self.kind = kind
+        self.description = description
+        self.buckets = buckets
+        self.series = {}
+
+
+class MetricsRegistry(object):
+    """The metrics of a process
+
+    Asking twice for a metric with the same name and labels returns the same object, this way components
+    sharing a process (and a client) report into the same series.
+
+    Attributes:
+        enabled (bool): always True, the NullRegistry is the disabled one
+        _families ({str: _Family}): the families indexed by name, in registration order
+        _lock (threading.Lock): the lock protecting the families
+    """
+    enabled = True
+
+    def __init__(self):
+        self._families = {}
+        self._lock = threading.Lock()
+
+    def _metric(self, name, kind, description, labels, buckets=None):
+        key = tuple(sorted((label, str(value)) for label, value in labels.items()))
+        family = self._families.get(name)
+        if family is not None:
+            metric = family.series.get(key)
+            if metric is not None and family.kind == kind:
+                return metric
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = self._families[name] = _Family(name, kind, description, buckets)
+            elif family.kind != kind:
+                raise ValueError("Metric {} already registered as a {}".format(name, family.kind))
+            metric = family.series.get(key)
+            if metric is None:
+                if kind == HISTOGRAM:
+                    metric = Histogram(family.buckets)
+                else:
+                    metric = Counter() if kind == COUNTER else Gauge()
+                family.series[key] = metric
+            return metric
+
+    def counter(self, name, description="", **labels):
+        """Return a counter, registering it the first time
+
+        Args:
+            name (str): the name of the counter, by convention it ends with _total
+            description (str, optional): what the counter counts
+            **labels: the labels of the series
+
+        Returns:
+            Counter
+
+        Raises:
+            ValueError: if a metric of another kind has the same name
+        """
+        return self._metric(name, COUNTER, description, labels)
+
+    def gauge(self, name, description="", **labels):
+        """Return a gauge, registering it the first time (see counter)"""
+        return self._metric(name, GAUGE, description, labels)
+
+    def histogram(self, name, description="", buckets=DEFAULT_LATENCY_BUCKETS, **labels):
+        """Return a histogram, registering it the first time (see counter)
+
+        Args:
+            buckets ((float), optional): the upper bounds of the buckets, the ones given when the family is
+                                         registered apply to all its series
+        """
+        return self._metric(name, HISTOGRAM, description, labels, tuple(buckets))
+
+    def unregister(self, name, **labels):
+        """Remove a series, for example the gauge computed by a component that is gone
+
+        Args:
+            name (str): the name of the metric
+            **labels: the labels of the series
+        """
+        key = tuple(sorted((label, str(value)) for label, value in labels.items()))
+        with self._lock:
+            family = self._families.get(name)
+            if family is not None:
+                family.series.pop(key, None)
+
+    def collect(self):
+        """Return the current value of every metric
+
+        Returns:
+            [(str, str, str, [({str: str}, object)])]. For every family its name, kind, description and series;
+            every series is a (labels, value) tuple where the value of a histogram is its snapshot (see
+            Histogram.snapshot) and the one of the other metrics a number
+        """
+        with self._lock:
+            families = [(family, list(family.series.items())) for family in self._families.values()]
+        collected = []
+        for family, series in families:
+            values = []
+            for key, metric in series:
+                values.append((dict(key), metric.snapshot() if family.kind == HISTOGRAM else metric.value))
+            collected.append((family.name, family.kind, family.description, values))
+        return collected
+
+    def as_dict(self):
+        """Return the metrics as a json friendly dictionary
+
+        Returns:
+            {str: [dict]}. The series indexed by metric name, every series is a dictionary with the labels and
+            either the value or, for histograms, count, sum, the bucket bounds and the counts of the buckets
+            (one more than the bounds, the last one counts the values beyond the last bound)
+        """
+        document = {}
+        for name, kind, _, series in self.collect():
+            items = []
+            for labels, value in series:
+                if kind == HISTOGRAM:
+                    items.append({"labels": labels, "count": value["count"], "sum": value["sum"],
+                                  "bounds": [bound for bound, _ in value["buckets"][:-1]],
+                                  "counts": [count for _, count in value["buckets"]]})
+                else:
+                    items.append({"labels": labels, "value": value})
+            document[name] = items
+        return document
+
+    def render_prometheus(self):
+        """Return the metrics in the Prometheus text exposition format (version 0.0.4)"""
+        lines = []
+        for name, kind, description, series in self.collect():
+            if description:
+                lines.append("# HELP {} {}".format(name, description.replace("\\", "\\\\").replace("\n", "\\n")))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for labels, value in series:
+                if kind != HISTOGRAM:
+                    if value is not None:
+                        lines.append("{}{} {}".format(name, _format_labels(labels), _format_value(value)))
+                    continue
+                cumulative = 0
+                for bound, count in value["buckets"]:
+                    cumulative += count
+                    lines.append("{}_bucket{} {}".format(name, _format_labels(labels, le=_format_value(bound)),
+                                                         cumulative))
+                lines.append("{}_sum{} {}".format(name, _format_labels(labels), _format_value(value["sum"])))
+                lines.append("{}_count{} {}".format(name, _format_labels(labels), value["count"]))
+        return "\n".join(lines) + "\n"
+
+
+class NullRegistry(object):
+    """The registry of a process whose metrics are disabled: every metric is a shared no-op one"""
+    enabled = False
+
+    def counter(self, name, description="", **labels):
+        return _NULL_METRIC
+
+    def gauge(self, name, description="", **labels):
+        return _NULL_METRIC
+
+    def histogram(self, name, description="", buckets=DEFAULT_LATENCY_BUCKETS, **labels):
+        return _NULL_METRIC
+
+    def unregister(self, name, **labels):
+        pass
+
+    def collect(self):
+        return []
+
+    def as_dict(self):
+        return {}
+
+    def render_prometheus(self):
+        return ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(label, str(value).replace("\\", "\\\\").replace('"', '\\"')
+                                           .replace("\n", "\\n")) for label, value in labels.items()) + "}"
+
+
+class MetricsExporter(object):
+    """Publishes the metrics of a process on the broker and, optionally, serves them to Prometheus
+
+    The metrics are published as a json document on the _metrics subtopic of the client:
+    {"source": str, "ts": float, "metrics": {...}} where source is the name of the process (the agents may run
+    in processes of their own, each one publishing its own document) and metrics is MetricsRegistry.as_dict.
+    Like the ConfigWatcher, the publication can be driven by the owner of the exporter (see publish), for
+    example as a task of a StoppableLoopProcess, or by the exporter's own thread (see start).
+    The Prometheus endpoint answers GET /metrics on localhost only.
+
+    Attributes:
+        interval (float): the amount of time, in seconds, between two publications
+        _mqtt_client (MQTTClient): the client publishing the metrics
+        _registry (MetricsRegistry): the metrics to export
+        _source (str): the name of the process exporting the metrics
+        _topic (str): the subtopic of the publications
+        _prometheus_port (int): the port of the Prometheus endpoint, 0 disables it
+        _prometheus_host (str): the address the endpoint listens on
+        _server (http.server.HTTPServer): the Prometheus endpoint, None if not started
+        _stop (threading.Event): the event set to stop the exporter's thread
+        _thread (threading.Thread): the exporter's thread, None if not started
+    """
+    TOPIC = "_metrics"
+
+    def __init__(self, mqtt_client, registry=None, source="", interval=60, prometheus_port=0,
+                 prometheus_host="127.0.0.1"):
+        """Initialize the MetricsExporter
+
+        Args:
+            mqtt_client (MQTTClient): the client publishing the metrics
+            registry (MetricsRegistry, optional): the metrics to export, by default the registry of the process
+            source (str, optional): the name of the process exporting the metrics
+            interval (float, optional): the amount of time, in seconds, between two publications
+            prometheus_port (int, optional): the port of the Prometheus endpoint, 0 (the default) disables it
+            prometheus_host (str, optional): the address the endpoint listens on
+        """
+        self.interval = interval
+        self._mqtt_client = mqtt_client
+        self._registry = registry if registry is not None else get_registry()
+        self._source = source
+        self._topic = self.TOPIC
+        self._prometheus_port = prometheus_port
+        self._prometheus_host = prometheus_host
+        self._server = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def publish(self):
+        """Publish the current value of the metrics"""
+        document = {"source": self._source, "ts": round(time.time(), 3), "metrics": self._registry.as_dict()}
+        self._mqtt_client.publish(self._topic, json.dumps(document, separators=(",", ":")))
+
+    def start_server(self):
+        """Start the Prometheus endpoint, if enabled"""
+        if self._server is not None or not self._prometheus_port:
+            return
+        # imported here since the endpoint is seldom enabled
+        import http.server
+        registry = self._registry
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug("Metrics endpoint: " + format, *args)
+
+        try:
+            self._server = http.server.ThreadingHTTPServer((self._prometheus_host, self._prometheus_port), Handler)
+        except OSError as error:
+            logger.error("Metrics endpoint not started on %s:%d: %s", self._prometheus_host,
+                         self._prometheus_port, error)
+            return
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="metrics-endpoint", daemon=True).start()
+        logger.info("Metrics served on http://%s:%d/metrics", self._prometheus_host, self._prometheus_port)
+
+    def stop_server(self):
+        """Stop the Prometheus endpoint"""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def _export(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.publish()
+            except Exception as error:
+                logger.exception("Publication of the metrics failed: %s", error)
+
+    def start(self):
+        """Start the Prometheus endpoint and the publications on the exporter's own thread"""
+        self.start_server()
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._export, name="metrics-exporter", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the exporter's thread and the Prometheus endpoint"""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self.stop_server()
+
+
+_registry = NullRegistry()
+
+
+def get_registry():
+    """Return the registry of the process, a NullRegistry till the metrics are enabled"""
+    return _registry
+
+
+def enable():
+    """Enable the metrics of the process
+
+    Only the components built afterwards report into the registry
+
+    Returns:
+        MetricsRegistry. The registry of the process
+    """
+    global _registry
+    if not _registry.enabled:
+        _registry = MetricsRegistry()
+    return _registry
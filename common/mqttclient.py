@@ -1,11 +1,11 @@
-import re
+import threading
+import time
 import paho.mqtt.client as mqtt
+from . import metrics
+from .delivery import DeliveryTracker, QoSPolicy, SequenceNumbers
 from .logger import logger
-
-
-def _topic_to_regex(topic):
-    regex_topic = topic.replace('/', '\\/').replace('#', '(.*)').replace('+', '(.*)')
-    return re.compile(regex_topic)
+from .payloads import CodecTable
+from .topictrie import TopicTrie
 
 
 class MQTTClient(object):
@@ -20,18 +20,42 @@ class MQTTClient(object):
     to do it only when it is really necessary (to avoid wasting resources not to mention the risks involved
     in serializing a socket).
     Once the connection is not needed anymore the "stop" method should be invoked to disconnect from the
-    MQTT broker.
+    MQTT broker. A client can be shared by several agents: start and stop are reference counted, the client
+    connects at the first start and disconnects at the stop matching the last one.
 
     Attributes:
         _addr (str): the address of the mqtt broker
         _port (int): the port where the mqtt broker is listening for connections
         _client (paho.mqtt.client.Client): the actuall mqtt client
         _connected (bool): values telling if currently connected or not to a MQTT broker
+        _callbacks (TopicTrie): the trie mapping the subscribed topic filters to their callbacks
+        _callbacks_lock (threading.Lock): the lock protecting _callbacks, updated by the agents (for example on a
+                                          configuration reload) while paho's thread looks the messages up
         _base_topic (str): the base topic to use when puplishing samples or notifications
                            (could be something like "home/living_room")
+        _online (threading.Event): set while the connection with the broker is up
+        _outbox (Outbox): the persistent queue holding the messages that could not be handed to the broker,
+                          if None such messages are lost
+        _replay_batch_size (int): the number of messages replayed from the outbox before waiting for their ack
+        _inflight ({int: int}): the messages replayed from the outbox and not acknowledged yet, the key is the
+                                paho message id and the value the outbox id
+        _acked (set): the paho message ids acknowledged before being tracked in _inflight
+        _inflight_lock (threading.Condition): the condition protecting _inflight and _acked
+        _replay_lock (threading.Lock): the lock held while replaying the outbox
+        _users (int): the number of start calls not matched by a stop yet
+        _users_lock (threading.Lock): the lock protecting _users and the connection state
+        name (str): the name of the client, usually the one of the agent using it
+        _metrics ({str: object}): the metrics of the client (messages published, failed, stored in the outbox
+                                  and received, connection status and queue depths) labelled with its name
+        codecs (CodecTable): the codecs encoding the documents published, and decoding the payloads received,
+                             on every topic
+        _qos_policy (QoSPolicy): the QoS and the topic class of the messages published on every topic
+        _sequence_numbers (SequenceNumbers): the sequence numbers of the documents published with QoS 1
+        _deliveries (DeliveryTracker): the messages in flight and their acknowledgement latency per topic class
 
     """
-    def __init__(self, addr, port, auth_info=None, base_topic=""):
+    def __init__(self, addr, port, auth_info=None, base_topic="", outbox=None, max_queued_messages=0,
+                 replay_batch_size=50, codecs=None, qos_policy=None, name="mqtt"):
         """Initialize the MQTTClient
 
         With the received parameters this class initializes the mqtt client and starts the backgroud loop
@@ -43,16 +67,61 @@ class MQTTClient(object):
                                     (keys should be "user" and "password").
             base_topic (str, optional): the base topic to use when puplishing samples or notifications
                               (could be something like "home/living_room")
+            outbox (Outbox, optional): the persistent queue where the messages that cannot be handed to the
+                                       broker are stored, they are replayed once the connection is restored
+            max_queued_messages (int, optional): the maximum number of messages paho keeps in memory while
+                                                 waiting to send them, 0 means no limit
+            replay_batch_size (int, optional): the number of messages replayed from the outbox before waiting
+                                               for their acknowledgement
+            codecs (CodecTable, optional): the codecs of the topics, by default every document is encoded as json
+            qos_policy (QoSPolicy, optional): the QoS of the topics, by default every message is sent with QoS 2
+            name (str, optional): the name of the client, it labels its metrics so that several clients in the
+                                  same process don't overwrite each other's
         """
         self._addr = addr
         self._port = port
         self._connected = False
+        self._online = threading.Event()
+        self._outbox = outbox
+        self._replay_batch_size = replay_batch_size
+        self._inflight = {}
+        self._acked = set()
+        self._inflight_lock = threading.Condition()
+        self._replay_lock = threading.Lock()
+        self._users = 0
+        self._users_lock = threading.Lock()
         self._client = mqtt.Client(client_id="", clean_session=True, userdata=None, protocol=mqtt.MQTTv311)
         self._client.on_message = self.on_messagge
-        self._callbacks = {}
+        self._client.on_connect = self._on_connect
+        self._client.on_disconnect = self._on_disconnect
+        self._client.on_publish = self._on_publish
+        self._client.max_queued_messages_set(max_queued_messages)
+        self._callbacks = TopicTrie()
+        self._callbacks_lock = threading.Lock()
         if auth_info is not None:
             self._client.username_pw_set(auth_info["user"], auth_info["password"])
         self._base_topic = base_topic
+        self.codecs = codecs if codecs is not None else CodecTable()
+        self._qos_policy = qos_policy if qos_policy is not None else QoSPolicy()
+        self._sequence_numbers = SequenceNumbers()
+        self._deliveries = DeliveryTracker()
+        self.name = name
+        registry = metrics.get_registry()
+        self._metrics = {
+            "published": registry.counter("mqtt_messages_published_total", "Messages handed to the broker",
+                                          client=name),
+            "failed": registry.counter("mqtt_publish_failures_total", "Messages refused by the client", client=name),
+            "stored": registry.counter("mqtt_messages_stored_total", "Messages stored in the outbox", client=name),
+            "received": registry.counter("mqtt_messages_received_total", "Messages received", client=name),
+            "connected": registry.gauge("mqtt_connected", "1 while the connection with the broker is up",
+                                        client=name),
+        }
+        # paho doesn't expose the number of messages waiting to be sent or acknowledged
+        registry.gauge("mqtt_queue_depth", "Messages waiting to be sent or acknowledged", client=name).set_function(
+            lambda: len(getattr(self._client, "_out_messages", ())))
+        if outbox is not None:
+            registry.gauge("mqtt_outbox_depth", "Messages stored in the outbox", client=name).set_function(
+                outbox.__len__)
 
     def __del__(self):
         """Clenup when class is destructed
@@ -60,29 +129,49 @@ class MQTTClient(object):
         When class is garbage collected this method perform sum clean-up such as stopping
         the background loop and disconnecting from the broker
         """
+        self._users = 0
         self.stop()
 
     def start(self):
         """Starts the client
 
-        The method connects the client to the MQTT broker and starts the network loop
+        The method connects the client to the MQTT broker and starts the network loop. When an outbox is
+        available it is opened and the connection is performed in background, this way the client can be
+        started (and can store the messages to publish) even if the broker is not reachable yet.
+        If the client is already started only its number of users is increased
         """
-        if not self._connected:
-            self._client.connect(self._addr, port=self._port, keepalive=60, bind_address="")
-            self._client.loop_start()
-            self._connected = True
-            logger.info("Connection with MQTT Broker at %s:%d estabilished.", self._addr, self._port)
+        with self._users_lock:
+            if not self._connected:
+                if self._outbox is not None:
+                    # the outbox is opened by the process running the client, not by the one that built it
+                    self._outbox.open()
+                    self._client.connect_async(self._addr, port=self._port, keepalive=60, bind_address="")
+                else:
+                    self._client.connect(self._addr, port=self._port, keepalive=60, bind_address="")
+                self._client.loop_start()
+                self._connected = True
+                logger.info("Connection with MQTT Broker at %s:%d estabilished.", self._addr, self._port)
+            self._users += 1
 
     def stop(self):
         """Stop the client
 
-        The method stops the network loop and disconnects from the MQTT broker
+        The method stops the network loop and disconnects from the MQTT broker, unless other users
+        of the client haven't stopped it yet
         """
-        if self._connected:
-            self._client.loop_stop()
+        with self._users_lock:
+            if self._users > 0:
+                self._users -= 1
+            if self._users > 0 or not self._connected:
+                return
             self._client.disconnect()
+            self._client.loop_stop()
+            self._online.clear()
             self._connected = False
             logger.info("Connection with MQTT Broker closed.")
+            for topic_class, stats in self._deliveries.stats().items():
+                logger.info("Deliveries of %s: %d acknowledged, %d in flight, p95 latency %s s", topic_class,
+                            stats["acknowledged"], stats["in_flight"], stats["latency"]["p95"])
 
     def is_connected(self):
         """Checks if the client is currently connected to a MQTT broker
@@ -95,21 +184,23 @@ class MQTTClient(object):
     def publish(self, topic, payload):
         """Publish a payload on a subtopic
 
-        The method publish the payload (whatever it is) received in input on a topic composed
-        as the concatenation of the base topic provided to the client at init time and the
-        topic parameter received in input
+        The method publish the payload received in input on a topic composed as the concatenation of the
+        base topic provided to the client at init time and the topic parameter received in input.
+        A document (for example a dictionary) is encoded with the codec of the topic, a str or bytes payload
+        is published as it is. The QoS of the message is the one of the topic in the QoS policy
 
         Args:
             topic (str): subtopic on which publishing the payload. For instance if the _base_topic of the
                          client wer "home/living_room" and this parameter "temperature" the final topic
                          would be "home/living_room/temperature"
-            payload (str): the payload to publish
+            payload (object): the document or the payload to publish
         """
         complete_topic = "{}/{}".format(self._base_topic, topic)
-        self._client.publish(complete_topic, payload, qos=2)
-        logger.info("On topic %s published: %s", complete_topic, payload)
+        topic_class, qos = self._qos_policy.classify(complete_topic)
+        if self._publish(complete_topic, payload, qos, topic_class):
+            logger.info("On topic %s published: %s", complete_topic, payload)
 
-    def publish_event(self, topic):
+    def publish_event(self, topic, payload=None):
         """Publish an event on a topic
 
         The method publish an event on the subtopic provided in input (the final topic is the concatenation of
@@ -119,25 +210,218 @@ class MQTTClient(object):
             topic (str): subtopic on which publishing the payload. For instance if the _base_topic of the
                          client wer "home/living_room" and this parameter "movement" the final topic
                          would be "home/living_room/movement"
+            payload (object, optional): the details of the event (for example when it happened), None by
+                                        default; like in publish a document is encoded with the codec of the topic
         """
         topic = "{}/{}".format(self._base_topic, topic)
-        self._client.publish(topic, qos=2)
-        logger.info("Event published on topic %s", topic)
+        topic_class, qos = self._qos_policy.classify(topic, event=True)
+        if self._publish(topic, payload, qos, topic_class):
+            logger.info("Event published on topic %s", topic)
+
+    def decode(self, topic, payload):
+        """Decode a payload received on a topic with the codec of the topic
+
+        Args:
+            topic (str): the complete topic on which the payload was received
+            payload (bytes): the payload
+
+        Returns:
+            object. The document, None for an empty payload
+
+        Raises:
+            ValueError: if the payload cannot be decoded by the codec of the topic
+        """
+        return self.codecs.decode(topic, payload)
+
+    def _publish(self, complete_topic, payload, qos, topic_class):
+        """Hand a message to paho or, if that is not possible, to the outbox
+
+        A document is first encoded with the codec of the topic, if that fails the message is discarded; when
+        the QoS policy requires it, the documents sent with QoS 1 get the next sequence number of the topic
+        as seq (replacing the one set by the publisher, if any).
+        While the broker is not reachable, or if paho refuses the message (for example because its queue
+        is full), the message is stored in the outbox so that it can be replayed later
+
+        Args:
+            complete_topic (str): the complete topic of the message
+            payload (object): the document or the payload (str or bytes) of the message (can be None)
+            qos (int): the quality of service level of the message
+            topic_class (str): the topic class of the message
+
+        Returns:
+            bool. True if the message has been handed to paho, False if it has been stored in the outbox or
+            discarded (the reason is logged)
+        """
+        if payload is not None and not isinstance(payload, (str, bytes, bytearray)):
+            if qos == 1 and self._qos_policy.sequence_numbers and isinstance(payload, dict):
+                payload = dict(payload, seq=self._sequence_numbers.next(complete_topic))
+            try:
+                payload = self.codecs.encode(complete_topic, payload)
+            except ValueError as error:
+                self._metrics["failed"].inc()
+                logger.error("Encoding of the payload on topic %s failed: %s", complete_topic, error)
+                return False
+        if self._outbox is not None and not self._online.is_set():
+            self._outbox.put(complete_topic, payload, qos)
+            self._metrics["stored"].inc()
+            logger.info("Broker not reachable, message on topic %s stored in the outbox", complete_topic)
+            return False
+        started = time.monotonic()
+        result = self._client.publish(complete_topic, payload, qos=qos)
+        if result.rc == mqtt.MQTT_ERR_SUCCESS:
+            self._deliveries.sent(result.mid, topic_class, started)
+            self._metrics["published"].inc()
+            return True
+        self._metrics["failed"].inc()
+        if self._outbox is not None:
+            self._outbox.put(complete_topic, payload, qos)
+            self._metrics["stored"].inc()
+            logger.warning("Publish on topic %s failed (%s), message stored in the outbox",
+                           complete_topic, mqtt.error_string(result.rc))
+        else:
+            logger.warning("Publish on topic %s failed, message discarded: %s", complete_topic,
+                           mqtt.error_string(result.rc))
+        return False
+
+    def _on_connect(self, client, user_data, flags, result_code):
+        """Callback invoked by paho when the connection with the broker is estabilished
+
+        The subscriptions are restored (the session is not persistent) and the replay of the outbox is started
+        """
+        if result_code != 0:
+            logger.error("Connection with MQTT Broker refused: %s", mqtt.connack_string(result_code))
+            return
+        self._online.set()
+        self._metrics["connected"].set(1)
+        with self._callbacks_lock:
+            topic_filters = self._callbacks.filters()
+        for topic_filter in topic_filters:
+            self._client.subscribe(topic_filter, 2)
+        if self._outbox is not None and len(self._outbox):
+            # the replay is performed on a separate thread to not block the network loop
+            threading.Thread(target=self._replay_outbox, name="outbox-replay", daemon=True).start()
+
+    def _on_disconnect(self, client, user_data, result_code):
+        """Callback invoked by paho when the connection with the broker is lost"""
+        self._online.clear()
+        self._metrics["connected"].set(0)
+        if result_code != 0:
+            logger.warning("Connection with MQTT Broker lost, paho will try to reconnect.")
+        with self._inflight_lock:
+            self._inflight.clear()
+            self._acked.clear()
+            self._inflight_lock.notify_all()
+
+    def _on_publish(self, client, user_data, mid):
+        """Callback invoked by paho when a message has been acknowledged by the broker
+
+        The messages replayed from the outbox are removed from it only once acknowledged
+        """
+        self._deliveries.acknowledged(mid)
+        with self._inflight_lock:
+            outbox_id = self._inflight.pop(mid, None)
+            if outbox_id is None:
+                self._acked.add(mid)
+            self._inflight_lock.notify_all()
+        if outbox_id is not None:
+            self._outbox.remove([outbox_id])
+
+    def _replay_outbox(self):
+        """Publish the messages stored in the outbox
+
+        The messages are replayed in batches: a new batch is sent only once the previous one has been
+        acknowledged, this way paho's memory queue never holds more than a batch of replayed messages.
+        The replay stops as soon as the connection is lost, the messages left are replayed at the next
+        connection.
+        """
+        # a quick reconnection could start a second replay while the first one is still running
+        if not self._replay_lock.acquire(blocking=False):
+            return
+        try:
+            self._outbox.evict_expired()
+            logger.info("Replaying %d messages from the outbox", len(self._outbox))
+            while self._online.is_set():
+                batch = self._outbox.peek(self._replay_batch_size)
+                if not batch:
+                    break
+                refused = False
+                for outbox_id, topic, payload, qos in batch:
+                    # paho runs _on_publish holding its own lock, publishing while holding _inflight_lock would
+                    # deadlock against it: an acknowledgement arriving before the message is tracked ends in _acked
+                    started = time.monotonic()
+                    result = self._client.publish(topic, payload, qos=qos)
+                    if result.rc != mqtt.MQTT_ERR_SUCCESS:
+                        refused = True
+                        break
+                    # the outbox doesn't keep whether a message was an event, the class is the one of a message
+                    self._deliveries.sent(result.mid, self._qos_policy.classify(topic)[0], started)
+                    with self._inflight_lock:
+                        if qos == 0 or result.mid in self._acked:
+                            self._acked.discard(result.mid)
+                            self._outbox.remove([outbox_id])
+                        else:
+                            self._inflight[result.mid] = outbox_id
+                with self._inflight_lock:
+                    while self._inflight and self._online.is_set():
+                        self._inflight_lock.wait(timeout=5)
+                if refused:
+                    # paho's queue is full, let's give it some time to drain
+                    time.sleep(1)
+            logger.info("Outbox replay completed, %d messages left", len(self._outbox))
+        finally:
+            self._replay_lock.release()
 
     def register(self, topic, callback):
+        """Register a callback for a subtopic
+
+        The subtopic is concatenated to the base topic and it can contain the MQTT wildcards '+' and '#'.
+        Several callbacks can be registered for the same topic, the broker subscription is performed only
+        when the first one is registered.
+
+        Args:
+            topic (str): the subtopic (or topic filter) to subscribe to
+            callback (callable): the function to call, with the received message, whenever a message
+                                 matching the topic is received
+        """
         complete_topic = "{}/{}".format(self._base_topic, topic)
-        self._callbacks[_topic_to_regex(complete_topic)] = callback
-        self._client.subscribe(complete_topic, 2)
+        with self._callbacks_lock:
+            already_subscribed = self._callbacks.has_filter(complete_topic)
+            self._callbacks.add(complete_topic, callback)
+        if not already_subscribed:
+            self._client.subscribe(complete_topic, 2)
         logger.info("Callback registered for topic %s", complete_topic)
 
-    def unregister(self, topic):
+    def unregister(self, topic, callback=None):
+        """Unregister callbacks from a subtopic
+
+        The broker subscription is dropped once no callback is registered for the topic anymore.
+
+        Args:
+            topic (str): the subtopic (or topic filter) used at registration time
+            callback (callable, optional): the callback to unregister, if None all the callbacks
+                                           registered for the topic are removed
+        """
         complete_topic = "{}/{}".format(self._base_topic, topic)
-        self._client.unsubscribe(complete_topic)
-        del self._callbacks[_topic_to_regex(complete_topic)]
+        with self._callbacks_lock:
+            unsubscribe = self._callbacks.remove(complete_topic, callback)
+        if unsubscribe:
+            self._client.unsubscribe(complete_topic)
         logger.info("Callback unregistered for topic %s", complete_topic)
 
     def on_messagge(self, client, user_data, message):
-        logger.info("Message on topic %s received with payload: %s", message.topic, message.payload)
-        for topic_regex, callback in self._callbacks.items():
-            if topic_regex.match(message.topic):
-                callback(message)
+        logger.debug("Message on topic %s received, %d bytes", message.topic, len(message.payload))
+        self._metrics["received"].inc()
+        # the callbacks are invoked outside the lock, they may register or unregister callbacks themselves
+        with self._callbacks_lock:
+            callbacks = self._callbacks.match(message.topic)
+        for callback in callbacks:
+            callback(message)
+
+    def delivery_stats(self):
+        """Return the messages in flight and the acknowledgement latency of every topic class
+
+        Returns:
+            {str: object}. A dictionary with the key classes, the statistics indexed by topic class (see
+            DeliveryTracker.stats)
+        """
+        return {"classes": self._deliveries.stats()}
@@ -0,0 +1,147 @@
+import os
+import sqlite3
+import threading
+import time
+from .logger import logger
+
+
+class Outbox(object):
+    """A persistent, bounded queue of messages waiting to be delivered to the broker
+
+    The messages are stored in a SQLite database in WAL mode, this way they survive a restart of the process
+    and the writes do not block the readers. The outbox is bounded both in size (once max_messages is reached
+    the oldest messages are evicted) and in age (messages older than max_age seconds are discarded).
+
+    The database is opened by the process using the outbox, at the first use or when open is called: a
+    SQLite connection must not be carried across a fork and the agents get their outbox in the parent
+    process, before being forked.
+
+    Attributes:
+        _path (str): the path of the database file
+        _max_messages (int): the maximum number of messages kept
+        _max_age (float): the maximum age, in seconds, of a message
+        _connection (sqlite3.Connection): the connection to the database, None till it is opened
+        _pid (int): the id of the process that opened the connection
+        _lock (threading.Lock): the lock serializing the access to the connection
+        _count (int): the number of messages currently stored, 0 till the database is opened
+    """
+
+    def __init__(self, path, max_messages=10000, max_age=86400):
+        """Initialize the Outbox, the database is not opened yet
+
+        Args:
+            path (str): the path of the database file
+            max_messages (int): the maximum number of messages kept
+            max_age (float): the maximum age, in seconds, of a message
+        """
+        self._path = path
+        self._max_messages = max_messages
+        self._max_age = max_age
+        self._lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def open(self):
+        """Open (or create) the database in the calling process
+
+        Opening it again in the same process does nothing; in a forked process the connection inherited from
+        the parent is left alone and a new one is opened. The messages older than max_age are discarded.
+        """
+        self._connect()
+
+    def _connect(self):
+        """Return the connection of the calling process, opening it if needed"""
+        if self._pid != os.getpid():
+            # a thread of the parent may have held the lock at the time of the fork
+            self._lock = threading.Lock()
+            self._connection = None
+            self._pid = os.getpid()
+        with self._lock:
+            if self._connection is not None:
+                return self._connection
+            directory = os.path.dirname(self._path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # autocommit mode, every statement is a transaction on its own
+            connection = sqlite3.connect(self._path, check_same_thread=False, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                               "created REAL NOT NULL, topic TEXT NOT NULL, payload BLOB, qos INTEGER NOT NULL)")
+            self._count = connection.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+            self._connection = connection
+        self.evict_expired()
+        return connection
+
+    def put(self, topic, payload, qos):
+        """Store a message
+
+        Args:
+            topic (str): the complete topic of the message
+            payload (str): the payload of the message (can be None)
+            qos (int): the quality of service level of the message
+        """
+        connection = self._connect()
+        with self._lock:
+            connection.execute("INSERT INTO outbox (created, topic, payload, qos) VALUES (?, ?, ?, ?)",
+                               (time.time(), topic, payload, qos))
+            self._count += 1
+            overflow = self._count - self._max_messages
+            if overflow > 0:
+                connection.execute("DELETE FROM outbox WHERE id IN "
+                                   "(SELECT id FROM outbox ORDER BY id LIMIT ?)", (overflow,))
+                self._count -= overflow
+                logger.warning("Outbox full, %d oldest messages discarded", overflow)
+
+    def peek(self, limit):
+        """Return the oldest messages without removing them
+
+        Args:
+            limit (int): the maximum number of messages to return
+
+        Returns:
+            [(int, str, str, int)]. The messages as (id, topic, payload, qos) tuples, oldest first
+        """
+        connection = self._connect()
+        with self._lock:
+            return connection.execute("SELECT id, topic, payload, qos FROM outbox ORDER BY id LIMIT ?",
+                                      (limit,)).fetchall()
+
+    def remove(self, message_ids):
+        """Remove delivered messages
+
+        Args:
+            message_ids ([int]): the ids of the messages to remove
+        """
+        if not message_ids:
+            return
+        connection = self._connect()
+        with self._lock:
+            cursor = connection.executemany("DELETE FROM outbox WHERE id = ?",
+                                            [(message_id,) for message_id in message_ids])
+            self._count -= cursor.rowcount
+
+    def evict_expired(self):
+        """Discard the messages older than max_age
+
+        Returns:
+            int. The number of messages discarded
+        """
+        connection = self._connect()
+        with self._lock:
+            cursor = connection.execute("DELETE FROM outbox WHERE created < ?", (time.time() - self._max_age,))
+            self._count -= cursor.rowcount
+        if cursor.rowcount:
+            logger.warning("%d expired messages discarded from the outbox", cursor.rowcount)
+        return cursor.rowcount
+
+    def close(self):
+        """Close the database, if opened by the calling process"""
+        with self._lock:
+            if self._connection is not None and self._pid == os.getpid():
+                self._connection.close()
+            self._connection = None
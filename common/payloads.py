@@ -0,0 +1,446 @@
+"""The encodings of the payloads published and received by the MQTTClient
+
+The publishers hand documents (dictionaries) to the MQTTClient, which encodes them with the codec of their topic:
+    - JSONCodec ("json"): compact json text, the default
+    - StructCodec ("struct"): a fixed layout binary record meant for the samples, the label is packed as its
+      position in a list shared by publishers and consumers and the unit is not sent at all
+    - CBORCodec ("cbor"): the same documents as the json ones in the binary CBOR format (RFC 8949)
+The CodecTable maps the topics to their codec, the receivers use it to decode the payloads transparently.
+"""
+import json
+import math
+import struct
+import threading
+import time
+from abc import ABCMeta, abstractmethod
+from .topictrie import TopicTrie
+
+
+class Codec(metaclass=ABCMeta):
+    """The base class of the codecs
+
+    Any codec must inherit from this class and implement the abstract methods encode and decode
+
+    Attributes:
+        name (str): the name of the codec, the one used in the configuration
+    """
+    name = None
+
+    @abstractmethod
+    def encode(self, topic, document):
+        """Encode a document
+
+        Args:
+            topic (str): the topic on which the document is published
+            document (object): the document
+
+        Returns:
+            bytes. The payload (a str for the text codecs)
+
+        Raises:
+            ValueError: if the codec cannot encode the document
+        """
+        pass
+
+    @abstractmethod
+    def decode(self, topic, payload):
+        """Decode a payload
+
+        Args:
+            topic (str): the topic on which the payload was received
+            payload (bytes): the payload
+
+        Returns:
+            object. The document
+
+        Raises:
+            ValueError: if the payload is not valid for the codec
+        """
+        pass
+
+
+class JSONCodec(Codec):
+    """Encodes the documents as compact json text"""
+    name = "json"
+
+    def encode(self, topic, document):
+        try:
+            return json.dumps(document, separators=(",", ":"))
+        except TypeError as error:
+            raise ValueError(str(error))
+
+    def decode(self, topic, payload):
+        return json.loads(payload)
+
+
+class StructCodec(Codec):
+    """Encodes the samples as fixed layout binary records
+
+    Two documents are supported, the ones published by the SensorsManager:
+        - a sample published on its label, {"data": float, "unit": str} plus the optional statistics of the
+          aggregated samples (min, max, stddev, last and count) and the optional ts and seq
+        - a batch document, {"seq": int, "ts": float, "samples": [[label, data, unit(, stats)], ...]}
+    All the values are little endian. Every record starts with the version of the layout and its kind
+    (sample or batch, the high bit set when the samples carry their statistics), then:
+        - sample: label id (uint16), seq (uint32), ts (float64), data (float32)
+        - batch: seq (uint32), ts (float64), number of samples (uint16) then label id (uint16) and data
+          (float32) for every sample
+    and, with the statistics, min, max, stddev, last (float32) and count (uint32) after the data of every
+    sample. A sample is 20 bytes (40 with the statistics) against the 24 to 30 bytes of its json text, which
+    has neither seq nor ts. The values are single precision floats, decoded with 7 significant digits. The
+    samples published without a seq get the next one of their label, the ones without a ts the current time.
+    A decoded sample document has the label, ts and seq keys besides the ones of the json document.
+
+    Attributes:
+        _labels ([(str, str)]): the (label, unit) known by the codec, the id of a label is its position
+        _ids ({str: int}): the ids of the labels indexed by label
+        _sequences ({str: int}): the last seq given to the samples published without one, indexed by label
+        _lock (threading.Lock): the lock protecting _sequences
+    """
+    name = "struct"
+    VERSION = 1
+    SAMPLE = 1
+    BATCH = 2
+    STATS = 0x80
+    _HEADER = struct.Struct("<BB")
+    _SAMPLE = struct.Struct("<HIdf")
+    _BATCH = struct.Struct("<IdH")
+    _ITEM = struct.Struct("<Hf")
+    _STATS = struct.Struct("<ffffI")
+    _STATS_KEYS = ("min", "max", "stddev", "last")
+
+    def __init__(self, labels):
+        """Initialize the StructCodec
+
+        Args:
+            labels ([(str, str)]): the (label, unit) known by the codec, publishers and consumers must share
+                                   the same list (new labels can only be appended)
+        """
+        self._labels = list(labels)
+        self._ids = {label: index for index, (label, _) in enumerate(self._labels)}
+        self._sequences = {}
+        self._lock = threading.Lock()
+
+    def _label_id(self, label):
+        try:
+            return self._ids[label]
+        except KeyError:
+            raise ValueError("Label {} unknown to the struct codec".format(label))
+
+    @classmethod
+    def _pack_stats(cls, stats):
+        return cls._STATS.pack(*[stats[key] for key in cls._STATS_KEYS], stats["count"])
+
+    @classmethod
+    def _unpack_stats(cls, payload, offset):
+        values = cls._STATS.unpack_from(payload, offset)
+        stats = {key: cls._decode_float(value) for key, value in zip(cls._STATS_KEYS, values)}
+        stats["count"] = values[-1]
+        return stats
+
+    @staticmethod
+    def _decode_float(value):
+        # a float32 has about 7 significant digits, the rest is noise of the conversion
+        return float("{:.7g}".format(value))
+
+    def encode(self, topic, document):
+        try:
+            if "samples" in document:
+                return self._encode_batch(document)
+            return self._encode_sample(topic.rsplit("/", 1)[-1], document)
+        except (KeyError, IndexError, TypeError, struct.error) as error:
+            raise ValueError("Document not supported by the struct codec: {}".format(error))
+
+    def _encode_sample(self, label, document):
+        label_id = self._label_id(label)
+        sequence = document.get("seq")
+        if sequence is None:
+            with self._lock:
+                sequence = self._sequences[label] = (self._sequences.get(label, 0) + 1) & 0xFFFFFFFF
+        with_stats = "count" in document
+        payload = self._HEADER.pack(self.VERSION, self.SAMPLE | (self.STATS if with_stats else 0)) + \
+            self._SAMPLE.pack(label_id, sequence, document.get("ts", time.time()), document["data"])
+        if with_stats:
+            payload += self._pack_stats(document)
+        return payload
+
+    def _encode_batch(self, document):
+        samples = document["samples"]
+        with_stats = any(len(sample) > 3 for sample in samples)
+        parts = [self._HEADER.pack(self.VERSION, self.BATCH | (self.STATS if with_stats else 0)),
+                 self._BATCH.pack(document["seq"], document["ts"], len(samples))]
+        for sample in samples:
+            parts.append(self._ITEM.pack(self._label_id(sample[0]), sample[1]))
+            if with_stats:
+                parts.append(self._pack_stats(sample[3]))
+        return b"".join(parts)
+
+    def decode(self, topic, payload):
+        try:
+            version, kind = self._HEADER.unpack_from(payload)
+            if version != self.VERSION:
+                raise ValueError("Unsupported struct record version {}".format(version))
+            with_stats = bool(kind & self.STATS)
+            if kind & ~self.STATS == self.SAMPLE:
+                return self._decode_sample(payload, with_stats)
+            if kind & ~self.STATS == self.BATCH:
+                return self._decode_batch(payload, with_stats)
+        except (struct.error, IndexError) as error:
+            raise ValueError("Invalid struct record: {}".format(error))
+        raise ValueError("Unsupported struct record kind {}".format(kind))
+
+    def _decode_sample(self, payload, with_stats):
+        label_id, sequence, timestamp, data = self._SAMPLE.unpack_from(payload, self._HEADER.size)
+        label, unit = self._labels[label_id]
+        document = {"data": self._decode_float(data), "unit": unit, "label": label, "ts": timestamp,
+                    "seq": sequence}
+        if with_stats:
+            document.update(self._unpack_stats(payload, self._HEADER.size + self._SAMPLE.size))
+        return document
+
+    def _decode_batch(self, payload, with_stats):
+        sequence, timestamp, count = self._BATCH.unpack_from(payload, self._HEADER.size)
+        offset = self._HEADER.size + self._BATCH.size
+        samples = []
+        for _ in range(count):
+            label_id, data = self._ITEM.unpack_from(payload, offset)
+            offset += self._ITEM.size
+            label, unit = self._labels[label_id]
+            sample = [label, self._decode_float(data), unit]
+            if with_stats:
+                sample.append(self._unpack_stats(payload, offset))
+                offset += self._STATS.size
+            samples.append(sample)
+        return {"seq": sequence, "ts": timestamp, "samples": samples}
+
+
+class CBORCodec(Codec):
+    """Encodes the documents in the CBOR format (RFC 8949)
+
+    The subset of CBOR needed by json like documents is supported: integers, floats, strings, byte strings,
+    arrays, maps, booleans and null, with definite lengths only. The floats are encoded in single precision
+    when that doesn't lose anything, in double precision otherwise.
+    """
+    name = "cbor"
+    _FLOAT32 = struct.Struct(">f")
+    _FLOAT64 = struct.Struct(">d")
+
+    @staticmethod
+    def _head(major, value):
+        """Encode the initial byte of a data item and its argument"""
+        major <<= 5
+        if value < 24:
+            return bytes((major | value,))
+        if value < 0x100:
+            return bytes((major | 24, value))
+        if value < 0x10000:
+            return bytes((major | 25,)) + value.to_bytes(2, "big")
+        if value < 0x100000000:
+            return bytes((major | 26,)) + value.to_bytes(4, "big")
+        if value < 0x10000000000000000:
+            return bytes((major | 27,)) + value.to_bytes(8, "big")
+        raise ValueError("Integer {} too large for CBOR".format(value))
+
+    def _encode_item(self, item, parts):
+        if item is None:
+            parts.append(b"\xf6")
+        elif item is True:
+            parts.append(b"\xf5")
+        elif item is False:
+            parts.append(b"\xf4")
+        elif isinstance(item, int):
+            parts.append(self._head(0, item) if item >= 0 else self._head(1, -1 - item))
+        elif isinstance(item, float):
+            single = self._FLOAT32.pack(item) if math.isfinite(item) and abs(item) < 3.4e38 else None
+            if single is not None and self._FLOAT32.unpack(single)[0] == item:
+                parts.append(b"\xfa" + single)
+            else:
+                parts.append(b"\xfb" + self._FLOAT64.pack(item))
+        elif isinstance(item, str):
+            encoded = item.encode("utf-8")
+            parts.append(self._head(3, len(encoded)))
+            parts.append(encoded)
+        elif isinstance(item, (bytes, bytearray)):
+            parts.append(self._head(2, len(item)))
+            parts.append(bytes(item))
+        elif isinstance(item, (list, tuple)):
+            parts.append(self._head(4, len(item)))
+            for element in item:
+                self._encode_item(element, parts)
+        elif isinstance(item, dict):
+            parts.append(self._head(5, len(item)))
+            for key, value in item.items():
+                self._encode_item(key, parts)
+                self._encode_item(value, parts)
+        else:
+            raise ValueError("Type {} not supported by the CBOR codec".format(type(item).__name__))
+
+    def encode(self, topic, document):
+        parts = []
+        self._encode_item(document, parts)
+        return b"".join(parts)
+
+    def _decode_item(self, payload, offset):
+        """Decode the data item starting at offset
+
+        Returns:
+            (object, int). The item and the offset of the next one
+        """
+        initial = payload[offset]
+        major, info = initial >> 5, initial & 0x1F
+        offset += 1
+        if major == 7:
+            if info == 20:
+                return False, offset
+            if info == 21:
+                return True, offset
+            if info in (22, 23):
+                return None, offset
+            if info == 25:
+                return struct.unpack_from(">e", payload, offset)[0], offset + 2
+            if info == 26:
+                return self._FLOAT32.unpack_from(payload, offset)[0], offset + 4
+            if info == 27:
+                return self._FLOAT64.unpack_from(payload, offset)[0], offset + 8
+            raise ValueError("Unsupported CBOR simple value {}".format(info))
+        if info < 24:
+            value = info
+        elif info <= 27:
+            size = 1 << (info - 24)
+            if offset + size > len(payload):
+                raise ValueError("Truncated CBOR payload")
+            value = int.from_bytes(payload[offset:offset + size], "big")
+            offset += size
+        else:
+            raise ValueError("Unsupported CBOR length {}".format(info))
+        if major == 0:
+            return value, offset
+        if major == 1:
+            return -1 - value, offset
+        if major in (2, 3):
+            if offset + value > len(payload):
+                raise ValueError("Truncated CBOR payload")
+            data = bytes(payload[offset:offset + value])
+            return (data.decode("utf-8") if major == 3 else data), offset + value
+        if major == 4:
+            items = []
+            for _ in range(value):
+                item, offset = self._decode_item(payload, offset)
+                items.append(item)
+            return items, offset
+        if major == 5:
+            document = {}
+            for _ in range(value):
+                key, offset = self._decode_item(payload, offset)
+                document[key], offset = self._decode_item(payload, offset)
+            return document, offset
+        raise ValueError("Unsupported CBOR major type {}".format(major))
+
+    def decode(self, topic, payload):
+        try:
+            document, offset = self._decode_item(payload, 0)
+        except (IndexError, struct.error, UnicodeDecodeError) as error:
+            raise ValueError("Invalid CBOR payload: {}".format(error))
+        if offset != len(payload):
+            raise ValueError("{} bytes after the CBOR document".format(len(payload) - offset))
+        return document
+
+
+class CodecTable(object):
+    """The codec of every topic
+
+    The rules map topic filters (subtopics of the base topic, with the MQTT wildcards) to codecs, the first
+    rule matching a topic gives its codec, the topics not matched by any rule get the default codec. The
+    lookups are cached per topic.
+
+    Attributes:
+        _trie (TopicTrie): the filters of the rules, every one mapped to its (position, codec)
+        _default (Codec): the codec of the topics not matched by any rule
+        _cache ({str: Codec}): the codec of the topics already looked up
+    """
+    _MAX_CACHED_TOPICS = 1024
+
+    def __init__(self, rules=(), default=None, base_topic=""):
+        """Initialize the CodecTable
+
+        Args:
+            rules ([(str, Codec)], optional): the (topic filter, codec) rules, in order of precedence
+            default (Codec, optional): the codec of the topics not matched by any rule, json by default
+            base_topic (str, optional): the base topic of the client, the filters are relative to it
+
+        Raises:
+            ValueError: if a filter is not a valid MQTT topic filter
+        """
+        self._trie = TopicTrie()
+        for index, (topic_filter, codec) in enumerate(rules):
+            self._trie.add("{}/{}".format(base_topic, topic_filter) if base_topic else topic_filter,
+                           (index, codec))
+        self._default = default if default is not None else JSONCodec()
+        self._cache = {}
+
+    def codec_for(self, topic):
+        """Return the codec of a topic
+
+        Args:
+            topic (str): the complete topic
+
+        Returns:
+            Codec
+        """
+        codec = self._cache.get(topic)
+        if codec is None:
+            matches = self._trie.match(topic)
+            codec = min(matches, key=lambda match: match[0])[1] if matches else self._default
+            # the topics received through wildcards are not bounded, nor is the cache then
+            if len(self._cache) >= self._MAX_CACHED_TOPICS:
+                self._cache.clear()
+            self._cache[topic] = codec
+        return codec
+
+    def encode(self, topic, document):
+        """Encode a document with the codec of its topic
+
+        Args:
+            topic (str): the complete topic
+            document (object): the document
+
+        Returns:
+            bytes. The payload (a str for the text codecs)
+        """
+        return self.codec_for(topic).encode(topic, document)
+
+    def decode(self, topic, payload):
+        """Decode a payload with the codec of its topic, an empty payload is decoded as None
+
+        Args:
+            topic (str): the complete topic
+            payload (bytes): the payload
+
+        Returns:
+            object. The document
+        """
+        if not payload:
+            return None
+        return self.codec_for(topic).decode(topic, payload)
+
+
+def get_codec(name, struct_labels=()):
+    """Return a codec by name
+
+    Args:
+        name (str): the name of the codec, one of "json", "struct" and "cbor"
+        struct_labels ([(str, str)], optional): the (label, unit) known by the struct codec
+
+    Returns:
+        Codec
+
+    Raises:
+        ValueError: if the codec is not supported
+    """
+    if name == JSONCodec.name:
+        return JSONCodec()
+    if name == StructCodec.name:
+        return StructCodec(struct_labels)
+    if name == CBORCodec.name:
+        return CBORCodec()
+    raise ValueError("Unsupported codec {}".format(name))
@@ -0,0 +1,196 @@
+"""The registry of the sensors and actions available to PiHome
+
+Besides the built-in ones, sensors and actions can be provided by other distributions through the entry
+point groups "pihome.sensors" and "pihome.actions"; for example a package shipping a sensor would declare
+in its setup.py:
+
+    entry_points={"pihome.sensors": ["sht31 = pihome_sht31:SHT31Sensor"],
+                  "pihome.actions": ["notify = pihome_sht31.actions:notify"]}
+
+The name of a sensor is the one used in the sensors_list of pihome.ini (and its parameters are read from
+the section with the same name), the name of an action is the one used in topics_and_actions.
+Scanning the installed distributions is slow on a Raspberry Pi, the entry points found are therefore saved
+in an index file and scanned again only when a distribution is installed, upgraded or removed. The modules of
+the plugins are imported only when a sensor or an action is actually requested.
+"""
+import importlib
+import json
+import os
+import sys
+import threading
+from .logger import logger
+
+SENSORS = "pihome.sensors"
+ACTIONS = "pihome.actions"
+
+# the built-in plugins, the module paths are relative to the PiHome package
+_BUILTINS = {SENSORS: {"dht": ".sensors.dhtsensor:DHTSensor",
+                       "bmp": ".sensors.bmpsensor:BMPSensor"},
+             ACTIONS: {"print_message": ".actions.actions:print_message"}}
+_ROOT_PACKAGE = __package__.rsplit(".", 1)[0]
+_METADATA_SUFFIXES = (".dist-info", ".egg-info", ".egg-link", ".pth")
+_INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "plugins.cache")
+
+
+class PluginRegistry(object):
+    """The index of the available plugins, loaded on demand
+
+    Attributes:
+        _index_path (str): the path of the file caching the entry points found, if None they are not cached
+        _paths ([str]): the directories searched for distributions (sys.path by default)
+        _index ({str: {str: str}}): the targets ("module:attribute") of the plugins indexed by group and name,
+                                    None till the first lookup
+        _loaded ({(str, str): object}): the plugins already imported indexed by (group, name)
+        _lock (threading.Lock): the lock protecting the index and the loaded plugins
+    """
+
+    def __init__(self, index_path=_INDEX_PATH, paths=None):
+        """Initialize the PluginRegistry
+
+        Args:
+            index_path (str, optional): the path of the index file, None disables it
+            paths ([str], optional): the directories searched for distributions, by default sys.path
+        """
+        self._index_path = index_path
+        self._paths = paths
+        self._index = None
+        self._loaded = {}
+        self._lock = threading.Lock()
+
+    def _signature(self):
+        """Return the metadata directories of the distributions installed in every directory of the search path
+
+        Installing, upgrading or removing a distribution adds or removes a metadata directory (named after
+        the distribution and its version)
+        """
+        signature = []
+        for path in (self._paths if self._paths is not None else sys.path):
+            try:
+                names = os.listdir(path or ".")
+            except OSError:
+                continue
+            distributions = sorted(name for name in names if name.endswith(_METADATA_SUFFIXES))
+            if distributions:
+                signature.append([path, distributions])
+        return signature
+
+    def _scan(self):
+        """Return the entry points of the installed distributions
+
+        Returns:
+            {str: {str: str}}. The targets of the entry points indexed by group and name
+        """
+        from importlib import metadata
+        entry_points = metadata.entry_points()
+        found = {}
+        for group in (SENSORS, ACTIONS):
+            if hasattr(entry_points, "select"):
+                group_entry_points = entry_points.select(group=group)
+            else:
+                group_entry_points = entry_points.get(group, [])
+            found[group] = {entry_point.name: entry_point.value for entry_point in group_entry_points}
+        return found
+
+    def _load_index(self):
+        """Return the index of the plugins, from the index file if it is still valid"""
+        signature = self._signature()
+        if self._index_path is not None:
+            try:
+                with open(self._index_path, "r") as index_file:
+                    index = json.load(index_file)
+                if index["signature"] == signature:
+                    return index["plugins"]
+            except (OSError, ValueError, KeyError):
+                pass
+        plugins = self._scan()
+        logger.info("Plugins found: %s", ", ".join("{} ({})".format(name, group) for group in sorted(plugins)
+                                                   for name in sorted(plugins[group])) or "none")
+        if self._index_path is not None:
+            try:
+                temporary_path = "{}.{}.tmp".format(self._index_path, os.getpid())
+                with open(temporary_path, "w") as index_file:
+                    json.dump({"signature": signature, "plugins": plugins}, index_file)
+                os.replace(temporary_path, self._index_path)
+            except OSError:
+                pass
+        return plugins
+
+    def _targets(self, group):
+        with self._lock:
+            if self._index is None:
+                self._index = self._load_index()
+            targets = dict(self._index.get(group, {}))
+        for name in set(targets) & set(_BUILTINS[group]):
+            logger.warning("Plugin %s of %s ignored, it has the name of a built-in one", targets[name], group)
+        targets.update(_BUILTINS[group])
+        return targets
+
+    def names(self, group):
+        """Return the names of the plugins of a group
+
+        Args:
+            group (str): the group, SENSORS or ACTIONS
+
+        Returns:
+            [str]. The names of the plugins, sorted
+        """
+        return sorted(self._targets(group))
+
+    def load(self, group, name):
+        """Import a plugin
+
+        Args:
+            group (str): the group, SENSORS or ACTIONS
+            name (str): the name of the plugin
+
+        Returns:
+            object. The object the entry point refers to (a Sensor subclass or an action)
+
+        Raises:
+            KeyError: if there is no plugin with that name
+        """
+        key = (group, name)
+        plugin = self._loaded.get(key)
+        if plugin is not None:
+            return plugin
+        # the built-in plugins don't require the index
+        target = _BUILTINS[group].get(name) or self._targets(group).get(name)
+        if target is None:
+            raise KeyError("No plugin {} in {}".format(name, group))
+        module_name, _, attribute = target.partition(":")
+        module = importlib.import_module(module_name, _ROOT_PACKAGE if module_name.startswith(".") else None)
+        plugin = module
+        for part in attribute.split(".") if attribute else []:
+            plugin = getattr(plugin, part)
+        with self._lock:
+            self._loaded[key] = plugin
+        return plugin
+
+    def sensor(self, name):
+        """Import a sensor plugin, see load"""
+        return self.load(SENSORS, name)
+
+    def action(self, name):
+        """Import an action plugin, see load"""
+        return self.load(ACTIONS, name)
+
+    def refresh(self):
+        """Forget the index, the distributions are scanned again at the next lookup"""
+        with self._lock:
+            self._index = None
+            if self._index_path is not None:
+                try:
+                    os.remove(self._index_path)
+                except OSError:
+                    pass
+
+
+_registry = None
+
+
+def get_registry():
+    """Return the registry shared by the whole process"""
+    global _registry
+    if _registry is None:
+        _registry = PluginRegistry()
+    return _registry
@@ -1,14 +1,23 @@
+import heapq
+import math
 import multiprocessing
 import threading
 import signal
+import time
+from ..common import metrics
 from ..common.logger import logger
 
+# the amount of time, in seconds, run_async sleeps between two checks of an empty task heap
+_IDLE_POLL = 1
+
 
 class StoppableProcess(multiprocessing.Process):
     """This is a generic class to be extendend to implement Processes that terminate in a controlled way
 
     The class register its internal method _shutdown as a callback when receiving the SIGTERM and SIGINT
-    signals, this way cleanup operations can be performed before terminating the process.
+    signals, this way cleanup operations can be performed before terminating the process. The callbacks are
+    registered by the running process (see _register_signal_handlers) since a signal handler is per process,
+    registering it at init time would let the last instance created steal the signals of the others.
     It is important to remember that the operations performed within the _shutdown method MUST lead to the
     termination of the process in a finite amount of time (in fact since the SIGTERM and SIGINT signals are
     intercepted they are not terminating the process anymore)
@@ -18,10 +27,16 @@ class StoppableProcess(multiprocessing.Process):
     def __init__(self):
         """Initialize an instance of StoppableProcess
         """
+        super(StoppableProcess, self).__init__()
+
+    def _register_signal_handlers(self):
+        """Register the _shutdown method as the handler of SIGTERM and SIGINT
+
+        The method must be called within the running process (at the beginning of run)
+        """
         # register the shutdown method when a SIGTERM is detected to perform a clean process termination
         signal.signal(signal.SIGTERM, self._shutdown)
         signal.signal(signal.SIGINT, self._shutdown)
-        super(StoppableProcess, self).__init__()
 
     def _shutdown(self, signum, frame):
         """Stop internal operations
@@ -36,6 +51,98 @@ class StoppableProcess(multiprocessing.Process):
         pass
 
 
+class ScheduledTask(object):
+    """A task executed periodically by StoppableLoopProcess
+
+    The task keeps its own timing statistics: the lateness of an execution is the difference between the
+    time it actually started and the time it was due, the jitter is the standard deviation of the lateness.
+    The lateness, the duration and the skipped executions are reported into the metrics too, labelled with
+    the name of the agent and of the task.
+
+    Attributes:
+        name (str): the name of the task
+        callback (callable): the function to execute
+        interval (float): the amount of time, in seconds, between two executions
+        next_due (float): the monotonic time at which the task must be executed again
+        runs (int): the number of executions
+        skipped (int): the number of executions skipped because the process fell behind by more than an interval
+        lateness_max (float): the maximum lateness observed
+        _lateness_mean (float): the mean lateness (updated incrementally)
+        _lateness_m2 (float): the sum of the squared differences from the mean (Welford's algorithm)
+        _lateness_metric (Histogram): the lateness of the executions, in the metrics
+        _duration_metric (Histogram): the duration of the executions, in the metrics
+        _skipped_metric (Counter): the executions skipped, in the metrics
+    """
+    __slots__ = ("name", "callback", "interval", "next_due", "runs", "skipped", "lateness_max",
+                 "_lateness_mean", "_lateness_m2", "_lateness_metric", "_duration_metric", "_skipped_metric")
+
+    def __init__(self, name, callback, interval, next_due, agent=""):
+        self.name = name
+        self.callback = callback
+        self.interval = interval
+        self.next_due = next_due
+        self.runs = 0
+        self.skipped = 0
+        self.lateness_max = 0.0
+        self._lateness_mean = 0.0
+        self._lateness_m2 = 0.0
+        registry = metrics.get_registry()
+        self._lateness_metric = registry.histogram("task_lateness_seconds", "Delay of the task executions",
+                                                   agent=agent, task=name)
+        self._duration_metric = registry.histogram("task_duration_seconds", "Duration of the task executions",
+                                                   agent=agent, task=name)
+        self._skipped_metric = registry.counter("task_skipped_total", "Task executions skipped",
+                                                agent=agent, task=name)
+
+    def __lt__(self, other):
+        return self.next_due < other.next_due
+
+    def record_start(self, started):
+        """Record the start of an execution and compute the next due time
+
+        The next due time is computed from the previous one (and not from the time the execution completes),
+        this way the period does not drift by the duration of the execution. If the process fell behind by
+        more than an interval the missed executions are skipped instead of being run in a burst.
+
+        Args:
+            started (float): the monotonic time at which the execution started
+        """
+        lateness = started - self.next_due
+        self.runs += 1
+        delta = lateness - self._lateness_mean
+        self._lateness_mean += delta / self.runs
+        self._lateness_m2 += delta * (lateness - self._lateness_mean)
+        self.lateness_max = max(self.lateness_max, lateness)
+        self._lateness_metric.observe(lateness)
+        self.next_due += self.interval
+        while self.next_due <= started:
+            self.next_due += self.interval
+            self.skipped += 1
+            self._skipped_metric.inc()
+
+    def execute(self):
+        """Execute the callback recording its duration"""
+        started = time.monotonic()
+        try:
+            self.callback()
+        finally:
+            self._duration_metric.observe(time.monotonic() - started)
+
+    def stats(self):
+        """Return the timing statistics of the task
+
+        Returns:
+            {str: float}. A dictionary with the keys: interval, runs, skipped, lateness_avg, lateness_max and
+            jitter (all the times are in seconds)
+        """
+        return {"interval": self.interval,
+                "runs": self.runs,
+                "skipped": self.skipped,
+                "lateness_avg": self._lateness_mean,
+                "lateness_max": self.lateness_max,
+                "jitter": math.sqrt(self._lateness_m2 / self.runs) if self.runs else 0.0}
+
+
 class StoppableLoopProcess(StoppableProcess):
     """This is a generic class to be extended to implement a process performing a task repetedly over time.
 
@@ -46,10 +153,19 @@ class StoppableLoopProcess(StoppableProcess):
         - _loop must perform the core operation to be repeated over time. The execution frequency is configurable
         - _teardown must perform all the operation to be done before terminating the process after the loop is stopped
 
+    The executions are driven by a deadline scheduler based on the monotonic clock: every task has its own
+    interval and its next due time is computed from the previous one, so the period doesn't drift by the time
+    spent executing the task. By default the only task is _loop, executed every loop_interval seconds, but
+    _setup can register any number of tasks, each with its own interval, through the _schedule method (in
+    that case _loop is not executed).
+
     Attributes:
         _stop_looping (threading.Event): this is the event used to perform an interruptible sleep. It mustn't be
                                          directly accessed.
-        _loop_interval (int): the amount of time, in seconds, to wait between each loop iteration
+        _loop_interval (int): the amount of time, in seconds, between each loop iteration
+        _tasks ([ScheduledTask]): the heap of the scheduled tasks ordered by next due time
+        _task_scheduled (threading.Event): the event set when a task is scheduled (or the process must stop),
+                                           waited for while there is no task to execute
     """
 
     def __init__(self, loop_interval):
@@ -64,6 +180,8 @@ class StoppableLoopProcess(StoppableProcess):
         """
         self._stop_looping = threading.Event()
         self._loop_interval = loop_interval
+        self._tasks = []
+        self._task_scheduled = threading.Event()
         super(StoppableLoopProcess, self).__init__()
 
     def _shutdown(self, signum, frame):
@@ -79,6 +197,7 @@ class StoppableLoopProcess(StoppableProcess):
         """
         logger.warning("Terminatin process. Signal %d received while in frame %s", signum, frame)
         self._stop_looping.set()
+        self._task_scheduled.set()
 
     def _wait(self, time_interval):
         """This method perform an interruptible sleep
@@ -91,6 +210,70 @@ class StoppableLoopProcess(StoppableProcess):
         """
         self._stop_looping.wait(timeout=time_interval)
 
+    def _schedule(self, name, interval, callback, delay=0):
+        """Register a task to be executed periodically
+
+        Args:
+            name (str): the name of the task (used in logs and statistics)
+            interval (float): the amount of time, in seconds, between two executions
+            callback (callable): the function to execute, it receives no arguments
+            delay (float, optional): the amount of time, in seconds, before the first execution
+        """
+        heapq.heappush(self._tasks, ScheduledTask(name, callback, interval, time.monotonic() + delay,
+                                                  agent=type(self).__name__))
+        self._task_scheduled.set()
+
+    def _unschedule(self, name):
+        """Remove a task
+
+        Args:
+            name (str): the name of the task
+
+        Returns:
+            ScheduledTask. The task removed, None if there was no task with that name
+        """
+        for index, task in enumerate(self._tasks):
+            if task.name == name:
+                self._tasks[index] = self._tasks[-1]
+                self._tasks.pop()
+                heapq.heapify(self._tasks)
+                return task
+        return None
+
+    def scheduler_stats(self):
+        """Return the timing statistics of the scheduled tasks
+
+        Returns:
+            {str: {str: float}}. The statistics (see ScheduledTask.stats) indexed by task name
+        """
+        return {task.name: task.stats() for task in self._tasks}
+
+    def _run_due_tasks(self):
+        """Execute the tasks that are due, or sleep till the next one is
+
+        The sleep is interruptible, as soon as the process is asked to terminate the method returns. A task
+        raising an exception is logged and executed again when due, like in run_async: it must not take the
+        other tasks of the process down with it. Without any task (for example once all the sensors have been
+        removed) the method sleeps till a task is scheduled or the process is asked to terminate
+        """
+        self._task_scheduled.clear()
+        if not self._tasks:
+            if not self._stop_looping.is_set():
+                self._task_scheduled.wait()
+            return
+        now = time.monotonic()
+        if self._tasks[0].next_due > now:
+            self._wait(self._tasks[0].next_due - now)
+            return
+        task = heapq.heappop(self._tasks)
+        task.record_start(now)
+        try:
+            task.execute()
+        except Exception:
+            logger.exception("Task %s failed", task.name)
+        finally:
+            heapq.heappush(self._tasks, task)
+
     def _setup(self):
         """Perform all the operations to be done before the main loop
 
@@ -115,20 +298,66 @@ class StoppableLoopProcess(StoppableProcess):
         """
         pass
 
+    def _log_scheduler_stats(self):
+        for name, stats in self.scheduler_stats().items():
+            logger.info("Task %s: %d runs, %d skipped, lateness avg %.3f s max %.3f s, jitter %.3f s", name,
+                        stats["runs"], stats["skipped"], stats["lateness_avg"], stats["lateness_max"], stats["jitter"])
+
     def run(self):
         """Method executed once the process is started
 
         This method calls the 3 methods that the user extending the class should override to properly have a task
-        periodically executed. It callse the _setup, then it loop over the _loop method and once the process receive
-        the order to terminate (a SIGTERM or SIGINT) it perform the _teardown
+        periodically executed. It callse the _setup, then it executes the scheduled tasks (by default only the _loop
+        method) and once the process receive the order to terminate (a SIGTERM or SIGINT) it perform the _teardown
         """
+        self._register_signal_handlers()
         self._setup()
+        if not self._tasks:
+            self._schedule("loop", self._loop_interval, self._loop)
 
         while not self._stop_looping.is_set():
-            self._loop()
             # to be able to gracefully stop sleeping in case of process temination we do use an event that is set to
-            # true when the process has to terminate; therefore if the process is not terminated this wait will act
-            # as a sleep for the timeout time
-            self._wait(self._loop_interval)
+            # true when the process has to terminate; therefore if the process is not terminated the wait performed
+            # till the next due task acts as a sleep
+            self._run_due_tasks()
 
         self._teardown()
+        self._log_scheduler_stats()
+
+    async def run_async(self, stop):
+        """Coroutine executing the process as an asyncio task instead of a separate process
+
+        The coroutine does what run does but, instead of sleeping, it awaits the next due task; _setup, _teardown
+        and the tasks, which may block, are executed on the default executor of the event loop. This way several
+        instances can share a single process (and a single MQTT client), see runtime.AgentRuntime.
+
+        Args:
+            stop (asyncio.Event): the event to set to terminate the coroutine
+        """
+        # imported here since it is needed only by the single process runtime
+        import asyncio
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._setup)
+        if not self._tasks:
+            self._schedule("loop", self._loop_interval, self._loop)
+        try:
+            while not stop.is_set() and not self._stop_looping.is_set():
+                # without any task the coroutine checks every _IDLE_POLL seconds if one has been scheduled
+                delay = self._tasks[0].next_due - time.monotonic() if self._tasks else _IDLE_POLL
+                if delay > 0:
+                    try:
+                        await asyncio.wait_for(stop.wait(), timeout=delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                task = heapq.heappop(self._tasks)
+                task.record_start(time.monotonic())
+                try:
+                    await loop.run_in_executor(None, task.execute)
+                except Exception:
+                    logger.exception("Task %s failed", task.name)
+                finally:
+                    heapq.heappush(self._tasks, task)
+        finally:
+            await loop.run_in_executor(None, self._teardown)
+            self._log_scheduler_stats()
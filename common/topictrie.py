@@ -0,0 +1,187 @@
+class _TrieNode(object):
+    """A node of the TopicTrie
+
+    Attributes:
+        children ({str: _TrieNode}): the child nodes indexed by topic level (wildcards included)
+        callbacks ([callable]): the callbacks registered for the filter ending at this node
+    """
+    __slots__ = ("children", "callbacks")
+
+    def __init__(self):
+        self.children = {}
+        self.callbacks = []
+
+
+class TopicTrie(object):
+    """A segment level trie mapping MQTT topic filters to callbacks
+
+    The trie stores every subscription filter splitted on the '/' separator, one level per node,
+    this way looking up the callbacks to invoke for an incoming topic costs O(topic depth) instead
+    of O(registered filters). The MQTT wildcards follow the semantic of the MQTT 3.1.1 specification:
+        - '+' matches exactly one topic level (an empty one included)
+        - '#' matches the parent level and any number of child levels, it must be the last level of a filter
+        - topics starting with '$' are not matched by filters starting with a wildcard
+
+    Several callbacks can be registered for the same filter.
+
+    Attributes:
+        _root (_TrieNode): the root of the trie
+        _size (int): the number of distinct filters currently stored in the trie
+    """
+
+    def __init__(self):
+        """Initialize an empty TopicTrie"""
+        self._root = _TrieNode()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @staticmethod
+    def _validate(topic_filter):
+        """Check that a topic filter is well formed
+
+        Args:
+            topic_filter (str): the filter to validate
+
+        Raises:
+            ValueError: if the filter is empty or its wildcards are misplaced
+        """
+        if not topic_filter:
+            raise ValueError("Topic filter must not be empty")
+        levels = topic_filter.split("/")
+        for index, level in enumerate(levels):
+            if "#" in level and (level != "#" or index != len(levels) - 1):
+                raise ValueError("Invalid topic filter {}: '#' must be the last level".format(topic_filter))
+            if "+" in level and level != "+":
+                raise ValueError("Invalid topic filter {}: '+' must occupy an entire level".format(topic_filter))
+        return levels
+
+    def add(self, topic_filter, callback):
+        """Register a callback for a topic filter
+
+        Args:
+            topic_filter (str): the topic filter (it can contain the '+' and '#' wildcards)
+            callback (callable): the callback to invoke when a matching topic is looked up
+
+        Raises:
+            ValueError: if the filter is not a valid MQTT topic filter
+        """
+        node = self._root
+        for level in self._validate(topic_filter):
+            child = node.children.get(level)
+            if child is None:
+                child = _TrieNode()
+                node.children[level] = child
+            node = child
+        if not node.callbacks:
+            self._size += 1
+        node.callbacks.append(callback)
+
+    def remove(self, topic_filter, callback=None):
+        """Unregister callbacks from a topic filter
+
+        Args:
+            topic_filter (str): the topic filter the callbacks were registered for
+            callback (callable, optional): the callback to remove, if None all the callbacks
+                                           registered for the filter are removed
+
+        Returns:
+            bool. True if no callback is registered for the filter anymore, False otherwise
+        """
+        path = [self._root]
+        for level in topic_filter.split("/"):
+            child = path[-1].children.get(level)
+            if child is None:
+                return True
+            path.append(child)
+
+        node = path[-1]
+        had_callbacks = bool(node.callbacks)
+        if callback is None:
+            node.callbacks = []
+        elif callback in node.callbacks:
+            node.callbacks.remove(callback)
+        if had_callbacks and not node.callbacks:
+            self._size -= 1
+
+        # prune the branches that do not lead to any callback anymore
+        levels = topic_filter.split("/")
+        for depth in range(len(levels), 0, -1):
+            current = path[depth]
+            if current.callbacks or current.children:
+                break
+            del path[depth - 1].children[levels[depth - 1]]
+        return not node.callbacks
+
+    def has_filter(self, topic_filter):
+        """Check if at least a callback is registered for a topic filter
+
+        Args:
+            topic_filter (str): the filter to look for
+
+        Returns:
+            bool. True if the filter has at least a callback registered, False otherwise
+        """
+        node = self._root
+        for level in topic_filter.split("/"):
+            node = node.children.get(level)
+            if node is None:
+                return False
+        return bool(node.callbacks)
+
+    def filters(self):
+        """Return all the topic filters having at least a callback registered
+
+        Returns:
+            [str]. The topic filters stored in the trie
+        """
+        filters = []
+        stack = [(self._root, [])]
+        while stack:
+            node, levels = stack.pop()
+            if node.callbacks:
+                filters.append("/".join(levels))
+            for level, child in node.children.items():
+                stack.append((child, levels + [level]))
+        return filters
+
+    def match(self, topic):
+        """Find all the callbacks whose filter matches a topic
+
+        Args:
+            topic (str): the topic name (no wildcards) to look up
+
+        Returns:
+            [callable]. The callbacks matching the topic, each callback appears once per matching filter
+        """
+        levels = topic.split("/")
+        matches = []
+        # topics beginning with '$' must not be matched by a wildcard on the first level
+        skip_wildcards = topic.startswith("$")
+        nodes = [self._root]
+        for depth, level in enumerate(levels):
+            next_nodes = []
+            for node in nodes:
+                children = node.children
+                if not (skip_wildcards and depth == 0):
+                    multi_level = children.get("#")
+                    if multi_level is not None:
+                        matches.extend(multi_level.callbacks)
+                    single_level = children.get("+")
+                    if single_level is not None:
+                        next_nodes.append(single_level)
+                exact = children.get(level)
+                if exact is not None:
+                    next_nodes.append(exact)
+            if not next_nodes:
+                return matches
+            nodes = next_nodes
+
+        for node in nodes:
+            matches.extend(node.callbacks)
+            # "a/#" matches "a" as well
+            multi_level = node.children.get("#")
+            if multi_level is not None:
+                matches.extend(multi_level.callbacks)
+        return matches
@@ -1,8 +1,21 @@
+from .common.actiondispatcher import ActionDispatcher
+
+
 class EventManager(object):
 
-    def __init__(self, broker_client, topics_and_actions):
+    def __init__(self, broker_client, topics_and_actions, dispatcher=None, config_watcher=None,
+                 metrics_exporter=None):
         self._broker_client = broker_client
-        self._topics_and_actions = topics_and_actions
+        self._topics_and_actions = list(topics_and_actions)
+        # the watcher runs on its own thread while listening, its listeners may call update_topics
+        self._config_watcher = config_watcher
+        # like the watcher, the exporter publishes the metrics on its own thread while listening
+        self._metrics_exporter = metrics_exporter
+        # the actions are run by the dispatcher so that they never block the network loop of the broker client
+        self._dispatcher = dispatcher if dispatcher is not None else ActionDispatcher()
+        # the actions get the payloads decoded with the codecs the publishers used on their topics
+        if self._dispatcher.codecs is None:
+            self._dispatcher.codecs = broker_client.codecs
         self._listening = False
 
     def __del__(self):
@@ -11,16 +24,64 @@ class EventManager(object):
     def start_listening(self):
         if not self._listening:
             self._broker_client.start()
-            for topic, action in self._topics_and_actions:
-                self._broker_client.register(topic, action)
+            for topic, name, action in self._topics_and_actions:
+                self._broker_client.register(topic, self._dispatcher.queue_for(name, action))
             self._listening = True
+            if self._config_watcher is not None:
+                self._config_watcher.start()
+            if self._metrics_exporter is not None:
+                self._metrics_exporter.start()
 
     def stop_listening(self):
         if self._listening:
-            for topic, _ in self._topics_and_actions:
-                self._broker_client.unregister(topic)
+            if self._config_watcher is not None:
+                self._config_watcher.stop()
+            if self._metrics_exporter is not None:
+                self._metrics_exporter.stop()
+            # the client may be shared, only the callbacks of this manager are unregistered
+            for topic, name, _ in self._topics_and_actions:
+                self._unregister(topic, name)
             self._broker_client.stop()
+            self._dispatcher.stop()
             self._listening = False
 
+    def update_topics(self, topics_and_actions):
+        """Replace the topics and actions while listening
+
+        Only the (topic, name, action) tuples added or removed are registered or unregistered on the broker
+        client, the subscriptions of the others are not touched. The queues of the actions no longer used are
+        stopped.
+
+        Args:
+            topics_and_actions ([(str, str, callable)]): the new list of topics and actions with their names
+        """
+        topics_and_actions = list(topics_and_actions)
+        if self._listening:
+            for topic, name, action in self._topics_and_actions:
+                if (topic, name, action) not in topics_and_actions:
+                    self._unregister(topic, name)
+            for topic, name, action in topics_and_actions:
+                if (topic, name, action) not in self._topics_and_actions:
+                    self._broker_client.register(topic, self._dispatcher.queue_for(name, action))
+            unused = {name for _, name, _ in self._topics_and_actions} - {name for _, name, _ in topics_and_actions}
+            for name in unused:
+                self._dispatcher.remove(name)
+        self._topics_and_actions = topics_and_actions
+
+    def _unregister(self, topic, name):
+        """Unregister the queue of an action from a topic, the lookup never creates a queue"""
+        action_queue = self._dispatcher.get(name)
+        # without a queue there is nothing to unregister, a None callback would drop every callback of the topic
+        if action_queue is not None:
+            self._broker_client.unregister(topic, action_queue)
+
     def is_listening(self):
         return self._listening
+
+    def stats(self):
+        """Return the queue depth and latency counters of every action
+
+        Returns:
+            {str: {str: float}}. The counters indexed by action name (see ActionQueue.stats)
+        """
+        return self._dispatcher.stats()
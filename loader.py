@@ -1,183 +1,612 @@
 from .common import configmanager
 
+# the Prometheus port of every agent, as an offset from prometheus_port, when the agents run as separate processes
+_METRICS_PORT_OFFSETS = {"sensors_manager": 0, "presence_detector": 1, "event_manager": 2, "runtime": 0}
 
-def _get_dht_sensor():
-    """Instantiate a DHTSensor
 
-    Calls the configuration manager to get all the parameters required to instantiate
-    a DHT sensor and return it
+def _get_sensor(sensor_name):
+    """Instantiate a sensor
+
+    The sensor class is looked up in the plugin registry (the built-in sensors and the ones provided by
+    the installed plugins), its module is imported only now; the sensor is instantiated from the config
+    section named after it (see Sensor.from_config)
 
     Args:
-        None
+        sensor_name (str): the name of the sensor, as listed in sensors_list
 
     Returns:
-        DHTSensor. An instance of DHTSensor (a subclass of Sensor)
+        Sensor. The sensor, None if there is no sensor with that name
     """
-    from .sensors import dhtsensor
-    pin = configmanager.config.getint("dht", "gpio_pin")
-    active_sensors = configmanager.config["dht"]["active_sensors"].split(",")
-    model = configmanager.config["dht"]["model"]
-    return dhtsensor.DHTSensor(active_sensors, model, pin)
-
-def _get_bmp_sensor():
-    """Instantiate a BMPSensor
-
-    Calls the configuration manager to get all the parameters required to instantiate
-    a BMP sensor and return it
+    from .common import plugins
+    try:
+        sensor_class = plugins.get_registry().sensor(sensor_name)
+    except KeyError:
+        from .common.logger import logger
+        logger.error("Unknown sensor %s, available sensors: %s", sensor_name,
+                     ", ".join(plugins.get_registry().names(plugins.SENSORS)))
+        return None
+    section = configmanager.settings.section(sensor_name)
+    sensor = sensor_class.from_config(section)
+    # the name in the list is unique, unlike the class name shared by the plugins providing the same sensor
+    sensor.name = sensor_name
+    if section is not None:
+        if section.get("read_timeout") is not None:
+            sensor.read_timeout = float(section.read_timeout)
+        if section.get("sampling_interval") is not None:
+            sensor.sampling_interval = float(section.sampling_interval)
+    return sensor
+
+def _get_sensors(reuse=None):
+    """Returns all the available sensors
+
+    The function returns the sensors using the configuration manager
+    to determine which sensors to instantiate. The configuration manager reads
+    the .ini config file to fetch the sensors list.
 
     Args:
-        None
+        reuse ({str: Sensor}, optional): the sensors that must not be instantiated again, indexed by name
+                                         (used to rebuild only the sensors whose configuration changed)
 
     Returns:
-        BMPSensor. An instance of BMPSensor (a subclass of Sensor)
+        {str: Sensor}. The instances of Sensor's subclasses indexed by sensor name, in the order of the list
     """
-    from .sensors import bmpsensor
-    active_sensors = configmanager.config["bmp"]["active_sensors"].split(",")
-    return bmpsensor.BMPSensor(active_sensors)
+    reuse = reuse or {}
+    sensors = {}
+    for sensor_name in configmanager.settings.sensors.sensors_list:
+        sensor = reuse[sensor_name] if sensor_name in reuse else _get_sensor(sensor_name)
+        if sensor is not None:
+            sensors[sensor_name] = sensor
+    return sensors
 
-def _get_sensors_builders():
-    """Returns a dictionary to get the sensors' instantiators
+def _get_all_events():
+    """Returns all the supported events
 
-    This function returns a dictionary where the keys are the name of the various sensors
-    and the values are the functions instantiating the sensors.
+    The function return a dictionary where the keys are the name of the event generators and the values
+    the sources of their events: the pir (the infrared motion sensor of the [pir] section) rises the event
+    "motion" whereas every section named event:<name> defines the generator <name>, rising the event
+    configured in the section (by default its name)
 
     Args:
         None
 
     Returns:
-        dict. A dictionary where the keys are sensors' name and the values are functions
-        returning an instance of Sensor's subclasses. For example:
+        {str: EventSource}. A dictionary where the key is the name of the generator rising the event and the
+        value the source of the event (GPIO channel, event name, edge, pull, bouncetime and window).
+        For example:
 
-        {"dht": _get_dht_sensor}
+        {"pir": EventSource(26, "motion")} => The sensor pir, connected to the gpio port 26 rises the
+        event "motion"
     """
-    sensors = {}
-    sensors["dht"] = _get_dht_sensor
-    sensors["bmp"] = _get_bmp_sensor
-    return sensors
+    from .agents.eventpipeline import EventSource
+    settings = configmanager.settings
+    events = {}
+    if settings.pir.gpio_pin is not None:
+        events["pir"] = EventSource(settings.pir.gpio_pin, "motion")
+    for section_name in settings.sections():
+        if section_name.startswith("event:"):
+            section = settings.section(section_name)
+            name = section_name.split(":", 1)[1]
+            events[name] = EventSource(section.gpio_pin, section.event or name, section.edge, section.pull,
+                                       section.bouncetime, section.window)
+    return events
 
-def _get_sensors():
-    """Returns an array with all the available sensors
+def _get_events():
+    """Returns a dictionary of the possible events
 
-    The function returns an array of sensors using the configuration manager
-    to determine which sensors to instantiate. The configuration manager reads
-    the .ini config file to fetch the sensors list.
+    The function uses the configuration manager to get the list of the events to monitor and returns
+    a dictionary where the key is the gpio port to monitor and the value is the source of the event
 
     Args:
         None
 
     Returns:
-        [Sensor]. An array of Sensor's subclasses
+        {int: EventSource}. A dictionary where the key is the gpio port rising the event and the value
+        the source of the event
     """
-    available_sensors = _get_sensors_builders()
-    sensors_list = configmanager.config["sensors"]["sensors_list"].split(",")
-    return [available_sensors[sensor]() for sensor in sensors_list if sensor in available_sensors]
+    from .common.logger import logger
+    available_events = _get_all_events()
+    events = {}
+    for generator in configmanager.settings.sensors.event_generators:
+        source = available_events.get(generator)
+        if source is None:
+            logger.error("Unknown event generator %s", generator)
+        elif source.channel in events:
+            logger.error("Event generator %s ignored, GPIO #%d is already used by %s", generator, source.channel,
+                         events[source.channel].event)
+        else:
+            events[source.channel] = source
+    return events
 
-def _get_all_events():
-    """Returns all the supported events
+def _get_outbox(name):
+    """Returns an instance of Outbox
 
-    The function return a dictionary of tuples where the keys are the name of the sensors
-    rising the events and the values are tuples where the first element is the GPIO port
-    to wich the sensor is connected and the second is the name of the event
+    The outbox is enabled through the "outbox" parameter of the [mqtt] section; its database is saved
+    within the data directory and it is named after the agent using it since each agent has its own client
 
     Args:
-        None
+        name (str): the name of the agent owning the outbox
 
     Returns:
-        {str: (int, str)}. A dictionary where the key is the name of the sensor rising the event
-        and the value is a tuple where the first element is a GPIO port number and the second
-        is the name associated to the event detected on the port number.
-        For example:
-
-        {"pir": (26, "motion")} => The sensor pir (infrared motion sensor), connected to the gpio
-        port 26 rises the event "motion"
+        Outbox. The outbox or None if it is disabled
     """
-    events = {}
-    pir_pin = configmanager.config.getint("pir", "gpio_pin")
-    events["pir"] = (pir_pin, "motion")
-    return events
+    section = configmanager.settings.mqtt
+    if not section.outbox:
+        return None
+    from .common.outbox import Outbox
+    return Outbox(_get_data_path("outbox_{}.sqlite".format(name)), section.outbox_max_messages,
+                  section.outbox_max_age)
 
-def _get_events():
-    """Returns a dictionary of the possible events
+def _get_codec_table():
+    """Returns an instance of CodecTable
 
-    The function uses the configuration manager to get the list of the events to monitor and returns
-    a dictionary where the key is the gpio port to monitor and the value is the event name
+    The codecs of the topics are configured through the [payloads] section
 
     Args:
         None
 
     Returns:
-        {int: str}. A dictionary where the key is the gpio port rising the event and the value
-        is the event name
+        CodecTable
     """
-    available_events = _get_all_events()
-    event_generators = configmanager.config["sensors"]["event_generators"].split(",")
-    return {available_events[generator][0] : available_events[generator][1]
-            for generator in event_generators if generator in available_events}
+    from .common import payloads
+    section = configmanager.settings.payloads
+    struct_labels = [tuple(label.split(":", 1)) if ":" in label else (label, "") for label in section.struct_labels]
+    # a single instance of every codec, the struct one numbers the samples of every label
+    codecs = {}
+    for name in [section.default] + [topic_and_codec.rsplit(":", 1)[-1] for topic_and_codec in section.codecs]:
+        if name not in codecs:
+            codecs[name] = payloads.get_codec(name, struct_labels)
+    rules = [(topic_and_codec.rsplit(":", 1)[0], codecs[topic_and_codec.rsplit(":", 1)[-1]])
+             for topic_and_codec in section.codecs]
+    return payloads.CodecTable(rules, codecs[section.default], configmanager.settings.mqtt.base_topic)
+
+def _get_qos_policy():
+    """Returns an instance of QoSPolicy
+
+    The QoS of the topics is configured through the [qos] section
 
-def _get_mqtt_client():
+    Args:
+        None
+
+    Returns:
+        QoSPolicy
+    """
+    from .common.delivery import QoSPolicy
+    section = configmanager.settings.qos
+    rules = []
+    for topic_and_qos in section.topics:
+        topic, qos = topic_and_qos.rsplit(":", 1)
+        rules.append((topic, int(qos)))
+    return QoSPolicy(rules, section.messages, section.events, section.sequence_numbers,
+                     configmanager.settings.mqtt.base_topic)
+
+def _get_mqtt_client(name, outbox=True):
     """Returns an instanc of MQTTClient
 
     The functions uses the configuration manager to get the parameters to initialize and
     then return an instance of MQTTClient
 
     Args:
-        None
+        name (str): the name of the agent using the client, it labels the metrics of the client
+        outbox (bool, optional): if True (and the outbox is enabled) the client gets an outbox named after
+                                 the agent
 
     Returns:
         MQTTClient
     """
     from .common.mqttclient import MQTTClient
-    addr = configmanager.config["mqtt"]["host"]
-    port = configmanager.config.getint("mqtt", "port")
+    section = configmanager.settings.mqtt
     auth_info = {}
-    auth_info["user"] = configmanager.config["mqtt"]["user"]
-    auth_info["password"] = configmanager.config["mqtt"]["password"]
+    auth_info["user"] = section.user
+    auth_info["password"] = section.password
     #if user was empty let's set to None the auth_info parameter
     if not auth_info["user"]:
         auth_info = None
-    base_topic = configmanager.config["mqtt"]["base_topic"]
-    return MQTTClient(addr, port, auth_info, base_topic)
+    return MQTTClient(section.host, section.port, auth_info, section.base_topic,
+                      outbox=_get_outbox(name) if outbox else None,
+                      max_queued_messages=section.max_queued_messages, codecs=_get_codec_table(),
+                      qos_policy=_get_qos_policy(), name=name)
+
+def _get_deadband_filter():
+    """Returns an instance of DeadbandFilter
+
+    The filter is configured through the [deadband] section, if the section is missing or it doesn't define
+    any deadband the filter is disabled
+
+    Args:
+        None
+
+    Returns:
+        DeadbandFilter. The filter or None if it is disabled
+    """
+    from .agents.deadband import DeadbandFilter, parse_deadbands
+    deadbands = parse_deadbands(configmanager.settings.deadband.deadbands)
+    if not deadbands:
+        return None
+    return DeadbandFilter(deadbands, configmanager.settings.deadband.heartbeat * 60)
+
+def _get_sample_aggregator():
+    """Returns an instance of SampleAggregator
+
+    The aggregator is configured through the [aggregation] section, it is disabled if the window is 0
+
+    Args:
+        None
+
+    Returns:
+        SampleAggregator. The aggregator or None if it is disabled
+    """
+    section = configmanager.settings.aggregation
+    if section.window <= 0:
+        return None
+    from .agents.aggregator import SampleAggregator
+    return SampleAggregator(section.window, section.max_samples)
+
+def _get_history_store():
+    """Returns an instance of HistoryStore
+
+    The store is configured through the [history] section and saved within the data directory
+
+    Args:
+        None
+
+    Returns:
+        HistoryStore. The store or None if it is disabled
+    """
+    section = configmanager.settings.history
+    if not section.enabled:
+        return None
+    from .common.historystore import HistoryStore
+    rollups = []
+    for rollup in section.rollups:
+        resolution, rollup_retention = rollup.split(":")
+        rollups.append((int(resolution), float(rollup_retention) * 86400))
+    return HistoryStore(_get_data_path("history"), section.partition_hours * 3600, section.segment_capacity,
+                        section.retention_days * 86400, rollups, section.maintenance_interval)
+
+def _get_config_watcher():
+    """Returns an instance of ConfigWatcher
+
+    The interval between two checks of the configuration file is the "interval" parameter of the [reload]
+    section, 0 disables the reload
+
+    Args:
+        None
 
-def get_sensors_manager():
+    Returns:
+        ConfigWatcher. The watcher or None if the reload is disabled
+    """
+    if configmanager.settings.reload.interval <= 0:
+        return None
+    from .common.configwatcher import ConfigWatcher
+    return ConfigWatcher(configmanager.settings.reload.interval)
+
+def _enable_metrics():
+    """Enable the metrics of the process if the "enabled" parameter of the [metrics] section is set
+
+    The components take their metrics when they are built, the function must therefore be called before
+    building them
+    """
+    if configmanager.settings.metrics.enabled:
+        from .common import metrics
+        metrics.enable()
+
+def _get_metrics_exporter(name, mqtt_client):
+    """Returns an instance of MetricsExporter
+
+    The exporter is configured through the [metrics] section
+
+    Args:
+        name (str): the name of the agent (or of the runtime) owning the process
+        mqtt_client (MQTTClient): the client of the process
+
+    Returns:
+        MetricsExporter. The exporter or None if the metrics are disabled
+    """
+    section = configmanager.settings.metrics
+    if not section.enabled:
+        return None
+    from .common.metrics import MetricsExporter
+    port = section.prometheus_port + _METRICS_PORT_OFFSETS[name] if section.prometheus_port else 0
+    return MetricsExporter(mqtt_client, source=name, interval=section.interval, prometheus_port=port)
+
+def _warn_restart_required(changes, sections):
+    """Log the changed sections, among the ones received in input, that cannot be applied without a restart"""
+    from .common.logger import logger
+    for section in sorted(name for name in changes if name in sections or name.split(":")[0] + ":*" in sections):
+        logger.warning("The changes of [%s] will be applied at the next restart", section)
+
+def _reload_sensors_manager(sensors_manager, sensors, settings, changes):
+    """Apply the changes of the configuration to a running SensorsManager
+
+    Only the sensors whose section changed (or that were added to the list) are instantiated again, the GPIO
+    events are updated only if the event generators or their pins changed.
+
+    Args:
+        sensors_manager (SensorsManager): the running SensorsManager
+        sensors ({str: Sensor}): the sensors in use indexed by name, it is updated
+        settings (Settings): the new configuration
+        changes ({str: set}): the parameters changed indexed by section name
+    """
+    sensors_changes = changes.get("sensors", set())
+    if sensors_changes & {"sensors_list", "sampling_interval"} or any(name in changes for name in sensors):
+        new_sensors = _get_sensors({name: sensor for name, sensor in sensors.items() if name not in changes})
+        sensors.clear()
+        sensors.update(new_sensors)
+        sensors_manager.update_sensors(list(sensors.values()), settings.sensors.sampling_interval)
+    if "event_generators" in sensors_changes or any(name == "pir" or name.startswith("event:") for name in changes):
+        sensors_manager.update_events(_get_events())
+    if sensors_changes & {"publish_mode", "batch_topic"}:
+        sensors_manager.update_publishing(settings.sensors.publish_mode, settings.sensors.batch_topic)
+    if sensors_changes & {"event_window", "event_bouncetime", "event_queue_size"}:
+        _warn_restart_required({"sensors": sensors_changes}, ("sensors",))
+    _warn_restart_required(changes, ("gpio", "mqtt", "qos", "payloads", "storage", "aggregation", "deadband",
+                                     "history", "metrics"))
+
+def get_sensors_manager(mqtt_client=None, config_watcher=None):
     """Returns an instance of SensorsManager
 
     The function uses the configuration manager to get all the info required to be able to instantiate
     the SensorsManager and return it
 
     Args:
-        None
+        mqtt_client (MQTTClient, optional): the client to use, if None the SensorsManager gets a client of its own
+        config_watcher (ConfigView, optional): the view of the watcher shared by the agents of the process, used
+                                               only with a shared client (an agent with a client of its own gets
+                                               a watcher of its own)
 
     Returns:
         SensorsManager
     """
     from .agents.sensorsmanager import SensorsManager
+    _enable_metrics()
     sensors = _get_sensors()
     events = _get_events()
-    mqtt_client = _get_mqtt_client()
-    return SensorsManager(sensors, events, mqtt_client)
+    # only an agent with a client of its own runs in a process of its own and exports its metrics
+    metrics_exporter = None
+    if mqtt_client is None:
+        mqtt_client = _get_mqtt_client("sensors_manager")
+        metrics_exporter = _get_metrics_exporter("sensors_manager", mqtt_client)
+        config_watcher = _get_config_watcher()
+    section = configmanager.settings.sensors
+    sensors_manager = SensorsManager(list(sensors.values()), events, mqtt_client, section.sampling_interval,
+                                     publish_mode=section.publish_mode, batch_topic=section.batch_topic,
+                                     deadband=_get_deadband_filter(), aggregator=_get_sample_aggregator(),
+                                     history=_get_history_store(), config_watcher=config_watcher,
+                                     metrics_exporter=metrics_exporter, event_window=section.event_window,
+                                     event_bouncetime=section.event_bouncetime,
+                                     event_queue_size=section.event_queue_size)
+    if config_watcher is not None:
+        config_watcher.add_listener(lambda settings, changes: _reload_sensors_manager(sensors_manager, sensors,
+                                                                                     settings, changes))
+    return sensors_manager
+
+def _get_data_path(file_name):
+    """Returns the path of a file within the data directory
+
+    Args:
+        file_name (str): the name of the file, if it is an absolute path it is returned as is
+
+    Returns:
+        str. The path of the file within the data_dir defined in the [storage] section
+    """
+    import os
+    return os.path.join(configmanager.settings.storage.data_dir, file_name)
+
+def _get_presence_backend():
+    """Returns the presence backend to use
+
+    The backend is chosen through the "backend" parameter of the [network_presence_detector] section:
+    "nmap" actively probes the IPs whereas "arp" reads the kernel neighbour table and probes with nmap
+    only the IPs it hasn't confirmed as reachable
 
-def get_presence_detector():
+    Args:
+        None
+
+    Returns:
+        PresenceBackend
+    """
+    from .agents import presencebackends
+    section = configmanager.settings.network_presence_detector
+    if section.backend == "arp":
+        return presencebackends.ArpTableBackend(fallback=presencebackends.NmapBackend())
+    return presencebackends.NmapBackend()
+
+def get_presence_detector(mqtt_client=None, config_watcher=None):
     """Return an instance of NetworkPresenceDetector
 
     The function uses the configuration manager to get all the knowkn ips to monitor and the MQTT broker info
     to be able to instantiate the NetworkPresenceDetector and return it
 
     Args:
-        None
+        mqtt_client (MQTTClient, optional): the client to use, if None the NetworkPresenceDetector gets a client
+                                            of its own
+        config_watcher (ConfigView, optional): the view of the watcher shared by the agents of the process, see
+                                               get_sensors_manager
 
     Returns:
         NetworkPresenceDetector
     """
     from .agents.presencedetector import NetworkPresenceDetector
-    mqtt_client = _get_mqtt_client()
-    persons = [(known_ip[0], known_ip[1]) for known_ip in configmanager.config["network_presence_detector"]["known_ips"].split(',')]
-    return NetworkPresenceDetector(persons, mqtt_client)
+    _enable_metrics()
+    metrics_exporter = None
+    if mqtt_client is None:
+        mqtt_client = _get_mqtt_client("presence_detector")
+        metrics_exporter = _get_metrics_exporter("presence_detector", mqtt_client)
+        config_watcher = _get_config_watcher()
+    section = configmanager.settings.network_presence_detector
+    identity_index = None
+    persons = _get_persons(section)
+    if section.identity == "mac":
+        from .agents.macindex import MacIdentityIndex
+        identity_index = MacIdentityIndex(persons, _get_data_path(section.index_file))
+    scheduler = None
+    if section.scheduling == "adaptive":
+        from .agents.presencescheduler import AdaptiveScheduler
+        scheduler = AdaptiveScheduler([person[0] for person in persons],
+                                      min_interval=section.min_interval,
+                                      max_interval=section.max_interval,
+                                      absent_max_interval=section.absent_max_interval,
+                                      misses_before_absent=section.misses_before_absent,
+                                      absent_after=section.absent_after)
+    presence_detector = NetworkPresenceDetector(persons, mqtt_client, batch_scan=section.batch_scan,
+                                                backend=_get_presence_backend(), identity_index=identity_index,
+                                                subnet=section.subnet, scheduler=scheduler,
+                                                config_watcher=config_watcher, metrics_exporter=metrics_exporter)
+    if config_watcher is not None:
+        config_watcher.add_listener(lambda settings, changes: _reload_presence_detector(presence_detector,
+                                                                                       settings, changes))
+    return presence_detector
+
+def _get_persons(section):
+    """Returns the known persons
 
-def get_event_manager():
+    Args:
+        section (Section): the [network_presence_detector] section
+
+    Returns:
+        [(str, str)]. The tuples (name, address) where the address is the IP or, when the persons are
+        identified by MAC, the MAC address of the person's device
+    """
+    if section.identity == "mac":
+        # the MAC address contains ':' therefore only the first one separates the name
+        return [tuple(known_mac.split(':', 1)) for known_mac in section.known_macs]
+    return [tuple(known_ip.split(':')) for known_ip in section.known_ips]
+
+def _reload_presence_detector(presence_detector, settings, changes):
+    """Apply the changes of the configuration to a running NetworkPresenceDetector
+
+    Args:
+        presence_detector (NetworkPresenceDetector): the running NetworkPresenceDetector
+        settings (Settings): the new configuration
+        changes ({str: set}): the parameters changed indexed by section name
+    """
+    section_changes = changes.get("network_presence_detector", set())
+    persons_key = "known_macs" if settings.network_presence_detector.identity == "mac" else "known_ips"
+    if persons_key in section_changes and "identity" not in section_changes:
+        presence_detector.update_persons(_get_persons(settings.network_presence_detector))
+        section_changes = section_changes - {"known_ips", "known_macs"}
+    if section_changes:
+        _warn_restart_required({"network_presence_detector": section_changes}, ("network_presence_detector",))
+    _warn_restart_required(changes, ("mqtt", "qos", "payloads", "storage", "metrics"))
+
+def _get_action_policy(section):
+    """Returns the execution policy of an action
+
+    The parameters not defined in the section received in input are read from the [actions] section
+
+    Args:
+        section (str): the name of the config section holding the policy parameters
+
+    Returns:
+        ActionPolicy
+    """
+    from .common.actiondispatcher import ActionPolicy
+    defaults = configmanager.settings.actions
+    section = configmanager.settings.section(section) or defaults
+    parameters = {}
+    for key in ("executor", "workers", "queue_size", "overflow_policy"):
+        # the parameters missing from an action:<name> section are None
+        value = section.get(key)
+        parameters[key] = value if value is not None else getattr(defaults, key)
+    return ActionPolicy(**parameters)
+
+def _get_action_dispatcher(action_names):
+    """Returns an instance of ActionDispatcher
+
+    The default execution policy is read from the [actions] section whereas the policy of a single action
+    can be overridden in a section named "action:<action name>". The queues of the actions discard the QoS 1
+    copies according to the "dedup_size" parameter of the [qos] section, 0 disables the deduplication
+
+    Args:
+        action_names ([str]): the names of the actions to dispatch
+
+    Returns:
+        ActionDispatcher
+    """
+    from .common.actiondispatcher import ActionDispatcher
+    policies = {name: _get_action_policy("action:" + name) for name in action_names
+                if configmanager.settings.has_section("action:" + name)}
+    return ActionDispatcher(policies, _get_action_policy("actions"), dedup_size=configmanager.settings.qos.dedup_size)
+
+def _get_topics_and_actions():
+    """Returns the topics to listen to with their actions, as listed in the [actions] section
+
+    The actions are named as in the configuration (the name of their plugin), the same name selects their
+    "action:<action name>" policy section and labels their queue
+
+    Returns:
+        [(str, str, callable)]. The tuples (topic, action name, action)
+    """
+    from .common import plugins
+    # only the actions actually used are imported
+    registry = plugins.get_registry()
+    topics_and_actions = []
+    for topic_and_action in configmanager.settings.actions.topics_and_actions:
+        topic, name = topic_and_action.split(':')[:2]
+        topics_and_actions.append((topic, name, registry.action(name)))
+    return topics_and_actions
+
+def _reload_event_manager(event_manager, settings, changes):
+    """Apply the changes of the configuration to a listening EventManager
+
+    Args:
+        event_manager (EventManager): the EventManager
+        settings (Settings): the new configuration
+        changes ({str: set}): the parameters changed indexed by section name
+    """
+    actions_changes = changes.get("actions", set())
+    if "topics_and_actions" in actions_changes:
+        event_manager.update_topics(_get_topics_and_actions())
+    if actions_changes - {"topics_and_actions"}:
+        _warn_restart_required({"actions": actions_changes}, ("actions",))
+    _warn_restart_required(changes, ("mqtt", "qos", "payloads", "action:*", "metrics"))
+
+def get_event_manager(mqtt_client=None, config_watcher=None):
     from .eventmanager import EventManager
-    from .actions.actions import get_actions
-    mqtt_client = _get_mqtt_client()
-    actions = get_actions()
-    topics_and_actions = [(topic_and_action.split(':')[0], actions[topic_and_action.split(':')[1]])
-                          for topic_and_action in configmanager.config["actions"]["topics_and_actions"].split(',')]
-    return EventManager(mqtt_client, topics_and_actions)
+    _enable_metrics()
+    metrics_exporter = None
+    if mqtt_client is None:
+        mqtt_client = _get_mqtt_client("event_manager", outbox=False)
+        metrics_exporter = _get_metrics_exporter("event_manager", mqtt_client)
+        config_watcher = _get_config_watcher()
+    topics_and_actions = _get_topics_and_actions()
+    dispatcher = _get_action_dispatcher([name for _, name, _ in topics_and_actions])
+    event_manager = EventManager(mqtt_client, topics_and_actions, dispatcher, config_watcher=config_watcher,
+                                 metrics_exporter=metrics_exporter)
+    if config_watcher is not None:
+        config_watcher.add_listener(lambda settings, changes: _reload_event_manager(event_manager, settings,
+                                                                                   changes))
+    return event_manager
+
+def get_runtime():
+    """Returns an instance of AgentRuntime
+
+    The runtime runs, in the current process and on a single MQTT connection, the agents listed in the
+    "agents" parameter of the [runtime] section. The agents share a single ConfigWatcher, run by the runtime:
+    every agent gets a view of it and applies the changes on its own thread
+
+    Args:
+        None
+
+    Returns:
+        AgentRuntime
+    """
+    from .runtime import AgentRuntime
+    agents = configmanager.settings.runtime.agents
+    _enable_metrics()
+    mqtt_client = _get_mqtt_client("runtime")
+    config_watcher = _get_config_watcher()
+
+    def view():
+        return config_watcher.share() if config_watcher is not None else None
+
+    loop_agents = []
+    event_managers = []
+    if "sensors_manager" in agents:
+        loop_agents.append(get_sensors_manager(mqtt_client, view()))
+    if "presence_detector" in agents:
+        loop_agents.append(get_presence_detector(mqtt_client, view()))
+    if "event_manager" in agents:
+        event_managers.append(get_event_manager(mqtt_client, view()))
+    return AgentRuntime(mqtt_client, loop_agents, event_managers,
+                        metrics_exporter=_get_metrics_exporter("runtime", mqtt_client), config_watcher=config_watcher)
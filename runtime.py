@@ -0,0 +1,92 @@
+import asyncio
+import signal
+from .common.logger import logger
+
+
+class AgentRuntime(object):
+    """Runs all the agents in a single process sharing a single MQTT connection
+
+    By default every agent (SensorsManager, NetworkPresenceDetector) is a process of its own and, like the
+    EventManager, it has its own MQTTClient: one interpreter and one broker connection per agent. The runtime
+    is the alternative for memory constrained boards: the loop agents run as asyncio tasks (see
+    StoppableLoopProcess.run_async) and the event managers listen on the same client, so the whole application
+    takes one interpreter and one broker connection. The blocking work (sensor readings, network scans,
+    actions) still runs on threads, the event loop only schedules it.
+    The runtime stops on SIGTERM and SIGINT, or when stop is called. The agents share a single ConfigWatcher,
+    run by the runtime on its own thread: every agent checks a view of it (see ConfigWatcher.share).
+
+    Attributes:
+        _mqtt_client (MQTTClient): the client shared by all the agents
+        _loop_agents ([StoppableLoopProcess]): the agents executed as asyncio tasks
+        _event_managers ([EventManager]): the event managers listening on the shared client
+        _metrics_exporter (MetricsExporter): the exporter publishing the metrics of all the agents, if None the
+                                             metrics are not exported
+        _config_watcher (ConfigWatcher): the watcher shared by the agents, if None the configuration is never reloaded
+        _loop (asyncio.AbstractEventLoop): the event loop of the runtime, None when not running
+        _stop (asyncio.Event): the event set to stop the runtime
+    """
+
+    def __init__(self, mqtt_client, loop_agents, event_managers=(), metrics_exporter=None, config_watcher=None):
+        """Initialize the AgentRuntime
+
+        Args:
+            mqtt_client (MQTTClient): the client shared by all the agents (the agents must have been built with it)
+            loop_agents ([StoppableLoopProcess]): the agents to execute, they must not be started as processes
+            event_managers ([EventManager], optional): the event managers to run
+            metrics_exporter (MetricsExporter, optional): the exporter publishing the metrics of the process
+            config_watcher (ConfigWatcher, optional): the watcher shared by the agents (built with views of it)
+        """
+        self._mqtt_client = mqtt_client
+        self._loop_agents = list(loop_agents)
+        self._event_managers = list(event_managers)
+        self._metrics_exporter = metrics_exporter
+        self._config_watcher = config_watcher
+        self._loop = None
+        self._stop = None
+
+    async def _run_event_manager(self, event_manager):
+        """Keep an event manager listening till the runtime is stopped"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, event_manager.start_listening)
+        try:
+            await self._stop.wait()
+        finally:
+            await loop.run_in_executor(None, event_manager.stop_listening)
+
+    async def _main(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            self._loop.add_signal_handler(signum, self._stop.set)
+        # the runtime holds a reference to the client, this way it stays connected while the agents start and stop
+        await self._loop.run_in_executor(None, self._mqtt_client.start)
+        if self._metrics_exporter is not None:
+            await self._loop.run_in_executor(None, self._metrics_exporter.start)
+        if self._config_watcher is not None:
+            self._config_watcher.start()
+        tasks = [asyncio.ensure_future(agent.run_async(self._stop)) for agent in self._loop_agents]
+        tasks += [asyncio.ensure_future(self._run_event_manager(manager)) for manager in self._event_managers]
+        logger.info("Runtime started: %d agents and %d event managers on a single connection",
+                    len(self._loop_agents), len(self._event_managers))
+        try:
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            for result in results:
+                if isinstance(result, Exception):
+                    logger.error("Agent terminated with an error: %r", result)
+        finally:
+            if self._config_watcher is not None:
+                await self._loop.run_in_executor(None, self._config_watcher.stop)
+            if self._metrics_exporter is not None:
+                await self._loop.run_in_executor(None, self._metrics_exporter.stop)
+            await self._loop.run_in_executor(None, self._mqtt_client.stop)
+            self._loop = None
+            logger.info("Runtime stopped")
+
+    def run(self):
+        """Run the agents till the runtime is stopped"""
+        asyncio.run(self._main())
+
+    def stop(self):
+        """Stop the runtime, the method can be called from any thread"""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stop.set)
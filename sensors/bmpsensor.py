@@ -16,6 +16,9 @@ class BMPSensor(Sensor):
     Attributes:
         _sensors ([str]): the list of data we want to sample (elements can be: "temerature" and "pressure")
     """
+    # the BMP180 sits on the I2C bus with any other I2C device
+    bus = "i2c"
+    read_timeout = 2
     def __init__(self, active_sensors: [str]):
         """Initialize the BMPSensor class
 
@@ -24,6 +27,11 @@ class BMPSensor(Sensor):
         """
         self._sensors = active_sensors
 
+    @classmethod
+    def from_config(cls, section):
+        """Instantiate the sensor from the [bmp] section"""
+        return cls(section.active_sensors)
+
     def _fetch_data(self, samples):
         """Collect sensor's data
 
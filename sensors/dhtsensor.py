@@ -1,7 +1,14 @@
+import time
+from collections import deque
 import MyPyDHT
+from .retrybudget import RetryBudget
 from .sensor import Sensor, Sample
 from ..common.logger import logger
 
+# the values a DHT22 can measure, a reading outside them is corrupted even if its checksum matched
+_TEMPERATURE_RANGE = (-40.0, 80.0)
+_HUMIDITY_RANGE = (0.0, 100.0)
+
 
 class DHTSensor(Sensor):
     """Class for sensors of type DHT11, DHT22, AM2302
@@ -20,9 +27,24 @@ class DHTSensor(Sensor):
         _pin (int): the GPIO pin number to which the sensor is connected
         _model (:enum: MyPyDHT.Sensor): an enum of the sensor driver defining the model of the sensor
                                         (the possible values are DHT11 and DHT22)
+        _retry_budget (RetryBudget): the budget of attempts of every reading, capped by the ones fitting in
+                                     read_timeout
+        _retry_delay (float): the pause, in seconds, between two attempts (the DHT needs some rest between reads)
+        _cache_ttl (float): the amount of time, in seconds, a reading is reused before accessing the sensor again
+        _max_jumps ({str: float}): the maximum plausible change, per label, between two consecutive readings
+        _history ({str: deque}): the last three plausible values read, per label
+        _cached ((float, float)): the last reading returned, as a (humidity, temperature) tuple
+        _cached_at (float): the time the cached reading was taken
+        _cache_hits (int): the number of readings served from the cache
+        _rejected (int): the number of values replaced by the median of the last readings
+        _clock (callable): the function returning the current time in seconds
+        _sleep (callable): the function pausing the execution between two attempts
     """
+    # the attempts of a reading, with the retry_delay between them, are capped by the ones fitting in this deadline
+    read_timeout = 20
 
-    def __init__(self, active_sensors, model, gpio_pin):
+    def __init__(self, active_sensors, model, gpio_pin, max_attempts=10, retry_delay=2.0, cache_ttl=2.0,
+                 max_temperature_jump=5.0, max_humidity_jump=20.0, clock=time.monotonic, sleep=time.sleep):
         """Initialize the DHTSensor class
 
         Args:
@@ -30,13 +52,104 @@ class DHTSensor(Sensor):
             model (str): a string describing the model of the sensor, if it is equal to "DHT11" then the model used
                          will indeed be the DHT11 whereas with any other string DHT22 will be used
             gpio_pin (int): the gpio pin to which the sensor is connected
+            max_attempts (int): the maximum number of attempts of a reading
+            retry_delay (float): the pause, in seconds, between two attempts
+            cache_ttl (float): the amount of time, in seconds, a reading is reused before accessing the sensor again
+            max_temperature_jump (float): the maximum plausible change of temperature between two readings
+            max_humidity_jump (float): the maximum plausible change of humidity between two readings
+            clock (callable): the function returning the current time in seconds
+            sleep (callable): the function pausing the execution between two attempts
         """
         self._sensors = active_sensors
         self._pin = gpio_pin
+        # the DHT protocol uses a dedicated data line, only the sensors sharing the pin must be serialized
+        self.bus = "gpio{}".format(gpio_pin)
         if model == "DHT11":
             self._model = MyPyDHT.Sensor.DHT11
         else:
             self._model = MyPyDHT.Sensor.DHT22
+        self._retry_budget = RetryBudget(max_attempts=max_attempts)
+        self._retry_delay = retry_delay
+        self._cache_ttl = cache_ttl
+        self._max_jumps = {"temperature": max_temperature_jump, "humidity": max_humidity_jump}
+        self._history = {"temperature": deque(maxlen=3), "humidity": deque(maxlen=3)}
+        self._cached = None
+        self._cached_at = None
+        self._cache_hits = 0
+        self._rejected = 0
+        self._clock = clock
+        self._sleep = sleep
+
+    @staticmethod
+    def _is_plausible(humidity, temperature):
+        """Check that a reading is within the range the sensor can measure"""
+        return (humidity is not None and temperature is not None and
+                _HUMIDITY_RANGE[0] <= humidity <= _HUMIDITY_RANGE[1] and
+                _TEMPERATURE_RANGE[0] <= temperature <= _TEMPERATURE_RANGE[1])
+
+    @classmethod
+    def from_config(cls, section):
+        """Instantiate the sensor from the [dht] section"""
+        return cls(section.active_sensors, section.model, section.gpio_pin, max_attempts=section.max_attempts,
+                   retry_delay=section.retry_delay, cache_ttl=section.cache_ttl,
+                   max_temperature_jump=section.max_temperature_jump, max_humidity_jump=section.max_humidity_jump)
+
+    def _read(self):
+        """Read the sensor within the retry budget
+
+        Every attempt is a single read of the driver; an attempt fails if the driver raises an error or returns
+        values the sensor cannot measure. The attempts stop at the first success; there are at most max_attempts
+        of them, fewer if the average latency of an attempt tells that they wouldn't fit in read_timeout.
+
+        Returns:
+            (float, float). The (humidity, temperature) tuple read or None if all the attempts failed
+        """
+        attempts = self._retry_budget.attempts(self.read_timeout, self._retry_delay)
+        error = None
+        for attempt in range(attempts):
+            if attempt:
+                self._sleep(self._retry_delay)
+            started = self._clock()
+            try:
+                humidity, temperature = MyPyDHT.sensor_read(self._model, self._pin, reading_attempts=1,
+                                                            use_cache=False)
+                success = self._is_plausible(humidity, temperature)
+                if not success:
+                    error = "implausible reading: {} %, {} C".format(humidity, temperature)
+            except MyPyDHT.DHTException as exception:
+                success = False
+                error = exception.message
+            self._retry_budget.record_attempt(success, self._clock() - started)
+            if success:
+                self._retry_budget.record_reading(True)
+                return humidity, temperature
+        self._retry_budget.record_reading(False)
+        logger.error("DHT reading failed after %d attempts: %s", attempts, error)
+        return None
+
+    def _filter(self, label, value):
+        """Reject the implausible jumps of a value
+
+        A value changing by more than the maximum jump since the last reading is replaced by the median of the
+        last three readings: an isolated spike is discarded without reading the sensor again whereas a real
+        change, being confirmed by the following reading, is let through with one reading of delay.
+
+        Args:
+            label (str): the label of the value ("temperature" or "humidity")
+            value (float): the value read
+
+        Returns:
+            float. The filtered value
+        """
+        history = self._history[label]
+        previous = history[-1] if history else None
+        history.append(value)
+        if previous is None or abs(value - previous) <= self._max_jumps[label] or len(history) < 3:
+            return value
+        median = sorted(history)[1]
+        if median != value:
+            self._rejected += 1
+        return median
 
     def _fetch_data(self, samples):
         """Collect sensor's data
@@ -49,11 +162,31 @@ class DHTSensor(Sensor):
         Args:
             samples ([Sample]): an empty array to be filled with Sample objects
         """
-        try:
-            humidity, temperature = MyPyDHT.sensor_read(self._model, self._pin, reading_attempts=10, use_cache=True)
-            if "temperature" in self._sensors:
-                samples.append(Sample("temperature", round(temperature, 2), "C"))
-            if "humidity" in self._sensors:
-                samples.append(Sample("humidity", round(humidity, 2), "%"))
-        except MyPyDHT.DHTException as error:
-            logger.error(error.message)
+        now = self._clock()
+        if self._cached is not None and now - self._cached_at < self._cache_ttl:
+            self._cache_hits += 1
+            humidity, temperature = self._cached
+        else:
+            reading = self._read()
+            if reading is None:
+                return
+            humidity = self._filter("humidity", reading[0])
+            temperature = self._filter("temperature", reading[1])
+            self._cached = humidity, temperature
+            self._cached_at = now
+        if "temperature" in self._sensors:
+            samples.append(Sample("temperature", round(temperature, 2), "C"))
+        if "humidity" in self._sensors:
+            samples.append(Sample("humidity", round(humidity, 2), "%"))
+
+    def stats(self):
+        """Return the reading statistics of the sensor
+
+        Returns:
+            {str: object}. The statistics of the retry budget (see RetryBudget.stats) along with cache_hits
+            and rejected (the values replaced by the median of the last readings)
+        """
+        stats = self._retry_budget.stats(self.read_timeout, self._retry_delay)
+        stats["cache_hits"] = self._cache_hits
+        stats["rejected"] = self._rejected
+        return stats
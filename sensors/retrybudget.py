@@ -0,0 +1,112 @@
+import math
+
+
+class RetryBudget(object):
+    """A budget of reading attempts bounded by the deadline of a reading
+
+    A reading gets up to max_attempts attempts (they stop at the first success, so a working sensor costs
+    a single attempt anyway): cutting the attempts of a sensor that answers, even rarely, only loses
+    readings. The attempts are capped by the ones that fit in the deadline of the reading, computed from an
+    exponentially weighted moving average of the latency of an attempt: an attempt started after the deadline
+    is wasted, the reading is abandoned anyway. The failed attempts cost the most time when the sensor doesn't
+    answer at all (it is disconnected or broken), so after probe_after consecutive readings whose attempts all
+    failed the budget drops to min_attempts, probing the sensor, till an attempt succeeds again.
+
+    Attributes:
+        _min_attempts (int): the attempts of a reading while the sensor is not answering
+        _max_attempts (int): the maximum number of attempts of a reading
+        _probe_after (int): the consecutive failed readings after which the sensor is only probed
+        _smoothing (float): the weight of the last attempt in the moving average of the latency
+        _latency (float): the moving average of the latency, in seconds, of an attempt (None if unknown)
+        _readings (int): the number of readings performed
+        _exhausted (int): the number of readings whose attempts all failed
+        _consecutive_exhausted (int): the number of the last readings whose attempts all failed
+        _attempts (int): the number of attempts performed
+        _failures (int): the number of failed attempts
+    """
+
+    def __init__(self, min_attempts=1, max_attempts=10, probe_after=5, smoothing=0.1):
+        """Initialize the RetryBudget
+
+        Args:
+            min_attempts (int): the attempts of a reading while the sensor is not answering
+            max_attempts (int): the maximum number of attempts of a reading
+            probe_after (int): the consecutive failed readings after which the sensor is only probed
+            smoothing (float): the weight, between 0 and 1, of the last attempt in the moving average of the latency
+        """
+        self._min_attempts = min_attempts
+        self._max_attempts = max(min_attempts, max_attempts)
+        self._probe_after = probe_after
+        self._smoothing = smoothing
+        self._latency = None
+        self._readings = 0
+        self._exhausted = 0
+        self._consecutive_exhausted = 0
+        self._attempts = 0
+        self._failures = 0
+
+    def attempts(self, time_budget=None, retry_delay=0.0):
+        """Return the number of attempts to perform for the next reading
+
+        Args:
+            time_budget (float, optional): the amount of time, in seconds, the reading may take; if None (or
+                                           while the latency of an attempt is unknown) the attempts are not capped
+            retry_delay (float, optional): the pause, in seconds, between two attempts
+
+        Returns:
+            int. The number of attempts
+        """
+        if self._consecutive_exhausted >= self._probe_after:
+            return self._min_attempts
+        if time_budget is None or self._latency is None or self._latency + retry_delay <= 0:
+            return self._max_attempts
+        # n attempts take n * latency + (n - 1) * retry_delay seconds
+        fitting = math.floor((time_budget + retry_delay) / (self._latency + retry_delay))
+        return max(self._min_attempts, min(self._max_attempts, fitting))
+
+    def record_attempt(self, success, latency):
+        """Record the outcome of an attempt
+
+        Args:
+            success (bool): True if the attempt succeeded
+            latency (float): the duration, in seconds, of the attempt
+        """
+        self._attempts += 1
+        if not success:
+            self._failures += 1
+        if self._latency is None:
+            self._latency = latency
+        else:
+            self._latency += self._smoothing * (latency - self._latency)
+
+    def record_reading(self, success):
+        """Record the outcome of a reading (a sequence of attempts)
+
+        Args:
+            success (bool): True if one of the attempts succeeded
+        """
+        self._readings += 1
+        if success:
+            self._consecutive_exhausted = 0
+        else:
+            self._exhausted += 1
+            self._consecutive_exhausted += 1
+
+    def stats(self, time_budget=None, retry_delay=0.0):
+        """Return the statistics of the attempts
+
+        Args:
+            time_budget (float, optional): the amount of time, in seconds, a reading may take (see attempts)
+            retry_delay (float, optional): the pause, in seconds, between two attempts
+
+        Returns:
+            {str: object}. A dictionary with the keys: readings, exhausted (readings without a successful attempt),
+            attempts, failures, attempt_latency (the moving average) and budget (the number of attempts of the
+            next reading)
+        """
+        return {"readings": self._readings,
+                "exhausted": self._exhausted,
+                "attempts": self._attempts,
+                "failures": self._failures,
+                "attempt_latency": self._latency,
+                "budget": self.attempts(time_budget, retry_delay)}
@@ -1,13 +1,86 @@
+import threading
 from abc import ABCMeta, abstractmethod
 from ..common.logger import logger
 
+_bus_locks = {}
+_bus_locks_guard = threading.Lock()
+
+
+def get_bus_lock(bus):
+    """Return the lock serializing the access to a bus
+
+    Args:
+        bus (str): the name of the bus (something like "i2c-1")
+
+    Returns:
+        threading.Lock. The lock shared by all the sensors connected to the bus
+    """
+    with _bus_locks_guard:
+        lock = _bus_locks.get(bus)
+        if lock is None:
+            lock = threading.Lock()
+            _bus_locks[bus] = lock
+        return lock
+
 
 class Sensor(metaclass=ABCMeta):
     """Base sensor class
 
     Any sensor class must inherit from this one and implement the abstract method
-    _fetch_data to be able to sample
+    _fetch_data to be able to sample.
+    Sensors can be read concurrently: the ones connected to the same bus are serialized through
+    a lock shared by all of them.
+
+    Attributes:
+        read_timeout (float): the amount of time, in seconds, a reading may take before being considered
+                              failed by the SensorsManager
+        bus (str): the name of the bus the sensor is connected to, None if the sensor doesn't share it
+                   with other sensors
+        sampling_interval (float): the amount of time, in seconds, between two readings of the sensor; if None
+                                   the sampling interval of the SensorsManager is used
     """
+    read_timeout = 10
+    bus = None
+    sampling_interval = None
+    _name = None
+
+    @property
+    def name(self):
+        """The name identifying the sensor in logs and statistics
+
+        The loader names every sensor after its entry in sensors_list, this way two sensors of the same class
+        have different names; a sensor without a name is identified by its class name
+        """
+        return self._name or self.__class__.__name__
+
+    @name.setter
+    def name(self, name):
+        self._name = name
+
+    @classmethod
+    def from_config(cls, section):
+        """Instantiate the sensor from its configuration section
+
+        The loader instantiates every sensor listed in pihome.ini through this method, the sensors requiring
+        parameters must override it. The read_timeout and sampling_interval parameters are applied by the
+        loader afterwards.
+
+        Args:
+            section (Section): the section of pihome.ini named after the sensor, None if there is none. The
+                               values of the sections unknown to configmanager's schema are strings
+
+        Returns:
+            Sensor. The sensor
+        """
+        return cls()
+
+    def stats(self):
+        """Return the statistics specific to the sensor (retries, cache hits, ...)
+
+        Returns:
+            {str: object}. The statistics of the sensor, empty by default
+        """
+        return {}
 
     @abstractmethod
     def _fetch_data(self, samples):
@@ -24,9 +97,13 @@ class Sensor(metaclass=ABCMeta):
         Returns:
             [Sample]. An array of Sample objects containing the data sampled from the sensor
         """
-        logger.info("%s: collect sensor data", self.__class__.__name__)
+        logger.info("%s: collect sensor data", self.name)
         samples = []
-        self._fetch_data(samples)
+        if self.bus is None:
+            self._fetch_data(samples)
+        else:
+            with get_bus_lock(self.bus):
+                self._fetch_data(samples)
         return samples
 
 
@@ -34,14 +111,17 @@ class Sample(object):
     """A Sample object
     An object containing the data sampled by the sensor
     """
-    def __init__(self, label, data, unit):
+    def __init__(self, label, data, unit, stats=None):
         """Initialiaze a Sample
 
         Args:
             label (str): a label describing the type of data (something like "temperature" or "pressure")
             data (float): a number describing the data sampled
             unit (str): the unit measure of the data (for temperature could be "C" whereas for pressure "mbar")
+            stats ({str: float}, optional): the statistics of the values the data was aggregated from
+                                            (something like {"min": 21.9, "max": 22.4, "stddev": 0.1})
         """
         self.label = label
         self.data = data
         self.unit = unit
+        self.stats = stats
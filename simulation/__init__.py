@@ -0,0 +1,109 @@
+"""Simulation backend: PiHome without a Raspberry Pi
+
+The package provides stand-ins for everything PiHome needs from the hardware and the network:
+    - FakeGPIO: RPi.GPIO, with edges raised on demand or at a given rate
+    - FakeDHTDriver and FakeBMPDriver: MyPyDHT and MyPyBMP180, with configurable latency and failure rate
+    - FakeNetwork: the devices probed through nmap, with configurable latency and answer probability
+    - SimulatedBroker: an MQTT broker running within the process
+install registers the fakes in place of the real modules, after that the agents can be built as usual (the
+hardware modules are imported lazily, see common.gpiomanager and loader), for example:
+
+    from PiHome import simulation
+    sim = simulation.install()
+    sim.network.connect("192.168.1.16", "aa:bb:cc:dd:ee:ff")
+    broker = simulation.SimulatedBroker()
+    broker.start()
+    ...
+    simulation.uninstall()
+"""
+import sys
+from .broker import SimulatedBroker
+from .drivers import FakeBMPDriver, FakeDHTDriver
+from .gpio import FakeGPIO
+from .network import FakeNetwork
+
+_MODULES = ("RPi", "RPi.GPIO", "MyPyDHT", "MyPyBMP180")
+_saved = None
+
+
+class Simulation(object):
+    """The fakes installed by install
+
+    Attributes:
+        gpio (FakeGPIO): the stand-in for RPi.GPIO
+        dht (FakeDHTDriver): the stand-in for MyPyDHT
+        bmp (FakeBMPDriver): the stand-in for MyPyBMP180
+        network (FakeNetwork): the network probed in place of the real one
+    """
+
+    def __init__(self, gpio, dht, bmp, network):
+        self.gpio = gpio
+        self.dht = dht
+        self.bmp = bmp
+        self.network = network
+
+
+def install(gpio=None, dht=None, bmp=None, network=None):
+    """Replace the hardware and network modules with their simulated counterparts
+
+    The modules already imported are patched as well, so the function can be called at any time; the
+    sensors built before the call keep using the real drivers though.
+
+    Args:
+        gpio (FakeGPIO, optional): the stand-in for RPi.GPIO, a new one by default
+        dht (FakeDHTDriver, optional): the stand-in for MyPyDHT, a new one by default
+        bmp (FakeBMPDriver, optional): the stand-in for MyPyBMP180, a new one by default
+        network (FakeNetwork, optional): the network to probe, an empty one by default
+
+    Returns:
+        Simulation. The fakes installed
+    """
+    global _saved
+    from ..agents import presencebackends
+    from ..common import gpiomanager
+    simulation = Simulation(gpio or FakeGPIO(), dht or FakeDHTDriver(), bmp or FakeBMPDriver(),
+                            network or FakeNetwork())
+    if _saved is None:
+        _saved = ({name: sys.modules.get(name) for name in _MODULES}, presencebackends.NmapProcess,
+                  gpiomanager.__dict__.get("GPIO"))
+    rpi = type(sys)("RPi")
+    rpi.GPIO = simulation.gpio
+    sys.modules.update({"RPi": rpi, "RPi.GPIO": simulation.gpio, "MyPyDHT": simulation.dht,
+                        "MyPyBMP180": simulation.bmp})
+    for module_name, attribute, fake in ((".sensors.dhtsensor", "MyPyDHT", simulation.dht),
+                                         (".sensors.bmpsensor", "MyPyBMP180", simulation.bmp)):
+        module = sys.modules.get(__package__.rsplit(".", 1)[0] + module_name)
+        if module is not None:
+            setattr(module, attribute, fake)
+    presencebackends.NmapProcess = simulation.network.process_class()
+    # gpiomanager sets the numbering mode at the first access of its GPIO attribute
+    gpiomanager.__dict__.pop("GPIO", None)
+    return simulation
+
+
+def uninstall():
+    """Restore the modules replaced by install"""
+    global _saved
+    if _saved is None:
+        return
+    from ..agents import presencebackends
+    from ..common import gpiomanager
+    modules, nmap_process, gpio = _saved
+    for name, module in modules.items():
+        if module is None:
+            sys.modules.pop(name, None)
+        else:
+            sys.modules[name] = module
+    for module_name, attribute in ((".sensors.dhtsensor", "MyPyDHT"), (".sensors.bmpsensor", "MyPyBMP180")):
+        module = sys.modules.get(__package__.rsplit(".", 1)[0] + module_name)
+        if module is not None:
+            if modules[attribute] is None:
+                # the module was imported with the fake driver, it must be imported again
+                del sys.modules[module.__name__]
+            else:
+                setattr(module, attribute, modules[attribute])
+    presencebackends.NmapProcess = nmap_process
+    gpiomanager.__dict__.pop("GPIO", None)
+    if gpio is not None:
+        gpiomanager.GPIO = gpio
+    _saved = None
@@ -0,0 +1,285 @@
+import random
+import socket
+import socketserver
+import struct
+import threading
+import time
+from ..common.topictrie import TopicTrie
+
+_CONNECT, _PUBLISH, _PUBACK, _PUBREC, _PUBREL, _PUBCOMP = 1, 3, 4, 5, 6, 7
+_SUBSCRIBE, _UNSUBSCRIBE, _PINGREQ, _DISCONNECT = 8, 10, 12, 14
+
+
+def _read_exact(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed by the client")
+        data += chunk
+    return data
+
+
+def _read_packet(sock):
+    """Read an MQTT control packet, return its first byte and its body"""
+    header = _read_exact(sock, 1)[0]
+    multiplier = 1
+    length = 0
+    while True:
+        byte = _read_exact(sock, 1)[0]
+        length += (byte & 127) * multiplier
+        multiplier *= 128
+        if not byte & 128:
+            break
+    return header, _read_exact(sock, length)
+
+
+def _packet(header, body=b""):
+    """Build an MQTT control packet"""
+    length = len(body)
+    encoded = b""
+    while True:
+        byte = length % 128
+        length //= 128
+        encoded += bytes([byte | (128 if length else 0)])
+        if not length:
+            break
+    return bytes([header]) + encoded + body
+
+
+def _string(body, position):
+    """Read a length prefixed string, return it with the position following it"""
+    length = struct.unpack("!H", body[position:position + 2])[0]
+    return body[position + 2:position + 2 + length].decode("utf-8"), position + 2 + length
+
+
+class _Session(object):
+    """A client connected to the SimulatedBroker
+
+    Attributes:
+        sock (socket.socket): the connection with the client
+        subscriptions ({str: int}): the QoS granted to the topic filters subscribed, indexed by filter
+        _send_lock (threading.Lock): the lock serializing the writes on the socket
+        _next_id (int): the next packet identifier of the messages delivered to the client
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.subscriptions = {}
+        self._send_lock = threading.Lock()
+        self._next_id = 0
+
+    def send(self, data):
+        with self._send_lock:
+            self.sock.sendall(data)
+
+    def deliver(self, topic, payload, qos, redeliver=False):
+        """Deliver a message, with redeliver the message is sent again (with the DUP flag) as if its
+        acknowledgement had been lost"""
+        encoded_topic = topic.encode("utf-8")
+        body = struct.pack("!H", len(encoded_topic)) + encoded_topic
+        with self._send_lock:
+            if qos:
+                self._next_id = self._next_id % 65535 + 1
+                body += struct.pack("!H", self._next_id)
+            self.sock.sendall(_packet((_PUBLISH << 4) | (qos << 1), body + payload))
+            if redeliver:
+                self.sock.sendall(_packet((_PUBLISH << 4) | 0x08 | (qos << 1), body + payload))
+
+
+class SimulatedBroker(object):
+    """An MQTT broker running within the process
+
+    The broker implements the subset of MQTT 3.1.1 used by PiHome: connections without persistent sessions,
+    publications with QoS 0, 1 and 2 and subscriptions with wildcards (matched through a TopicTrie). It is
+    meant for tests and benchmarks: there is no authentication, no retained message and no will, and a QoS 2
+    message is routed as soon as it is received. Every message received is recorded, with the time of its
+    reception, in the messages attribute. A fraction of the QoS 1 deliveries can be duplicated, to simulate
+    the redeliveries following a lost acknowledgement.
+
+    Attributes:
+        messages ([(float, str, bytes)]): the perf_counter time, the topic and the payload of the messages received
+        redelivery_rate (float): the fraction of the QoS 1 deliveries sent twice to the subscribers
+        _random (random.Random): the generator choosing the deliveries to duplicate
+        _subscriptions (TopicTrie): the sessions (with the QoS granted) indexed by topic filter
+        _sessions (set): the sessions of the connected clients
+        _lock (threading.Condition): the condition protecting the messages, the subscriptions and the sessions
+        _server (socketserver.ThreadingTCPServer): the server accepting the connections
+        _thread (threading.Thread): the thread serving the connections, None if not started
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, redelivery_rate=0.0, seed=None):
+        """Initialize the SimulatedBroker
+
+        Args:
+            host (str, optional): the address to listen on
+            port (int, optional): the port to listen on, 0 picks a free one (see the port attribute)
+            redelivery_rate (float, optional): the fraction of the QoS 1 deliveries sent twice to the subscribers
+            seed (int, optional): the seed of the generator choosing the deliveries to duplicate
+        """
+        self.messages = []
+        self.redelivery_rate = redelivery_rate
+        self._random = random.Random(seed)
+        self._subscriptions = TopicTrie()
+        self._sessions = set()
+        self._lock = threading.Condition()
+        self._thread = None
+        broker = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                broker._serve(self.request)
+
+        class Server(socketserver.ThreadingTCPServer):
+            allow_reuse_address = True
+            daemon_threads = True
+
+        self._server = Server((host, port), Handler)
+
+    @property
+    def host(self):
+        return self._server.server_address[0]
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        """Start accepting connections"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._server.serve_forever, name="simulated-broker", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the broker closing all the connections"""
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+        with self._lock:
+            sessions = list(self._sessions)
+        for session in sessions:
+            try:
+                session.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def wait_for(self, count, timeout=10):
+        """Wait for the broker to have received a number of messages
+
+        Args:
+            count (int): the number of messages
+            timeout (float, optional): the maximum amount of time, in seconds, to wait
+
+        Returns:
+            bool. True if the messages have been received, False if the timeout expired
+        """
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while len(self.messages) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._lock.wait(remaining)
+            return True
+
+    def clear(self):
+        """Forget the messages received"""
+        with self._lock:
+            self.messages = []
+
+    def connections(self):
+        """Return the number of clients connected"""
+        with self._lock:
+            return len(self._sessions)
+
+    def _route(self, topic, payload, qos):
+        with self._lock:
+            self.messages.append((time.perf_counter(), topic, payload))
+            self._lock.notify_all()
+            # a session matching several filters gets the message once, with the highest QoS granted
+            deliveries = {}
+            for session, granted_qos in self._subscriptions.match(topic):
+                deliveries[session] = max(deliveries.get(session, 0), granted_qos)
+            redeliveries = {session for session, granted_qos in deliveries.items() if min(qos, granted_qos) == 1 and
+                            self._random.random() < self.redelivery_rate}
+        for session, granted_qos in deliveries.items():
+            try:
+                session.deliver(topic, payload, min(qos, granted_qos), session in redeliveries)
+            except OSError:
+                pass
+
+    def _subscribe(self, session, body):
+        packet_id = body[:2]
+        position = 2
+        granted = b""
+        while position < len(body):
+            topic_filter, position = _string(body, position)
+            qos = min(body[position], 2)
+            position += 1
+            with self._lock:
+                previous_qos = session.subscriptions.get(topic_filter)
+                if previous_qos is not None:
+                    self._subscriptions.remove(topic_filter, (session, previous_qos))
+                session.subscriptions[topic_filter] = qos
+                self._subscriptions.add(topic_filter, (session, qos))
+            granted += bytes([qos])
+        session.send(_packet(0x90, packet_id + granted))
+
+    def _unsubscribe(self, session, body):
+        position = 2
+        while position < len(body):
+            topic_filter, position = _string(body, position)
+            with self._lock:
+                qos = session.subscriptions.pop(topic_filter, None)
+                if qos is not None:
+                    self._subscriptions.remove(topic_filter, (session, qos))
+        session.send(_packet(0xb0, body[:2]))
+
+    def _serve(self, sock):
+        """Serve a client till it disconnects"""
+        session = _Session(sock)
+        with self._lock:
+            self._sessions.add(session)
+        try:
+            while True:
+                header, body = _read_packet(sock)
+                kind = header >> 4
+                if kind == _CONNECT:
+                    session.send(_packet(0x20, b"\x00\x00"))
+                elif kind == _PUBLISH:
+                    qos = (header >> 1) & 3
+                    topic, position = _string(body, 0)
+                    packet_id = b""
+                    if qos:
+                        packet_id = body[position:position + 2]
+                        position += 2
+                    if qos == 1:
+                        session.send(_packet(_PUBACK << 4, packet_id))
+                    elif qos == 2:
+                        session.send(_packet(_PUBREC << 4, packet_id))
+                    self._route(topic, body[position:], qos)
+                elif kind == _PUBREC:
+                    session.send(_packet((_PUBREL << 4) | 0x02, body[:2]))
+                elif kind == _PUBREL:
+                    session.send(_packet(_PUBCOMP << 4, body[:2]))
+                elif kind == _SUBSCRIBE:
+                    self._subscribe(session, body)
+                elif kind == _UNSUBSCRIBE:
+                    self._unsubscribe(session, body)
+                elif kind == _PINGREQ:
+                    session.send(_packet(0xd0))
+                elif kind == _DISCONNECT:
+                    return
+        except (ConnectionError, OSError):
+            return
+        finally:
+            with self._lock:
+                self._sessions.discard(session)
+                for topic_filter, qos in session.subscriptions.items():
+                    self._subscriptions.remove(topic_filter, (session, qos))
+            try:
+                sock.close()
+            except OSError:
+                pass
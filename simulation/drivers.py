@@ -0,0 +1,93 @@
+import random
+import threading
+import time
+
+
+class _DriverException(Exception):
+    """The exceptions of the drivers carry their message in the message attribute"""
+
+    def __init__(self, message):
+        super(_DriverException, self).__init__(message)
+        self.message = message
+
+
+class FakeDriver(object):
+    """The common part of the fake sensor drivers
+
+    Every reading takes latency seconds (plus up to jitter more) and fails with probability failure_rate;
+    the values follow a random walk around their base values.
+
+    Attributes:
+        latency (float): the time, in seconds, a reading takes
+        jitter (float): the maximum random time, in seconds, added to the latency
+        failure_rate (float): the probability of a reading failing
+        readings (int): the number of readings performed
+        failures (int): the number of readings failed
+        _values ({str: float}): the current values
+        _step (float): the maximum change of a value between two readings
+        _random (random.Random): the generator of the failures, of the jitter and of the values
+        _lock (threading.Lock): the lock protecting the counters and the values
+        _sleep (callable): the function waiting the latency
+    """
+
+    def __init__(self, values, latency=0.0, jitter=0.0, failure_rate=0.0, step=0.1, seed=None, sleep=time.sleep):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.readings = 0
+        self.failures = 0
+        self._values = dict(values)
+        self._step = step
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._sleep = sleep
+
+    def _read(self, exception_class):
+        with self._lock:
+            self.readings += 1
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            failed = self._random.random() < self.failure_rate
+            if failed:
+                self.failures += 1
+            else:
+                for label in self._values:
+                    self._values[label] += self._random.uniform(-self._step, self._step)
+            values = dict(self._values)
+        if delay:
+            self._sleep(delay)
+        if failed:
+            raise exception_class("Simulated reading failure")
+        return values
+
+
+class FakeDHTDriver(FakeDriver):
+    """A stand-in for the MyPyDHT module"""
+
+    class Sensor(object):
+        DHT11 = 11
+        DHT22 = 22
+        AM2302 = 22
+
+    class DHTException(_DriverException):
+        pass
+
+    def __init__(self, humidity=50.0, temperature=21.0, **kwargs):
+        super(FakeDHTDriver, self).__init__({"humidity": humidity, "temperature": temperature}, **kwargs)
+
+    def sensor_read(self, sensor, pin, reading_attempts=3, use_cache=False):
+        values = self._read(self.DHTException)
+        return round(values["humidity"], 1), round(values["temperature"], 1)
+
+
+class FakeBMPDriver(FakeDriver):
+    """A stand-in for the MyPyBMP180 module"""
+
+    class BMP180Exception(_DriverException):
+        pass
+
+    def __init__(self, pressure=1013.0, temperature=21.0, **kwargs):
+        super(FakeBMPDriver, self).__init__({"pressure": pressure, "temperature": temperature}, **kwargs)
+
+    def sensor_read(self):
+        values = self._read(self.BMP180Exception)
+        return round(values["pressure"], 2), round(values["temperature"], 1)
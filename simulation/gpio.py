@@ -0,0 +1,186 @@
+import queue
+import random
+import threading
+import time
+
+
+class FakeGPIO(object):
+    """A stand-in for the RPi.GPIO module
+
+    The object implements the subset of RPi.GPIO used by PiHome (setmode, setup, input, add_event_detect,
+    remove_event_detect, cleanup and the constants) and lets the caller raise edges on the input channels,
+    either one at a time (see fire) or at a given rate from a background thread (see start_edges).
+    Like the real library the callbacks of all the channels are invoked, one at a time, on a single thread of
+    their own and the edges falling within the bouncetime of the previous one are dropped, unless
+    honor_bouncetime is False (handy to raise events faster than the bouncetime used by the agents).
+
+    Attributes:
+        edges ([(int, float)]): the channel and the perf_counter time of every edge delivered to a callback
+        dropped (int): the number of edges dropped by the bouncetime
+        _honor_bouncetime (bool): if False the bouncetime of the event detections is ignored
+        _mode (int): the numbering mode set, None if not set yet
+        _channels ({int: int}): the direction of the channels set up
+        _levels ({int: int}): the current level of the channels
+        _detections ({int: (int, callable, float)}): the edge, callback and bouncetime (in seconds) of the
+                                                     event detections indexed by channel
+        _last_edge ({int: float}): the time of the last edge delivered per channel
+        _lock (threading.Lock): the lock protecting the detections
+        _generators ([(threading.Thread, threading.Event)]): the running edge generators
+        _callbacks (queue.Queue): the (callback, channel, completion event) waiting for the callback thread
+        _callback_thread (threading.Thread): the thread invoking the callbacks, None till the first edge
+    """
+    BCM = 11
+    BOARD = 10
+    IN = 1
+    OUT = 0
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+    HIGH = 1
+    LOW = 0
+
+    def __init__(self, honor_bouncetime=True):
+        """Initialize the FakeGPIO
+
+        Args:
+            honor_bouncetime (bool, optional): if False the bouncetime of the event detections is ignored
+        """
+        self.edges = []
+        self.dropped = 0
+        self._honor_bouncetime = honor_bouncetime
+        self._mode = None
+        self._channels = {}
+        self._levels = {}
+        self._detections = {}
+        self._last_edge = {}
+        self._lock = threading.Lock()
+        self._generators = []
+        self._callbacks = queue.Queue()
+        self._callback_thread = None
+
+    def setmode(self, mode):
+        self._mode = mode
+
+    def getmode(self):
+        return self._mode
+
+    def setup(self, channel, direction, pull_up_down=PUD_OFF, initial=LOW):
+        if self._mode is None:
+            raise RuntimeError("Please set pin numbering mode using GPIO.setmode(GPIO.BOARD) or GPIO.setmode(GPIO.BCM)")
+        self._channels[channel] = direction
+        self._levels[channel] = self.HIGH if pull_up_down == self.PUD_UP else self.LOW
+
+    def input(self, channel):
+        return self._levels.get(channel, self.LOW)
+
+    def output(self, channel, value):
+        self._levels[channel] = value
+
+    def add_event_detect(self, channel, edge, callback=None, bouncetime=0):
+        if self._channels.get(channel) != self.IN:
+            raise RuntimeError("You must setup() the GPIO channel as an input first")
+        with self._lock:
+            if channel in self._detections:
+                raise RuntimeError("Conflicting edge detection already enabled for this GPIO channel")
+            self._detections[channel] = (edge, callback, bouncetime / 1000.0)
+
+    def remove_event_detect(self, channel):
+        with self._lock:
+            self._detections.pop(channel, None)
+
+    def cleanup(self, channel=None):
+        with self._lock:
+            channels = [channel] if channel is not None else list(self._channels)
+            for cleaned in channels:
+                self._channels.pop(cleaned, None)
+                self._detections.pop(cleaned, None)
+
+    def _invoke_callbacks(self):
+        while True:
+            callback, channel, completed = self._callbacks.get()
+            try:
+                callback(channel)
+            except Exception:
+                # the real library prints the traceback and keeps serving the other callbacks
+                import traceback
+                traceback.print_exc()
+            if completed is not None:
+                completed.set()
+
+    def fire(self, channel, wait=False, level=HIGH):
+        """Raise an edge on a channel
+
+        Args:
+            channel (int): the channel
+            wait (bool, optional): if True the method returns once the callback has completed
+            level (int, optional): the level the channel goes to, HIGH (the default) raises a rising edge and
+                                   LOW a falling one
+
+        Returns:
+            bool. True if the edge was delivered to a callback, False if nobody was listening or it was
+            dropped by the bouncetime
+        """
+        now = time.perf_counter()
+        self._levels[channel] = level
+        with self._lock:
+            detection = self._detections.get(channel)
+            if detection is None or detection[0] == (self.FALLING if level == self.HIGH else self.RISING):
+                return False
+            _, callback, bouncetime = detection
+            last_edge = self._last_edge.get(channel)
+            if self._honor_bouncetime and last_edge is not None and now - last_edge < bouncetime:
+                self.dropped += 1
+                return False
+            self._last_edge[channel] = now
+            self.edges.append((channel, now))
+            if callback is not None and self._callback_thread is None:
+                self._callback_thread = threading.Thread(target=self._invoke_callbacks, name="gpio-callbacks",
+                                                         daemon=True)
+                self._callback_thread.start()
+        if callback is not None:
+            completed = threading.Event() if wait else None
+            self._callbacks.put((callback, channel, completed))
+            if wait:
+                completed.wait()
+        return True
+
+    def start_edges(self, channel, rate, count=None, poisson=True, seed=None, level=HIGH):
+        """Raise edges on a channel from a background thread
+
+        Args:
+            channel (int): the channel
+            rate (float): the average number of edges per second
+            count (int, optional): the number of edges to raise, if None they are raised till stop_edges
+            poisson (bool, optional): if True the intervals between the edges are exponentially distributed
+                                      (independent events like the ones of a PIR sensor), otherwise constant
+            seed (int, optional): the seed of the random intervals
+            level (int, optional): HIGH to raise rising edges, LOW to raise falling ones
+
+        Returns:
+            threading.Thread. The generator thread
+        """
+        stop = threading.Event()
+        generator = random.Random(seed)
+
+        def generate():
+            raised = 0
+            while not stop.is_set() and (count is None or raised < count):
+                stop.wait(generator.expovariate(rate) if poisson else 1.0 / rate)
+                if not stop.is_set():
+                    self.fire(channel, level=level)
+                    raised += 1
+
+        thread = threading.Thread(target=generate, name="gpio-edges-{}".format(channel), daemon=True)
+        self._generators.append((thread, stop))
+        thread.start()
+        return thread
+
+    def stop_edges(self):
+        """Stop all the edge generators"""
+        for thread, stop in self._generators:
+            stop.set()
+            thread.join()
+        self._generators = []
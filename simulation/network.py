@@ -0,0 +1,117 @@
+import ipaddress
+import random
+import threading
+import time
+
+_NMAP_REPORT = """<?xml version="1.0"?>
+<nmaprun scanner="nmap" args="nmap -sn" start="0" version="7.80" xmloutputversion="1.04">
+{hosts}
+<runstats><finished time="0" elapsed="0"/><hosts up="{up}" down="{down}" total="{total}"/></runstats>
+</nmaprun>"""
+_NMAP_HOST = """<host><status state="{state}" reason="arp-response"/><address addr="{ip}" addrtype="ipv4"/>{mac}</host>"""
+_NMAP_MAC = """<address addr="{mac}" addrtype="mac"/>"""
+
+
+class FakeNetwork(object):
+    """The devices of a simulated network, probed through a stand-in for libnmap's NmapProcess
+
+    Every scan costs spawn_latency seconds (the start of the nmap process) plus probe_latency seconds per
+    target; a device connected to the network answers a probe with its own probability (phones sleep).
+    The report is the XML nmap would print, so the real parser and backends are exercised.
+
+    Attributes:
+        spawn_latency (float): the time, in seconds, spent starting a scan
+        probe_latency (float): the time, in seconds, spent probing every target
+        scans (int): the number of scans performed
+        probes (int): the number of targets probed
+        _devices ({str: (str, float)}): the MAC address and the probability to answer of the devices
+                                        connected to the network, indexed by IP
+        _random (random.Random): the generator of the answers
+        _lock (threading.Lock): the lock protecting the devices and the counters
+        _sleep (callable): the function waiting the latency of the scans
+    """
+
+    def __init__(self, devices=None, spawn_latency=0.0, probe_latency=0.0, seed=None, sleep=time.sleep):
+        """Initialize the FakeNetwork
+
+        Args:
+            devices ({str: (str, float)}, optional): the MAC address and the probability to answer of the
+                                                     devices connected to the network, indexed by IP
+            spawn_latency (float, optional): the time, in seconds, spent starting a scan
+            probe_latency (float, optional): the time, in seconds, spent probing every target
+            seed (int, optional): the seed of the answers
+            sleep (callable, optional): the function waiting the latency of the scans
+        """
+        self.spawn_latency = spawn_latency
+        self.probe_latency = probe_latency
+        self.scans = 0
+        self.probes = 0
+        self._devices = dict(devices or {})
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._sleep = sleep
+
+    def connect(self, ip_addr, mac="00:00:00:00:00:00", answer_probability=1.0):
+        """Connect a device to the network"""
+        with self._lock:
+            self._devices[ip_addr] = (mac, answer_probability)
+
+    def disconnect(self, ip_addr):
+        """Disconnect a device from the network"""
+        with self._lock:
+            self._devices.pop(ip_addr, None)
+
+    def _targets(self, targets):
+        """Expand the targets of a scan, a subnet is swept entirely"""
+        expanded = []
+        for target in ([targets] if isinstance(targets, str) else targets):
+            if "/" in target:
+                network = ipaddress.ip_network(target, strict=False)
+                with self._lock:
+                    expanded.extend(ip_addr for ip_addr in self._devices if ipaddress.ip_address(ip_addr) in network)
+            else:
+                expanded.append(target)
+        return expanded
+
+    def scan(self, targets):
+        """Probe targets, as nmap -sn would
+
+        Args:
+            targets (str or [str]): the IPs or subnets to probe
+
+        Returns:
+            str. The XML report of the scan
+        """
+        targets = self._targets(targets)
+        hosts = []
+        with self._lock:
+            self.scans += 1
+            self.probes += len(targets)
+            for ip_addr in targets:
+                mac, probability = self._devices.get(ip_addr, (None, 0.0))
+                answers = self._random.random() < probability
+                hosts.append(_NMAP_HOST.format(state="up" if answers else "down", ip=ip_addr,
+                                               mac=_NMAP_MAC.format(mac=mac.upper()) if answers and mac else ""))
+        delay = self.spawn_latency + self.probe_latency * len(targets)
+        if delay:
+            self._sleep(delay)
+        up = sum(1 for host in hosts if 'state="up"' in host)
+        return _NMAP_REPORT.format(hosts="\n".join(hosts), up=up, down=len(hosts) - up, total=len(hosts))
+
+    def process_class(self):
+        """Return a class implementing the subset of libnmap.process.NmapProcess used by the presence backends"""
+        network = self
+
+        class FakeNmapProcess(object):
+
+            def __init__(self, targets, options):
+                self.targets = targets
+                self.options = options
+                self.stdout = ""
+                self.stderr = ""
+
+            def run(self):
+                self.stdout = network.scan(self.targets)
+                return 0
+
+        return FakeNmapProcess
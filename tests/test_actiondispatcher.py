@@ -0,0 +1,164 @@
+"""Tests of the dispatch of the messages to the actions"""
+import json
+import threading
+import time
+from ..common import metrics
+from ..common.actiondispatcher import ActionDispatcher, ActionPolicy, DispatchedMessage
+from ..common.payloads import CodecTable
+from ..eventmanager import EventManager
+
+
+class RecordingBrokerClient(object):
+    """A stand-in for MQTTClient recording the callbacks registered on every topic"""
+
+    codecs = None
+
+    def __init__(self):
+        self.callbacks = {}
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def register(self, topic, callback):
+        self.callbacks.setdefault(topic, []).append(callback)
+
+    def unregister(self, topic, callback):
+        self.callbacks[topic].remove(callback)
+
+
+def _wait(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def _handlers(received):
+    """Return two different actions whose functions are both called handle, like the ones of two plugins"""
+    def first():
+        def handle(message):
+            received.append(("first", message.topic))
+        return handle
+
+    def second():
+        def handle(message):
+            received.append(("second", message.topic))
+        return handle
+
+    return first(), second()
+
+
+def test_same_named_functions_get_their_own_queue():
+    received = []
+    first, second = _handlers(received)
+    dispatcher = ActionDispatcher({"lights": ActionPolicy(queue_size=1)})
+    lights = dispatcher.queue_for("lights", first)
+    alarm = dispatcher.queue_for("alarm", second)
+    assert lights is not alarm
+    assert lights._policy.queue_size == 1 and alarm._policy.queue_size == 100
+    lights(DispatchedMessage("home/door", b""))
+    alarm(DispatchedMessage("home/motion", b""))
+    assert _wait(lambda: len(received) == 2)
+    assert sorted(received) == [("first", "home/door"), ("second", "home/motion")]
+    dispatcher.stop()
+
+
+def test_stop_does_not_hang_on_a_stuck_action():
+    release = threading.Event()
+    dispatcher = ActionDispatcher(default_policy=ActionPolicy(queue_size=2))
+    stuck = dispatcher.queue_for("stuck", lambda message: release.wait(10))
+    for index in range(4):
+        stuck(DispatchedMessage("home/motion", index))
+    assert _wait(lambda: stuck.stats()["queue_depth"] == 2)
+    started = time.monotonic()
+    stuck.stop(timeout=0.2)
+    assert time.monotonic() - started < 1
+    release.set()
+
+
+def test_stop_processes_the_queued_messages():
+    received = []
+    dispatcher = ActionDispatcher()
+    action_queue = dispatcher.queue_for("slow", lambda message: (time.sleep(0.01), received.append(message)))
+    for index in range(5):
+        action_queue(DispatchedMessage("home/motion", index))
+    dispatcher.stop()
+    assert len(received) == 5
+
+
+def test_update_topics_stops_the_queues_of_removed_actions():
+    received = []
+    first, second = _handlers(received)
+    client = RecordingBrokerClient()
+    event_manager = EventManager(client, [("home/door", "lights", first), ("home/motion", "alarm", second)])
+    event_manager.start_listening()
+    alarm = event_manager._dispatcher.queue_for("alarm", second)
+    workers = list(alarm._workers)
+    event_manager.update_topics([("home/door", "lights", first)])
+    assert client.callbacks["home/motion"] == []
+    assert set(event_manager.stats()) == {"lights"}
+    assert _wait(lambda: not any(worker.is_alive() for worker in workers))
+    event_manager.stop_listening()
+
+
+def test_every_queue_discards_its_own_qos1_copies():
+    received = []
+    first, second = _handlers(received)
+    dispatcher = ActionDispatcher(codecs=CodecTable(), dedup_size=16)
+    lights = dispatcher.queue_for("lights", first)
+    alarm = dispatcher.queue_for("alarm", second)
+    event = json.dumps({"ts": 1.0, "seq": 7}).encode()
+    for action_queue in (lights, alarm):
+        for qos in (1, 1, 0):
+            action_queue(DispatchedMessage("home/motion", event, qos=qos))
+        # without a sequence number a message is never a copy
+        action_queue(DispatchedMessage("home/motion", json.dumps({"ts": 1.0}).encode(), qos=1))
+        action_queue(DispatchedMessage("home/motion", json.dumps({"ts": 1.0}).encode(), qos=1))
+    dispatcher.stop()
+    assert sorted(received) == [("first", "home/motion")] * 4 + [("second", "home/motion")] * 4
+    assert lights.stats()["duplicates"] == 1 and lights.stats()["processed"] == 4
+    assert alarm.stats()["duplicates"] == 1
+
+
+def test_no_copy_is_discarded_without_dedup_size():
+    received = []
+    dispatcher = ActionDispatcher(codecs=CodecTable())
+    action_queue = dispatcher.queue_for("alarm", received.append)
+    event = json.dumps({"ts": 1.0, "seq": 7}).encode()
+    action_queue(DispatchedMessage("home/motion", event, qos=1))
+    action_queue(DispatchedMessage("home/motion", event, qos=1))
+    dispatcher.stop()
+    assert len(received) == 2
+    assert action_queue.stats()["duplicates"] == 0
+
+
+def test_removing_an_action_never_creates_a_queue():
+    received = []
+    first, second = _handlers(received)
+    client = RecordingBrokerClient()
+    event_manager = EventManager(client, [("home/door", "lights", first), ("home/motion", "alarm", second)])
+    event_manager.start_listening()
+    event_manager._dispatcher.remove("alarm")
+    event_manager.update_topics([("home/door", "lights", first)])
+    assert event_manager._dispatcher.get("alarm") is None
+    assert set(event_manager.stats()) == {"lights"}
+    event_manager.stop_listening()
+    assert event_manager._dispatcher.get("lights") is None
+    assert client.callbacks["home/door"] == []
+
+
+def test_queue_depth_gauge_is_dropped_with_its_queue(monkeypatch):
+    registry = metrics.MetricsRegistry()
+    monkeypatch.setattr(metrics, "_registry", registry)
+    dispatcher = ActionDispatcher()
+    dispatcher.queue_for("lights", lambda message: None)
+    dispatcher.queue_for("alarm", lambda message: None)
+    depths = lambda: {item["labels"]["action"] for item in registry.as_dict()["action_queue_depth"]}
+    assert depths() == {"lights", "alarm"}
+    dispatcher.remove("alarm")
+    assert depths() == {"lights"}
+    dispatcher.stop()
+    assert depths() == set()
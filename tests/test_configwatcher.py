@@ -0,0 +1,54 @@
+"""Tests of a ConfigWatcher shared by several agents through its views"""
+import os
+from ..common import configmanager
+from ..common.configwatcher import ConfigWatcher
+
+
+def _write(path, interval):
+    path.write_text("[sensors]\nsampling_interval = {}\n".format(interval))
+    # the watcher compares the modification time and the size of the file, let's make sure the first one changes
+    stat = os.stat(str(path))
+    os.utime(str(path), ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+
+
+def test_views_notify_their_listeners_when_checked(tmp_path):
+    ini = tmp_path / "pihome.ini"
+    _write(ini, 60)
+    parsed = []
+
+    def parse(path):
+        parsed.append(path)
+        return configmanager.parse_settings(path)
+
+    watcher = ConfigWatcher(path=str(ini), parse=parse)
+    sampling, presence = watcher.share(), watcher.share()
+    notified = []
+    sampling.add_listener(lambda settings, changes: notified.append(("sampling", changes)))
+    presence.add_listener(lambda settings, changes: notified.append(("presence", changes)))
+    _write(ini, 30)
+    assert watcher.check() == {"sensors": {"sampling_interval"}}
+    # the views are notified only when their owner checks them
+    assert notified == []
+    assert sampling.check() == {"sensors": {"sampling_interval"}}
+    assert sampling.check() == {}
+    assert presence.check() == {"sensors": {"sampling_interval"}}
+    assert [name for name, _ in notified] == ["sampling", "presence"]
+    assert presence.settings.sensors.sampling_interval == 30
+    # the file is parsed once at init and once per change, whatever the number of views
+    assert len(parsed) == 2
+
+
+def test_started_view_is_checked_on_the_watcher_thread(tmp_path):
+    ini = tmp_path / "pihome.ini"
+    _write(ini, 60)
+    watcher = ConfigWatcher(path=str(ini))
+    actions = watcher.share()
+    notified = []
+    actions.add_listener(lambda settings, changes: notified.append(settings.sensors.sampling_interval))
+    actions.start()
+    _write(ini, 30)
+    watcher.check()
+    actions.stop()
+    _write(ini, 15)
+    watcher.check()
+    assert notified == [30]
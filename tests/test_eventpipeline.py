@@ -0,0 +1,19 @@
+"""Tests of the counters of the EventPipeline"""
+from ..agents.eventpipeline import EventPipeline, EventSource
+from ..common import metrics
+
+
+def test_edges_are_throttled_and_dropped(monkeypatch):
+    monkeypatch.setattr(metrics, "_registry", metrics.MetricsRegistry())
+    published = []
+    pipeline = EventPipeline(lambda source, timestamp: published.append(source.event),
+                             {26: EventSource(26, "motion")}, window=60, queue_size=3)
+    # the publisher thread is not started, the queue keeps the last 3 edges
+    for _ in range(5):
+        pipeline.push(26)
+    assert pipeline.stats()["dropped"] == 2
+    pipeline.start()
+    pipeline.stop()
+    stats = pipeline.stats()
+    assert published == ["motion"]
+    assert (stats["edges"], stats["published"], stats["throttled"], stats["pending"]) == (3, 1, 2, 0)
@@ -0,0 +1,48 @@
+"""Tests of the agents built out of the configuration"""
+import pytest
+from .. import loader
+from ..common import configmanager, plugins
+from .test_actiondispatcher import RecordingBrokerClient, _handlers
+
+
+class StubRegistry(object):
+    """A plugin registry serving the actions of a dictionary"""
+
+    def __init__(self, actions):
+        self.actions = actions
+
+    def action(self, name):
+        return self.actions[name]
+
+
+@pytest.fixture
+def settings(tmp_path, monkeypatch):
+    ini = tmp_path / "pihome.ini"
+    ini.write_text("[actions]\n"
+                   "topics_and_actions = home/door:lights, home/motion:alarm\n"
+                   "[action:lights]\n"
+                   "queue_size = 1\n")
+    monkeypatch.setattr(configmanager, "settings", configmanager.parse_settings(str(ini)), raising=False)
+    received = []
+    lights, alarm = _handlers(received)
+    monkeypatch.setattr(plugins, "_registry", StubRegistry({"lights": lights, "alarm": alarm}))
+    return lights, alarm
+
+
+def test_actions_are_named_as_configured(settings):
+    lights, alarm = settings
+    # both functions are called handle, only the configured names tell them apart
+    assert loader._get_topics_and_actions() == [("home/door", "lights", lights), ("home/motion", "alarm", alarm)]
+
+
+def test_event_manager_queues_use_the_configured_names(settings, monkeypatch):
+    monkeypatch.setattr(loader, "_get_config_watcher", lambda: None)
+    event_manager = loader.get_event_manager(RecordingBrokerClient())
+    event_manager.start_listening()
+    try:
+        queues = event_manager._dispatcher._queues
+        assert set(queues) == {"lights", "alarm"}
+        assert queues["lights"]._policy.queue_size == 1
+        assert queues["alarm"]._policy.queue_size == 100
+    finally:
+        event_manager.stop_listening()
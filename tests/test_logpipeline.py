@@ -0,0 +1,26 @@
+"""Tests of the rate limited logging pipeline"""
+import logging
+from ..common.logpipeline import RateLimitFilter
+
+
+def _record(msg, args=()):
+    return logging.LogRecord("PiHomeLogger", logging.INFO, "mqttclient.py", 42, msg, args, None)
+
+
+def test_dropped_records_are_reported_by_the_next_one():
+    rate_filter = RateLimitFilter(sample_every=3)
+    outcomes = [rate_filter.filter(_record("Queue %s at %d%%", ("lights", 90))) for _ in range(6)]
+    assert outcomes == [False, False, True, False, False, True]
+    record = _record("Queue %s at %d%%", ("lights", 90))
+    rate_filter = RateLimitFilter(sample_every=2)
+    rate_filter.filter(_record("Queue %s at %d%%", ("lights", 90)))
+    assert rate_filter.filter(record)
+    assert record.getMessage() == "Queue lights at 90% [1 similar records dropped]"
+
+
+def test_record_without_arguments_keeps_its_message():
+    rate_filter = RateLimitFilter(sample_every=2)
+    rate_filter.filter(_record("Outbox 100% full"))
+    record = _record("Outbox 100% full")
+    assert rate_filter.filter(record)
+    assert record.getMessage() == "Outbox 100% full [1 similar records dropped]"
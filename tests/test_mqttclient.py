@@ -0,0 +1,32 @@
+"""Tests of the MQTTClient"""
+import pytest
+from ..common import metrics
+from ..common.mqttclient import MQTTClient
+
+
+class SizedOutbox(object):
+    """A stand-in for Outbox holding a fixed number of messages"""
+
+    def __init__(self, size):
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    registry = metrics.MetricsRegistry()
+    monkeypatch.setattr(metrics, "_registry", registry)
+    return registry
+
+
+def test_every_client_has_its_own_gauges(registry):
+    MQTTClient("localhost", 1883, None, "home", outbox=SizedOutbox(3), name="sensors_manager")
+    MQTTClient("localhost", 1883, None, "home", outbox=SizedOutbox(5), name="presence_detector")
+    document = registry.as_dict()
+    outbox_depths = {series["labels"]["client"]: series["value"] for series in document["mqtt_outbox_depth"]}
+    assert outbox_depths == {"sensors_manager": 3, "presence_detector": 5}
+    assert {series["labels"]["client"] for series in document["mqtt_queue_depth"]} == {"sensors_manager",
+                                                                                       "presence_detector"}
+    assert len(document["mqtt_connected"]) == 2
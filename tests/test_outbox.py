@@ -0,0 +1,113 @@
+"""Tests of the outbox, against a simulated broker that is stopped and restarted"""
+import logging
+import multiprocessing
+import os
+import time
+import pytest
+from ..common.mqttclient import MQTTClient
+from ..common.outbox import Outbox
+from ..simulation import SimulatedBroker
+
+
+def _wait(condition, timeout=15):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return condition()
+
+
+def test_database_is_opened_at_first_use(tmp_path):
+    outbox = Outbox(str(tmp_path / "outbox.sqlite"))
+    assert outbox._connection is None
+    outbox.put("home/temperature", b"22.5", 1)
+    assert len(outbox) == 1 and outbox._pid == os.getpid()
+    outbox.close()
+
+
+def test_outbox_is_bounded(tmp_path):
+    outbox = Outbox(str(tmp_path / "outbox.sqlite"), max_messages=3)
+    for index in range(5):
+        outbox.put("home/temperature", str(index), 1)
+    assert len(outbox) == 3
+    assert [payload for _, _, payload, _ in outbox.peek(10)] == ["2", "3", "4"]
+    outbox.remove([message_id for message_id, _, _, _ in outbox.peek(2)])
+    assert [payload for _, _, payload, _ in outbox.peek(10)] == ["4"]
+    outbox.close()
+
+
+def test_expired_messages_are_discarded(tmp_path):
+    path = str(tmp_path / "outbox.sqlite")
+    outbox = Outbox(path, max_age=0.1)
+    outbox.put("home/temperature", "22.5", 1)
+    time.sleep(0.2)
+    assert outbox.evict_expired() == 1 and len(outbox) == 0
+    outbox.put("home/temperature", "22.6", 1)
+    outbox.close()
+    # the messages survive a restart
+    reopened = Outbox(path)
+    reopened.open()
+    assert len(reopened) == 1
+    reopened.close()
+
+
+def _fill_in_child(outbox, messages):
+    for index in range(messages):
+        outbox.put("home/temperature", str(index), 1)
+    outbox.close()
+
+
+@pytest.mark.skipif("fork" not in multiprocessing.get_all_start_methods(), reason="fork not available")
+def test_forked_process_opens_its_own_connection(tmp_path):
+    outbox = Outbox(str(tmp_path / "outbox.sqlite"))
+    outbox.open()
+    parent_connection = outbox._connection
+    child = multiprocessing.get_context("fork").Process(target=_fill_in_child, args=(outbox, 3))
+    child.start()
+    child.join(10)
+    assert child.exitcode == 0
+    # the child left the connection of the parent alone
+    assert outbox._connection is parent_connection
+    assert [payload for _, _, payload, _ in outbox.peek(10)] == ["0", "1", "2"]
+    outbox.close()
+
+
+def test_messages_stored_while_the_broker_is_down_are_replayed(tmp_path):
+    broker = SimulatedBroker()
+    broker.start()
+    port = broker.port
+    outbox = Outbox(str(tmp_path / "outbox.sqlite"))
+    client = MQTTClient(broker.host, port, None, "home", outbox=outbox)
+    client.start()
+    try:
+        assert _wait(client._online.is_set)
+        client.publish("temperature", "22.5")
+        assert broker.wait_for(1)
+
+        broker.stop()
+        assert _wait(lambda: not client._online.is_set())
+        for value in ("22.6", "22.7", "22.8"):
+            client.publish("temperature", value)
+        assert len(outbox) == 3
+
+        broker = SimulatedBroker(port=port)
+        broker.start()
+        assert broker.wait_for(3, timeout=30)
+        assert [payload for _, _, payload in broker.messages] == [b"22.6", b"22.7", b"22.8"]
+        assert _wait(lambda: len(outbox) == 0)
+    finally:
+        client.stop()
+        broker.stop()
+        outbox.close()
+
+
+def test_stored_message_is_not_logged_as_published(tmp_path, caplog):
+    outbox = Outbox(str(tmp_path / "outbox.sqlite"))
+    client = MQTTClient("127.0.0.1", 1883, None, "home", outbox=outbox)
+    caplog.set_level(logging.INFO, logger="PiHomeLogger")
+    try:
+        client.publish("temperature", "22.5")
+        client.publish_event("movement")
+    finally:
+        outbox.close()
+    assert len(caplog.records) == 2
+    assert all("stored in the outbox" in record.getMessage() for record in caplog.records)
@@ -0,0 +1,137 @@
+"""Tests of the presence backends reading the kernel neighbour table from a fixture"""
+import socket
+import struct
+import pytest
+from ..agents import presencebackends
+
+
+class RecordingBackend(presencebackends.PresenceBackend):
+    """A fallback backend recording the IPs it is asked to probe, the IPs in online answer the probes"""
+
+    def __init__(self, online=()):
+        self.online = set(online)
+        self.probed = []
+
+    def get_online_ips(self, ip_addrs):
+        self.probed.extend(ip_addrs)
+        return self.online & set(ip_addrs)
+
+    def discover(self, subnet):
+        return {}
+
+
+_STATES = {"INCOMPLETE": 0x01, "REACHABLE": 0x02, "STALE": 0x04, "DELAY": 0x08, "FAILED": 0x20, "PERMANENT": 0x80}
+
+
+def _attribute(attribute_type, value):
+    length = 4 + len(value)
+    return struct.pack("=HH", length, attribute_type) + value + b"\0" * ((4 - length % 4) % 4)
+
+
+def _neighbour_message(ip_addr, mac, state):
+    """Build the RTM_NEWNEIGH message of an entry, like the kernel does answering a dump"""
+    body = struct.pack("=BxxxiHBB", socket.AF_INET, 2, _STATES[state], 0, 1)
+    body += _attribute(1, socket.inet_aton(ip_addr))
+    if mac:
+        body += _attribute(2, bytes(int(byte, 16) for byte in mac.split(":")))
+    return struct.pack("=LHHLL", 16 + len(body), 28, 0x02, 1, 0) + body
+
+
+_DONE = struct.pack("=LHHLLi", 20, 3, 0x02, 1, 0, 0)
+
+
+@pytest.fixture
+def neighbour_table():
+    entries = [("192.168.1.10", "AA:00:00:00:00:10", "REACHABLE"),
+               ("192.168.1.11", "aa:00:00:00:00:11", "STALE"),
+               ("192.168.1.12", "aa:00:00:00:00:12", "DELAY"),
+               ("192.168.1.13", None, "FAILED"),
+               ("192.168.1.14", "aa:00:00:00:00:14", "PERMANENT")]
+    table = {}
+    assert presencebackends.parse_neighbour_messages(b"".join(_neighbour_message(*entry) for entry in entries) +
+                                                     _DONE, table)
+    return lambda: dict(table)
+
+
+def test_parse_neighbour_messages(neighbour_table):
+    table = neighbour_table()
+    assert table["192.168.1.10"] == ("aa:00:00:00:00:10", "REACHABLE")
+    assert table["192.168.1.11"] == ("aa:00:00:00:00:11", "STALE")
+    assert table["192.168.1.13"] == (None, "FAILED")
+    assert presencebackends.confirmed_entries(table) == {"192.168.1.10": "aa:00:00:00:00:10",
+                                                         "192.168.1.14": "aa:00:00:00:00:14"}
+
+
+def test_parse_neighbour_messages_across_reads():
+    table = {}
+    assert not presencebackends.parse_neighbour_messages(_neighbour_message("192.168.1.10", "aa:00:00:00:00:10",
+                                                                            "REACHABLE"), table)
+    assert presencebackends.parse_neighbour_messages(_DONE, table)
+    assert table == {"192.168.1.10": ("aa:00:00:00:00:10", "REACHABLE")}
+    error = struct.pack("=LHHLLi", 20, 2, 0, 1, 0, -1)
+    with pytest.raises(OSError):
+        presencebackends.parse_neighbour_messages(error, {})
+
+
+def test_unreadable_table_hands_every_ip_to_the_fallback(monkeypatch):
+    def no_netlink(*args):
+        raise OSError("netlink not available")
+
+    monkeypatch.setattr(presencebackends.socket, "socket", no_netlink)
+    assert presencebackends.read_neighbour_table() == {}
+    fallback = RecordingBackend(online={"192.168.1.10"})
+    backend = presencebackends.ArpTableBackend(fallback=fallback)
+    assert backend.get_online_ips(["192.168.1.10", "192.168.1.11"]) == {"192.168.1.10"}
+    assert sorted(fallback.probed) == ["192.168.1.10", "192.168.1.11"]
+
+
+def test_only_unconfirmed_ips_are_probed(neighbour_table):
+    fallback = RecordingBackend(online={"192.168.1.12"})
+    backend = presencebackends.ArpTableBackend(fallback=fallback, read_table=neighbour_table)
+    ips = ["192.168.1.10", "192.168.1.11", "192.168.1.12", "192.168.1.13", "192.168.1.14", "192.168.1.15"]
+    assert backend.get_online_ips(ips) == {"192.168.1.10", "192.168.1.12", "192.168.1.14"}
+    assert sorted(fallback.probed) == ["192.168.1.11", "192.168.1.12", "192.168.1.13", "192.168.1.15"]
+
+
+def test_stale_entry_of_departed_device_is_offline(neighbour_table):
+    backend = presencebackends.ArpTableBackend(fallback=RecordingBackend(), read_table=neighbour_table)
+    assert not backend.is_ip_online("192.168.1.11")
+    assert presencebackends.ArpTableBackend(read_table=neighbour_table).get_online_ips(["192.168.1.11"]) == set()
+
+
+class RecordingMacBackend(RecordingBackend):
+    """A fallback backend whose sweep finds the devices in hosts"""
+
+    def __init__(self, online=(), hosts=None):
+        super(RecordingMacBackend, self).__init__(online)
+        self.hosts = hosts or {}
+
+    def discover(self, subnet):
+        return dict(self.hosts)
+
+
+def test_online_macs_probe_stale_entries(neighbour_table):
+    fallback = RecordingBackend()
+    backend = presencebackends.ArpTableBackend(fallback=fallback, read_table=neighbour_table)
+    bindings = {"192.168.1.10": "aa:00:00:00:00:10", "192.168.1.11": "aa:00:00:00:00:11",
+                "192.168.1.14": "bb:00:00:00:00:14"}
+    # the reassigned IP is not probed, the stale one is and doesn't answer
+    assert backend.get_online_macs(bindings) == {"aa:00:00:00:00:10"}
+    assert fallback.probed == ["192.168.1.11"]
+
+
+def test_discover_leaves_stale_entries_out(neighbour_table):
+    fallback = RecordingMacBackend(hosts={"cc:00:00:00:00:20": "192.168.1.20"})
+    backend = presencebackends.ArpTableBackend(fallback=fallback, read_table=neighbour_table)
+    assert backend.discover("192.168.1.0/24") == {"cc:00:00:00:00:20": "192.168.1.20",
+                                                  "aa:00:00:00:00:10": "192.168.1.10",
+                                                  "aa:00:00:00:00:14": "192.168.1.14"}
+
+
+def test_discover_is_abstract():
+    class IpOnlyBackend(presencebackends.PresenceBackend):
+        def get_online_ips(self, ip_addrs):
+            return set()
+
+    with pytest.raises(TypeError):
+        IpOnlyBackend()
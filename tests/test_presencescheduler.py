@@ -0,0 +1,55 @@
+"""Tests of the hysteresis of AdaptiveScheduler"""
+from ..agents.presencescheduler import AdaptiveScheduler
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def _present_scheduler(clock, **parameters):
+    scheduler = AdaptiveScheduler(["alice"], min_interval=30, clock=clock, **parameters)
+    scheduler.pop_due()
+    assert scheduler.record("alice", True)
+    return scheduler
+
+
+def _miss(scheduler, clock, count):
+    """Record count missed detections one min_interval apart, return True if the status changed"""
+    changed = False
+    for _ in range(count):
+        clock.now += scheduler.min_interval
+        changed = scheduler.record("alice", False) or changed
+    return changed
+
+
+def test_absence_requires_the_misses_to_span_absent_after():
+    clock = FakeClock()
+    scheduler = _present_scheduler(clock, misses_before_absent=5, absent_after=300)
+    # a detection long ago does not count: the time runs from the first miss
+    clock.now += 600
+    assert not _miss(scheduler, clock, 10)
+    assert scheduler.is_present("alice")
+    assert _miss(scheduler, clock, 1)
+    assert not scheduler.is_present("alice")
+
+
+def test_a_detection_restarts_the_absence_countdown():
+    clock = FakeClock()
+    scheduler = _present_scheduler(clock, misses_before_absent=5, absent_after=300)
+    assert not _miss(scheduler, clock, 9)
+    clock.now += scheduler.min_interval
+    assert not scheduler.record("alice", True)
+    assert not _miss(scheduler, clock, 10)
+    assert scheduler.is_present("alice")
+
+
+def test_absent_after_zero_keeps_the_miss_count_only():
+    clock = FakeClock()
+    scheduler = _present_scheduler(clock, misses_before_absent=5, absent_after=0)
+    assert not _miss(scheduler, clock, 4)
+    assert _miss(scheduler, clock, 1)
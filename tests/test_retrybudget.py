@@ -0,0 +1,163 @@
+"""Tests of the retry budget of DHTSensor, with a fake MyPyDHT failing in a controlled way"""
+import enum
+import sys
+import types
+import pytest
+from ..sensors.retrybudget import RetryBudget
+
+
+class DHTException(Exception):
+
+    def __init__(self, message):
+        super(DHTException, self).__init__(message)
+        self.message = message
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def _fake_driver(outcomes):
+    """Build a fake MyPyDHT module whose readings are taken from outcomes
+
+    Every outcome is a (humidity, temperature) tuple or None for a failed attempt; once the outcomes are over
+    every attempt fails
+    """
+    driver = types.ModuleType("MyPyDHT")
+    driver.Sensor = enum.Enum("Sensor", "DHT11 DHT22")
+    driver.DHTException = DHTException
+    driver.outcomes = list(outcomes)
+    driver.attempts = 0
+
+    def sensor_read(model, pin, reading_attempts=1, use_cache=False):
+        assert reading_attempts == 1
+        driver.attempts += 1
+        outcome = driver.outcomes.pop(0) if driver.outcomes else None
+        if outcome is None:
+            raise DHTException("DHT sensor not responding")
+        return outcome
+
+    driver.sensor_read = sensor_read
+    return driver
+
+
+@pytest.fixture
+def make_sensor(monkeypatch):
+    def make_sensor(outcomes, **parameters):
+        driver = _fake_driver(outcomes)
+        monkeypatch.setitem(sys.modules, "MyPyDHT", driver)
+        from ..sensors import dhtsensor
+        monkeypatch.setattr(dhtsensor, "MyPyDHT", driver)
+        clock = FakeClock()
+        sensor = dhtsensor.DHTSensor(["temperature", "humidity"], "AM2302", 17, clock=clock, sleep=clock.sleep,
+                                     **parameters)
+        return sensor, driver, clock
+    return make_sensor
+
+
+def _temperatures(sensor):
+    return [sample.data for sample in sensor.sample() if sample.label == "temperature"]
+
+
+def test_budget_keeps_the_fixed_attempts_while_the_sensor_answers():
+    budget = RetryBudget(max_attempts=10, probe_after=3)
+    for success in (False, False, True, False, False):
+        budget.record_reading(success)
+        assert budget.attempts() == 10
+
+
+def test_budget_probes_a_sensor_not_answering_till_it_answers_again():
+    budget = RetryBudget(max_attempts=10, probe_after=3)
+    for _ in range(3):
+        budget.record_reading(False)
+    assert budget.attempts() == 1
+    budget.record_reading(False)
+    assert budget.attempts() == 1
+    budget.record_reading(True)
+    assert budget.attempts() == 10
+
+
+def test_flaky_sensor_gets_all_the_attempts(make_sensor):
+    sensor, driver, clock = make_sensor([None] * 9 + [(45.0, 21.0)], retry_delay=2.0)
+    assert _temperatures(sensor) == [21.0]
+    assert driver.attempts == 10
+    assert clock.now == 18.0
+    stats = sensor.stats()
+    assert (stats["readings"], stats["exhausted"], stats["attempts"], stats["failures"]) == (1, 0, 10, 9)
+
+
+def test_disconnected_sensor_is_only_probed(make_sensor):
+    sensor, driver, clock = make_sensor([], max_attempts=4, cache_ttl=0)
+    for _ in range(5):
+        assert _temperatures(sensor) == []
+    # 5 readings are needed to tell a disconnected sensor, then every reading is a single attempt
+    assert driver.attempts == 5 * 4
+    for _ in range(3):
+        sensor.sample()
+    assert driver.attempts == 5 * 4 + 3
+    driver.outcomes = [(45.0, 21.0)]
+    assert _temperatures(sensor) == [21.0]
+    assert sensor.stats()["budget"] == 4
+
+
+def test_implausible_reading_is_retried(make_sensor):
+    sensor, driver, _ = make_sensor([(45.0, 150.0), (45.0, 21.0)])
+    assert _temperatures(sensor) == [21.0]
+    assert driver.attempts == 2
+
+
+def test_recent_reading_is_reused(make_sensor):
+    sensor, driver, clock = make_sensor([(45.0, 21.0), (45.0, 22.0)], cache_ttl=2.0)
+    assert _temperatures(sensor) == [21.0]
+    clock.now += 1.0
+    assert _temperatures(sensor) == [21.0]
+    clock.now += 2.0
+    assert _temperatures(sensor) == [22.0]
+    assert driver.attempts == 2
+    assert sensor.stats()["cache_hits"] == 1
+
+
+def test_isolated_jump_is_replaced_by_the_median(make_sensor):
+    sensor, _, clock = make_sensor([(45.0, 21.0), (45.0, 21.2), (45.0, 35.0), (45.0, 21.1)], cache_ttl=0)
+    readings = []
+    for _ in range(4):
+        readings.extend(_temperatures(sensor))
+        clock.now += 5
+    # the reading after the spike jumps back, it is replaced by the median as well
+    assert readings == [21.0, 21.2, 21.2, 21.2]
+    assert sensor.stats()["rejected"] == 2
+
+
+def test_budget_is_capped_by_the_attempts_fitting_in_the_deadline():
+    budget = RetryBudget(max_attempts=10)
+    assert budget.attempts(20, 2.0) == 10
+    budget.record_attempt(False, 1.0)
+    # n attempts of 1 second with 2 seconds between them take 3n - 2 seconds
+    assert budget.attempts(20, 2.0) == 7
+    assert budget.attempts() == 10
+    assert budget.stats(20, 2.0)["budget"] == 7
+
+
+def test_slow_sensor_gets_only_the_attempts_fitting_in_read_timeout(make_sensor):
+    sensor, driver, clock = make_sensor([], retry_delay=2.0, cache_ttl=0)
+    original_read = driver.sensor_read
+
+    def slow_read(*args, **kwargs):
+        clock.now += 1.0
+        return original_read(*args, **kwargs)
+
+    driver.sensor_read = slow_read
+    sensor.sample()
+    assert driver.attempts == 10
+    # the second reading knows an attempt takes a second, only 7 fit in the 20 seconds of read_timeout
+    sensor.sample()
+    assert driver.attempts == 17
+    assert sensor.stats()["budget"] == 7
@@ -0,0 +1,50 @@
+"""Tests of the reading statistics of SensorsManager across the reloads of the sensors"""
+from ..agents.sensorsmanager import SensorsManager
+from ..common import metrics
+from ..sensors.sensor import Sample, Sensor
+
+
+class ThermometerSensor(Sensor):
+
+    def _fetch_data(self, samples):
+        samples.append(Sample("temperature", 21.0, "C"))
+
+
+class StubMQTTClient(object):
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def publish(self, topic, payload):
+        pass
+
+
+def _thermometer(name):
+    sensor = ThermometerSensor()
+    sensor.name = name
+    return sensor
+
+
+def test_sensors_of_the_same_class_have_their_own_stats(monkeypatch):
+    monkeypatch.setattr(metrics, "_registry", metrics.MetricsRegistry())
+    kitchen, bedroom = _thermometer("kitchen"), _thermometer("bedroom")
+    manager = SensorsManager([kitchen, bedroom], {}, StubMQTTClient())
+    assert len(manager._collect_samples([kitchen, bedroom])) == 2
+    stats = manager.read_stats()
+    assert set(stats) == {"kitchen", "bedroom"}
+    assert stats["kitchen"]["latency"]["count"] == stats["bedroom"]["latency"]["count"] == 1
+
+
+def test_teardown_after_a_sensor_is_removed(monkeypatch):
+    registry = metrics.MetricsRegistry()
+    monkeypatch.setattr(metrics, "_registry", registry)
+    kitchen, bedroom = _thermometer("kitchen"), _thermometer("bedroom")
+    manager = SensorsManager([kitchen, bedroom], {}, StubMQTTClient())
+    manager._collect_samples([kitchen, bedroom])
+    manager.update_sensors([kitchen])
+    assert set(manager.read_stats()) == {"kitchen"}
+    assert {series["labels"]["sensor"] for series in registry.as_dict()["sensor_read_seconds"]} == {"kitchen"}
+    manager._teardown()
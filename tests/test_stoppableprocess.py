@@ -0,0 +1,46 @@
+"""Tests of the task scheduler of StoppableLoopProcess"""
+import threading
+from ..common import metrics
+from ..common.stoppableprocess import StoppableLoopProcess
+
+
+def test_a_failing_task_does_not_stop_the_loop(monkeypatch):
+    monkeypatch.setattr(metrics, "_registry", metrics.MetricsRegistry())
+    process = StoppableLoopProcess(60)
+    runs = []
+
+    def fail():
+        runs.append("fail")
+        raise RuntimeError("broken task")
+
+    process._schedule("failing", 60, fail)
+    process._schedule("working", 60, lambda: runs.append("work"))
+    process._run_due_tasks()
+    process._run_due_tasks()
+    assert sorted(runs) == ["fail", "work"]
+    # the failed task is rescheduled like the others
+    assert process.scheduler_stats()["failing"]["runs"] == 1
+    assert len(process._tasks) == 2
+
+
+def test_an_empty_scheduler_sleeps_till_a_task_is_scheduled(monkeypatch):
+    monkeypatch.setattr(metrics, "_registry", metrics.MetricsRegistry())
+    process = StoppableLoopProcess(60)
+    runs = []
+    timer = threading.Timer(0.1, process._schedule, ("late", 60, lambda: runs.append("late")))
+    timer.start()
+    process._run_due_tasks()
+    timer.join()
+    process._run_due_tasks()
+    assert runs == ["late"]
+
+
+def test_an_empty_scheduler_wakes_up_when_stopped():
+    process = StoppableLoopProcess(60)
+    timer = threading.Timer(0.1, process._shutdown, (15, None))
+    timer.start()
+    process._run_due_tasks()
+    timer.join()
+    assert process._stop_looping.is_set()
+    # once stopped the method returns right away
+    process._run_due_tasks()